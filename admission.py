@@ -0,0 +1,440 @@
+# Controle de admissão e prazos (deadlines) dos servidores
+# Vinicius Gomes - 2021421869
+
+import asyncio
+import contextlib
+import threading
+import time
+
+import grpc
+
+import metrics
+
+# Acima desse valor, o tempo restante informado pelo servidor síncrono
+# significa que a chamada não tem prazo (o gRPC usa o maior instante
+# representável)
+_NO_DEADLINE = 1e9
+
+# Threads do pool do servidor síncrono reservadas para recusar chamadas: as
+# chamadas admitidas nunca ocupam mais que max_active + max_queue threads,
+# então uma chamada recusada não espera na fila do pool
+SPARE_THREADS = 4
+
+
+def time_remaining(context) -> float | None:
+    """
+    Retorna o tempo restante, em segundos, até o prazo da chamada que está
+    sendo atendida, tanto no servidor síncrono quanto no grpc.aio.
+
+    Parâmetros:
+        context: contexto da chamada (grpc.ServicerContext)
+
+    Retorna:
+        O tempo restante (0 quando o prazo já passou), ou None caso o
+        cliente não tenha definido um prazo.
+    """
+
+    remaining = context.time_remaining()
+    if remaining is None or remaining > _NO_DEADLINE:
+        return None
+    return remaining
+
+
+def deadline(timeout: float | None) -> float | None:
+    """
+    Retorna o instante (relógio de time.monotonic()) em que termina um prazo
+    de `timeout` segundos a partir de agora, ou None caso não haja prazo.
+    """
+
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def remaining(deadline: float | None) -> float | None:
+    """
+    Retorna o tempo, em segundos, que falta até o instante `deadline` (0
+    quando ele já passou), para ser usado como o timeout de uma chamada feita
+    dentro do prazo, ou None caso não haja prazo.
+    """
+
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def pool_size(max_workers: int, max_queue: int | None, max_streams: int = 0) -> int:
+    """
+    Retorna o número de threads do pool de um servidor síncrono com o
+    controle de admissão de AdmissionInterceptor.
+
+    Parâmetros:
+        max_workers (int): número de chamadas executadas ao mesmo tempo
+        max_queue (int | None): tamanho da fila de admissão (None: sem
+                                limite, as chamadas esperam na fila do pool)
+        max_streams (int): número máximo de chamadas com stream abertas, cada
+                           uma ocupando uma thread além das de `max_workers`
+    """
+
+    if max_queue is None:
+        return max_workers + max_streams
+    return max_workers + max_queue + max_streams + SPARE_THREADS
+
+
+class _Admission:
+    # Estado compartilhado pelos interceptadores síncrono e assíncrono
+    def __init__(self, max_active, max_queue, rejections, max_streams):
+        self.max_active = max_active
+        self.limit = None if max_queue is None else max_active + max_queue
+        self.rejections = rejections or {}
+        self.max_streams = max_streams
+        # Chamadas admitidas (executando ou esperando uma vaga)
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        # Chamadas com stream abertas e recusadas
+        self.streams = 0
+        self.rejected_streams = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        with self._lock:
+            if self.limit is not None and self.admitted >= self.limit:
+                self.rejected += 1
+                return False
+            self.admitted += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.admitted -= 1
+
+    def open_stream(self):
+        with self._lock:
+            if self.streams >= self.max_streams:
+                self.rejected_streams += 1
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self.streams -= 1
+
+    def late(self, context):
+        remaining = time_remaining(context)
+        if remaining is not None and remaining <= 0:
+            self.expired += 1
+            return True
+        return False
+
+    def rejection(self, name, request):
+        # Resposta dada a uma chamada recusada, ou None para recusá-la com
+        # um código do gRPC
+        reply = self.rejections.get(name)
+        return None if reply is None else reply(request)
+
+    def counters(self):
+        counters = {
+            "admission_rejected": self.rejected,
+            "deadline_expired": self.expired,
+        }
+        if self.limit is not None:
+            counters["admission_queue"] = max(0, self.admitted - self.max_active)
+        if self.max_streams is not None:
+            counters["open_streams"] = self.streams
+            counters["streams_rejected"] = self.rejected_streams
+        return counters
+
+
+# Motivos de recusa de uma chamada
+_FULL = (grpc.StatusCode.RESOURCE_EXHAUSTED, "fila de admissão cheia")
+_LATE = (grpc.StatusCode.DEADLINE_EXCEEDED, "prazo esgotado")
+_STREAMS = (grpc.StatusCode.RESOURCE_EXHAUSTED, "limite de streams atingido")
+
+
+def _stream_behavior(handler):
+    # Procedimento de uma chamada com stream e a função que cria um handler
+    # do mesmo tipo
+    if handler.unary_stream is not None:
+        return handler.unary_stream, grpc.unary_stream_rpc_method_handler
+    if handler.stream_stream is not None:
+        return handler.stream_stream, grpc.stream_stream_rpc_method_handler
+    return handler.stream_unary, grpc.stream_unary_rpc_method_handler
+
+
+class AdmissionInterceptor(grpc.ServerInterceptor):
+    def __init__(
+        self,
+        max_active: int,
+        max_queue: int | None = None,
+        rejections: dict | None = None,
+        max_streams: int | None = None,
+    ) -> None:
+        """
+        Interceptador do servidor síncrono que recusa o trabalho que não
+        adianta fazer. Uma chamada cujo prazo já passou (ao chegar ou
+        enquanto esperava para executar) é recusada com DEADLINE_EXCEEDED,
+        sem executar o procedimento, já que o cliente não espera mais pela
+        resposta.
+
+        Com `max_queue`, o trabalho aceito também é limitado: no máximo
+        `max_active` chamadas executam ao mesmo tempo e outras `max_queue`
+        esperam por uma vaga. Uma chamada que chega com a fila cheia é
+        recusada imediatamente com RESOURCE_EXHAUSTED. Assim, sob
+        sobrecarga, a latência das chamadas admitidas continua limitada pelo
+        tamanho da fila em vez de crescer sem limite. O pool de threads do
+        servidor deve ter `pool_size(max_active, max_queue)` threads, para
+        que as chamadas esperem na fila deste interceptador (onde podem ser
+        recusadas) e não na do pool.
+
+        Apenas os procedimentos sem stream passam por essa fila. As chamadas
+        com stream, de resposta (replicação, eventos de saldo), de requisição
+        (importação de carteiras) ou nos dois sentidos (sessões), duram tanto
+        quanto o cliente quiser e ocupam uma thread do pool durante todo esse
+        tempo, então, com `max_streams`, no máximo esse número delas fica
+        aberto ao mesmo tempo, e as demais são recusadas com
+        RESOURCE_EXHAUSTED. Com o pool de `pool_size(max_active, max_queue,
+        max_streams)` threads, essas chamadas nunca ocupam as threads das
+        outras.
+
+        Parâmetros:
+            max_active (int): número máximo de chamadas em execução
+            max_queue (int | None): número máximo de chamadas esperando uma
+                                    vaga (None: sem limite)
+            rejections (dict | None): procedimento → função que recebe a
+                                      requisição e retorna a resposta dada
+                                      quando ela é recusada (p.ex. o código
+                                      -9 de `sell`), no lugar de um código do
+                                      gRPC
+            max_streams (int | None): número máximo de chamadas com stream
+                                      abertas (None: sem limite)
+        """
+
+        self.state = _Admission(max_active, max_queue, rejections, max_streams)
+        self._slots = contextlib.nullcontext()
+        if max_queue is not None:
+            self._slots = threading.BoundedSemaphore(max_active)
+
+    def counters(self) -> dict[str, int]:
+        return self.state.counters()
+
+    def _limit_stream(self, handler):
+        # Envolve uma chamada com stream, que só executa com um dos
+        # `max_streams` lugares livre
+        state = self.state
+        behavior, method_handler = _stream_behavior(handler)
+
+        if handler.response_streaming:
+
+            def opened(request, context):
+                if not state.open_stream():
+                    context.abort(*_STREAMS)
+                try:
+                    yield from behavior(request, context)
+                finally:
+                    state.close_stream()
+
+        else:
+
+            def opened(request_iterator, context):
+                if not state.open_stream():
+                    context.abort(*_STREAMS)
+                try:
+                    return behavior(request_iterator, context)
+                finally:
+                    state.close_stream()
+
+        return method_handler(
+            opened,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return handler
+        if handler.unary_unary is None:
+            if self.state.max_streams is None:
+                return handler
+            return self._limit_stream(handler)
+        name = handler_call_details.method.rsplit("/", 1)[-1]
+        state = self.state
+        slots = self._slots
+        behavior = handler.unary_unary
+
+        def reject(request, context, reason):
+            reply = state.rejection(name, request)
+            if reply is None:
+                context.abort(*reason)
+            return reply
+
+        def admitted(request, context):
+            # A decisão é tomada já na thread do pool (e não aqui no
+            # interceptador), para que uma chamada cancelada antes de
+            # executar não ocupe uma vaga para sempre
+            if not state.admit():
+                return reject(request, context, _FULL)
+            try:
+                if state.late(context):
+                    return reject(request, context, _LATE)
+                with slots:
+                    # O prazo pode ter passado enquanto a chamada esperava
+                    if state.late(context):
+                        return reject(request, context, _LATE)
+                    return behavior(request, context)
+            finally:
+                state.leave()
+
+        return grpc.unary_unary_rpc_method_handler(
+            admitted,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+
+class AsyncAdmissionInterceptor(grpc.aio.ServerInterceptor):
+    def __init__(
+        self,
+        max_active: int,
+        max_queue: int | None = None,
+        rejections: dict | None = None,
+        max_streams: int | None = None,
+    ) -> None:
+        """
+        Versão de AdmissionInterceptor para o servidor grpc.aio. As chamadas
+        esperam por uma vaga sem ocupar threads, e a recusa é feita no próprio
+        event loop. As chamadas com stream também são limitadas a
+        `max_streams`, já que os streams de resposta esperam pelos próximos
+        eventos em uma thread do executor padrão do event loop, e as sessões
+        e importações ficam abertas tanto quanto o cliente quiser.
+
+        Parâmetros:
+            max_active (int): número máximo de chamadas em execução
+            max_queue (int | None): número máximo de chamadas esperando uma
+                                    vaga (None: sem limite)
+            rejections (dict | None): respostas dadas às chamadas recusadas
+                                      (ver AdmissionInterceptor)
+            max_streams (int | None): número máximo de chamadas com stream
+                                      abertas (None: sem limite)
+        """
+
+        self.state = _Admission(max_active, max_queue, rejections, max_streams)
+        # O semáforo é criado na primeira chamada, dentro do event loop do
+        # servidor
+        self._limited = max_queue is not None
+        self._slots = contextlib.nullcontext()
+
+    def counters(self) -> dict[str, int]:
+        return self.state.counters()
+
+    def _limit_stream(self, handler):
+        state = self.state
+        behavior, method_handler = _stream_behavior(handler)
+
+        if handler.response_streaming:
+
+            async def opened(request, context):
+                if not state.open_stream():
+                    await context.abort(*_STREAMS)
+                try:
+                    async for message in behavior(request, context):
+                        yield message
+                finally:
+                    state.close_stream()
+
+        else:
+
+            async def opened(request_iterator, context):
+                if not state.open_stream():
+                    await context.abort(*_STREAMS)
+                try:
+                    return await behavior(request_iterator, context)
+                finally:
+                    state.close_stream()
+
+        return method_handler(
+            opened,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return handler
+        if handler.unary_unary is None:
+            if self.state.max_streams is None:
+                return handler
+            return self._limit_stream(handler)
+        if self._limited and isinstance(self._slots, contextlib.nullcontext):
+            self._slots = asyncio.Semaphore(self.state.max_active)
+        name = handler_call_details.method.rsplit("/", 1)[-1]
+        state = self.state
+        slots = self._slots
+        behavior = handler.unary_unary
+
+        async def reject(request, context, reason):
+            reply = state.rejection(name, request)
+            if reply is None:
+                await context.abort(*reason)
+            return reply
+
+        async def admitted(request, context):
+            if not state.admit():
+                return await reject(request, context, _FULL)
+            try:
+                if state.late(context):
+                    return await reject(request, context, _LATE)
+                async with slots:
+                    if state.late(context):
+                        return await reject(request, context, _LATE)
+                    return await behavior(request, context)
+            finally:
+                state.leave()
+
+        return grpc.unary_unary_rpc_method_handler(
+            admitted,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+
+def server_interceptors(
+    registry: metrics.Metrics,
+    max_active: int,
+    max_queue: int | None = None,
+    rejections: dict | None = None,
+    asynchronous: bool = False,
+    max_streams: int | None = None,
+) -> list:
+    """
+    Cria os interceptadores de um servidor: o das métricas, que envolve
+    todos os outros (e por isso também mede as chamadas recusadas e o tempo
+    de espera na fila), e o de admissão, cujos contadores são acrescentados
+    às métricas.
+
+    Parâmetros:
+        registry (Metrics): registro das métricas do servidor
+        max_active (int): número máximo de chamadas em execução
+        max_queue (int | None): tamanho da fila de admissão (None: sem
+                                limite)
+        rejections (dict | None): respostas dadas às chamadas recusadas
+        asynchronous (bool): cria os interceptadores do servidor grpc.aio
+        max_streams (int | None): número máximo de chamadas com stream
+                                  abertas (None: sem limite)
+
+    Retorna:
+        A lista de interceptadores, na ordem em que devem ser passados ao
+        servidor.
+    """
+
+    if asynchronous:
+        control = AsyncAdmissionInterceptor(
+            max_active, max_queue, rejections, max_streams
+        )
+        interceptors = [metrics.AsyncMetricsInterceptor(registry), control]
+    else:
+        control = AdmissionInterceptor(max_active, max_queue, rejections, max_streams)
+        interceptors = [metrics.MetricsInterceptor(registry), control]
+    registry.add_counters(control.counters)
+    return interceptors
@@ -0,0 +1,254 @@
+# Log de auditoria dos servidores
+# Vinicius Gomes - 2021421869
+
+import collections
+import struct
+import sys
+import threading
+import time
+
+# Níveis de detalhe do log, do menos para o mais detalhado:
+#   off: nenhum evento
+#   mutations: operações que alteraram o estado (o que era exibido antes)
+#   requests: todas as requisições, inclusive as que falharam e as consultas
+#   state: além das operações, o estado completo após cada alteração (o
+#          formato antigo de depuração, com custo O(N) por operação)
+OFF, MUTATIONS, REQUESTS, STATE = range(4)
+VERBOSITY = {"off": OFF, "mutations": MUTATIONS, "requests": REQUESTS, "state": STATE}
+
+# Cabeçalho de um registro binário: instante e número de campos (incluindo a
+# operação)
+_HEADER = struct.Struct("<dB")
+_INT = struct.Struct("<q")
+_LENGTH = struct.Struct("<I")
+
+# Intervalo, em segundos, entre as verificações de que a thread de escrita
+# continua viva enquanto `flush` espera
+_FLUSH_CHECK = 0.5
+
+
+class AuditLog:
+    def __init__(
+        self,
+        path: str | None = None,
+        binary: bool = False,
+        verbosity: int = MUTATIONS,
+        rate: float | None = None,
+        capacity: int = 65536,
+        interval: float = 0.05,
+    ) -> None:
+        """
+        Log de auditoria assíncrono. Os procedimentos apenas enfileiram um
+        evento compacto por operação (uma tupla com o instante, a operação e
+        os seus campos) e retornam; uma thread dedicada formata e escreve os
+        eventos acumulados em lotes, com uma única escrita e um único flush
+        por lote.
+
+        Os eventos acima da taxa máxima ou que não cabem na fila são
+        descartados (os procedimentos nunca esperam pelo log) e o número de
+        descartes é registrado em um evento "dropped" no próximo lote.
+
+        No formato de linha, cada evento é escrito como
+        "<instante> <operação> <campos...>". No formato binário, cada evento
+        é um cabeçalho (instante em double e número de campos) seguido dos
+        campos, que são inteiros de 64 bits (marca "i") ou textos em UTF-8
+        precedidos do tamanho (marca "s"); `read_binary` lê esse formato.
+
+        Parâmetros:
+            path (str | None): arquivo do log (None usa a saída padrão)
+            binary (bool): usa o formato binário em vez do formato de linha
+            verbosity (int): nível de detalhe (OFF, MUTATIONS, REQUESTS ou
+                             STATE)
+            rate (float | None): número máximo de eventos por segundo (None
+                                 não limita)
+            capacity (int): número máximo de eventos na fila
+            interval (float): intervalo, em segundos, entre os lotes
+        """
+
+        self.verbosity = verbosity
+        self.binary = binary
+        self.capacity = capacity
+        self.interval = interval
+        # Contagem aproximada: os incrementos concorrentes não são protegidos
+        # por lock, já que ela só é usada para informação
+        self.dropped = 0
+
+        if path is None:
+            self._file = sys.stdout.buffer if binary else sys.stdout
+            self._owns_file = False
+        else:
+            self._file = open(path, "ab" if binary else "a")
+            self._owns_file = True
+
+        # Balde de fichas da taxa máxima, protegido por um lock próprio
+        self.rate = rate
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._rate_lock = threading.Lock()
+
+        # O append e o popleft do deque são atômicos, então os procedimentos
+        # não precisam de lock para enfileirar
+        self._queue = collections.deque()
+        self._reported_drops = 0
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._writer = None
+        if verbosity > OFF:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def enabled(self, level: int) -> bool:
+        """
+        Indica se os eventos do nível informado são registrados.
+
+        Parâmetros:
+            level (int): nível do evento
+        """
+
+        return self.verbosity >= level
+
+    def record(self, level: int, operation: str, *fields) -> None:
+        """
+        Enfileira um evento, caso o nível esteja ativo.
+
+        Parâmetros:
+            level (int): nível do evento
+            operation (str): nome da operação
+            fields: campos do evento (inteiros ou textos)
+        """
+
+        if self.verbosity < level:
+            return
+        if len(self._queue) >= self.capacity or not self._admit():
+            self.dropped += 1
+            return
+        self._queue.append((time.time(), operation, fields))
+
+    def _admit(self):
+        # Retira uma ficha do balde, caso a taxa seja limitada
+        if self.rate is None:
+            return True
+        with self._rate_lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._refilled) * self.rate
+            )
+            self._refilled = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._drain()
+            if self._closed and not self._queue:
+                return
+
+    def _drain(self):
+        # Escreve todos os eventos enfileirados até agora em um único lote
+        events = []
+        markers = []
+        queue = self._queue
+        for _ in range(len(queue)):
+            event = queue.popleft()
+            # Marcas de `flush` são sinalizadas após a escrita do lote
+            if isinstance(event, threading.Event):
+                markers.append(event)
+            else:
+                events.append(event)
+
+        dropped = self.dropped
+        if dropped != self._reported_drops:
+            events.append((time.time(), "dropped", (dropped - self._reported_drops,)))
+            self._reported_drops = dropped
+
+        try:
+            if events:
+                encode = _encode_binary if self.binary else _encode_line
+                self._file.write(
+                    (b"" if self.binary else "").join(map(encode, events))
+                )
+                self._file.flush()
+        except Exception as error:
+            # Uma falha de escrita (p.ex. disco cheio) perde o lote, mas não
+            # termina a thread de escrita nem deixa `flush` esperando
+            print(
+                f"audit log write failed ({len(events)} events lost):",
+                error,
+                file=sys.stderr,
+            )
+        finally:
+            for marker in markers:
+                marker.set()
+
+    def flush(self) -> None:
+        """
+        Bloqueia até que todos os eventos enfileirados antes da chamada
+        estejam escritos (ou perdidos, caso a escrita falhe). Retorna também
+        caso a thread de escrita termine, em vez de esperar para sempre.
+        """
+
+        if self._writer is None or not self._writer.is_alive():
+            return
+        marker = threading.Event()
+        self._queue.append(marker)
+        self._wake.set()
+        while not marker.wait(_FLUSH_CHECK):
+            if not self._writer.is_alive():
+                return
+
+    def close(self) -> None:
+        """
+        Escreve os eventos pendentes e fecha o log.
+        """
+
+        self._closed = True
+        if self._writer is not None:
+            self._wake.set()
+            self._writer.join()
+        if self._owns_file:
+            self._file.close()
+
+
+def _encode_line(event):
+    timestamp, operation, fields = event
+    return f"{timestamp:.6f} {operation} {' '.join(map(str, fields))}\n"
+
+
+def _encode_binary(event):
+    timestamp, operation, fields = event
+    parts = [_HEADER.pack(timestamp, len(fields) + 1)]
+    for field in (operation, *fields):
+        if isinstance(field, int):
+            parts.append(b"i" + _INT.pack(field))
+        else:
+            data = str(field).encode()
+            parts.append(b"s" + _LENGTH.pack(len(data)) + data)
+    return b"".join(parts)
+
+
+def read_binary(stream):
+    """
+    Lê os eventos de um log no formato binário.
+
+    Parâmetros:
+        stream: arquivo aberto em modo binário
+
+    Retorna:
+        Um gerador de tuplas (instante, operação, campos).
+    """
+
+    while header := stream.read(_HEADER.size):
+        timestamp, count = _HEADER.unpack(header)
+        values = []
+        for _ in range(count):
+            if stream.read(1) == b"i":
+                values.append(_INT.unpack(stream.read(_INT.size))[0])
+            else:
+                (length,) = _LENGTH.unpack(stream.read(_LENGTH.size))
+                values.append(stream.read(length).decode())
+        yield timestamp, values[0], tuple(values[1:])
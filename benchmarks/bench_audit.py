@@ -0,0 +1,60 @@
+# Benchmark do registro das operações: estado completo x log de auditoria
+# Vinicius Gomes - 2021421869
+#
+# Mede o custo, no caminho da requisição, de registrar uma operação do
+# servidor de carteiras de duas formas: exibindo o estado completo (carteiras
+# e ordens de pagamento), como os procedimentos faziam antes, ou enfileirando
+# um evento no AuditLog. A saída vai para /dev/null, então apenas o custo de
+# formatação e de escrita é medido, para vários números de carteiras.
+#
+# Uso: python3 benchmarks/bench_audit.py [--sizes 100,10000,100000]
+
+import argparse
+import os
+
+import common
+
+import audit
+
+
+def run_print(wallets, payment_orders, operations, sink):
+    # Formato antigo: o estado completo a cada operação
+    with common.Timer() as timer:
+        for _ in range(operations):
+            print("create payment order", file=sink)
+            print("wallets:", wallets, file=sink)
+            print("payment orders:", payment_orders, file=sink)
+    return timer.elapsed
+
+
+def run_audit(wallets, payment_orders, operations, binary):
+    log = audit.AuditLog(os.devnull, binary=binary, capacity=operations + 1)
+    with common.Timer() as timer:
+        for i in range(operations):
+            log.record(audit.MUTATIONS, "create_payment_order", "wallet0", 10, i)
+    log.close()
+    return timer.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="estado completo x AuditLog")
+    parser.add_argument("--sizes", default="100,10000,100000")
+    parser.add_argument("--operations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'wallets':>8} {'us/op':>10}")
+    with open(os.devnull, "w") as sink:
+        for size in map(int, args.sizes.split(",")):
+            wallets = {f"wallet{i}": 1000 for i in range(size)}
+            payment_orders = {i: 10 for i in range(1, size // 10 + 1)}
+            results = {
+                "print": run_print(wallets, payment_orders, args.operations, sink),
+                "line": run_audit(wallets, payment_orders, args.operations, False),
+                "binary": run_audit(wallets, payment_orders, args.operations, True),
+            }
+            for mode, elapsed in results.items():
+                print(f"{mode:>8} {size:>8} {elapsed / args.operations * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Benchmark do disjuntor (circuit breaker) da loja
+# Vinicius Gomes - 2021421869
+#
+# Executa a loja contra um servidor de carteiras substituto, neste mesmo
+# processo, que alterna entre o funcionamento normal e fases com falhas
+# injetadas: fora do ar (toda transferência falha com UNAVAILABLE), travado
+# (as transferências nunca respondem, até o prazo acabar) e lento (cada
+# transferência demora --slow-delay segundos). Várias threads vendem durante
+# todas as fases, com o prazo --deadline, e uma outra consulta o preço
+# (read_price) periodicamente. Para cada fase, exibe as latências das vendas
+# e das consultas de preço (atribuídas à fase em que começaram) e o número
+# de vendas com -9, com e sem o disjuntor; ao final, exibe as mudanças de
+# estado do disjuntor, lidas do log de auditoria da loja.
+#
+# Uso: python3 benchmarks/bench_breaker.py [--rounds off,on]
+#      [--store-args="--async"]
+
+import argparse
+import os
+import shlex
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+import common
+import grpc
+
+import store_pb2
+import store_pb2_grpc
+import wallet_pb2_grpc
+
+# O servidor de carteiras substituto é compartilhado com os testes
+from tests.stand_in_wallet import StandInWallet
+
+PRICE = 10
+
+# Fases do servidor substituto: (modo, duração em segundos)
+PHASES = [
+    ("ok", 2.0),
+    ("down", 2.0),
+    ("ok", 2.0),
+    ("hang", 3.0),
+    ("ok", 3.0),
+    ("slow", 3.0),
+    ("ok", 3.0),
+]
+
+# Opções do disjuntor usadas na rodada "on" (janela e tempo aberto curtos,
+# para que as mudanças de estado caibam nas fases)
+BREAKER_ARGS = [
+    "--breaker",
+    "--breaker-window",
+    "1",
+    "--breaker-min-calls",
+    "10",
+    "--breaker-slow-call",
+    "0.1",
+    "--breaker-open-for",
+    "0.5",
+]
+
+
+def run_round(store_args, threads, deadline, slow_delay):
+    """
+    Executa uma rodada do benchmark, passando pelas fases de PHASES.
+
+    Retorna:
+        Uma tupla (amostras das vendas, amostras das consultas de preço,
+        contadores da loja, mudanças de estado do disjuntor, instante do
+        início da primeira fase). Cada amostra é uma tupla (fase, latência
+        em segundos, status).
+    """
+
+    wallet = StandInWallet(slow_delay)
+    wallet_server = grpc.server(futures.ThreadPoolExecutor(max_workers=64))
+    wallet_pb2_grpc.add_WalletServicer_to_server(wallet, wallet_server)
+    wallet_port = common.free_port()
+    wallet_server.add_insecure_port(f"localhost:{wallet_port}")
+    wallet_server.start()
+
+    audit_path = os.path.join(tempfile.mkdtemp(), "audit.log")
+    store_port = common.free_port()
+    store_server = common.start_store_server(
+        store_port,
+        PRICE,
+        "seller",
+        wallet_port,
+        "--workers",
+        "16",
+        "--audit-log",
+        audit_path,
+        *store_args,
+    )
+
+    channel = grpc.insecure_channel(f"localhost:{store_port}")
+    stub = store_pb2_grpc.StoreStub(channel)
+    phase = 0
+    done = threading.Event()
+    sales = []
+    prices = []
+
+    def seller():
+        while not done.is_set():
+            current = phase
+            started = time.perf_counter()
+            try:
+                status = stub.sell(
+                    store_pb2.SellRequest(payment_order=1), timeout=deadline
+                ).status
+            except grpc.RpcError:
+                status = "error"
+            sales.append((current, time.perf_counter() - started, status))
+
+    def price_reader():
+        while not done.wait(0.01):
+            current = phase
+            started = time.perf_counter()
+            stub.read_price(store_pb2.ReadPriceRequest())
+            prices.append((current, time.perf_counter() - started, 0))
+
+    workers = [threading.Thread(target=seller) for _ in range(threads)]
+    workers.append(threading.Thread(target=price_reader))
+    for worker in workers:
+        worker.start()
+    started = time.time()
+    for index, (mode, duration) in enumerate(PHASES):
+        phase = index
+        wallet.mode = mode
+        time.sleep(duration)
+    done.set()
+    for worker in workers:
+        worker.join()
+
+    counters = stub.stats(store_pb2.StatsRequest()).counters
+    stub.end_execution(store_pb2.EndExecutionRequest())
+    channel.close()
+    store_server.wait(timeout=30)
+    wallet_server.stop(None)
+
+    with open(audit_path) as audit:
+        transitions = [line.split() for line in audit if " breaker " in line]
+    return sales, prices, counters, transitions, started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disjuntor da loja")
+    parser.add_argument("--rounds", default="off,on")
+    parser.add_argument("--store-args", default="")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--deadline", type=float, default=2.0)
+    parser.add_argument("--slow-delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    for name in args.rounds.split(","):
+        store_args = shlex.split(args.store_args)
+        if name == "on":
+            store_args += BREAKER_ARGS
+        sales, prices, counters, transitions, started = run_round(
+            store_args, args.threads, args.deadline, args.slow_delay
+        )
+
+        print(f"breaker {name}")
+        print(
+            f"{'phase':>6} {'sales':>7} {'-9':>6} {'p50 ms':>8} {'p99 ms':>8}"
+            f" {'price p50':>10} {'price p99':>10}"
+        )
+        for index, (mode, _) in enumerate(PHASES):
+            latencies = [elapsed for phase, elapsed, _ in sales if phase == index]
+            failed = sum(
+                status != 0 for phase, _, status in sales if phase == index
+            )
+            price_latencies = [
+                elapsed for phase, elapsed, _ in prices if phase == index
+            ]
+            print(
+                f"{mode:>6} {len(latencies):>7} {failed:>6}"
+                f" {common.percentile(latencies, 0.5) * 1000:>8.2f}"
+                f" {common.percentile(latencies, 0.99) * 1000:>8.2f}"
+                f" {common.percentile(price_latencies, 0.5) * 1000:>10.2f}"
+                f" {common.percentile(price_latencies, 0.99) * 1000:>10.2f}"
+            )
+        if "breaker_opened" in counters:
+            print(
+                f"opened {counters['breaker_opened']}"
+                f" rejected {counters['breaker_rejected']}"
+            )
+        for timestamp, _, previous, state in transitions:
+            print(f"  {float(timestamp) - started:7.2f}s {previous} -> {state}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
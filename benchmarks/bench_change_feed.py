@@ -0,0 +1,207 @@
+# Benchmark do stream de alterações de saldo (watch_mutations)
+# Vinicius Gomes - 2021421869
+#
+# Mede a vazão de escrita do servidor de carteiras (pares
+# create_payment_order + transfer por segundo, feitos por vários processos
+# clientes) sem o registro de eventos, com o registro e nenhum assinante, com
+# --subscribers assinantes que leem os eventos o mais rápido possível e com
+# esses assinantes mais um assinante lento, que espera --slow-delay segundos
+# a cada mensagem. O assinante lento não deve atrasar as operações: ele fica
+# para trás, e perde o stream (DATA_LOSS) quando volta a ler no ritmo normal
+# caso os eventos que ainda não leu tenham sido descartados do registro.
+#
+# Ao final de cada rodada, confere que o saldo de cada carteira segundo os
+# eventos recebidos por um assinante rápido é igual ao saldo consultado no
+# servidor.
+#
+# Uso: python3 benchmarks/bench_change_feed.py [--subscribers 4]
+
+import argparse
+import multiprocessing
+import threading
+import time
+
+import common
+import grpc
+from bench_wallet_locks import client_process
+
+import wallet_pb2
+import wallet_pb2_grpc
+
+# Carteira usada para marcar o fim da carga no stream de eventos
+MARKER = "marker"
+
+
+class Subscriber:
+    def __init__(self, port: int, delay: float = 0.0) -> None:
+        """
+        Assinante de `watch_mutations`, executado em uma thread própria, que
+        guarda o último saldo de cada carteira recebido nos eventos.
+
+        Parâmetros:
+            port (int): porta do servidor de carteiras
+            delay (float): espera, em segundos, a cada mensagem recebida
+        """
+
+        self.delay = delay
+        self.events = 0
+        self.balances = {}
+        self.lost = False
+        self.marker = threading.Event()
+        self._channel = grpc.insecure_channel(f"localhost:{port}")
+        self._stream = wallet_pb2_grpc.WalletStub(self._channel).watch_mutations(
+            wallet_pb2.WatchMutationsRequest()
+        )
+        # A primeira mensagem confirma a assinatura
+        next(self._stream)
+        self._thread = threading.Thread(target=self._read)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            for message in self._stream:
+                for event in message.events:
+                    self.events += 1
+                    if event.wallet:
+                        self.balances[event.wallet] = event.balance
+                    if event.wallet == MARKER:
+                        self.marker.set()
+                time.sleep(self.delay)
+        except grpc.RpcError as error:
+            self.lost = error.code() == grpc.StatusCode.DATA_LOSS
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def close(self):
+        self._stream.cancel()
+        self._thread.join()
+        self._channel.close()
+
+
+def run_round(feed, subscribers, slow_delay, args):
+    """
+    Executa uma rodada do benchmark.
+
+    Parâmetros:
+        feed (bool): ativa o registro de eventos no servidor
+        subscribers (int): número de assinantes rápidos
+        slow_delay (float | None): espera do assinante lento (None: sem
+                                   assinante lento)
+        args (argparse.Namespace): parâmetros do benchmark
+
+    Retorna:
+        Uma tupla (vazão em operações por segundo, média de eventos recebidos
+        pelos assinantes rápidos, eventos recebidos pelo assinante lento ou
+        None, se o assinante lento perdeu o stream, se os saldos dos eventos
+        conferem com os do servidor ou None sem assinantes).
+    """
+
+    wallets = common.make_wallets(args.wallets)
+    wallets[MARKER] = 1_000_000
+    port = common.free_port()
+    feed_args = ["--change-feed", "--change-feed-size", str(args.feed_size)]
+    server = common.start_wallet_server(
+        port,
+        wallets,
+        "--workers",
+        str(args.processes * args.threads + subscribers + 2),
+        *(feed_args if feed else []),
+    )
+    fast = [Subscriber(port) for _ in range(subscribers)]
+    slow = Subscriber(port, slow_delay) if slow_delay is not None else None
+
+    # Este processo já tem canais gRPC abertos, que não sobrevivem a um
+    # fork, então os clientes são iniciados com spawn
+    context = multiprocessing.get_context("spawn")
+    names = list(wallets)[:-1]
+    results = context.Queue()
+    clients = [
+        context.Process(
+            target=client_process,
+            args=(port, names[i::args.processes], args.threads, args.duration, results),
+        )
+        for i in range(args.processes)
+    ]
+    for client in clients:
+        client.start()
+    operations = 0
+    for _ in clients:
+        operations += len(results.get())
+    for client in clients:
+        client.join()
+
+    consistent = None
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        stub = wallet_pb2_grpc.WalletStub(channel)
+        if fast:
+            # Os eventos são entregues em ordem, então quando o evento da
+            # marca chega, todos os da carga já chegaram
+            stub.create_payment_order(
+                wallet_pb2.CreatePaymentOrderRequest(wallet=MARKER, value=1)
+            )
+            for subscriber in fast:
+                subscriber.marker.wait(timeout=60)
+            balances = {
+                name: stub.balance(wallet_pb2.BalanceRequest(wallet=name)).balance
+                for name in fast[0].balances
+            }
+            consistent = all(
+                subscriber.balances == balances for subscriber in fast
+            )
+
+    # O envio ao assinante lento fica parado pelo controle de fluxo, então
+    # ele só percebe a perda dos eventos quando volta a ler no ritmo normal
+    if slow is not None:
+        slow.delay = 0.0
+        slow.join(timeout=10)
+
+    for subscriber in [*fast, *([slow] if slow else [])]:
+        subscriber.close()
+    common.stop_wallet_server(server, port)
+
+    received = sum(subscriber.events for subscriber in fast) / max(1, len(fast))
+    return (
+        operations / args.duration,
+        received,
+        slow.events if slow else None,
+        slow.lost if slow else None,
+        consistent,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream de alterações de saldo")
+    parser.add_argument("--subscribers", type=int, default=4)
+    parser.add_argument("--slow-delay", type=float, default=0.5)
+    parser.add_argument("--feed-size", type=int, default=4096)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wallets", type=int, default=64)
+    args = parser.parse_args()
+
+    rounds = [
+        ("off", False, 0, None),
+        ("feed", True, 0, None),
+        (f"{args.subscribers} subs", True, args.subscribers, None),
+        (f"{args.subscribers} + slow", True, args.subscribers, args.slow_delay),
+    ]
+    print(
+        f"{'round':>10} {'ops/s':>10} {'events':>10} {'slow':>8} {'slow lost':>9}"
+        f" {'balances':>9}"
+    )
+    for label, feed, subscribers, slow_delay in rounds:
+        throughput, received, slow, lost, consistent = run_round(
+            feed, subscribers, slow_delay, args
+        )
+        check = {None: "-", True: "ok", False: "DIFFERENT"}[consistent]
+        print(
+            f"{label:>10} {throughput:>10.0f} {received:>10.0f}"
+            f" {'-' if slow is None else slow:>8} {str(lost or '-'):>9}"
+            f" {check:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
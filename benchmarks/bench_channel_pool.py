@@ -0,0 +1,188 @@
+# Benchmark do conjunto de canais entre a loja e o servidor de carteiras
+# Vinicius Gomes - 2021421869
+#
+# Mede a vazão de vendas (procedimento `sell` da loja) com 1 ou mais canais
+# (conexões HTTP/2) entre a loja e o servidor de carteiras (--channels do
+# servidor da loja). As ordens de pagamento são criadas antes, em lote, e
+# vários processos clientes, cada um com várias threads, disparam as vendas;
+# assim, a vazão medida é a do caminho cliente → loja → carteiras.
+#
+# Os ganhos dependem do número de núcleos da máquina e da latência da rede:
+# localmente, uma conexão raramente esgota o limite de streams simultâneos.
+#
+# Uso: python3 benchmarks/bench_channel_pool.py [--channels 1,2,4,8]
+#      [--policy least_outstanding] [--store-args="--async"]
+
+import argparse
+import multiprocessing
+import shlex
+import threading
+import time
+
+import common
+import grpc
+
+import store_pb2
+import store_pb2_grpc
+import wallet_pb2
+import wallet_pb2_grpc
+
+PRICE = 10
+
+
+def create_orders(port, wallets, count):
+    """
+    Cria `count` ordens de pagamento no valor do produto, distribuídas entre
+    as carteiras, usando as chamadas em lote do servidor de carteiras.
+
+    Retorna:
+        A lista com os identificadores das ordens criadas.
+    """
+
+    orders = []
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        stub = wallet_pb2_grpc.WalletStub(channel)
+        for start in range(0, count, 1000):
+            items = [
+                wallet_pb2.CreatePaymentOrderRequest(
+                    wallet=wallets[index % len(wallets)], value=PRICE
+                )
+                for index in range(start, min(count, start + 1000))
+            ]
+            reply = stub.batch_create_payment_orders(
+                wallet_pb2.BatchCreatePaymentOrdersRequest(orders=items)
+            )
+            orders.extend(result.retval for result in reply.results)
+    return orders
+
+
+def client_process(port, orders, threads, start, results):
+    """
+    Processo cliente: divide as ordens entre `threads` threads, que vendem
+    cada uma na loja, a partir do instante `start` (relógio de
+    time.time(), o mesmo em todos os processos).
+
+    Parâmetros:
+        port (int): porta da loja
+        orders (list[int]): ordens de pagamento a serem vendidas
+        threads (int): número de threads do processo
+        start (float): instante de início das vendas
+        results (multiprocessing.Queue): fila onde é enviado o número de
+                                         vendas com status diferente de 0
+    """
+
+    channel = grpc.insecure_channel(f"localhost:{port}")
+    stub = store_pb2_grpc.StoreStub(channel)
+    stub.read_price(store_pb2.ReadPriceRequest())
+    failures = []
+
+    def worker(chunk):
+        failed = 0
+        for order in chunk:
+            status = stub.sell(store_pb2.SellRequest(payment_order=order)).status
+            failed += status != 0
+        failures.append(failed)
+
+    pool = [
+        threading.Thread(target=worker, args=(orders[i::threads],))
+        for i in range(threads)
+    ]
+    time.sleep(max(0.0, start - time.time()))
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    channel.close()
+    results.put(sum(failures))
+
+
+def run_round(channels, policy, store_args, processes, threads, sales):
+    """
+    Executa uma rodada do benchmark com `channels` canais entre a loja e o
+    servidor de carteiras.
+
+    Retorna:
+        Uma tupla (vendas por segundo, número de vendas que falharam).
+    """
+
+    wallets = common.make_wallets(64)
+    wallet_port = common.free_port()
+    wallet_server = common.start_wallet_server(
+        wallet_port, wallets, "--workers", "32"
+    )
+    orders = create_orders(wallet_port, list(wallets), sales)
+
+    store_port = common.free_port()
+    store_server = common.start_store_server(
+        store_port,
+        PRICE,
+        "wallet0",
+        wallet_port,
+        "--workers",
+        "32",
+        "--channels",
+        str(channels),
+        "--channel-policy",
+        policy,
+        *store_args,
+    )
+
+    # Este processo já usou o gRPC, que não sobrevive a um fork, então os
+    # clientes são iniciados com spawn
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start = time.time() + 2.0
+    clients = [
+        context.Process(
+            target=client_process,
+            args=(store_port, orders[i::processes], threads, start, results),
+        )
+        for i in range(processes)
+    ]
+    for client in clients:
+        client.start()
+    failures = sum(results.get() for _ in clients)
+    elapsed = time.time() - start
+    for client in clients:
+        client.join()
+
+    with grpc.insecure_channel(f"localhost:{store_port}") as channel:
+        store_pb2_grpc.StoreStub(channel).end_execution(
+            store_pb2.EndExecutionRequest()
+        )
+    store_server.wait(timeout=30)
+    wallet_server.wait(timeout=30)
+
+    return sales / elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conjunto de canais da loja")
+    parser.add_argument("--channels", default="1,2,4,8")
+    parser.add_argument(
+        "--policy",
+        choices=["round_robin", "least_outstanding"],
+        default="round_robin",
+    )
+    parser.add_argument("--store-args", default="")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--sales", type=int, default=8000)
+    args = parser.parse_args()
+
+    print(f"{'channels':>8} {'sales/s':>10} {'failed':>7}")
+    for channels in map(int, args.channels.split(",")):
+        throughput, failures = run_round(
+            channels,
+            args.policy,
+            shlex.split(args.store_args),
+            args.processes,
+            args.threads,
+            args.sales,
+        )
+        print(f"{channels:>8} {throughput:>10.0f} {failures:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Benchmark das chamadas redundantes (hedging) da loja
+# Vinicius Gomes - 2021421869
+#
+# Mede a latência das vendas (procedimento `sell` da loja, vista pelos
+# clientes) sem chamadas redundantes e com a loja reenviando `transfer`
+# quando a resposta demora mais que um percentil da latência. Cada rodada
+# também confere que nenhuma venda foi transferida duas vezes: o saldo final
+# do vendedor deve ser exatamente o valor das vendas, e todas as vendas
+# devem ter status 0 (uma repetição não reconhecida pelo servidor de
+# carteiras receberia -1).
+#
+# Uso: python3 benchmarks/bench_hedging.py [--percentiles off,90,95,99]
+#      [--store-args="--async"]
+
+import argparse
+import multiprocessing
+import shlex
+import threading
+import time
+
+import common
+import grpc
+from bench_channel_pool import create_orders
+
+import store_pb2
+import store_pb2_grpc
+import wallet_pb2
+import wallet_pb2_grpc
+
+PRICE = 10
+
+
+def client_process(port, orders, threads, start, results):
+    """
+    Processo cliente: divide as ordens entre `threads` threads, que vendem
+    cada uma na loja a partir do instante `start`, medindo a latência de
+    cada venda.
+
+    Parâmetros:
+        port (int): porta da loja
+        orders (list[int]): ordens de pagamento a serem vendidas
+        threads (int): número de threads do processo
+        start (float): instante de início das vendas
+        results (multiprocessing.Queue): fila onde é enviada uma tupla
+                                         (latências em segundos, número de
+                                         vendas com status diferente de 0)
+    """
+
+    channel = grpc.insecure_channel(f"localhost:{port}")
+    stub = store_pb2_grpc.StoreStub(channel)
+    stub.read_price(store_pb2.ReadPriceRequest())
+    latencies = []
+    failures = []
+
+    def worker(chunk):
+        failed = 0
+        for order in chunk:
+            started = time.perf_counter()
+            status = stub.sell(store_pb2.SellRequest(payment_order=order)).status
+            latencies.append(time.perf_counter() - started)
+            failed += status != 0
+        failures.append(failed)
+
+    pool = [
+        threading.Thread(target=worker, args=(orders[i::threads],))
+        for i in range(threads)
+    ]
+    time.sleep(max(0.0, start - time.time()))
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    channel.close()
+    results.put((latencies, sum(failures)))
+
+
+def run_round(percentile, store_args, processes, threads, sales):
+    """
+    Executa uma rodada do benchmark (`percentile` None desativa as chamadas
+    redundantes).
+
+    Retorna:
+        Uma tupla (latências das vendas, número de vendas que falharam,
+        contadores da loja, diferença entre o saldo final do vendedor e o
+        esperado).
+    """
+
+    # O vendedor não compra, então o seu saldo só muda com as vendas
+    wallets = common.make_wallets(65)
+    buyers = list(wallets)[:-1]
+    seller = list(wallets)[-1]
+    wallet_port = common.free_port()
+    wallet_server = common.start_wallet_server(wallet_port, wallets)
+    orders = create_orders(wallet_port, buyers, sales)
+
+    if percentile is not None:
+        store_args = [*store_args, "--hedge-percentile", str(percentile)]
+        store_args += ["--retries", "2"]
+    store_port = common.free_port()
+    store_server = common.start_store_server(
+        store_port, PRICE, seller, wallet_port, *store_args
+    )
+
+    # Este processo já usou o gRPC, que não sobrevive a um fork, então os
+    # clientes são iniciados com spawn
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start = time.time() + 2.0
+    clients = [
+        context.Process(
+            target=client_process,
+            args=(store_port, orders[i::processes], threads, start, results),
+        )
+        for i in range(processes)
+    ]
+    for client in clients:
+        client.start()
+    latencies = []
+    failures = 0
+    for _ in clients:
+        samples, failed = results.get()
+        latencies += samples
+        failures += failed
+    for client in clients:
+        client.join()
+
+    with grpc.insecure_channel(f"localhost:{wallet_port}") as channel:
+        balance = (
+            wallet_pb2_grpc.WalletStub(channel)
+            .balance(wallet_pb2.BalanceRequest(wallet=seller))
+            .balance
+        )
+    with grpc.insecure_channel(f"localhost:{store_port}") as channel:
+        stub = store_pb2_grpc.StoreStub(channel)
+        counters = stub.stats(store_pb2.StatsRequest()).counters
+        stub.end_execution(store_pb2.EndExecutionRequest())
+    store_server.wait(timeout=30)
+    wallet_server.wait(timeout=30)
+
+    return latencies, failures, counters, balance - wallets[seller] - sales * PRICE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chamadas redundantes da loja")
+    parser.add_argument("--percentiles", default="off,90,95,99")
+    parser.add_argument("--store-args", default="")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--sales", type=int, default=8000)
+    args = parser.parse_args()
+
+    print(
+        f"{'hedge':>6} {'p50 ms':>7} {'p99 ms':>7} {'p99.9 ms':>8} {'max ms':>7}"
+        f" {'hedged':>7} {'wins':>6} {'failed':>7} {'extra':>6}"
+    )
+    for value in args.percentiles.split(","):
+        percentile = None if value == "off" else float(value)
+        latencies, failures, counters, extra = run_round(
+            percentile,
+            shlex.split(args.store_args),
+            args.processes,
+            args.threads,
+            args.sales,
+        )
+        print(
+            f"{value:>6}"
+            f" {common.percentile(latencies, 0.5) * 1000:>7.2f}"
+            f" {common.percentile(latencies, 0.99) * 1000:>7.2f}"
+            f" {common.percentile(latencies, 0.999) * 1000:>8.2f}"
+            f" {max(latencies) * 1000:>7.2f}"
+            f" {counters['hedged_transfers']:>7} {counters['hedge_wins']:>6}"
+            f" {failures:>7} {extra:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# Benchmark dos transportes entre a loja e o servidor de carteiras na mesma
+# máquina
+# Vinicius Gomes - 2021421869
+#
+# Mede a latência de `sell`, feita em sequência por um cliente, com a loja e
+# o servidor de carteiras em processos separados ligados por TCP (loopback)
+# e por sockets Unix, e com os dois serviços no mesmo processo
+# (store-server.py --in-process), em que a loja chama o servicer de
+# carteiras diretamente. O cliente usa o mesmo transporte dos servidores
+# (socket Unix no modo no mesmo processo), então a diferença entre as duas
+# últimas rodadas é apenas a chamada `transfer` feita pela loja, que também
+# é exibida a partir das estatísticas da loja ("wallet.transfer").
+#
+# Uso: python3 benchmarks/bench_local_transport.py [--sales 2000]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import grpc
+
+import store_pb2
+import store_pb2_grpc
+import wallet_pb2
+import wallet_pb2_grpc
+
+PRICE = 10
+
+
+def start(script, *args, stdin=None):
+    """
+    Inicia um dos servidores em um processo separado, escrevendo `stdin` na
+    sua entrada padrão.
+
+    Retorna:
+        O processo (subprocess.Popen) do servidor.
+    """
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(common.ROOT, script), *args],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=common.ROOT,
+    )
+    process.stdin.write(stdin or b"")
+    process.stdin.close()
+    return process
+
+
+def run_round(mode, sales, warmup, directory):
+    """
+    Executa uma rodada do benchmark no modo informado ("tcp", "uds" ou
+    "in-process").
+
+    Retorna:
+        Uma tupla (latências de `sell` em segundos, estatísticas da chamada
+        `transfer` feita pela loja, número de vendas que falharam).
+    """
+
+    wallets = f"buyer {PRICE * (sales + warmup)}\nseller 0\n".encode()
+    if mode == "tcp":
+        wallet_port, store_port = common.free_port(), common.free_port()
+        wallet_endpoint, store_endpoint = str(wallet_port), str(store_port)
+        wallet_target = f"localhost:{wallet_port}"
+        store_target = f"localhost:{store_port}"
+    else:
+        wallet_endpoint = wallet_target = f"unix:{directory}/wallet-{mode}.sock"
+        store_endpoint = store_target = f"unix:{directory}/store-{mode}.sock"
+
+    servers = []
+    if mode == "in-process":
+        servers.append(
+            start(
+                "store-server.py",
+                str(PRICE),
+                store_endpoint,
+                "seller",
+                wallet_target,
+                "--in-process",
+                stdin=wallets,
+            )
+        )
+    else:
+        servers.append(start("wallet-server.py", wallet_endpoint, stdin=wallets))
+        common.wait_for_server(wallet_target)
+        servers.append(
+            start(
+                "store-server.py", str(PRICE), store_endpoint, "seller", wallet_target
+            )
+        )
+    common.wait_for_server(wallet_target)
+    common.wait_for_server(store_target)
+
+    wallet_channel = grpc.insecure_channel(wallet_target)
+    store_channel = grpc.insecure_channel(store_target)
+    wallet_stub = wallet_pb2_grpc.WalletStub(wallet_channel)
+    store_stub = store_pb2_grpc.StoreStub(store_channel)
+
+    latencies = []
+    failed = 0
+    for i in range(warmup + sales):
+        order = wallet_stub.create_payment_order(
+            wallet_pb2.CreatePaymentOrderRequest(wallet="buyer", value=PRICE)
+        ).retval
+        started = time.perf_counter()
+        status = store_stub.sell(store_pb2.SellRequest(payment_order=order)).status
+        elapsed = time.perf_counter() - started
+        if i >= warmup:
+            latencies.append(elapsed)
+            failed += status != 0
+
+    transfer = next(
+        method
+        for method in store_stub.stats(store_pb2.StatsRequest()).methods
+        if method.method == "wallet.transfer"
+    )
+    store_stub.end_execution(store_pb2.EndExecutionRequest())
+    wallet_channel.close()
+    store_channel.close()
+    for server in servers:
+        server.wait(timeout=30)
+    return latencies, transfer, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transportes locais")
+    parser.add_argument("--sales", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    args = parser.parse_args()
+
+    print(
+        f"{'mode':>10} {'p50 ms':>7} {'p99 ms':>7} {'mean ms':>8}"
+        f" {'transfer p50 us':>15} {'transfer p99 us':>15} {'failed':>6}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ("tcp", "uds", "in-process"):
+            latencies, transfer, failed = run_round(
+                mode, args.sales, args.warmup, directory
+            )
+            mean = sum(latencies) / len(latencies)
+            print(
+                f"{mode:>10} {common.percentile(latencies, 0.5) * 1000:>7.3f}"
+                f" {common.percentile(latencies, 0.99) * 1000:>7.3f}"
+                f" {mean * 1000:>8.3f} {transfer.p50_us:>15} {transfer.p99_us:>15}"
+                f" {failed:>6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
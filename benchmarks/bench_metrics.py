@@ -0,0 +1,70 @@
+# Benchmark do custo das métricas por chamada
+# Vinicius Gomes - 2021421869
+#
+# Chama um procedimento trivial diretamente e através do handler criado pelo
+# MetricsInterceptor, sem rede, para isolar o custo que o interceptador
+# acrescenta a cada chamada (medição do tempo, contagem dos códigos e
+# registro no histograma). Exibe também o custo de Histogram.record.
+#
+# Uso: python3 benchmarks/bench_metrics.py [--calls 200000]
+
+import argparse
+from collections import namedtuple
+
+import grpc
+
+import common
+
+import metrics
+import wallet_pb2
+
+HandlerCallDetails = namedtuple("HandlerCallDetails", ["method", "invocation_metadata"])
+
+
+def transfer(request, context):
+    return wallet_pb2.TransferReply(status=-1 if request.payment_order % 10 else 0)
+
+
+def timed(function, requests):
+    with common.Timer() as timer:
+        for request in requests:
+            function(request, None)
+    return timer.elapsed / len(requests) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="custo das métricas")
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+
+    requests = [
+        wallet_pb2.TransferRequest(payment_order=i, recount=10, wallet="wallet0")
+        for i in range(args.calls)
+    ]
+
+    registry = metrics.Metrics()
+    interceptor = metrics.MetricsInterceptor(registry)
+    handler = interceptor.intercept_service(
+        lambda details: grpc.unary_unary_rpc_method_handler(transfer),
+        HandlerCallDetails("/wallet.Wallet/transfer", ()),
+    )
+
+    direct = timed(transfer, requests)
+    intercepted = timed(handler.unary_unary, requests)
+
+    histogram = metrics.Histogram()
+    values = [i * 37 % 100_000 for i in range(args.calls)]
+    with common.Timer() as timer:
+        for value in values:
+            histogram.record(value)
+    record = timer.elapsed / args.calls * 1e9
+
+    print(f"{'direct ns/call':>22} {direct:>8.0f}")
+    print(f"{'intercepted ns/call':>22} {intercepted:>8.0f}")
+    print(f"{'overhead ns/call':>22} {intercepted - direct:>8.0f}")
+    print(f"{'Histogram.record ns':>22} {record:>8.0f}")
+    print(registry.render(), end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Benchmark da expiração das ordens de pagamento: roda de temporização x
+# varredura
+# Vinicius Gomes - 2021421869
+#
+# Simula um tráfego de compras abandonadas: ordens de pagamento são criadas
+# continuamente com um prazo fixo e nenhuma é transferida. A cada tick, as
+# ordens vencidas são expiradas com a roda de temporização (TimingWheel) ou
+# com uma varredura de todas as ordens pendentes (a alternativa sem
+# estrutura auxiliar). Exibe o custo médio por tick e por ordem expirada e o
+# maior número de ordens pendentes, que fica limitado pelo prazo.
+#
+# Uso: python3 benchmarks/bench_order_expiry.py [--rate 10000] [--ttl 5]
+
+import argparse
+
+import common
+
+from timing_wheel import TimingWheel
+
+
+def run_wheel(rate, ttl, tick, duration):
+    """
+    Executa a simulação com a roda de temporização.
+
+    Retorna:
+        Uma tupla (tempo total de expiração, ordens expiradas, maior número de
+        ordens pendentes).
+    """
+
+    wheel = TimingWheel(tick, 0.0)
+    pending = set()
+    next_order = 1
+    spent = 0.0
+    expired = peak = 0
+
+    per_tick = int(rate * tick)
+    for step in range(1, int(duration / tick) + 1):
+        now = step * tick
+        for _ in range(per_tick):
+            pending.add(next_order)
+            wheel.schedule(next_order, now + ttl)
+            next_order += 1
+        peak = max(peak, len(pending))
+
+        with common.Timer() as timer:
+            for payment_order in wheel.advance(now):
+                pending.discard(payment_order)
+                expired += 1
+        spent += timer.elapsed
+
+    return spent, expired, peak
+
+
+def run_scan(rate, ttl, tick, duration):
+    """
+    Executa a simulação varrendo as ordens pendentes a cada tick.
+
+    Retorna:
+        Uma tupla (tempo total de expiração, ordens expiradas, maior número de
+        ordens pendentes).
+    """
+
+    deadlines = {}
+    next_order = 1
+    spent = 0.0
+    expired = peak = 0
+
+    per_tick = int(rate * tick)
+    for step in range(1, int(duration / tick) + 1):
+        now = step * tick
+        for _ in range(per_tick):
+            deadlines[next_order] = now + ttl
+            next_order += 1
+        peak = max(peak, len(deadlines))
+
+        with common.Timer() as timer:
+            due = [order for order, deadline in deadlines.items() if deadline <= now]
+            for payment_order in due:
+                del deadlines[payment_order]
+            expired += len(due)
+        spent += timer.elapsed
+
+    return spent, expired, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TimingWheel x varredura")
+    # Ordens de pagamento criadas por segundo (simulado)
+    parser.add_argument("--rate", type=int, default=10_000)
+    parser.add_argument("--ttl", type=float, default=5.0)
+    parser.add_argument("--tick", type=float, default=0.1)
+    # Duração simulada em segundos
+    parser.add_argument("--duration", type=float, default=30.0)
+    args = parser.parse_args()
+
+    ticks = int(args.duration / args.tick)
+    print(f"{'mode':>6} {'expired':>9} {'peak':>8} {'us/tick':>9} {'ns/order':>9}")
+    for mode, simulate in [("wheel", run_wheel), ("scan", run_scan)]:
+        spent, expired, peak = simulate(args.rate, args.ttl, args.tick, args.duration)
+        print(
+            f"{mode:>6} {expired:>9} {peak:>8} {spent / ticks * 1e6:>9.0f} "
+            f"{spent / max(expired, 1) * 1e9:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Benchmark das ordens de pagamento: dicionário x CompactOrderStore
+# Vinicius Gomes - 2021421869
+#
+# Cria um grande número de ordens de pagamento e transfere a maior parte
+# delas, na ordem de criação, como acontece em uma execução longa do
+# servidor. Exibe a latência média de criação e de transferência e a memória
+# ocupada ao final pelas ordens que ficaram pendentes. Cada medição é feita
+# em um processo separado, para que a memória de uma não interfira na outra.
+#
+# Uso: python3 benchmarks/bench_order_store.py [--orders 10000000] [--redeemed 0.9]
+
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+
+import common
+
+from order_store import CompactOrderStore, DictOrderStore
+
+
+def measure(storage, orders, redeemed):
+    """
+    Cria e transfere as ordens de pagamento e mede o seu custo. Executada no
+    processo filho.
+
+    Retorna:
+        Um dicionário com as latências médias em nanossegundos, o número de
+        ordens pendentes e os bytes por ordem criada.
+    """
+
+    store = CompactOrderStore() if storage == "compact" else DictOrderStore()
+
+    # As ordens não transferidas ficam espalhadas entre as transferidas
+    rng = random.Random(0)
+    keep = [rng.random() >= redeemed for _ in range(orders)]
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    create = take = 0.0
+    # As transferências acompanham as criações com um pequeno atraso, como
+    # em clientes que criam a ordem e a transferem logo em seguida
+    lag = 1000
+    for start in range(0, orders, lag):
+        end = min(start + lag, orders)
+
+        with common.Timer() as timer:
+            for _ in range(start, end):
+                store.create(10, "wallet0")
+        create += timer.elapsed
+
+        with common.Timer() as timer:
+            for index in range(start, end):
+                if not keep[index]:
+                    store.take(index + 1, 10)
+        take += timer.elapsed
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    taken = orders - sum(keep)
+    return {
+        "create_ns": create / orders * 1e9,
+        "take_ns": take / max(taken, 1) * 1e9,
+        "pending": len(store),
+        # ru_maxrss é medido em KiB no Linux
+        "bytes_per_order": (after - before) * 1024 / orders,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dict x CompactOrderStore")
+    parser.add_argument("--orders", type=int, default=10_000_000)
+    # Fração das ordens que é transferida
+    parser.add_argument("--redeemed", type=float, default=0.9)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.orders, args.redeemed)))
+        return
+
+    print(
+        f"{'storage':>8} {'orders':>10} {'pending':>9} "
+        f"{'create ns':>10} {'take ns':>8} {'B/order':>8}"
+    )
+    for storage in ["dict", "compact"]:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--orders",
+                str(args.orders),
+                "--redeemed",
+                str(args.redeemed),
+                "--child",
+                storage,
+            ],
+            capture_output=True,
+            check=True,
+        ).stdout
+        result = json.loads(output)
+        print(
+            f"{storage:>8} {args.orders:>10} {result['pending']:>9} "
+            f"{result['create_ns']:>10.0f} {result['take_ns']:>8.0f} "
+            f"{result['bytes_per_order']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# Benchmark dos clientes com vários comandos em andamento (--window)
+# Vinicius Gomes - 2021421869
+#
+# Executa os clientes de carteiras e de lojas com uma lista de comandos,
+# conectados aos servidores por um proxy TCP que atrasa cada sentido em
+# metade de --rtt segundos (simulando um enlace de alta latência), com uma
+# janela de um comando por vez e com as janelas de --windows. Para cada
+# rodada, exibe o tempo de execução dos comandos e confere que a saída do
+# cliente de carteiras é idêntica à da execução em sequência (para o
+# cliente de lojas, cuja numeração das ordens pode mudar, confere o número
+# de compras com sucesso e o saldo final do vendedor).
+#
+# Uso: python3 benchmarks/bench_pipeline.py [--rtt 0.02] [--windows 1,8,32]
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import common
+
+PRICE = 10
+
+
+class DelayProxy:
+    def __init__(self, target_port: int, delay: float) -> None:
+        """
+        Proxy TCP, executado em uma thread própria, que repassa os dados para
+        a porta `target_port` da máquina local e de volta, cada trecho com
+        `delay` segundos de atraso (sem limitar a banda, já que o atraso de
+        um trecho não segura os seguintes).
+
+        Parâmetros:
+            target_port (int): porta do servidor
+            delay (float): atraso, em segundos, de cada sentido
+        """
+
+        self.port = common.free_port()
+        self.target_port = target_port
+        self.delay = delay
+        self._started = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+        self._started.wait()
+
+    async def _pipe(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def send():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    writer.close()
+                    return
+                await asyncio.sleep(max(0.0, due - loop.time()))
+                writer.write(data)
+                await writer.drain()
+
+        sender = asyncio.create_task(send())
+        try:
+            while data := await reader.read(1 << 16):
+                queue.put_nowait((loop.time() + self.delay, data))
+        except ConnectionError:
+            pass
+        queue.put_nowait((0.0, None))
+        await sender
+
+    async def _connect(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(
+            "localhost", self.target_port
+        )
+        await asyncio.gather(
+            self._pipe(client_reader, server_writer),
+            self._pipe(server_reader, client_writer),
+            return_exceptions=True,
+        )
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._connect, "localhost", self.port)
+        self._started.set()
+        async with server:
+            await server.serve_forever()
+
+
+def wallet_commands(wallets, rounds, batch):
+    """
+    Gera os comandos do cliente de carteiras: em cada rodada, `batch`
+    ordens de pagamento (O), a transferência de cada uma para uma carteira
+    diferente (X) e `batch` consultas de saldo (S), terminando com F.
+    """
+
+    lines = []
+    order = 1
+    for _ in range(rounds):
+        lines += ["O 1"] * batch
+        for i in range(batch):
+            lines.append(f"X {order + i} 1 {wallets[i % len(wallets)]}")
+        order += batch
+        lines += ["S"] * batch
+    lines.append("F")
+    return "\n".join(lines) + "\n"
+
+
+def run_client(script, commands, *args):
+    """
+    Executa um cliente com os comandos na entrada padrão.
+
+    Retorna:
+        Uma tupla (saída do cliente, tempo de execução em segundos).
+    """
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, os.path.join(common.ROOT, script), *args],
+        input=commands.encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+        cwd=common.ROOT,
+    )
+    return result.stdout.decode(), time.perf_counter() - started
+
+
+def wallet_round(window, rtt, rounds, batch):
+    wallets = common.make_wallets(batch)
+    wallets["client"] = 1_000_000
+    port = common.free_port()
+    server = common.start_wallet_server(port, wallets)
+    proxy = DelayProxy(port, rtt / 2)
+    output, elapsed = run_client(
+        "wallet-client.py",
+        wallet_commands(list(wallets)[:-1], rounds, batch),
+        "client",
+        f"localhost:{proxy.port}",
+        "--window",
+        str(window),
+    )
+    server.wait(timeout=30)
+    return output, elapsed
+
+
+def store_round(window, rtt, purchases, atomic):
+    wallets = {"buyer": PRICE * purchases, "seller": 0}
+    wallet_port = common.free_port()
+    wallet_server = common.start_wallet_server(wallet_port, wallets)
+    store_port = common.free_port()
+    store_server = common.start_store_server(
+        store_port, PRICE, "seller", wallet_port
+    )
+    wallet_proxy = DelayProxy(wallet_port, rtt / 2)
+    store_proxy = DelayProxy(store_port, rtt / 2)
+    output, elapsed = run_client(
+        "store-client.py",
+        "C\n" * purchases + "T\n",
+        "buyer",
+        f"localhost:{wallet_proxy.port}",
+        f"localhost:{store_proxy.port}",
+        "--window",
+        str(window),
+        *(["--atomic"] if atomic else []),
+    )
+    store_server.wait(timeout=30)
+    wallet_server.wait(timeout=30)
+    lines = output.split("\n")
+    # Preço, pares (ordem, status) de cada compra e, por fim, o saldo do
+    # vendedor e as pendências
+    statuses = lines[2 : 1 + 2 * purchases : 2]
+    return sum(status == "0" for status in statuses), lines[-2], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clientes com janela de comandos")
+    parser.add_argument("--rtt", type=float, default=0.02)
+    parser.add_argument("--windows", default="1,8,32")
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--purchases", type=int, default=400)
+    args = parser.parse_args()
+    windows = [int(window) for window in args.windows.split(",")]
+
+    print(f"rtt {args.rtt * 1000:.0f} ms")
+    print(f"{'client':>14} {'window':>6} {'seconds':>8} {'speedup':>8} {'check':>10}")
+    expected = base = None
+    for window in windows:
+        output, elapsed = wallet_round(window, args.rtt, args.rounds, args.batch)
+        if expected is None:
+            expected, base = output, elapsed
+        check = "same" if output == expected else "DIFFERENT"
+        print(
+            f"{'wallet':>14} {window:>6} {elapsed:>8.2f}"
+            f" {base / elapsed:>7.1f}x {check:>10}"
+        )
+
+    for atomic in (False, True):
+        name = "store atomic" if atomic else "store"
+        base = None
+        for window in windows:
+            sold, final, elapsed = store_round(
+                window, args.rtt, args.purchases, atomic
+            )
+            base = base or elapsed
+            print(
+                f"{name:>14} {window:>6} {elapsed:>8.2f}"
+                f" {base / elapsed:>7.1f}x {sold:>4} ok {final.split()[0]:>5}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# Benchmark da replicação para réplicas de leitura
+# Vinicius Gomes - 2021421869
+#
+# Mede a vazão de escrita do servidor de carteiras (pares
+# create_payment_order + transfer por segundo, feitos por vários processos
+# clientes) sem o registro de alterações, com o registro e nenhuma réplica e
+# com 1 ou mais réplicas conectadas. Durante a carga, as estatísticas de cada
+# réplica são consultadas periodicamente para medir o atraso: quantas
+# alterações ainda não foram aplicadas e há quantos milissegundos o estado da
+# réplica pode estar desatualizado. Ao final, mede quanto tempo as réplicas
+# levam para alcançar o servidor principal e verifica se os saldos delas são
+# iguais aos do principal.
+#
+# Réplicas e servidor principal dividem os núcleos da máquina, então o custo
+# de aplicar as alterações também aparece na vazão do principal.
+#
+# Uso: python3 benchmarks/bench_replication.py [--replicas 0,1,2]
+
+import argparse
+import multiprocessing
+import threading
+import time
+
+import common
+import grpc
+from bench_wallet_locks import client_process
+
+import wallet_pb2
+import wallet_pb2_grpc
+
+
+def counters(stub):
+    return stub.stats(wallet_pb2.StatsRequest()).counters
+
+
+def sample_lag(stubs, stop, samples, interval=0.02):
+    """
+    Consulta periodicamente o atraso das réplicas até que `stop` seja
+    sinalizado, acrescentando a `samples` pares (alterações não aplicadas,
+    atraso em milissegundos).
+    """
+
+    while not stop.wait(interval):
+        for stub in stubs:
+            values = counters(stub)
+            if values["replica_staleness_ms"] >= 0:
+                samples.append(
+                    (values["replica_lag"], values["replica_staleness_ms"])
+                )
+
+
+def run_round(replicas, processes, threads, duration, wallet_count):
+    """
+    Executa uma rodada do benchmark com `replicas` réplicas (None desativa o
+    registro de alterações no servidor principal).
+
+    Retorna:
+        Uma tupla (vazão em operações por segundo, amostras do atraso, tempo
+        em segundos para as réplicas alcançarem o principal, número de
+        réplicas com saldos diferentes dos do principal).
+    """
+
+    wallets = common.make_wallets(wallet_count)
+    port = common.free_port()
+    server = common.start_wallet_server(
+        port, wallets, *(["--replication"] if replicas is not None else [])
+    )
+    replica_ports = [common.free_port() for _ in range(replicas or 0)]
+    replica_servers = [
+        common.start_wallet_replica(replica_port, port)
+        for replica_port in replica_ports
+    ]
+
+    channels = [
+        grpc.insecure_channel(f"localhost:{replica_port}")
+        for replica_port in replica_ports
+    ]
+    stubs = [wallet_pb2_grpc.WalletStub(channel) for channel in channels]
+    # Espera o snapshot inicial de todas as réplicas
+    for stub in stubs:
+        while counters(stub)["replica_staleness_ms"] < 0:
+            time.sleep(0.05)
+
+    samples = []
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_lag, args=(stubs, stop, samples))
+    sampler.start()
+
+    # Este processo já tem canais gRPC abertos, que não sobrevivem a um
+    # fork, então os clientes são iniciados com spawn
+    context = multiprocessing.get_context("spawn")
+    names = list(wallets)
+    results = context.Queue()
+    clients = [
+        context.Process(
+            target=client_process,
+            args=(port, names[i::processes], threads, duration, results),
+        )
+        for i in range(processes)
+    ]
+    for client in clients:
+        client.start()
+    operations = 0
+    for _ in clients:
+        operations += len(results.get())
+    for client in clients:
+        client.join()
+    stop.set()
+    sampler.join()
+
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        primary = wallet_pb2_grpc.WalletStub(channel)
+
+        # Tempo até todas as réplicas aplicarem a última alteração
+        started = time.perf_counter()
+        if replicas:
+            target = counters(primary)["replication_lsn"]
+            for stub in stubs:
+                while counters(stub)["replica_lsn"] < target:
+                    time.sleep(0.001)
+        catch_up = time.perf_counter() - started
+
+        # As consultas só são atendidas depois que as réplicas se consideram
+        # em dia (o próximo heartbeat confirma que nada mudou)
+        for stub in stubs:
+            while not 0 <= counters(stub)["replica_staleness_ms"] < 500:
+                time.sleep(0.01)
+
+        balances = [
+            primary.balance(wallet_pb2.BalanceRequest(wallet=name)).balance
+            for name in names
+        ]
+        diverged = sum(
+            [
+                stub.balance(wallet_pb2.BalanceRequest(wallet=name)).balance
+                for name in names
+            ]
+            != balances
+            for stub in stubs
+        )
+
+    for channel in channels:
+        channel.close()
+    for replica_port, replica_server in zip(replica_ports, replica_servers):
+        common.stop_wallet_server(replica_server, replica_port)
+    common.stop_wallet_server(server, port)
+
+    return operations / duration, samples, catch_up, diverged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Réplicas de leitura")
+    parser.add_argument("--replicas", default="0,1,2")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wallets", type=int, default=64)
+    args = parser.parse_args()
+
+    print(
+        f"{'replicas':>8} {'ops/s':>10} {'lag p50':>8} {'lag max':>8}"
+        f" {'ms p50':>7} {'ms p99':>7} {'ms max':>7} {'catchup':>8} {'diverged':>8}"
+    )
+    # A primeira rodada é feita sem o registro de alterações
+    rounds = [None] + [int(count) for count in args.replicas.split(",")]
+    for replicas in rounds:
+        throughput, samples, catch_up, diverged = run_round(
+            replicas, args.processes, args.threads, args.duration, args.wallets
+        )
+        label = "off" if replicas is None else str(replicas)
+        if not samples:
+            print(f"{label:>8} {throughput:>10.0f}")
+            continue
+        lags = [lag for lag, _ in samples]
+        delays = [delay for _, delay in samples]
+        print(
+            f"{label:>8} {throughput:>10.0f}"
+            f" {common.percentile(lags, 0.5):>8.0f} {max(lags):>8}"
+            f" {common.percentile(delays, 0.5):>7.0f}"
+            f" {common.percentile(delays, 0.99):>7.0f} {max(delays):>7}"
+            f" {catch_up * 1000:>6.0f}ms {diverged:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Benchmark de escalabilidade das carteiras particionadas
+# Vinicius Gomes - 2021421869
+#
+# Para cada número de shards, inicia um servidor de carteiras por shard (todos
+# na mesma máquina, cada um em um processo) e mede a vazão de pares
+# create_payment_order + transfer feitos por vários processos clientes
+# através do ShardRouter. A carteira de destino de cada transferência é
+# sorteada, então uma fração (K - 1) / K das transferências cruza shards e
+# usa a confirmação em duas fases; com --local, o destino é sorteado entre as
+# carteiras do mesmo shard da origem, o que mede o limite sem coordenação.
+# Ao final de cada rodada, verifica se o dinheiro total foi conservado.
+#
+# Os ganhos dependem do número de núcleos da máquina: cada shard é um
+# processo Python limitado a um núcleo pelo GIL.
+#
+# Uso: python3 benchmarks/bench_sharding.py [--shards 1,2,4,8] [--local]
+
+import argparse
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+import common
+
+import sharding
+import wallet_pb2
+
+
+def client_process(addresses, wallets, threads, duration, local, results):
+    """
+    Processo cliente: dispara `threads` threads que repetem o par criação de
+    ordem de pagamento + transferência durante `duration` segundos.
+
+    Parâmetros:
+        addresses (list[tuple[str, int]]): endereços dos shards
+        wallets (list[str]): todas as carteiras
+        threads (int): número de threads do processo
+        duration (float): duração da rodada em segundos
+        local (bool): escolhe o destino no mesmo shard da origem
+        results (multiprocessing.Queue): fila onde são enviados os números de
+                                         pares feitos e de pares entre shards
+    """
+
+    router = sharding.ShardRouter(addresses)
+    by_shard = {}
+    for wallet in wallets:
+        by_shard.setdefault(router.ring.shard(wallet), []).append(wallet)
+    deadline = time.perf_counter() + duration
+    counts = []
+
+    def worker(index):
+        rng = random.Random(os.getpid() * 1000 + index)
+        done = crossing = 0
+        while time.perf_counter() < deadline:
+            source = rng.choice(wallets)
+            shard = router.ring.shard(source)
+            destination = rng.choice(by_shard[shard] if local else wallets)
+            order = router.create_payment_order(
+                wallet_pb2.CreatePaymentOrderRequest(wallet=source, value=1)
+            ).retval
+            router.transfer(
+                wallet_pb2.TransferRequest(
+                    payment_order=order, recount=1, wallet=destination
+                )
+            )
+            done += 1
+            crossing += router.ring.shard(destination) != shard
+        counts.append((done, crossing))
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    router.close()
+    results.put(
+        (sum(done for done, _ in counts), sum(crossing for _, crossing in counts))
+    )
+
+
+def run_round(shards, processes, threads, duration, wallet_count, local):
+    """
+    Executa uma rodada do benchmark com `shards` servidores de carteiras.
+
+    Retorna:
+        Uma tupla (vazão em pares por segundo, fração dos pares entre shards,
+        diferença entre o dinheiro total final e o inicial).
+    """
+
+    wallets = common.make_wallets(wallet_count)
+    addresses = [("localhost", common.free_port()) for _ in range(shards)]
+    servers = [
+        common.start_wallet_server(
+            port, wallets, "--shard", str(index), "--shards", str(shards)
+        )
+        for index, (_, port) in enumerate(addresses)
+    ]
+
+    names = list(wallets)
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(
+            target=client_process,
+            args=(addresses, names, threads, duration, local, results),
+        )
+        for _ in range(processes)
+    ]
+    for client in clients:
+        client.start()
+    done = crossing = 0
+    for _ in clients:
+        client_done, client_crossing = results.get()
+        done += client_done
+        crossing += client_crossing
+    for client in clients:
+        client.join()
+
+    router = sharding.ShardRouter(addresses)
+    total = sum(
+        router.balance(wallet_pb2.BalanceRequest(wallet=name)).balance
+        for name in names
+    )
+    router.end_execution(wallet_pb2.EndExecutionRequest())
+    router.close()
+    for server in servers:
+        server.wait(timeout=30)
+
+    return done / duration, crossing / max(done, 1), total - sum(wallets.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Escalabilidade com shards")
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wallets", type=int, default=1024)
+    parser.add_argument("--local", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'shards':>7} {'ops/s':>10} {'cross':>6} {'drift':>6}")
+    for shards in map(int, args.shards.split(",")):
+        throughput, crossing, drift = run_round(
+            shards,
+            args.processes,
+            args.threads,
+            args.duration,
+            args.wallets,
+            args.local,
+        )
+        print(f"{shards:>7} {throughput:>10.0f} {crossing:>6.2f} {drift:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Benchmark do log de escrita antecipada: fsync por operação x group commit
+# Vinicius Gomes - 2021421869
+#
+# Várias threads registram operações no log e esperam que elas estejam
+# gravadas em disco, como fazem as requisições do servidor de carteiras no
+# modo durável. Para cada número de threads, exibe a vazão (operações
+# duráveis por segundo) com um fsync por operação e com group commit, além do
+# número médio de operações gravadas por fsync.
+#
+# Uso: python3 benchmarks/bench_wal.py [--threads 1,8,32,64] [--dir /tmp]
+
+import argparse
+import tempfile
+import threading
+import time
+
+import common
+
+from wal import WriteAheadLog
+
+
+def run_round(directory, group_commit, threads, duration):
+    """
+    Executa uma rodada do benchmark.
+
+    Retorna:
+        Uma tupla (operações por segundo, operações por fsync).
+    """
+
+    with tempfile.TemporaryDirectory(dir=directory) as wal_dir:
+        wal = WriteAheadLog(wal_dir, group_commit=group_commit)
+        wal.recover({"wallet0": 0})
+
+        # Conta os fsyncs feitos pelo log
+        fsyncs = 0
+        write = wal._write
+
+        def counting_write(lines, max_lsn):
+            nonlocal fsyncs
+            fsyncs += 1
+            write(lines, max_lsn)
+
+        wal._write = counting_write
+
+        deadline = time.perf_counter() + duration
+        counts = [0] * threads
+
+        def worker(index):
+            while time.perf_counter() < deadline:
+                wal.wait(wal.append("O", index, "wallet0", 1))
+                counts[index] += 1
+
+        # As últimas operações terminam depois do prazo, então a vazão usa o
+        # tempo medido
+        pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        with common.Timer() as timer:
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+        wal.close()
+
+    operations = sum(counts)
+    return operations / timer.elapsed, operations / max(fsyncs, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fsync por operação x group commit")
+    parser.add_argument("--threads", default="1,8,32,64")
+    parser.add_argument("--duration", type=float, default=3.0)
+    # Diretório (e portanto sistema de arquivos) onde o log é gravado
+    parser.add_argument("--dir", default=None)
+    args = parser.parse_args()
+
+    modes = {"per-op": False, "group": True}
+    print(f"{'mode':>7} {'threads':>8} {'ops/s':>9} {'ops/fsync':>10}")
+    for threads in map(int, args.threads.split(",")):
+        for mode, group_commit in modes.items():
+            throughput, per_fsync = run_round(
+                args.dir, group_commit, threads, args.duration
+            )
+            print(f"{mode:>7} {threads:>8} {throughput:>9.0f} {per_fsync:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
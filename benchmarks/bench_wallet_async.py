@@ -0,0 +1,89 @@
+# Comparação entre o servidor de carteiras com threads e o modo --async
+# Vinicius Gomes - 2021421869
+#
+# Para cada nível de concorrência (número de chamadas em andamento ao mesmo
+# tempo), dispara pares create_payment_order + transfer contra o servidor
+# no modo com pool de threads e no modo grpc.aio, e exibe a vazão e as
+# latências p50/p99 de cada par.
+#
+# Uso: python3 benchmarks/bench_wallet_async.py [--concurrency 10,100,1000]
+
+import argparse
+import asyncio
+import time
+
+import common
+import grpc
+
+import wallet_pb2
+import wallet_pb2_grpc
+
+
+async def drive(port, wallets, concurrency, duration):
+    """
+    Mantém `concurrency` chamadas em andamento contra o servidor durante
+    `duration` segundos.
+
+    Retorna:
+        A lista de latências (em segundos) de cada par de chamadas.
+    """
+
+    latencies = []
+    async with grpc.aio.insecure_channel(f"localhost:{port}") as channel:
+        stub = wallet_pb2_grpc.WalletStub(channel)
+        deadline = time.perf_counter() + duration
+
+        async def worker(index):
+            source = wallets[index % len(wallets)]
+            destination = wallets[(index + 1) % len(wallets)]
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                reply = await stub.create_payment_order(
+                    wallet_pb2.CreatePaymentOrderRequest(wallet=source, value=1)
+                )
+                await stub.transfer(
+                    wallet_pb2.TransferRequest(
+                        payment_order=reply.retval, recount=1, wallet=destination
+                    )
+                )
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return latencies
+
+
+def run_round(mode_args, concurrency, duration, wallet_count):
+    wallets = common.make_wallets(wallet_count)
+    port = common.free_port()
+    server = common.start_wallet_server(port, wallets, *mode_args)
+    latencies = asyncio.run(drive(port, list(wallets), concurrency, duration))
+    common.stop_wallet_server(server, port)
+    return (
+        len(latencies) / duration,
+        common.percentile(latencies, 0.50) * 1000,
+        common.percentile(latencies, 0.99) * 1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Threads x grpc.aio")
+    parser.add_argument("--concurrency", default="10,100,1000")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wallets", type=int, default=64)
+    args = parser.parse_args()
+
+    modes = {"threads": [], "async": ["--async"]}
+    print(f"{'mode':>8} {'inflight':>9} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for concurrency in map(int, args.concurrency.split(",")):
+        for mode, mode_args in modes.items():
+            throughput, p50, p99 = run_round(
+                mode_args, concurrency, args.duration, args.wallets
+            )
+            print(
+                f"{mode:>8} {concurrency:>9} {throughput:>9.0f} "
+                f"{p50:>8.2f} {p99:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
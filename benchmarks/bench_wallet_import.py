@@ -0,0 +1,191 @@
+# Benchmark da carga das carteiras do servidor de carteiras
+# Vinicius Gomes - 2021421869
+#
+# Gera um arquivo com --wallets carteiras, no formato da entrada padrão do
+# servidor, e mede:
+#   - a carga das carteiras, em um processo separado para cada rodada, com o
+#     laço original (um `input()` e um `split()` por linha e uma atribuição
+#     por carteira) e com `wallet_loader.load_wallets` (blocos grandes e um
+#     `update` por bloco, com e sem processos auxiliares), para o dicionário e
+#     para a WalletTable;
+#   - o tempo de inicialização do servidor de carteiras, do início do
+#     processo até ele aceitar conexões, com as carteiras na entrada padrão;
+#   - a importação das mesmas carteiras com o servidor em execução, pelo
+#     procedimento `import_wallets`.
+#
+# Uso: python3 benchmarks/bench_wallet_import.py [--wallets 1000000]
+#      [--load-workers 2]
+
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import grpc
+
+import wallet_loader
+import wallet_pb2
+import wallet_pb2_grpc
+from wallet_table import WalletTable
+
+STORAGES = {"dict": dict, "array": WalletTable}
+
+
+def load_lines(path, storage):
+    # Laço original do servidor de carteiras, lendo da entrada padrão
+    wallets = STORAGES[storage]()
+    sys.stdin = open(path)
+    started = time.perf_counter()
+    while True:
+        try:
+            line = input()
+        except EOFError:
+            break
+        if not line:
+            continue
+        id, value = line.split()
+        wallets[id] = int(value)
+    return len(wallets), time.perf_counter() - started
+
+
+def load_chunks(path, storage, workers):
+    wallets = STORAGES[storage]()
+    with open(path, "rb") as stream:
+        _, elapsed = wallet_loader.load_wallets(stream, wallets, workers=workers)
+    return len(wallets), elapsed
+
+
+def load_round(path, storage, workers, results):
+    """
+    Processo de uma rodada de carga (`workers` None usa o laço original).
+    Envia à fila uma tupla (número de carteiras, tempo em segundos).
+    """
+
+    if workers is None:
+        results.put(load_lines(path, storage))
+    else:
+        results.put(load_chunks(path, storage, workers))
+
+
+def startup_time(path, *args):
+    """
+    Retorna o tempo, em segundos, do início do servidor de carteiras até ele
+    aceitar conexões, com as carteiras do arquivo na entrada padrão.
+    """
+
+    port = common.free_port()
+    with open(path, "rb") as stdin:
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(common.ROOT, "wallet-server.py"),
+                str(port),
+                *args,
+            ],
+            stdin=stdin,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=common.ROOT,
+        )
+        common.wait_for_server(f"localhost:{port}", timeout=300)
+    elapsed = time.perf_counter() - started
+    common.stop_wallet_server(process, port)
+    return elapsed
+
+
+def import_time(path, batch_size, *args):
+    """
+    Importa as carteiras do arquivo em um servidor de carteiras iniciado sem
+    carteiras.
+
+    Retorna:
+        Uma tupla (resposta de `import_wallets`, tempo em segundos).
+    """
+
+    port = common.free_port()
+    process = common.start_wallet_server(port, {}, *args)
+
+    def requests():
+        with open(path, "rb") as stream:
+            for data in wallet_loader.read_chunks(stream):
+                names, balances = wallet_loader.parse_chunk(data)
+                for start in range(0, len(names), batch_size):
+                    yield wallet_pb2.ImportWalletsRequest(
+                        wallets=[
+                            wallet_pb2.WalletEntry(wallet=name, balance=balance)
+                            for name, balance in zip(
+                                names[start : start + batch_size],
+                                balances[start : start + batch_size],
+                            )
+                        ]
+                    )
+
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        started = time.perf_counter()
+        reply = wallet_pb2_grpc.WalletStub(channel).import_wallets(requests())
+        elapsed = time.perf_counter() - started
+    common.stop_wallet_server(process, port)
+    return reply, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga das carteiras")
+    parser.add_argument("--wallets", type=int, default=1_000_000)
+    parser.add_argument("--load-workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "wallets.txt")
+    with open(path, "w") as wallets:
+        for i in range(args.wallets):
+            wallets.write(f"wallet{i} {i % 1000}\n")
+
+    print(f"wallets: {args.wallets}")
+    print(f"{'load':>16} {'storage':>8} {'seconds':>8} {'wallets/s':>10}")
+    # Cada rodada em um processo novo, sem a memória das rodadas anteriores
+    # (com spawn, já que este processo ainda vai usar o gRPC)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    loaders = [
+        ("input() loop", None),
+        ("chunks", 1),
+        (f"chunks, {args.load_workers} proc", args.load_workers),
+    ]
+    for storage in STORAGES:
+        for name, workers in loaders:
+            process = context.Process(
+                target=load_round, args=(path, storage, workers, results)
+            )
+            process.start()
+            count, elapsed = results.get()
+            process.join()
+            print(
+                f"{name:>16} {storage:>8} {elapsed:>8.2f} {count / elapsed:>10.0f}"
+            )
+
+    print()
+    print(f"{'startup':>24} {'seconds':>8}")
+    for storage in STORAGES:
+        for workers in (1, args.load_workers):
+            elapsed = startup_time(
+                path, "--storage", storage, "--load-workers", str(workers)
+            )
+            print(f"{storage + ', ' + str(workers) + ' load proc':>24} {elapsed:>8.2f}")
+
+    print()
+    print(f"{'import_wallets':>14} {'seconds':>8} {'wallets/s':>10} {'imported':>9}")
+    for name, server_args in (("sync", ()), ("async", ("--async",))):
+        reply, elapsed = import_time(path, args.batch_size, *server_args)
+        print(
+            f"{name:>14} {elapsed:>8.2f} {args.wallets / elapsed:>10.0f}"
+            f" {reply.imported:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
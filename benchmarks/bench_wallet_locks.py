@@ -0,0 +1,127 @@
+# Benchmark de contenção do servidor de carteiras
+# Vinicius Gomes - 2021421869
+#
+# Mede a vazão do servidor de carteiras (pares create_payment_order +
+# transfer por segundo) à medida que o número de threads do pool do servidor
+# cresce. Ao final de cada rodada, verifica também se nenhum identificador de
+# ordem de pagamento foi entregue duas vezes e se o dinheiro total das
+# carteiras foi conservado.
+#
+# Uso: python3 benchmarks/bench_wallet_locks.py [--workers 1,2,4,8,16]
+
+import argparse
+import multiprocessing
+import threading
+import time
+
+import common
+import grpc
+
+import wallet_pb2
+import wallet_pb2_grpc
+
+
+def client_process(port, wallets, threads, duration, results):
+    """
+    Processo cliente: dispara `threads` threads que repetem o par criação de
+    ordem de pagamento + transferência durante `duration` segundos.
+
+    Parâmetros:
+        port (int): porta do servidor de carteiras
+        wallets (list[str]): carteiras usadas por esse processo
+        threads (int): número de threads do processo
+        duration (float): duração da rodada em segundos
+        results (multiprocessing.Queue): fila onde são enviados os
+                                         identificadores de ordens criadas
+    """
+
+    channel = grpc.insecure_channel(f"localhost:{port}")
+    stub = wallet_pb2_grpc.WalletStub(channel)
+    deadline = time.perf_counter() + duration
+    order_ids = []
+
+    def worker(index):
+        source = wallets[index % len(wallets)]
+        destination = wallets[(index + 1) % len(wallets)]
+        while time.perf_counter() < deadline:
+            order = stub.create_payment_order(
+                wallet_pb2.CreatePaymentOrderRequest(wallet=source, value=1)
+            ).retval
+            stub.transfer(
+                wallet_pb2.TransferRequest(
+                    payment_order=order, recount=1, wallet=destination
+                )
+            )
+            order_ids.append(order)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    channel.close()
+    results.put(order_ids)
+
+
+def run_round(workers, processes, threads, duration, wallet_count):
+    """
+    Executa uma rodada do benchmark com um servidor de `workers` threads.
+
+    Retorna:
+        Uma tupla (vazão em operações por segundo, número de IDs repetidos,
+        diferença entre o dinheiro total final e o inicial).
+    """
+
+    wallets = common.make_wallets(wallet_count)
+    port = common.free_port()
+    server = common.start_wallet_server(port, wallets, "--workers", str(workers))
+
+    names = list(wallets)
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(
+            target=client_process,
+            args=(port, names[i::processes], threads, duration, results),
+        )
+        for i in range(processes)
+    ]
+    for client in clients:
+        client.start()
+    order_ids = []
+    for _ in clients:
+        order_ids.extend(results.get())
+    for client in clients:
+        client.join()
+
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        stub = wallet_pb2_grpc.WalletStub(channel)
+        total = sum(
+            stub.balance(wallet_pb2.BalanceRequest(wallet=name)).balance
+            for name in names
+        )
+    common.stop_wallet_server(server, port)
+
+    duplicates = len(order_ids) - len(set(order_ids))
+    return len(order_ids) / duration, duplicates, total - sum(wallets.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de contenção")
+    parser.add_argument("--workers", default="1,2,4,8,16")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wallets", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'ops/s':>10} {'dup ids':>8} {'drift':>6}")
+    for workers in map(int, args.workers.split(",")):
+        throughput, duplicates, drift = run_round(
+            workers, args.processes, args.threads, args.duration, args.wallets
+        )
+        print(f"{workers:>8} {throughput:>10.0f} {duplicates:>8} {drift:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Benchmark do servidor de carteiras com vários processos
+# Vinicius Gomes - 2021421869
+#
+# Mede a vazão do servidor de carteiras (pares create_payment_order +
+# transfer por segundo) com 1 ou mais processos atendendo a mesma porta
+# (--processes do servidor), com o estado em memória compartilhada. Cada
+# processo cliente abre a sua própria conexão, e o kernel distribui as
+# conexões entre os processos do servidor. Ao final de cada rodada, verifica
+# se nenhum identificador de ordem de pagamento foi entregue duas vezes e se
+# o dinheiro total das carteiras foi conservado, o que exercita os locks
+# compartilhados entre os processos.
+#
+# Os ganhos dependem do número de núcleos da máquina.
+#
+# Uso: python3 benchmarks/bench_wallet_processes.py [--server-processes 1,2,4]
+
+import argparse
+import multiprocessing
+
+import common
+import grpc
+from bench_wallet_locks import client_process
+
+import wallet_pb2
+import wallet_pb2_grpc
+
+
+def run_round(server_processes, processes, threads, duration, wallet_count):
+    """
+    Executa uma rodada do benchmark com um servidor de `server_processes`
+    processos.
+
+    Retorna:
+        Uma tupla (vazão em operações por segundo, número de IDs repetidos,
+        diferença entre o dinheiro total final e o inicial).
+    """
+
+    wallets = common.make_wallets(wallet_count)
+    port = common.free_port()
+    server = common.start_wallet_server(
+        port, wallets, "--processes", str(server_processes)
+    )
+
+    names = list(wallets)
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(
+            target=client_process,
+            args=(port, names[i::processes], threads, duration, results),
+        )
+        for i in range(processes)
+    ]
+    for client in clients:
+        client.start()
+    order_ids = []
+    for _ in clients:
+        order_ids.extend(results.get())
+    for client in clients:
+        client.join()
+
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        stub = wallet_pb2_grpc.WalletStub(channel)
+        total = sum(
+            stub.balance(wallet_pb2.BalanceRequest(wallet=name)).balance
+            for name in names
+        )
+    common.stop_wallet_server(server, port)
+
+    duplicates = len(order_ids) - len(set(order_ids))
+    return len(order_ids) / duration, duplicates, total - sum(wallets.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor com vários processos")
+    parser.add_argument("--server-processes", default="1,2,4")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wallets", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'servers':>8} {'ops/s':>10} {'dup ids':>8} {'drift':>6}")
+    for server_processes in map(int, args.server_processes.split(",")):
+        throughput, duplicates, drift = run_round(
+            server_processes, args.processes, args.threads, args.duration, args.wallets
+        )
+        print(f"{server_processes:>8} {throughput:>10.0f} {duplicates:>8} {drift:>6}")
+
+
+if __name__ == "__main__":
+    main()
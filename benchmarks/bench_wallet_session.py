@@ -0,0 +1,101 @@
+# Benchmark dos modos de execução do cliente de carteiras
+# Vinicius Gomes - 2021421869
+#
+# Gera um arquivo de comandos com blocos de "O" seguidos dos "X" que
+# transferem as ordens criadas (e um "S" ao fim de cada bloco)
+# e mede o tempo que o wallet-client.py leva para processá-lo no modo com uma
+# chamada por comando, no modo com lotes e no modo com stream (--stream).
+# A saída de cada modo é comparada com a do modo com uma chamada por comando.
+#
+# Uso: python3 benchmarks/bench_wallet_session.py [--lines 100000]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import common
+
+
+def make_commands(lines, wallet):
+    """
+    Gera os comandos do benchmark. Cada bloco cria `block` ordens de
+    pagamento e depois as transfere de volta para a própria carteira, o que
+    mantém a tabela de ordens de pagamento do servidor pequena.
+
+    Parâmetros:
+        lines (int): número aproximado de linhas
+        wallet (str): carteira do cliente
+    """
+
+    block = 50
+    commands = []
+    order = 1
+    while len(commands) < lines:
+        commands.extend(["O 1"] * block)
+        commands.extend(f"X {order + i} 1 {wallet}" for i in range(block))
+        commands.append("S")
+        order += block
+    return "\n".join(commands) + "\n"
+
+
+def run_client(port, wallet, commands_path, *args):
+    """
+    Executa o cliente de carteiras com a entrada redirecionada do arquivo de
+    comandos.
+
+    Retorna:
+        Uma tupla (tempo de execução em segundos, saída do cliente).
+    """
+
+    with open(commands_path) as commands, common.Timer() as timer:
+        output = subprocess.run(
+            [
+                sys.executable,
+                os.path.join(common.ROOT, "wallet-client.py"),
+                wallet,
+                f"localhost:{port}",
+                *args,
+            ],
+            stdin=commands,
+            capture_output=True,
+            check=True,
+        ).stdout
+    return timer.elapsed, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Modos do cliente de carteiras")
+    parser.add_argument("--lines", type=int, default=100_000)
+    args = parser.parse_args()
+
+    modes = {
+        "unary": [],
+        "batch": ["--batch-size", "1000"],
+        "stream": ["--stream"],
+    }
+
+    wallet = "wallet0"
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as commands:
+        commands.write(make_commands(args.lines, wallet))
+        commands.flush()
+
+        expected = None
+        print(f"{'mode':>8} {'seconds':>9} {'cmds/s':>9} {'output':>7}")
+        for mode, mode_args in modes.items():
+            port = common.free_port()
+            server = common.start_wallet_server(port, {wallet: 1_000_000})
+            elapsed, output = run_client(port, wallet, commands.name, *mode_args)
+            common.stop_wallet_server(server, port)
+
+            expected = expected if expected is not None else output
+            status = "same" if output == expected else "DIFF"
+            print(
+                f"{mode:>8} {elapsed:>9.2f} {args.lines / elapsed:>9.0f} "
+                f"{status:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
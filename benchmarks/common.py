@@ -0,0 +1,213 @@
+# Funções auxiliares compartilhadas pelos benchmarks
+# Vinicius Gomes - 2021421869
+
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# Diretório raiz do repositório, onde ficam os servidores, os clientes e os
+# stubs gerados pelo `make stubs`
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import grpc  # noqa: E402
+
+import wallet_pb2  # noqa: E402
+import wallet_pb2_grpc  # noqa: E402
+
+
+def load_script(name):
+    """
+    Carrega como módulo um dos programas do repositório. Os nomes dos
+    programas usam "-" (p.ex. wallet-server.py), então não podem ser
+    importados diretamente.
+
+    Parâmetros:
+        name (str): nome do arquivo, sem a extensão .py
+
+    Retorna:
+        O módulo carregado.
+    """
+
+    path = os.path.join(ROOT, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    """
+    Retorna uma porta TCP livre na máquina local.
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_wallets(count, value=1_000_000):
+    """
+    Gera um dicionário de carteiras no mesmo formato lido da entrada padrão
+    pelo servidor de carteiras.
+
+    Parâmetros:
+        count (int): número de carteiras
+        value (int): saldo inicial de cada carteira
+    """
+
+    return {f"wallet{i}": value for i in range(count)}
+
+
+def start_wallet_server(port, wallets, *args):
+    """
+    Inicia o servidor de carteiras em um processo separado, escrevendo as
+    carteiras na sua entrada padrão, e espera até que ele aceite conexões.
+
+    Parâmetros:
+        port (int): porta do servidor
+        wallets (dict[str, int]): carteiras iniciais
+        args (str): argumentos extras de linha de comando
+
+    Retorna:
+        O processo (subprocess.Popen) do servidor.
+    """
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "wallet-server.py"), str(port), *args],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        cwd=ROOT,
+    )
+    process.stdin.write(
+        "".join(f"{wallet} {value}\n" for wallet, value in wallets.items()).encode()
+    )
+    process.stdin.close()
+    wait_for_server(f"localhost:{port}")
+    return process
+
+
+def start_wallet_replica(port, primary_port, *args):
+    """
+    Inicia uma réplica de leitura do servidor de carteiras em um processo
+    separado e espera até que ela aceite conexões (o estado do servidor
+    principal pode ainda não ter chegado).
+
+    Parâmetros:
+        port (int): porta da réplica
+        primary_port (int): porta do servidor principal
+        args (str): argumentos extras de linha de comando
+
+    Retorna:
+        O processo (subprocess.Popen) da réplica.
+    """
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "wallet-server.py"),
+            str(port),
+            "--replica-of",
+            f"localhost:{primary_port}",
+            *args,
+        ],
+        stdout=subprocess.DEVNULL,
+        cwd=ROOT,
+    )
+    wait_for_server(f"localhost:{port}")
+    return process
+
+
+def start_store_server(port, price, seller_wallet, wallet_port, *args):
+    """
+    Inicia um servidor de loja em um processo separado e espera até que ele
+    aceite conexões.
+
+    Parâmetros:
+        port (int): porta do servidor da loja
+        price (int): preço do produto
+        seller_wallet (str): carteira do vendedor
+        wallet_port (int): porta do servidor de carteiras
+        args (str): argumentos extras de linha de comando
+
+    Retorna:
+        O processo (subprocess.Popen) do servidor.
+    """
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "store-server.py"),
+            str(price),
+            str(port),
+            seller_wallet,
+            f"localhost:{wallet_port}",
+            *args,
+        ],
+        stdout=subprocess.DEVNULL,
+        cwd=ROOT,
+    )
+    wait_for_server(f"localhost:{port}")
+    return process
+
+
+def wait_for_server(target, timeout=30):
+    """
+    Espera até que o servidor no endereço informado aceite conexões.
+
+    Parâmetros:
+        target (str): endereço do servidor
+        timeout (float): tempo máximo de espera em segundos
+    """
+
+    with grpc.insecure_channel(target) as channel:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+
+
+def stop_wallet_server(process, port):
+    """
+    Termina o servidor de carteiras usando o procedimento de fim de execução
+    e espera o processo acabar.
+
+    Parâmetros:
+        process (subprocess.Popen): processo do servidor
+        port (int): porta do servidor
+    """
+
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        wallet_pb2_grpc.WalletStub(channel).end_execution(
+            wallet_pb2.EndExecutionRequest()
+        )
+    process.wait(timeout=30)
+
+
+def percentile(samples, fraction):
+    """
+    Retorna o percentil informado de uma lista de amostras.
+
+    Parâmetros:
+        samples (list[float]): amostras (não precisam estar ordenadas)
+        fraction (float): percentil desejado, entre 0 e 1
+    """
+
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+class Timer:
+    """
+    Gerenciador de contexto que mede o tempo de execução do bloco.
+    """
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
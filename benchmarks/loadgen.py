@@ -0,0 +1,403 @@
+# Gerador de carga de ponta a ponta para o par loja/carteiras
+# Vinicius Gomes - 2021421869
+#
+# Inicia localmente um servidor de carteiras (com as carteiras escritas na
+# entrada padrão, como o __main__ do servidor as lê) e N servidores de loja,
+# e dispara contra eles:
+#   - M compradores, cada um repetindo o fluxo de `buy()` do store-client.py
+#     (create_payment_order no servidor de carteiras seguido de sell na loja)
+#     ou, com --atomic, o fluxo de `buy_atomic()` (buy na loja);
+#   - K clientes de carteira, cada um executando uma mistura de comandos O
+#     (create_payment_order) e X (transfer de uma das suas ordens pendentes).
+#
+# Em malha fechada (--loop closed), cada cliente espera a resposta antes de
+# começar a próxima operação. Em malha aberta (--loop open), as operações
+# chegam segundo um processo de Poisson com a taxa total informada,
+# independentemente das respostas, e a latência é medida a partir do instante
+# programado da chegada (um servidor lento não reduz a carga oferecida nem
+# esconde a fila das medições).
+#
+# Exibe a vazão e as latências p50/p99/p999 de cada RPC e de cada fluxo e
+# grava os resultados, junto das estatísticas dos próprios servidores
+# (procedimento `stats`), em JSON. Com --baseline, compara o resultado com
+# uma execução anterior e termina com código 1 caso haja regressão.
+#
+# Uso: python3 benchmarks/loadgen.py [--stores 2] [--buyers 16]
+#          [--wallet-clients 4] [--loop closed|open] [--rate 2000]
+#          [--output resultado.json] [--baseline anterior.json]
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+import grpc
+from google.protobuf.json_format import MessageToDict
+
+import common  # ajusta também o sys.path para a raiz do repositório
+
+import metrics
+import store_pb2
+import store_pb2_grpc
+import wallet_pb2
+import wallet_pb2_grpc
+
+
+class Recorder:
+    """
+    Acumula, por nome de RPC ou de fluxo, o histograma de latências e a
+    contagem dos códigos de retorno. Todo o gerador executa em um único event
+    loop, então não há acesso concorrente.
+    """
+
+    def __init__(self):
+        self.histograms = defaultdict(metrics.Histogram)
+        self.codes = defaultdict(Counter)
+        # As medições só começam depois do aquecimento
+        self.active = False
+
+    def record(self, name, started, code):
+        if not self.active:
+            return
+        elapsed = int((time.perf_counter() - started) * 1e6)
+        self.histograms[name].record(elapsed)
+        self.codes[name][str(code)] += 1
+
+    def results(self, duration):
+        results = {}
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            results[name] = {
+                "count": histogram.count,
+                "throughput": histogram.count / duration,
+                "codes": dict(self.codes[name]),
+                "p50_ms": histogram.quantile(0.5) / 1000,
+                "p99_ms": histogram.quantile(0.99) / 1000,
+                "p999_ms": histogram.quantile(0.999) / 1000,
+                "mean_ms": histogram.mean() / 1000,
+                "max_ms": histogram.max / 1000,
+            }
+        return results
+
+
+async def call(recorder, name, rpc, request, timeout=None):
+    """
+    Faz uma chamada, com o prazo `timeout` em segundos (None: sem prazo), e
+    registra a sua latência e o seu código de retorno.
+
+    Retorna:
+        A resposta, ou None caso a chamada tenha falhado.
+    """
+
+    started = time.perf_counter()
+    try:
+        reply = await rpc(request, timeout=timeout)
+    except grpc.RpcError as error:
+        recorder.record(name, started, error.code().name)
+        return None
+    recorder.record(name, started, metrics.reply_codes(reply)[0])
+    return reply
+
+
+class Workload:
+    def __init__(self, args, wallet_stub, store_stubs, price):
+        self.args = args
+        self.wallet_stub = wallet_stub
+        self.store_stubs = store_stubs
+        self.price = price
+        self.recorder = Recorder()
+        # Ordens de pagamento pendentes de cada cliente de carteira
+        self.pending = defaultdict(list)
+        self.rng = random.Random(args.seed)
+
+    async def buy(self, buyer, started):
+        # Mesmo fluxo de `buy` (ou de `buy_atomic`) do store-client.py
+        store_stub = self.store_stubs[buyer % len(self.store_stubs)]
+        wallet = f"wallet{buyer}"
+
+        if self.args.atomic:
+            reply = await call(
+                self.recorder,
+                "buy",
+                store_stub.buy,
+                store_pb2.BuyRequest(wallet=wallet),
+                self.args.deadline,
+            )
+            code = "error" if reply is None else metrics.reply_codes(reply)[0]
+            self.recorder.record("flow.buy_atomic", started, code)
+            return
+
+        reply = await call(
+            self.recorder,
+            "create_payment_order",
+            self.wallet_stub.create_payment_order,
+            wallet_pb2.CreatePaymentOrderRequest(wallet=wallet, value=self.price),
+            self.args.deadline,
+        )
+        code = "error" if reply is None else min(reply.retval, 0)
+        if reply is not None and reply.retval not in [-1, -2, -3]:
+            sell = await call(
+                self.recorder,
+                "sell",
+                store_stub.sell,
+                store_pb2.SellRequest(payment_order=reply.retval),
+                self.args.deadline,
+            )
+            code = "error" if sell is None else sell.status
+        self.recorder.record("flow.buy", started, code)
+
+    async def wallet_operation(self, client, started):
+        # Comando O (cria uma ordem) ou X (transfere a ordem pendente mais
+        # antiga do cliente para outra carteira)
+        wallet = f"wallet{self.args.buyers + client}"
+        pending = self.pending[client]
+
+        if pending and self.rng.random() >= self.args.create_ratio:
+            payment_order = pending.pop(0)
+            destination = f"wallet{self.rng.randrange(self.args.wallets)}"
+            reply = await call(
+                self.recorder,
+                "transfer",
+                self.wallet_stub.transfer,
+                wallet_pb2.TransferRequest(
+                    payment_order=payment_order, recount=1, wallet=destination
+                ),
+                self.args.deadline,
+            )
+            code = "error" if reply is None else reply.status
+            self.recorder.record("flow.wallet_x", started, code)
+            return
+
+        reply = await call(
+            self.recorder,
+            "create_payment_order",
+            self.wallet_stub.create_payment_order,
+            wallet_pb2.CreatePaymentOrderRequest(wallet=wallet, value=1),
+            self.args.deadline,
+        )
+        if reply is not None and reply.retval > 0:
+            pending.append(reply.retval)
+        code = "error" if reply is None else min(reply.retval, 0)
+        self.recorder.record("flow.wallet_o", started, code)
+
+    def clients(self):
+        # Lista de (operação, índice do cliente) de todos os clientes
+        return [(self.buy, i) for i in range(self.args.buyers)] + [
+            (self.wallet_operation, i) for i in range(self.args.wallet_clients)
+        ]
+
+    async def closed_loop(self, deadline):
+        async def client(operation, index):
+            while time.perf_counter() < deadline:
+                await operation(index, time.perf_counter())
+
+        await asyncio.gather(*(client(*c) for c in self.clients()))
+
+    async def open_loop(self, deadline):
+        # Cada cliente recebe uma fração da taxa total e gera chegadas de
+        # Poisson; cada chegada vira uma tarefa própria, sem esperar as
+        # anteriores
+        clients = self.clients()
+        rate = self.args.rate / len(clients)
+        tasks = set()
+
+        async def arrivals(operation, index):
+            scheduled = time.perf_counter()
+            while True:
+                scheduled += self.rng.expovariate(rate)
+                if scheduled >= deadline:
+                    return
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                task = asyncio.create_task(operation(index, scheduled))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*(arrivals(*c) for c in clients))
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def run(self):
+        start = time.perf_counter()
+        warmup_end = start + self.args.warmup
+        deadline = warmup_end + self.args.duration
+
+        async def start_measuring():
+            await asyncio.sleep(self.args.warmup)
+            self.recorder.active = True
+
+        measuring = asyncio.create_task(start_measuring())
+        if self.args.loop == "open":
+            await self.open_loop(deadline)
+        else:
+            await self.closed_loop(deadline)
+        await measuring
+
+        # Em malha aberta, as respostas das últimas chegadas podem terminar
+        # depois do prazo
+        elapsed = max(time.perf_counter(), deadline) - warmup_end
+        return self.recorder.results(elapsed)
+
+
+async def server_stats(wallet_port, store_ports):
+    # Estatísticas de cada servidor, lidas pelo procedimento `stats`
+    stats = {}
+    async with grpc.aio.insecure_channel(f"localhost:{wallet_port}") as channel:
+        reply = await wallet_pb2_grpc.WalletStub(channel).stats(
+            wallet_pb2.StatsRequest()
+        )
+        stats["wallet"] = MessageToDict(reply)
+    for index, port in enumerate(store_ports):
+        async with grpc.aio.insecure_channel(f"localhost:{port}") as channel:
+            reply = await store_pb2_grpc.StoreStub(channel).stats(
+                store_pb2.StatsRequest()
+            )
+            stats[f"store{index}"] = MessageToDict(reply)
+    return stats
+
+
+async def drive(args, wallet_port, store_ports):
+    async with grpc.aio.insecure_channel(f"localhost:{wallet_port}") as wallet_channel:
+        store_channels = [
+            grpc.aio.insecure_channel(f"localhost:{port}") for port in store_ports
+        ]
+        store_stubs = [store_pb2_grpc.StoreStub(channel) for channel in store_channels]
+
+        price_reply = await store_stubs[0].read_price(store_pb2.ReadPriceRequest())
+        workload = Workload(
+            args,
+            wallet_pb2_grpc.WalletStub(wallet_channel),
+            store_stubs,
+            price_reply.price,
+        )
+        results = await workload.run()
+
+        for channel in store_channels:
+            await channel.close()
+
+    return results, await server_stats(wallet_port, store_ports)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compara os resultados com os de uma execução anterior.
+
+    Retorna:
+        A lista de regressões encontradas (textos), vazia se não houver.
+    """
+
+    regressions = []
+    for name, before in baseline["results"].items():
+        after = results.get(name)
+        if after is None:
+            continue
+        if after["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {before['throughput']:.0f} -> "
+                f"{after['throughput']:.0f}/s"
+            )
+        for key in ["p50_ms", "p99_ms", "p999_ms"]:
+            if after[key] > before[key] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {key} {before[key]:.2f} -> {after[key]:.2f}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gerador de carga loja/carteiras")
+    parser.add_argument("--stores", type=int, default=2)
+    parser.add_argument("--buyers", type=int, default=16)
+    parser.add_argument("--wallet-clients", type=int, default=4)
+    # Número total de carteiras (as primeiras são dos compradores e dos
+    # clientes de carteira)
+    parser.add_argument("--wallets", type=int, default=1000)
+    parser.add_argument("--price", type=int, default=10)
+    # Fração dos comandos dos clientes de carteira que criam uma ordem (O)
+    parser.add_argument("--create-ratio", type=float, default=0.5)
+    parser.add_argument("--atomic", action="store_true")
+    parser.add_argument("--loop", choices=["closed", "open"], default="closed")
+    # Taxa total de operações por segundo na malha aberta
+    parser.add_argument("--rate", type=float, default=2000.0)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    # Prazo, em segundos, de cada chamada (as chamadas que não terminam
+    # dentro dele aparecem com o código DEADLINE_EXCEEDED)
+    parser.add_argument("--deadline", type=float)
+    # Argumentos extras dos servidores, p.ex. --wallet-args="--async"
+    parser.add_argument("--wallet-args", default="")
+    parser.add_argument("--store-args", default="")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    # Variação relativa tolerada na comparação com --baseline
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    wallets = common.make_wallets(max(args.wallets, args.buyers + args.wallet_clients))
+    for store in range(args.stores):
+        wallets[f"seller{store}"] = 0
+    wallet_port = common.free_port()
+    store_ports = [common.free_port() for _ in range(args.stores)]
+
+    wallet_server = common.start_wallet_server(
+        wallet_port, wallets, *args.wallet_args.split()
+    )
+    store_servers = []
+    try:
+        for store, port in enumerate(store_ports):
+            store_servers.append(
+                common.start_store_server(
+                    port,
+                    args.price,
+                    f"seller{store}",
+                    wallet_port,
+                    *args.store_args.split(),
+                )
+            )
+        results, stats = asyncio.run(drive(args, wallet_port, store_ports))
+    finally:
+        # O end_execution de uma loja também termina o servidor de carteiras,
+        # então as lojas são apenas terminadas e o servidor de carteiras é
+        # encerrado pelo próprio procedimento
+        for process in store_servers:
+            process.terminate()
+            process.wait()
+        common.stop_wallet_server(wallet_server, wallet_port)
+
+    print(
+        f"{'name':>22} {'count':>8} {'ops/s':>9} {'p50 ms':>8} "
+        f"{'p99 ms':>8} {'p999 ms':>8}  codes"
+    )
+    for name, result in results.items():
+        codes = " ".join(f"{code}:{n}" for code, n in sorted(result["codes"].items()))
+        print(
+            f"{name:>22} {result['count']:>8} {result['throughput']:>9.0f} "
+            f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+            f"{result['p999_ms']:>8.2f}  {codes}"
+        )
+
+    report = {
+        "config": vars(args),
+        "results": results,
+        "server_stats": stats,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print("regression:", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
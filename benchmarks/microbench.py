@@ -0,0 +1,268 @@
+# Micro-benchmarks dos procedimentos dos servidores, sem a rede
+# Vinicius Gomes - 2021421869
+#
+# Chama diretamente os métodos Wallet.balance, Wallet.create_payment_order,
+# Wallet.transfer e Store.sell com mensagens de requisição montadas antes da
+# medição, isolando o custo dos procedimentos do custo do gRPC. A loja usa um
+# stub de carteiras falso, que encaminha as chamadas para o servicer de
+# carteiras do mesmo processo.
+#
+# Cada procedimento é medido com 1 ou mais threads (contenção nos locks) e
+# para vários números de carteiras e de ordens de pagamento pendentes. O
+# resultado de cada medição (a melhor de --repeat repetições, em
+# nanossegundos por operação) é comparado com o arquivo de referência
+# informado em --baseline: uma medição mais lenta que a referência além de
+# --threshold termina a execução com código 1. Caso o arquivo não exista (ou
+# com --update), os resultados são gravados como a nova referência.
+#
+# Uso: python3 benchmarks/microbench.py [--baseline microbench.json]
+#          [--threshold 0.15] [--wallets 1000,100000] [--orders 0,100000]
+#          [--threads 1,4]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import common
+
+import store_pb2
+import wallet_pb2
+from order_store import CompactOrderStore, DictOrderStore
+
+wallet_server = common.load_script("wallet-server")
+store_server = common.load_script("store-server")
+
+PRICE = 10
+CASES = ["balance", "create_payment_order", "transfer", "sell"]
+
+# Resposta de sucesso de cada procedimento medido
+SUCCESS = {
+    "balance": lambda reply: reply.balance >= 0,
+    "create_payment_order": lambda reply: reply.retval > 0,
+    "transfer": lambda reply: reply.status == 0,
+    "sell": lambda reply: reply.status == 0,
+}
+
+
+class FakeWalletStub:
+    """
+    Stub de carteiras usado pela loja que chama os procedimentos do servicer
+    de carteiras diretamente, no mesmo processo.
+    """
+
+    def __init__(self, wallet):
+        self._wallet = wallet
+
+    # A loja passa o prazo das chamadas (timeout) e pode passar outras
+    # opções do gRPC, que são ignoradas
+
+    def transfer(self, request, timeout=None, **kwargs):
+        return self._wallet.transfer(request, None)
+
+    def batch_transfer(self, request, timeout=None, **kwargs):
+        return self._wallet.batch_transfer(request, None)
+
+    def balance(self, request, timeout=None, **kwargs):
+        return self._wallet.balance(request, None)
+
+    def purchase(self, request, timeout=None, **kwargs):
+        return self._wallet.purchase(request, None)
+
+
+def build(wallet_count, order_count, order_store):
+    """
+    Cria os servicers de carteiras e da loja, com `order_count` ordens de
+    pagamento pendentes.
+
+    Retorna:
+        Uma tupla (servicer de carteiras, servicer da loja, nomes das
+        carteiras).
+    """
+
+    wallets = common.make_wallets(wallet_count)
+    wallets["seller"] = 0
+    names = [f"wallet{i}" for i in range(wallet_count)]
+
+    # Os construtores exibem o estado inicial e a configuração
+    with contextlib.redirect_stdout(io.StringIO()):
+        wallet = wallet_server.Wallet(
+            threading.Event(), wallets, order_store=order_store
+        )
+        store = store_server.Store(threading.Event(), ("localhost", 0), "seller", PRICE)
+    store.wallet_channel.close()
+    store.wallet_stub = FakeWalletStub(wallet)
+
+    for i in range(order_count):
+        wallet.create_payment_order(
+            wallet_pb2.CreatePaymentOrderRequest(
+                wallet=names[i % wallet_count], value=1
+            ),
+            None,
+        )
+    return wallet, store, names
+
+
+def prepare(case, wallet, names, operations, rng):
+    """
+    Monta as requisições de uma medição. As ordens de pagamento transferidas
+    por `transfer` e `sell` são criadas aqui, fora da medição.
+
+    Retorna:
+        Uma tupla (procedimento, lista de requisições).
+    """
+
+    def create_order(value):
+        return wallet.create_payment_order(
+            wallet_pb2.CreatePaymentOrderRequest(wallet=rng.choice(names), value=value),
+            None,
+        ).retval
+
+    if case == "balance":
+        return wallet.balance, [
+            wallet_pb2.BalanceRequest(wallet=rng.choice(names))
+            for _ in range(operations)
+        ]
+    if case == "create_payment_order":
+        return wallet.create_payment_order, [
+            wallet_pb2.CreatePaymentOrderRequest(wallet=rng.choice(names), value=1)
+            for _ in range(operations)
+        ]
+    if case == "transfer":
+        return wallet.transfer, [
+            wallet_pb2.TransferRequest(
+                payment_order=create_order(1), recount=1, wallet=rng.choice(names)
+            )
+            for _ in range(operations)
+        ]
+    return None, [
+        store_pb2.SellRequest(payment_order=create_order(PRICE))
+        for _ in range(operations)
+    ]
+
+
+def warm_up(case, function, requests):
+    """
+    Executa as requisições uma vez, sem medir, aquecendo os caches, e
+    verifica que todas tiveram sucesso: uma medição de chamadas que falham
+    (p.ex. por um erro no stub falso) não pode virar a referência.
+    """
+
+    for request in requests:
+        reply = function(request, None)
+        if not SUCCESS[case](reply):
+            sys.exit(f"{case}: resposta sem sucesso: {reply}".replace("\n", " "))
+
+
+def measure(function, requests, threads):
+    """
+    Executa as requisições divididas entre `threads` threads.
+
+    Retorna:
+        O tempo total dividido pelo número de requisições, em nanossegundos.
+    """
+
+    chunks = [requests[i::threads] for i in range(threads)]
+
+    def worker(chunk):
+        for request in chunk:
+            function(request, None)
+
+    pool = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return (time.perf_counter() - start) / len(requests) * 1e9
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    order_store = CompactOrderStore if args.order_store == "compact" else DictOrderStore
+    results = {}
+
+    for wallet_count in map(int, args.wallets.split(",")):
+        for order_count in map(int, args.orders.split(",")):
+            wallet, store, names = build(wallet_count, order_count, order_store)
+            for case in CASES:
+                for threads in map(int, args.threads.split(",")):
+                    # A primeira execução aquece os caches, verifica as
+                    # respostas e não é medida
+                    best = None
+                    for repetition in range(args.repeat + 1):
+                        function, requests = prepare(
+                            case, wallet, names, args.operations, rng
+                        )
+                        function = function or store.sell
+                        if repetition == 0:
+                            warm_up(case, function, requests)
+                            continue
+                        elapsed = measure(function, requests, threads)
+                        best = elapsed if best is None else min(best, elapsed)
+                    key = f"{case}/t{threads}/w{wallet_count}/o{order_count}"
+                    results[key] = best
+                    print(f"{key:>42} {best:>10.0f}", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compara os resultados com a referência.
+
+    Retorna:
+        A lista de regressões (textos), vazia se não houver.
+    """
+
+    regressions = []
+    for key, before in baseline.items():
+        after = results.get(key)
+        if after is not None and after > before * (1 + threshold):
+            regressions.append(
+                f"{key}: {before:.0f} -> {after:.0f} ns/op "
+                f"(+{(after / before - 1) * 100:.0f}%)"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="micro-benchmarks dos servicers")
+    parser.add_argument("--wallets", default="1000,100000")
+    parser.add_argument("--orders", default="0,100000")
+    parser.add_argument("--threads", default="1,4")
+    parser.add_argument("--operations", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--order-store", choices=["dict", "compact"], default="dict")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline")
+    # Aumento relativo tolerado em relação à referência
+    parser.add_argument("--threshold", type=float, default=0.15)
+    parser.add_argument("--update", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'benchmark':>42} {'ns/op':>10}")
+    results = run(args)
+
+    if args.baseline is None:
+        return
+    if args.update or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as baseline:
+            json.dump(results, baseline, indent=2)
+        print("baseline saved to", args.baseline)
+        return
+
+    with open(args.baseline) as baseline:
+        regressions = compare(results, json.load(baseline), args.threshold)
+    for regression in regressions:
+        print("regression:", regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
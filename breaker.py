@@ -0,0 +1,285 @@
+# Disjuntor (circuit breaker) das chamadas a um servidor remoto
+# Vinicius Gomes - 2021421869
+
+import collections
+import contextlib
+import threading
+import time
+
+import grpc
+
+# Estados do disjuntor
+CLOSED, OPEN, HALF_OPEN = range(3)
+STATES = {CLOSED: "closed", OPEN: "open", HALF_OPEN: "half_open"}
+
+# Códigos do gRPC que contam como falha do servidor remoto; os demais (p.ex.
+# CANCELLED, quando o próprio cliente desiste, ou os erros da requisição)
+# não dizem nada sobre a saúde dele
+FAILURES = (
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.UNKNOWN,
+)
+
+# Número de intervalos em que a janela de observação é dividida
+_BUCKETS = 10
+
+
+class CircuitOpenError(grpc.RpcError):
+    """
+    Erro de uma chamada recusada pelo disjuntor aberto, sem chegar ao
+    servidor remoto. Tem a interface de um erro do gRPC (código UNAVAILABLE),
+    então é tratado pelo mesmo código que trata as falhas de comunicação.
+    """
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+    def details(self):
+        return "disjuntor aberto"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        window: float = 10.0,
+        min_calls: int = 20,
+        error_rate: float = 0.5,
+        slow_call: float | None = None,
+        slow_rate: float = 0.5,
+        open_for: float = 5.0,
+        probes: int = 1,
+    ) -> None:
+        """
+        Disjuntor das chamadas a um servidor remoto. Fechado, deixa passar
+        todas as chamadas e observa as dos últimos `window` segundos: quando
+        houve pelo menos `min_calls` chamadas e a fração das que falharam
+        (códigos em FAILURES) chega a `error_rate`, ou a fração das que
+        demoraram `slow_call` segundos ou mais chega a `slow_rate`, o
+        disjuntor abre.
+
+        Aberto, recusa todas as chamadas imediatamente com CircuitOpenError,
+        sem esperar o servidor remoto responder ou o prazo acabar. Depois de
+        `open_for` segundos, fica meio aberto: deixa passar até `probes`
+        chamadas de teste ao mesmo tempo e recusa as demais. Se `probes`
+        chamadas de teste tiverem sucesso (sem falhar nem demorar), o
+        disjuntor fecha com a janela vazia; se uma delas falhar ou demorar,
+        abre de novo.
+
+        A janela é dividida em intervalos, e os totais são atualizados a
+        cada chamada, então o custo de `allow` e de `record` não depende do
+        número de chamadas. Os métodos podem ser chamados de várias threads.
+
+        O atributo `on_change` pode receber uma função chamada a cada
+        mudança de estado, com o estado anterior e o novo (é chamada com o
+        lock do disjuntor adquirido, então não deve bloquear).
+
+        Parâmetros:
+            window (float): duração, em segundos, da janela de observação
+            min_calls (int): número mínimo de chamadas na janela para que o
+                             disjuntor possa abrir
+            error_rate (float): fração de falhas que abre o disjuntor
+            slow_call (float | None): duração, em segundos, a partir da qual
+                                      uma chamada é considerada lenta (None:
+                                      a latência não abre o disjuntor)
+            slow_rate (float): fração de chamadas lentas que abre o disjuntor
+            open_for (float): tempo, em segundos, que o disjuntor fica aberto
+                              antes das chamadas de teste
+            probes (int): número de chamadas de teste no estado meio aberto
+        """
+
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.probes = probes
+        self.on_change = None
+
+        self.state = CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = 0
+        self._passed = 0
+        # Geração do estado atual, incrementada a cada mudança de estado
+        self._generation = 1
+
+        # Intervalos da janela: [início, chamadas, falhas, lentas], do mais
+        # antigo para o mais recente, e os totais de todos eles
+        self._width = window / _BUCKETS
+        self._buckets = collections.deque()
+        self._calls = self._failures = self._slow = 0
+        self._lock = threading.Lock()
+
+    def counters(self) -> dict[str, int]:
+        return {
+            "breaker_state": self.state,
+            "breaker_opened": self.opened,
+            "breaker_rejected": self.rejected,
+        }
+
+    def _change(self, state, now):
+        previous, self.state = self.state, state
+        self._generation += 1
+        if state == OPEN:
+            self.opened += 1
+            self._opened_at = now
+        elif state == HALF_OPEN:
+            self._probing = self._passed = 0
+        else:
+            self._buckets.clear()
+            self._calls = self._failures = self._slow = 0
+        if self.on_change is not None:
+            self.on_change(previous, state)
+
+    def allow(self) -> int:
+        """
+        Decide se uma chamada pode ser feita. Toda chamada permitida deve
+        ter o resultado informado depois com `record`, junto do valor
+        retornado aqui.
+
+        Retorna:
+            A geração do estado em que a chamada foi permitida (um inteiro
+            positivo), ou 0 caso ela deva ser recusada.
+        """
+
+        with self._lock:
+            if self.state == CLOSED:
+                return self._generation
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now < self._opened_at + self.open_for:
+                    self.rejected += 1
+                    return 0
+                self._change(HALF_OPEN, now)
+            if self._probing >= self.probes:
+                self.rejected += 1
+                return 0
+            self._probing += 1
+            return self._generation
+
+    def record(self, generation: int, failed: bool, elapsed: float) -> None:
+        """
+        Informa o resultado de uma chamada permitida por `allow`.
+
+        Parâmetros:
+            generation (int): valor retornado por `allow` para a chamada
+            failed (bool): a chamada falhou por causa do servidor remoto
+            elapsed (float): duração da chamada, em segundos
+        """
+
+        slow = self.slow_call is not None and elapsed >= self.slow_call
+        with self._lock:
+            now = time.monotonic()
+            if generation != self._generation:
+                # Chamada permitida antes da última mudança de estado (p.ex.
+                # uma chamada lenta iniciada com o disjuntor fechado que
+                # termina com ele meio aberto): o resultado não conta como
+                # chamada de teste nem entra na janela atual
+                return
+            if self.state == HALF_OPEN:
+                self._probing -= 1
+                if failed or slow:
+                    self._change(OPEN, now)
+                else:
+                    self._passed += 1
+                    if self._passed >= self.probes:
+                        self._change(CLOSED, now)
+                return
+
+            buckets = self._buckets
+            while buckets and buckets[0][0] <= now - self._width * _BUCKETS:
+                _, calls, failures, slows = buckets.popleft()
+                self._calls -= calls
+                self._failures -= failures
+                self._slow -= slows
+            if not buckets or buckets[-1][0] <= now - self._width:
+                buckets.append([now, 0, 0, 0])
+            bucket = buckets[-1]
+            bucket[1] += 1
+            bucket[2] += failed
+            bucket[3] += slow
+            self._calls += 1
+            self._failures += failed
+            self._slow += slow
+
+            if self._calls < self.min_calls:
+                return
+            if self._failures >= self.error_rate * self._calls or (
+                self.slow_call is not None
+                and self._slow >= self.slow_rate * self._calls
+            ):
+                self._change(OPEN, now)
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        Context manager que envolve uma chamada ao servidor remoto: recusa a
+        chamada com CircuitOpenError caso o disjuntor não a permita e, caso
+        contrário, registra a sua duração e se ela falhou (um grpc.RpcError
+        com um dos códigos de FAILURES).
+        """
+
+        generation = self.allow()
+        if not generation:
+            raise CircuitOpenError()
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except grpc.RpcError as error:
+            failed = error.code() in FAILURES
+            raise
+        finally:
+            self.record(generation, failed, time.perf_counter() - started)
+
+
+def add_arguments(parser) -> None:
+    """
+    Acrescenta a um argparse.ArgumentParser as opções do disjuntor, lidas
+    depois por `from_args`.
+
+    Parâmetros:
+        parser (argparse.ArgumentParser): parser da linha de comando
+    """
+
+    # Ativa o disjuntor das chamadas ao servidor de carteiras
+    parser.add_argument("--breaker", action="store_true")
+    # Janela de observação (segundos) e número mínimo de chamadas nela
+    parser.add_argument("--breaker-window", type=float, default=10.0)
+    parser.add_argument("--breaker-min-calls", type=int, default=20)
+    # Fração de falhas e de chamadas lentas (com a duração em segundos a
+    # partir da qual uma chamada é lenta) que abrem o disjuntor
+    parser.add_argument("--breaker-error-rate", type=float, default=0.5)
+    parser.add_argument("--breaker-slow-call", type=float)
+    parser.add_argument("--breaker-slow-rate", type=float, default=0.5)
+    # Tempo aberto, em segundos, e número de chamadas de teste
+    parser.add_argument("--breaker-open-for", type=float, default=5.0)
+    parser.add_argument("--breaker-probes", type=int, default=1)
+
+
+def from_args(args) -> CircuitBreaker | None:
+    """
+    Cria o disjuntor definido pelas opções de `add_arguments`.
+
+    Parâmetros:
+        args (argparse.Namespace): opções lidas da linha de comando
+
+    Retorna:
+        O disjuntor, ou None caso ele não tenha sido ativado.
+    """
+
+    if not args.breaker:
+        return None
+    return CircuitBreaker(
+        args.breaker_window,
+        args.breaker_min_calls,
+        args.breaker_error_rate,
+        args.breaker_slow_call,
+        args.breaker_slow_rate,
+        args.breaker_open_for,
+        args.breaker_probes,
+    )
@@ -0,0 +1,200 @@
+# Registro das alterações de saldo para assinantes externos (change data
+# capture)
+# Vinicius Gomes - 2021421869
+
+import collections
+import itertools
+import threading
+import time
+import uuid
+
+import wallet_pb2
+
+# Número máximo de eventos em cada mensagem enviada a um assinante
+EVENTS_PER_MESSAGE = 500
+
+# Intervalo, em segundos, em que um assinante sem eventos novos confere se
+# a chamada continua ativa
+POLL_INTERVAL = 0.1
+
+
+class EventsLost(Exception):
+    """
+    Os eventos seguintes ao número de sequência pedido por um assinante já
+    foram descartados (ou são de outra execução do servidor), então o
+    stream não pode continuar de onde parou.
+    """
+
+
+class ChangeFeed:
+    def __init__(self, capacity: int = 65536) -> None:
+        """
+        Registro em memória dos eventos que alteram os saldos do servidor de
+        carteiras (criação, transferência e expiração de ordens de pagamento,
+        transferências entre shards e carteiras importadas), lido pelos
+        assinantes do procedimento `watch_mutations`.
+
+        Cada evento recebe um número de sequência crescente, na ordem em que
+        as alterações aconteceram, e traz o saldo da carteira alterada logo
+        depois dela, então um assinante não precisa consultar `balance`.
+        Apenas os `capacity` eventos mais recentes são mantidos: um
+        assinante pode retomar o stream a partir do último evento recebido
+        enquanto os seguintes ainda estiverem guardados.
+
+        A publicação de um evento nunca espera pelos assinantes: cada um lê
+        o registro no seu próprio ritmo, limitado pelo controle de fluxo do
+        HTTP/2, e um assinante lento demais perde o stream (EventsLost) em
+        vez de atrasar as operações.
+
+        Parâmetros:
+            capacity (int): número de eventos mantidos
+        """
+
+        # Identifica este registro: os números de sequência de outra execução
+        # do servidor não correspondem aos deste
+        self.id = uuid.uuid4().hex
+        self._cond = threading.Condition()
+        # Tuplas (sequência, instante, tipo, ordem, carteira, origem, valor,
+        # saldo)
+        self._events = collections.deque(maxlen=capacity)
+        self.sequence = 0
+
+    def publish(
+        self,
+        kind: str,
+        wallet: str,
+        value: int,
+        balance: int,
+        payment_order: int = 0,
+        source: str = "",
+    ) -> None:
+        """
+        Acrescenta um evento ao registro. Deve ser chamada com o lock das
+        ordens de pagamento adquirido (todas as alterações o adquirem), para
+        que a ordem das sequências seja a ordem em que as alterações
+        aconteceram.
+
+        Parâmetros:
+            kind (str): tipo do evento
+            wallet (str): carteira alterada ("" quando nenhuma foi)
+            value (int): valor da alteração
+            balance (int): saldo da carteira depois da alteração
+            payment_order (int): identificador (externo) da ordem de
+                                 pagamento, quando há uma
+            source (str): carteira de origem da ordem, nas transferências
+        """
+
+        with self._cond:
+            self.sequence += 1
+            self._events.append(
+                (
+                    self.sequence,
+                    time.time(),
+                    kind,
+                    payment_order,
+                    wallet,
+                    source,
+                    value,
+                    balance,
+                )
+            )
+            self._cond.notify_all()
+
+    def read(self, after: int, timeout: float):
+        """
+        Retorna os eventos posteriores ao número de sequência informado,
+        esperando até `timeout` segundos caso ainda não haja nenhum.
+
+        Parâmetros:
+            after (int): último número de sequência já recebido
+            timeout (float): tempo máximo de espera em segundos
+
+        Retorna:
+            A lista de tuplas dos eventos, vazia caso nenhum tenha acontecido
+            no período. Gera EventsLost caso os eventos seguintes a `after`
+            já tenham sido descartados.
+        """
+
+        with self._cond:
+            if self.sequence <= after:
+                self._cond.wait(timeout)
+            first = self.sequence - len(self._events) + 1
+            if after + 1 < first:
+                raise EventsLost(
+                    f"eventos após {after} descartados; o mais antigo guardado"
+                    f" é {first}"
+                )
+            return list(itertools.islice(self._events, after + 1 - first, None))
+
+    def stream(self, request, active, stop: threading.Event):
+        """
+        Gera as mensagens enviadas a um assinante pelo procedimento
+        `watch_mutations`. A primeira mensagem é enviada imediatamente, sem
+        eventos, com o identificador do registro e a sequência a partir da
+        qual o stream começa; as seguintes trazem os eventos das carteiras
+        pedidas, em ordem.
+
+        Parâmetros:
+            request (WatchMutationsRequest): requisição do assinante
+            active (Callable[[], bool]): indica se a chamada continua ativa
+            stop (threading.Event): evento que encerra o stream
+
+        Retorna:
+            Um gerador de mensagens do tipo MutationEvents. Gera EventsLost
+            caso o stream não possa começar (ou continuar) sem perder
+            eventos.
+        """
+
+        if request.after == 0:
+            after = self.sequence
+        elif request.feed_id != self.id or request.after > self.sequence:
+            raise EventsLost(f"sequência {request.after} de outro registro")
+        else:
+            after = request.after
+        wallets = set(request.wallets)
+
+        yield wallet_pb2.MutationEvents(feed_id=self.id, sequence=after)
+        while not stop.is_set() and active():
+            events = self.read(after, POLL_INTERVAL)
+            if not events:
+                continue
+            after = events[-1][0]
+            if wallets:
+                events = [
+                    event
+                    for event in events
+                    if event[4] in wallets or event[5] in wallets
+                ]
+
+            # A sequência de cada mensagem é a do seu último evento (na
+            # última, a do último evento lido, mesmo que ele tenha sido
+            # filtrado), a partir da qual o assinante pode retomar o stream
+            for start in range(0, len(events), EVENTS_PER_MESSAGE):
+                batch = events[start : start + EVENTS_PER_MESSAGE]
+                last = start + EVENTS_PER_MESSAGE >= len(events)
+                yield wallet_pb2.MutationEvents(
+                    feed_id=self.id,
+                    sequence=after if last else batch[-1][0],
+                    events=[
+                        wallet_pb2.MutationEvent(
+                            sequence=sequence,
+                            time=created,
+                            type=kind,
+                            payment_order=payment_order,
+                            wallet=wallet,
+                            source=source,
+                            value=value,
+                            balance=balance,
+                        )
+                        for (
+                            sequence,
+                            created,
+                            kind,
+                            payment_order,
+                            wallet,
+                            source,
+                            value,
+                            balance,
+                        ) in batch
+                    ],
+                )
@@ -0,0 +1,287 @@
+# Conjunto de canais gRPC para um mesmo servidor
+# Vinicius Gomes - 2021421869
+
+import asyncio
+import itertools
+import threading
+
+import grpc
+
+# Políticas de escolha do canal de cada chamada
+POLICIES = ("round_robin", "least_outstanding")
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+
+def channel_options(
+    keepalive: float | None = None,
+    keepalive_timeout: float | None = None,
+    max_message_size: int | None = None,
+    window_size: int | None = None,
+) -> list[tuple[str, int]]:
+    """
+    Monta as opções de um canal gRPC a partir dos parâmetros de HTTP/2
+    configuráveis na linha de comando. Parâmetros None mantêm o padrão do
+    gRPC.
+
+    Parâmetros:
+        keepalive (float | None): intervalo, em segundos, entre os pings de
+                                  keepalive (inclusive sem chamadas em
+                                  andamento)
+        keepalive_timeout (float | None): tempo, em segundos, de espera pela
+                                          resposta de um ping antes de fechar
+                                          a conexão
+        max_message_size (int | None): tamanho máximo, em bytes, das
+                                       mensagens enviadas e recebidas
+        window_size (int | None): janela de controle de fluxo, em bytes, de
+                                  cada stream; fixa a janela em vez de
+                                  deixá-la ser ajustada pelo gRPC (BDP probe)
+
+    Retorna:
+        A lista de pares (opção, valor).
+    """
+
+    options = []
+    if keepalive is not None:
+        options += [
+            ("grpc.keepalive_time_ms", int(keepalive * 1000)),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    if keepalive_timeout is not None:
+        options.append(("grpc.keepalive_timeout_ms", int(keepalive_timeout * 1000)))
+    if max_message_size is not None:
+        options += [
+            ("grpc.max_send_message_length", max_message_size),
+            ("grpc.max_receive_message_length", max_message_size),
+        ]
+    if window_size is not None:
+        options += [
+            ("grpc.http2.lookahead_bytes", window_size),
+            ("grpc.http2.bdp_probe", 0),
+        ]
+    return options
+
+
+class ChannelPool:
+    def __init__(
+        self,
+        target: str,
+        size: int = 1,
+        policy: str = "round_robin",
+        options: list[tuple[str, int]] | None = None,
+        compression: str = "none",
+        asynchronous: bool = False,
+    ) -> None:
+        """
+        Conjunto de `size` canais para o mesmo servidor, cada um com a sua
+        própria conexão HTTP/2. Com um único canal, todas as chamadas
+        concorrentes dividem a mesma conexão, e o limite de streams
+        simultâneos e a janela de controle de fluxo dela passam a limitar a
+        vazão; com vários, as chamadas são distribuídas entre as conexões.
+
+        Cada chamada usa o canal escolhido pela política: "round_robin"
+        alterna entre os canais e "least_outstanding" escolhe o canal com
+        menos chamadas em andamento.
+
+        Parâmetros:
+            target (str): endereço do servidor ("host:porta")
+            size (int): número de canais
+            policy (str): política de escolha do canal
+            options (list[tuple[str, int]] | None): opções dos canais (ver
+                                                    `channel_options`)
+            compression (str): compressão das mensagens ("none", "gzip" ou
+                               "deflate")
+            asynchronous (bool): cria canais grpc.aio em vez de síncronos
+        """
+
+        if policy not in POLICIES:
+            raise ValueError(f"política desconhecida: {policy}")
+
+        options = list(options or [])
+        # Canais com as mesmas opções para o mesmo endereço dividem a mesma
+        # conexão (subchannel) dentro do gRPC, então cada canal do conjunto
+        # usa um conjunto de subchannels próprio
+        if size > 1:
+            options.append(("grpc.use_local_subchannel_pool", 1))
+
+        factory = grpc.aio.insecure_channel if asynchronous else grpc.insecure_channel
+        self.channels = [
+            factory(target, options=options, compression=COMPRESSION[compression])
+            for _ in range(size)
+        ]
+        self.asynchronous = asynchronous
+
+        # Chamadas em andamento em cada canal, usadas pela política
+        # "least_outstanding"
+        self.outstanding = [0] * size
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._least = policy == "least_outstanding"
+
+    def acquire(self) -> int:
+        """
+        Escolhe o canal de uma chamada e a conta como em andamento nele.
+
+        Retorna:
+            O índice do canal escolhido, que deve ser devolvido com `release`
+            ao fim da chamada.
+        """
+
+        with self._lock:
+            if self._least:
+                index = min(
+                    range(len(self.channels)), key=self.outstanding.__getitem__
+                )
+            else:
+                index = next(self._next) % len(self.channels)
+            self.outstanding[index] += 1
+        return index
+
+    def release(self, index: int) -> None:
+        """
+        Registra o fim de uma chamada feita no canal informado.
+
+        Parâmetros:
+            index (int): índice retornado por `acquire`
+        """
+
+        with self._lock:
+            self.outstanding[index] -= 1
+
+    def stub(self, stub_class):
+        """
+        Retorna um stub que distribui as chamadas entre os canais, com a
+        mesma interface de `stub_class`. Com um único canal, é o próprio
+        stub gerado, sem nenhum custo a mais por chamada.
+
+        Parâmetros:
+            stub_class: classe do stub gerado (por exemplo, WalletStub)
+        """
+
+        if len(self.channels) == 1:
+            return stub_class(self.channels[0])
+        return PooledStub(self, stub_class)
+
+    def close(self):
+        """
+        Fecha todos os canais. Com canais grpc.aio, retorna um awaitable.
+        """
+
+        if self.asynchronous:
+            return asyncio.gather(*(channel.close() for channel in self.channels))
+        for channel in self.channels:
+            channel.close()
+
+
+class PooledStub:
+    def __init__(self, pool: ChannelPool, stub_class) -> None:
+        """
+        Stub que faz cada chamada em um dos canais do conjunto. Os
+        procedimentos têm a mesma assinatura dos do stub gerado; no modo
+        síncrono, `.future` também é suportado. Uma chamada com stream de
+        resposta conta como em andamento apenas até o stream ser aberto.
+
+        Parâmetros:
+            pool (ChannelPool): conjunto de canais
+            stub_class: classe do stub gerado
+        """
+
+        self._pool = pool
+        self._stubs = [stub_class(channel) for channel in pool.channels]
+
+    def __getattr__(self, name):
+        methods = [getattr(stub, name) for stub in self._stubs]
+        if self._pool.asynchronous:
+            method = _AsyncPooledMethod(self._pool, methods)
+        else:
+            method = _PooledMethod(self._pool, methods)
+        # Os próximos acessos encontram o método sem passar por __getattr__
+        setattr(self, name, method)
+        return method
+
+
+class _PooledMethod:
+    def __init__(self, pool, methods):
+        self._pool = pool
+        self._methods = methods
+
+    def __call__(self, request, **kwargs):
+        index = self._pool.acquire()
+        try:
+            return self._methods[index](request, **kwargs)
+        finally:
+            self._pool.release(index)
+
+    def future(self, request, **kwargs):
+        index = self._pool.acquire()
+        try:
+            call = self._methods[index].future(request, **kwargs)
+        except BaseException:
+            self._pool.release(index)
+            raise
+        call.add_done_callback(lambda _: self._pool.release(index))
+        return call
+
+
+class _AsyncPooledMethod:
+    def __init__(self, pool, methods):
+        self._pool = pool
+        self._methods = methods
+
+    async def __call__(self, request, **kwargs):
+        index = self._pool.acquire()
+        try:
+            return await self._methods[index](request, **kwargs)
+        finally:
+            self._pool.release(index)
+
+
+def add_arguments(parser) -> None:
+    """
+    Acrescenta a um argparse.ArgumentParser as opções do conjunto de canais
+    e de HTTP/2, lidas depois por `from_args`.
+
+    Parâmetros:
+        parser (argparse.ArgumentParser): parser da linha de comando
+    """
+
+    # Número de canais (conexões) com o servidor e política de escolha do
+    # canal de cada chamada
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--channel-policy", choices=POLICIES, default="round_robin")
+    # Intervalo e tempo de espera, em segundos, dos pings de keepalive
+    parser.add_argument("--keepalive", type=float)
+    parser.add_argument("--keepalive-timeout", type=float)
+    # Tamanho máximo das mensagens e janela de controle de fluxo de cada
+    # stream, em bytes
+    parser.add_argument("--max-message-size", type=int)
+    parser.add_argument("--window-size", type=int)
+    # Compressão das mensagens enviadas
+    parser.add_argument("--compression", choices=list(COMPRESSION), default="none")
+
+
+def from_args(args) -> dict:
+    """
+    Retorna os parâmetros de ChannelPool (exceto o endereço) definidos pelas
+    opções de `add_arguments`.
+
+    Parâmetros:
+        args (argparse.Namespace): opções lidas da linha de comando
+    """
+
+    return {
+        "size": args.channels,
+        "policy": args.channel_policy,
+        "options": channel_options(
+            args.keepalive,
+            args.keepalive_timeout,
+            args.max_message_size,
+            args.window_size,
+        ),
+        "compression": args.compression,
+    }
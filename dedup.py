@@ -0,0 +1,90 @@
+# Cache de respostas para requisições repetidas (chaves de idempotência)
+# Vinicius Gomes - 2021421869
+
+import collections
+import time
+
+
+class DedupCache:
+    def __init__(self, capacity: int = 100_000, ttl: float = 60.0) -> None:
+        """
+        Cache das respostas das requisições recentes que têm um identificador
+        (request_id), usado pelo servidor de carteiras para que uma repetição
+        da mesma requisição (uma nova tentativa ou uma chamada redundante do
+        cliente) receba a resposta da primeira em vez de ser executada de
+        novo.
+
+        Cada resposta fica guardada por `ttl` segundos e, no máximo,
+        `capacity` respostas são mantidas; as mais antigas são descartadas
+        primeiro. Como todas as entradas têm o mesmo prazo, a ordem de
+        inserção é também a ordem de expiração, e o descarte é O(1) por
+        entrada.
+
+        Os métodos não são sincronizados: quem os chama deve ter o lock que
+        protege o cache adquirido (no servidor de carteiras, o lock das
+        ordens de pagamento, o mesmo que torna a consulta e a execução da
+        requisição uma única operação atômica).
+
+        Parâmetros:
+            capacity (int): número máximo de respostas guardadas
+            ttl (float): tempo, em segundos, que cada resposta é guardada
+        """
+
+        self.capacity = capacity
+        self.ttl = ttl
+        # Chave → (instante de expiração, resposta), em ordem de inserção
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self, now):
+        entries = self._entries
+        while entries and (
+            len(entries) > self.capacity or next(iter(entries.values()))[0] <= now
+        ):
+            entries.popitem(last=False)
+
+    def get(self, key):
+        """
+        Retorna a resposta guardada para a chave informada.
+
+        Parâmetros:
+            key: procedimento e identificador da requisição
+
+        Retorna:
+            A resposta da primeira requisição com essa chave, ou None caso
+            ela não exista ou já tenha expirado.
+        """
+
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, reply) -> None:
+        """
+        Guarda a resposta de uma requisição.
+
+        Parâmetros:
+            key: procedimento e identificador da requisição
+            reply: resposta enviada ao cliente
+        """
+
+        now = time.monotonic()
+        # Uma chave que já existe (p.ex. uma repetição que chega depois de a
+        # entrada expirar) é removida antes, para ir para o fim da ordem de
+        # inserção junto do seu novo prazo
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self.ttl, reply)
+        self._evict(now)
+
+    def keys(self) -> list:
+        """
+        Retorna as chaves que ainda não expiraram, em ordem de inserção.
+        """
+
+        now = time.monotonic()
+        return [key for key, (expires, _) in self._entries.items() if expires > now]
@@ -0,0 +1,112 @@
+# Gerenciador de locks do servidor de carteiras
+# Vinicius Gomes - 2021421869
+
+import threading
+import zlib
+from contextlib import ExitStack, contextmanager
+
+
+class OrderIdAllocator:
+    def __init__(self, start: int = 1) -> None:
+        """
+        Alocador atômico de identificadores sequenciais para as ordens de
+        pagamento.
+
+        Parâmetros:
+            start (int): primeiro identificador a ser entregue
+        """
+
+        self._lock = threading.Lock()
+        self._next = start
+
+    def allocate(self) -> int:
+        """
+        Reserva e retorna o próximo identificador de ordem de pagamento. Duas
+        chamadas concorrentes nunca recebem o mesmo identificador.
+
+        Retorna:
+            O identificador reservado.
+        """
+
+        with self._lock:
+            order_id = self._next
+            self._next += 1
+            return order_id
+
+    @property
+    def next_id(self) -> int:
+        """
+        Identificador que será entregue na próxima alocação.
+        """
+
+        return self._next
+
+
+class LockManager:
+    def __init__(self, stripes: int = 64, lock_factory=threading.Lock) -> None:
+        """
+        Gerenciador dos locks usados pelo servicer de carteiras.
+
+        As carteiras são protegidas por um conjunto fixo de locks ("stripes"):
+        cada carteira é mapeada para um deles a partir do hash do seu
+        identificador. Assim, operações sobre carteiras diferentes raramente
+        disputam o mesmo lock, sem que seja preciso criar um lock por carteira.
+        A tabela de ordens de pagamento tem um lock próprio.
+
+        Para evitar deadlocks, quem precisar de mais de um lock deve sempre
+        adquirir os locks de carteira antes do lock das ordens de pagamento, e
+        os locks de carteira em ordem crescente de índice.
+
+        Parâmetros:
+            stripes (int): número de locks usados para as carteiras
+            lock_factory: função que cria cada lock (multiprocessing.Lock
+                          para locks compartilhados entre processos)
+        """
+
+        self._stripes = [lock_factory() for _ in range(stripes)]
+        self.orders_lock = lock_factory()
+
+    def _stripe_index(self, wallet: str) -> int:
+        # O crc32 é usado no lugar de `hash` para que o mapeamento seja o
+        # mesmo em qualquer processo (o hash de strings do Python é
+        # randomizado a cada execução)
+        return zlib.crc32(wallet.encode()) % len(self._stripes)
+
+    def wallet_lock(self, wallet: str):
+        """
+        Retorna o lock que protege o saldo da carteira informada.
+
+        Parâmetros:
+            wallet (str): identificador da carteira
+        """
+
+        return self._stripes[self._stripe_index(wallet)]
+
+    @contextmanager
+    def wallets_lock(self, wallets):
+        """
+        Adquire, de uma vez, os locks de todas as carteiras informadas (cada
+        lock uma única vez e em ordem crescente de índice).
+
+        Parâmetros:
+            wallets (Iterable[str]): identificadores das carteiras
+        """
+
+        indexes = sorted({self._stripe_index(wallet) for wallet in wallets})
+        with ExitStack() as stack:
+            for index in indexes:
+                stack.enter_context(self._stripes[index])
+            yield
+
+    @contextmanager
+    def all_locks(self):
+        """
+        Adquire todos os locks (carteiras e ordens de pagamento), obtendo uma
+        visão consistente de todo o estado do servidor.
+        """
+
+        with ExitStack() as stack:
+            for lock in self._stripes:
+                stack.enter_context(lock)
+            stack.enter_context(self.orders_lock)
+            yield
@@ -0,0 +1,557 @@
+# Métricas dos servidores: contadores, histogramas de latência e
+# interceptadores
+# Vinicius Gomes - 2021421869
+
+import collections
+import http.server
+import threading
+import time
+
+import grpc
+from google.protobuf.descriptor import FieldDescriptor
+
+# Número de bits de mantissa do histograma: cada faixa de potência de 2 é
+# dividida em 64 baldes, o que dá um erro relativo de no máximo 1/64
+_SUB_BITS = 6
+_SUB = 1 << _SUB_BITS
+# Com 40 faixas, o histograma cobre até 2**46 µs (mais de dois anos)
+_BUCKETS = 41 * _SUB
+
+# Quantis exibidos nas estatísticas
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    def __init__(self) -> None:
+        """
+        Histograma de latências no estilo HDR (log-linear), em microssegundos.
+
+        Valores menores que 128 µs têm um balde cada; acima disso, cada
+        potência de 2 é dividida em 64 baldes de mesma largura. Registrar um
+        valor é O(1) (o índice vem do número de bits do valor) e a memória é
+        fixa, independentemente do número de valores registrados. Os quantis
+        têm erro relativo de no máximo 1/64.
+
+        Os métodos não são sincronizados: quem os chama deve ter o lock que
+        protege o histograma adquirido.
+        """
+
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        """
+        Registra um valor.
+
+        Parâmetros:
+            value (int): latência em microssegundos
+        """
+
+        shift = value.bit_length() - _SUB_BITS - 1
+        if shift <= 0:
+            index = value
+        else:
+            index = min(shift * _SUB + (value >> shift), _BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> int:
+        """
+        Retorna o limite superior do balde que contém o quantil informado.
+
+        Parâmetros:
+            q (float): quantil entre 0 e 1
+        """
+
+        if not self.count:
+            return 0
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_upper_bound(index), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+def _upper_bound(index):
+    # Maior valor que cai no balde informado
+    if index < 2 * _SUB:
+        return index
+    shift = index // _SUB - 1
+    return ((index - shift * _SUB + 1) << shift) - 1
+
+
+class MethodStats:
+    def __init__(self, name: str) -> None:
+        """
+        Estatísticas de um procedimento (ou de uma chamada feita a outro
+        servidor): número de chamadas, chamadas em andamento, contagem dos
+        códigos de retorno e histograma de latência.
+
+        Parâmetros:
+            name (str): nome do procedimento
+        """
+
+        self.name = name
+        self.calls = 0
+        self.in_flight = 0
+        # Código de retorno → número de ocorrências. Os códigos negativos são
+        # os códigos de erro das respostas; 0 conta as respostas de sucesso e
+        # os nomes dos códigos do gRPC contam as chamadas que falharam
+        self.codes: dict = {}
+        self.latency = Histogram()
+        self._lock = threading.Lock()
+
+    def start(self) -> int:
+        """
+        Registra o início de uma chamada.
+
+        Retorna:
+            O instante de início, em nanossegundos, para `finish`.
+        """
+
+        with self._lock:
+            self.in_flight += 1
+        return time.perf_counter_ns()
+
+    def finish(self, started: int, codes) -> None:
+        """
+        Registra o fim de uma chamada.
+
+        Parâmetros:
+            started (int): instante retornado por `start`
+            codes: códigos de retorno da chamada
+        """
+
+        elapsed = (time.perf_counter_ns() - started) // 1000
+        counts = self.codes
+        with self._lock:
+            self.in_flight -= 1
+            self.calls += 1
+            self.latency.record(elapsed)
+            for code in codes:
+                counts[code] = counts.get(code, 0) + 1
+
+    def quantile(self, q: float) -> int:
+        """
+        Retorna o quantil informado da latência, em microssegundos.
+
+        Parâmetros:
+            q (float): quantil entre 0 e 1
+        """
+
+        with self._lock:
+            return self.latency.quantile(q)
+
+    def summary(self) -> dict:
+        """
+        Retorna uma cópia consistente das estatísticas.
+        """
+
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "in_flight": self.in_flight,
+                "codes": dict(self.codes),
+                "quantiles": {q: self.latency.quantile(q) for q in QUANTILES},
+                "mean_us": self.latency.mean(),
+                "max_us": self.latency.max,
+            }
+
+
+class _Tracker:
+    # Gerenciador de contexto de `Metrics.track`
+    def __init__(self, stats):
+        self._stats = stats
+        self.code = 0
+
+    def __enter__(self):
+        self._started = self._stats.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # Uma chamada que terminou com exceção conta como erro de
+        # comunicação (-9)
+        self._stats.finish(self._started, [-9 if exc_type else self.code])
+        return False
+
+
+class Metrics:
+    def __init__(self) -> None:
+        """
+        Registro das métricas de um servidor. Guarda as estatísticas de cada
+        procedimento atendido (preenchidas pelos interceptadores) e de cada
+        chamada feita a outros servidores (preenchidas por `track`), além de
+        contadores fornecidos pelo próprio servidor.
+        """
+
+        self._methods: dict[str, MethodStats] = {}
+        self._lock = threading.Lock()
+        # Funções que retornam contadores adicionais (nome → valor)
+        self._counters = []
+
+    def method(self, name: str) -> MethodStats:
+        """
+        Retorna (criando, se necessário) as estatísticas de um procedimento.
+
+        Parâmetros:
+            name (str): nome do procedimento
+        """
+
+        stats = self._methods.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._methods.setdefault(name, MethodStats(name))
+        return stats
+
+    def track(self, name: str) -> _Tracker:
+        """
+        Mede uma chamada feita a outro servidor. O código de retorno é
+        informado atribuindo `code` ao objeto retornado; uma exceção conta
+        como o código -9.
+
+        Parâmetros:
+            name (str): nome da chamada
+        """
+
+        return _Tracker(self.method(name))
+
+    def add_counters(self, counters) -> None:
+        """
+        Registra uma função que retorna contadores adicionais do servidor.
+
+        Parâmetros:
+            counters: função sem parâmetros que retorna um dict[str, int]
+        """
+
+        self._counters.append(counters)
+
+    def counters(self) -> dict[str, int]:
+        values = {}
+        for counters in self._counters:
+            values.update(counters())
+        return values
+
+    def summaries(self) -> dict[str, dict]:
+        with self._lock:
+            methods = sorted(self._methods.items())
+        return {name: stats.summary() for name, stats in methods}
+
+    def stats_reply(self, pb2):
+        """
+        Monta a resposta do procedimento `stats`.
+
+        Parâmetros:
+            pb2: módulo gerado pelo protoc do serviço (wallet_pb2 ou
+                 store_pb2), que definem as mesmas mensagens
+
+        Retorna:
+            Uma mensagem do tipo StatsReply.
+        """
+
+        methods = []
+        for name, summary in self.summaries().items():
+            quantiles = summary["quantiles"]
+            methods.append(
+                pb2.MethodStats(
+                    method=name,
+                    calls=summary["calls"],
+                    in_flight=summary["in_flight"],
+                    codes={str(code): n for code, n in summary["codes"].items()},
+                    p50_us=quantiles[0.5],
+                    p90_us=quantiles[0.9],
+                    p99_us=quantiles[0.99],
+                    p999_us=quantiles[0.999],
+                    mean_us=summary["mean_us"],
+                    max_us=summary["max_us"],
+                )
+            )
+        return pb2.StatsReply(methods=methods, counters=self.counters())
+
+    def render(self) -> str:
+        """
+        Retorna as métricas no formato de exposição em texto (uma métrica por
+        linha, no estilo do Prometheus).
+        """
+
+        lines = []
+        for name, summary in self.summaries().items():
+            labels = f'method="{name}"'
+            lines.append(f"rpc_calls_total{{{labels}}} {summary['calls']}")
+            lines.append(f"rpc_in_flight{{{labels}}} {summary['in_flight']}")
+            for code, n in summary["codes"].items():
+                lines.append(f'rpc_codes_total{{{labels},code="{code}"}} {n}')
+            for q, value in summary["quantiles"].items():
+                lines.append(f'rpc_latency_us{{{labels},quantile="{q}"}} {value}')
+            lines.append(f"rpc_latency_us_max{{{labels}}} {summary['max_us']}")
+            lines.append(f"rpc_latency_us_mean{{{labels}}} {summary['mean_us']:.1f}")
+        for name, value in self.counters().items():
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> http.server.HTTPServer:
+        """
+        Inicia, em uma thread própria, um servidor HTTP local que responde
+        qualquer GET com `render`.
+
+        Parâmetros:
+            port (int): porta local do servidor HTTP
+
+        Retorna:
+            O servidor HTTP, que deve ser encerrado com `shutdown`.
+        """
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def reply_codes(reply):
+    """
+    Extrai os códigos de retorno de uma resposta: o primeiro valor negativo
+    dos campos inteiros (status, retval, balance, ...) é o código de erro e
+    uma resposta sem nenhum deles conta como sucesso (0). Respostas em lote
+    (campo repetido `results`) e resultados de sessão (campos de um oneof)
+    são percorridos item a item.
+
+    Parâmetros:
+        reply: mensagem de resposta
+
+    Retorna:
+        A lista de códigos.
+    """
+
+    layout = _LAYOUTS.get(reply.DESCRIPTOR)
+    if layout is None:
+        layout = _LAYOUTS[reply.DESCRIPTOR] = _layout(reply.DESCRIPTOR)
+    scalars, results, oneof = layout
+
+    if results:
+        codes = []
+        for item in getattr(reply, results):
+            codes.extend(reply_codes(item))
+        return codes
+    if oneof:
+        field = reply.WhichOneof(oneof)
+        return reply_codes(getattr(reply, field)) if field else []
+
+    for name in scalars:
+        value = getattr(reply, name)
+        if value < 0:
+            return [value]
+    return [0]
+
+
+# Campos de cada tipo de resposta consultados por `reply_codes`, calculados
+# uma única vez por tipo a partir do descritor da mensagem
+_LAYOUTS = {}
+_INTEGER_TYPES = {
+    FieldDescriptor.CPPTYPE_INT32,
+    FieldDescriptor.CPPTYPE_INT64,
+}
+
+
+def _layout(descriptor):
+    scalars = tuple(
+        field.name
+        for field in descriptor.fields
+        if field.cpp_type in _INTEGER_TYPES and field.containing_oneof is None
+    )
+    results = "results" if "results" in descriptor.fields_by_name else None
+    oneof = descriptor.oneofs[0].name if descriptor.oneofs else None
+    return scalars, results, oneof
+
+
+def _method_name(handler_call_details):
+    # "/wallet.Wallet/transfer" → "transfer"
+    return handler_call_details.method.rsplit("/", 1)[-1]
+
+
+def _status(context):
+    """
+    Retorna o nome do código do gRPC com que terminou uma chamada que gerou
+    uma exceção: o código definido pelo procedimento ou pelos interceptadores
+    (`context.abort` ou `context.set_code`, p.ex. RESOURCE_EXHAUSTED na fila
+    de admissão ou DATA_LOSS no stream de eventos), ou UNKNOWN caso nenhum
+    tenha sido definido (uma exceção inesperada).
+
+    Parâmetros:
+        context: contexto da chamada, do servidor síncrono ou do grpc.aio
+    """
+
+    code = context.code()
+    # O contexto do grpc.aio guarda o valor numérico do código
+    if isinstance(code, int):
+        code = _STATUS_CODES.get(code)
+    if code is None or code == grpc.StatusCode.OK:
+        return grpc.StatusCode.UNKNOWN.name
+    return code.name
+
+
+_STATUS_CODES = {code.value[0]: code for code in grpc.StatusCode}
+
+
+def _wrap(handler, behavior_wrapper):
+    # Recria o handler com o comportamento envolvido, mantendo os
+    # serializadores
+    if handler.unary_unary:
+        return grpc.unary_unary_rpc_method_handler(
+            behavior_wrapper(handler.unary_unary, False, False),
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+    if handler.unary_stream:
+        return grpc.unary_stream_rpc_method_handler(
+            behavior_wrapper(handler.unary_stream, False, True),
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+    if handler.stream_unary:
+        return grpc.stream_unary_rpc_method_handler(
+            behavior_wrapper(handler.stream_unary, True, False),
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+    return grpc.stream_stream_rpc_method_handler(
+        behavior_wrapper(handler.stream_stream, True, True),
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    def __init__(self, metrics: Metrics) -> None:
+        """
+        Interceptador do servidor síncrono que mede cada procedimento
+        atendido. Um stream de respostas (como a sessão) conta como uma única
+        chamada, do início ao fim do stream, com os códigos de todas as
+        respostas.
+
+        Parâmetros:
+            metrics (Metrics): registro das métricas
+        """
+
+        self.metrics = metrics
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        stats = self.metrics.method(_method_name(handler_call_details))
+
+        def wrapper(behavior, _, response_streaming):
+            if response_streaming:
+
+                def stream(request, context):
+                    started = stats.start()
+                    # Os códigos são contados à medida que as respostas são
+                    # enviadas, já que um stream (como o da replicação) pode
+                    # durar toda a execução do servidor
+                    codes = collections.Counter()
+                    try:
+                        for reply in behavior(request, context):
+                            codes.update(reply_codes(reply))
+                            yield reply
+                    except Exception:
+                        codes[_status(context)] += 1
+                        raise
+                    finally:
+                        stats.finish(started, codes.elements())
+
+                return stream
+
+            def unary(request, context):
+                started = stats.start()
+                codes = []
+                try:
+                    reply = behavior(request, context)
+                    codes = reply_codes(reply)
+                    return reply
+                except Exception:
+                    codes = [_status(context)]
+                    raise
+                finally:
+                    stats.finish(started, codes)
+
+            return unary
+
+        return _wrap(handler, wrapper)
+
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    def __init__(self, metrics: Metrics) -> None:
+        """
+        Versão de MetricsInterceptor para o servidor grpc.aio.
+
+        Parâmetros:
+            metrics (Metrics): registro das métricas
+        """
+
+        self.metrics = metrics
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        stats = self.metrics.method(_method_name(handler_call_details))
+
+        def wrapper(behavior, _, response_streaming):
+            if response_streaming:
+
+                async def stream(request, context):
+                    started = stats.start()
+                    # Os códigos são contados à medida que as respostas são
+                    # enviadas, já que um stream (como o da replicação) pode
+                    # durar toda a execução do servidor
+                    codes = collections.Counter()
+                    try:
+                        async for reply in behavior(request, context):
+                            codes.update(reply_codes(reply))
+                            yield reply
+                    except Exception:
+                        codes[_status(context)] += 1
+                        raise
+                    finally:
+                        stats.finish(started, codes.elements())
+
+                return stream
+
+            async def unary(request, context):
+                started = stats.start()
+                codes = []
+                try:
+                    reply = await behavior(request, context)
+                    codes = reply_codes(reply)
+                    return reply
+                except Exception:
+                    codes = [_status(context)]
+                    raise
+                finally:
+                    stats.finish(started, codes)
+
+            return unary
+
+        return _wrap(handler, wrapper)
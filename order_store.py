@@ -0,0 +1,311 @@
+# Armazenamento das ordens de pagamento do servidor de carteiras
+# Vinicius Gomes - 2021421869
+
+import sys
+from array import array
+
+from locks import OrderIdAllocator
+
+
+class DictOrderStore:
+    def __init__(
+        self, orders: dict[int, tuple[int, str]] | None = None, next_id: int = 1
+    ) -> None:
+        """
+        Armazenamento das ordens de pagamento em um dicionário (ID → valor),
+        com os identificadores entregues por um OrderIdAllocator. É a
+        representação original do servidor. A carteira de origem de cada
+        ordem fica em um segundo dicionário.
+
+        Os métodos não são sincronizados: quem os chama deve ter o lock das
+        ordens de pagamento adquirido.
+
+        Parâmetros:
+            orders (dict[int, tuple[int, str]] | None): ordens de pagamento
+                                                        iniciais (ID → valor e
+                                                        carteira de origem)
+            next_id (int): próximo identificador a ser entregue
+        """
+
+        orders = orders or {}
+        self._orders = {order: value for order, (value, _) in orders.items()}
+        self._sources = {order: wallet for order, (_, wallet) in orders.items()}
+        self._ids = OrderIdAllocator(next_id)
+
+    def has_room(self) -> bool:
+        """
+        Indica se uma nova ordem de pagamento pode ser criada. O dicionário
+        não tem limite de ordens pendentes.
+        """
+
+        return True
+
+    def create(self, value: int, wallet: str) -> int:
+        """
+        Registra uma nova ordem de pagamento.
+
+        Parâmetros:
+            value (int): valor da ordem de pagamento
+            wallet (str): carteira de origem
+
+        Retorna:
+            O identificador da ordem de pagamento criada.
+        """
+
+        payment_order = self._ids.allocate()
+        self._orders[payment_order] = value
+        self._sources[payment_order] = wallet
+        return payment_order
+
+    def check(self, payment_order: int, recount: int) -> int:
+        """
+        Verifica se a ordem de pagamento pode ser transferida, sem removê-la.
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+            recount (int): valor de conferência
+
+        Retorna:
+            0, caso a ordem exista e tenha o valor de conferência, -1, caso a
+            ordem não exista, ou -2, caso o valor seja diferente.
+        """
+
+        value = self._orders.get(payment_order)
+        if value is None:
+            return -1
+        if value != recount:
+            return -2
+        return 0
+
+    def take(self, payment_order: int, recount: int) -> int:
+        """
+        Verifica e remove a ordem de pagamento em uma única operação. Em caso
+        de sucesso, o valor da ordem é igual ao valor de conferência.
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+            recount (int): valor de conferência
+
+        Retorna:
+            Os mesmos códigos de `check`; a ordem só é removida quando o
+            código é 0.
+        """
+
+        status = self.check(payment_order, recount)
+        if status == 0:
+            del self._orders[payment_order]
+            del self._sources[payment_order]
+        return status
+
+    def source(self, payment_order: int) -> str | None:
+        """
+        Retorna a carteira de origem da ordem de pagamento, ou None caso a
+        ordem não esteja pendente (ou a origem seja desconhecida).
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+        """
+
+        return self._sources.get(payment_order)
+
+    def expire(self, payment_order: int) -> tuple[int, str] | None:
+        """
+        Remove a ordem de pagamento sem transferi-la, independentemente do
+        valor.
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+
+        Retorna:
+            Uma tupla (valor, carteira de origem), ou None caso a ordem não
+            esteja pendente.
+        """
+
+        value = self._orders.pop(payment_order, None)
+        if value is None:
+            return None
+        return value, self._sources.pop(payment_order)
+
+    @property
+    def next_id(self) -> int:
+        """
+        Identificador que será entregue à próxima ordem de pagamento.
+        """
+
+        return self._ids.next_id
+
+    def __contains__(self, payment_order) -> bool:
+        return payment_order in self._orders
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def items(self):
+        return self._orders.items()
+
+    def records(self):
+        """
+        Percorre as ordens pendentes como tuplas (ID, valor, carteira de
+        origem).
+        """
+
+        for payment_order, value in self._orders.items():
+            yield payment_order, value, self._sources[payment_order]
+
+    def __repr__(self) -> str:
+        return repr(self._orders)
+
+
+class CompactOrderStore:
+    # Tamanho mínimo do prefixo de ordens já removidas para que ele seja
+    # descartado dos arrays
+    COMPACT_MIN = 4096
+
+    def __init__(
+        self, orders: dict[int, tuple[int, str]] | None = None, next_id: int = 1
+    ) -> None:
+        """
+        Armazenamento compacto das ordens de pagamento. Como os
+        identificadores são sequenciais, a ordem de ID `base + i` fica na
+        posição `i` de um array de inteiros de 64 bits com os valores, e um
+        bitmap marca quais posições ainda estão pendentes (as demais são
+        lápides de ordens já transferidas). A carteira de origem fica em uma
+        lista paralela; os identificadores são internalizados, então a lista
+        guarda apenas uma referência por ordem.
+
+        Quando todas as ordens do início do array já foram transferidas, esse
+        prefixo é descartado e a base avança. Assim, a memória fica
+        proporcional à janela entre a ordem pendente mais antiga e a mais
+        recente, e não ao número de ordens já criadas. Um contador das ordens
+        pendentes torna o `len` O(1).
+
+        Parâmetros:
+            orders (dict[int, tuple[int, str]] | None): ordens de pagamento
+                                                        iniciais (ID → valor e
+                                                        carteira de origem)
+            next_id (int): próximo identificador a ser entregue
+        """
+
+        orders = orders or {}
+        self._base = min(orders, default=next_id)
+        self._amounts = array("q")
+        self._sources: list[str | None] = []
+        self._live = bytearray()
+        self._count = 0
+        # Posição da primeira ordem que pode estar pendente
+        self._head = 0
+
+        for payment_order in range(self._base, next_id):
+            value, wallet = orders.get(payment_order, (0, None))
+            self._append(value, wallet, payment_order in orders)
+        self._advance_head()
+
+    def _append(self, value, wallet, live):
+        # Acrescenta uma posição no fim dos arrays
+        index = len(self._amounts)
+        self._amounts.append(value)
+        self._sources.append(wallet)
+        if index % 8 == 0:
+            self._live.append(0)
+        if live:
+            self._live[index >> 3] |= 1 << (index & 7)
+            self._count += 1
+        return index
+
+    def _index(self, payment_order):
+        # Posição da ordem de pagamento, ou -1 caso ela não esteja pendente
+        index = payment_order - self._base
+        if index < self._head or index >= len(self._amounts):
+            return -1
+        if not self._live[index >> 3] & (1 << (index & 7)):
+            return -1
+        return index
+
+    def has_room(self) -> bool:
+        return True
+
+    def create(self, value: int, wallet: str) -> int:
+        return self._base + self._append(value, sys.intern(wallet), True)
+
+    def check(self, payment_order: int, recount: int) -> int:
+        index = self._index(payment_order)
+        if index < 0:
+            return -1
+        if self._amounts[index] != recount:
+            return -2
+        return 0
+
+    def take(self, payment_order: int, recount: int) -> int:
+        index = self._index(payment_order)
+        if index < 0:
+            return -1
+        if self._amounts[index] != recount:
+            return -2
+
+        self._remove(index)
+        return 0
+
+    def source(self, payment_order: int) -> str | None:
+        index = self._index(payment_order)
+        return self._sources[index] if index >= 0 else None
+
+    def expire(self, payment_order: int) -> tuple[int, str] | None:
+        index = self._index(payment_order)
+        if index < 0:
+            return None
+        entry = self._amounts[index], self._sources[index]
+        self._remove(index)
+        return entry
+
+    def _remove(self, index):
+        # Marca a posição como lápide
+        self._live[index >> 3] &= ~(1 << (index & 7))
+        self._sources[index] = None
+        self._count -= 1
+
+        if index == self._head:
+            self._advance_head()
+
+    def _advance_head(self):
+        # Avança o início da janela sobre as lápides e descarta o prefixo
+        # quando ele passa a ocupar metade dos arrays
+        size = len(self._amounts)
+        head = self._head
+        while head < size and not self._live[head >> 3] & (1 << (head & 7)):
+            head += 1
+        self._head = head
+
+        if head >= self.COMPACT_MIN and 2 * head >= size:
+            # O corte é feito em um múltiplo de 8 para que o bitmap possa ser
+            # cortado em bytes inteiros
+            cut = head & ~7
+            del self._amounts[:cut]
+            del self._sources[:cut]
+            del self._live[: cut >> 3]
+            self._base += cut
+            self._head -= cut
+
+    @property
+    def next_id(self) -> int:
+        return self._base + len(self._amounts)
+
+    def __contains__(self, payment_order) -> bool:
+        return self._index(payment_order) >= 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def items(self):
+        for payment_order, value, _ in self.records():
+            yield payment_order, value
+
+    def records(self):
+        for index in range(self._head, len(self._amounts)):
+            if self._live[index >> 3] & (1 << (index & 7)):
+                yield self._base + index, self._amounts[index], self._sources[index]
+
+    def __repr__(self) -> str:
+        # Mesmo formato da exibição de um dicionário
+        return (
+            "{" + ", ".join(f"{order}: {value}" for order, value in self.items()) + "}"
+        )
@@ -0,0 +1,184 @@
+# Execução dos comandos dos clientes com várias chamadas em andamento
+# Vinicius Gomes - 2021421869
+
+import collections
+import threading
+from concurrent import futures
+
+import grpc
+
+
+def _copy(source, target):
+    # Repassa o resultado (ou o erro) de um future já terminado para outro
+    error = source.exception()
+    if error is not None:
+        target.set_exception(error)
+    else:
+        target.set_result(source.result())
+
+
+def then(future, step) -> futures.Future:
+    """
+    Encadeia um passo ao fim de um future (do gRPC ou de concurrent.futures),
+    sem bloquear quem chama: `step` é chamado com o future terminado, na
+    thread que o terminou, e pode retornar um valor ou um novo future (p.ex.
+    a próxima chamada feita com `.future`).
+
+    Parâmetros:
+        future: future que deve terminar antes do passo
+        step (Callable): passo executado com o future terminado
+
+    Retorna:
+        Um concurrent.futures.Future com o valor retornado pelo passo ou,
+        caso ele retorne um future, com o resultado desse future. Uma exceção
+        do passo (ou do future retornado) termina o future com ela.
+    """
+
+    result = futures.Future()
+
+    def done(previous):
+        try:
+            value = step(previous)
+        except Exception as error:
+            result.set_exception(error)
+            return
+        if isinstance(value, (futures.Future, grpc.Future)):
+            value.add_done_callback(lambda current: _copy(current, result))
+        else:
+            result.set_result(value)
+
+    future.add_done_callback(done)
+    return result
+
+
+def after(dependencies, start) -> futures.Future:
+    """
+    Inicia uma chamada apenas quando todos os futures de que ela depende
+    terminarem (com sucesso ou não).
+
+    Parâmetros:
+        dependencies (list): futures que devem terminar antes
+        start (Callable[[], Future]): função que faz a chamada e retorna o
+                                      seu future
+
+    Retorna:
+        Um concurrent.futures.Future com o resultado da chamada.
+    """
+
+    ready = futures.Future()
+    remaining = len(dependencies)
+    lock = threading.Lock()
+
+    def done(_):
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            last = remaining == 0
+        if last:
+            ready.set_result(None)
+
+    if not dependencies:
+        ready.set_result(None)
+    for dependency in dependencies:
+        dependency.add_done_callback(done)
+    return then(ready, lambda _: start())
+
+
+class Dependencies:
+    def __init__(self) -> None:
+        """
+        Registro das dependências entre os comandos de um cliente, para que
+        comandos independentes executem ao mesmo tempo sem mudar o resultado
+        da execução em sequência. Cada comando lê ou altera alguns recursos
+        (p.ex. uma carteira); ele deve esperar a última alteração de cada
+        recurso que lê e, para os que altera, também as leituras feitas
+        depois dessa alteração. Leituras do mesmo recurso não dependem umas
+        das outras.
+        """
+
+        # Recurso → (future da última alteração, futures das leituras
+        # feitas depois dela)
+        self._resources = collections.defaultdict(lambda: (None, []))
+
+    def wait_for(self, reads=(), writes=()) -> list:
+        """
+        Retorna os futures que um comando deve esperar.
+
+        Parâmetros:
+            reads: recursos lidos pelo comando
+            writes: recursos alterados pelo comando
+        """
+
+        dependencies = []
+        for resource in (*reads, *writes):
+            write, _ = self._resources[resource]
+            if write is not None:
+                dependencies.append(write)
+        for resource in writes:
+            dependencies += self._resources[resource][1]
+        # Os comandos que já terminaram não precisam ser esperados
+        return [future for future in dependencies if not future.done()]
+
+    def register(self, future, reads=(), writes=()) -> None:
+        """
+        Registra o future de um comando como a última leitura ou alteração
+        dos recursos informados.
+
+        Parâmetros:
+            future: future do comando
+            reads: recursos lidos pelo comando
+            writes: recursos alterados pelo comando
+        """
+
+        for resource in reads:
+            if resource not in writes:
+                write, readers = self._resources[resource]
+                readers = [reader for reader in readers if not reader.done()]
+                self._resources[resource] = (write, [*readers, future])
+        for resource in writes:
+            self._resources[resource] = (future, [])
+
+
+class Pipeline:
+    def __init__(self, window: int) -> None:
+        """
+        Comandos em andamento de um cliente, com os resultados exibidos na
+        ordem em que os comandos foram lidos. No máximo `window` comandos
+        ficam em andamento (ou terminados, esperando a vez de serem
+        exibidos); ao chegar nesse limite, o mais antigo é esperado antes
+        do próximo ser enviado.
+
+        Parâmetros:
+            window (int): número máximo de comandos em andamento
+        """
+
+        self.window = window
+        self._pending = collections.deque()
+
+    def submit(self, future, report) -> None:
+        """
+        Acrescenta um comando em andamento.
+
+        Parâmetros:
+            future: future com o resultado do comando
+            report (Callable): função que recebe o future e exibe o
+                               resultado do comando (esperando por ele)
+        """
+
+        self._pending.append((future, report))
+        while len(self._pending) >= self.window:
+            self._finish_oldest()
+
+    def _finish_oldest(self):
+        future, report = self._pending.popleft()
+        report(future)
+
+    def drain(self) -> None:
+        """
+        Espera todos os comandos em andamento e exibe os seus resultados, na
+        ordem. Usado antes dos comandos que não podem executar junto com os
+        anteriores (p.ex. o fim da execução).
+        """
+
+        while self._pending:
+            self._finish_oldest()
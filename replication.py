@@ -0,0 +1,347 @@
+# Replicação do servidor de carteiras para réplicas de leitura
+# Vinicius Gomes - 2021421869
+
+import collections
+import itertools
+import threading
+import time
+import uuid
+
+import grpc
+
+import wallet_pb2
+import wallet_pb2_grpc
+from wal import apply_record
+
+# Número de carteiras (e de ordens pendentes) em cada mensagem do snapshot
+# enviado às réplicas
+SNAPSHOT_CHUNK = 10000
+
+# Número máximo de alterações em cada mensagem enviada às réplicas
+RECORDS_PER_MESSAGE = 1000
+
+# Intervalo, em segundos, entre os heartbeats enviados às réplicas enquanto
+# não há alterações
+HEARTBEAT_INTERVAL = 0.1
+
+
+class MutationLog:
+    def __init__(self, capacity: int = 65536) -> None:
+        """
+        Registro em memória das alterações mais recentes do servidor de
+        carteiras, lido pelas réplicas. Cada alteração recebe um número de
+        sequência (LSN) crescente e é guardada no mesmo formato dos registros
+        do log de escrita antecipada ("<operação> <campos...>"), junto do
+        instante em que foi feita.
+
+        Apenas as `capacity` alterações mais recentes são mantidas; uma
+        réplica que fica mais atrasada que isso recebe um novo snapshot.
+
+        Parâmetros:
+            capacity (int): número de alterações mantidas
+        """
+
+        # Identifica este registro: os LSNs de outra execução do servidor não
+        # correspondem aos deste
+        self.id = uuid.uuid4().hex
+        self._cond = threading.Condition()
+        # Tuplas (LSN, instante, registro)
+        self._records = collections.deque(maxlen=capacity)
+        self.lsn = 0
+
+    def append(self, *fields) -> int:
+        """
+        Acrescenta uma alteração ao registro. Deve ser chamada com os locks
+        que protegem a alteração adquiridos, para que a ordem dos LSNs seja a
+        ordem em que as alterações aconteceram.
+
+        Parâmetros:
+            fields: operação e campos do registro
+
+        Retorna:
+            O LSN da alteração.
+        """
+
+        with self._cond:
+            self.lsn += 1
+            self._records.append(
+                (self.lsn, time.time(), " ".join(map(str, fields)))
+            )
+            self._cond.notify_all()
+            return self.lsn
+
+    def read(self, after: int, timeout: float):
+        """
+        Retorna as alterações posteriores ao LSN informado, esperando até
+        `timeout` segundos caso ainda não haja nenhuma.
+
+        Parâmetros:
+            after (int): último LSN já recebido
+            timeout (float): tempo máximo de espera em segundos
+
+        Retorna:
+            A lista de tuplas (LSN, instante, registro), vazia caso nenhuma
+            alteração tenha acontecido no período, ou None caso as alterações
+            seguintes a `after` já tenham sido descartadas.
+        """
+
+        with self._cond:
+            if self.lsn <= after:
+                self._cond.wait(timeout)
+            first = self.lsn - len(self._records) + 1
+            if after + 1 < first:
+                return None
+            return list(
+                itertools.islice(self._records, after + 1 - first, None)
+            )
+
+    def stream(self, request, snapshot, stop: threading.Event):
+        """
+        Gera as mensagens enviadas a uma réplica pelo procedimento
+        `replicate`: um snapshot, caso a réplica não tenha um estado
+        compatível com este registro (ou fique atrasada demais), e depois as
+        alterações e os heartbeats.
+
+        Parâmetros:
+            request (ReplicateRequest): requisição da réplica
+            snapshot: função que retorna uma cópia consistente do estado do
+                      servidor, como uma tupla (LSN, carteiras, ordens
+                      pendentes, próximo identificador de ordem)
+            stop (threading.Event): evento que encerra o stream
+
+        Retorna:
+            Um gerador de mensagens do tipo ReplicationMessage.
+        """
+
+        after = request.after if request.log_id == self.id else None
+        while not stop.is_set():
+            records = None
+            if after is not None:
+                records = self.read(after, HEARTBEAT_INTERVAL)
+            if records is None:
+                after = yield from self._snapshot(*snapshot())
+                continue
+
+            # As alterações acumuladas desde o último envio vão em lotes, o que
+            # reduz o custo por alteração quando a réplica fica para trás
+            for start in range(0, len(records), RECORDS_PER_MESSAGE):
+                batch = records[start : start + RECORDS_PER_MESSAGE]
+                after, created, _ = batch[-1]
+                yield wallet_pb2.ReplicationMessage(
+                    lsn=after,
+                    primary_lsn=self.lsn,
+                    sent_at=created,
+                    records=[record for _, _, record in batch],
+                )
+
+            if not records:
+                # O instante é lido antes do LSN, então a réplica só se
+                # considera em dia até ele quando nada mudou entre os dois
+                now = time.time()
+                yield wallet_pb2.ReplicationMessage(
+                    lsn=after, primary_lsn=self.lsn, sent_at=now
+                )
+
+    def _snapshot(self, lsn, wallets, orders, next_order):
+        """
+        Gera as partes de um snapshot do estado.
+
+        Retorna:
+            Um gerador de mensagens do tipo ReplicationMessage, cujo valor de
+            retorno é o LSN do snapshot.
+        """
+
+        sent_at = time.time()
+        orders = [
+            wallet_pb2.PendingOrder(
+                payment_order=payment_order, value=value, wallet=wallet or ""
+            )
+            for payment_order, value, wallet in orders
+        ]
+        parts = max(
+            1, -(-len(wallets) // SNAPSHOT_CHUNK), -(-len(orders) // SNAPSHOT_CHUNK)
+        )
+        for part in range(parts):
+            chunk = slice(part * SNAPSHOT_CHUNK, (part + 1) * SNAPSHOT_CHUNK)
+            yield wallet_pb2.ReplicationMessage(
+                lsn=lsn,
+                primary_lsn=lsn,
+                sent_at=sent_at,
+                snapshot=wallet_pb2.SnapshotChunk(
+                    log_id=self.id,
+                    wallets=dict(wallets[chunk]),
+                    orders=orders[chunk],
+                    next_order=next_order,
+                    first=part == 0,
+                    last=part == parts - 1,
+                ),
+            )
+        return lsn
+
+
+class Replica:
+    def __init__(
+        self, primary_addr: tuple[str, int], retry_interval: float = 0.5
+    ) -> None:
+        """
+        Cópia somente-leitura do estado de um servidor de carteiras, mantida
+        por uma thread que recebe as alterações do servidor principal pelo
+        procedimento `replicate` e as aplica na mesma ordem. Caso a conexão
+        caia, a thread volta a se conectar a partir do último LSN aplicado.
+
+        O atraso da réplica é medido pelo instante (no relógio do servidor
+        principal) até o qual o seu estado é conhecido como igual ao do
+        principal: o instante da última alteração aplicada ou, quando a
+        réplica está em dia, o do último heartbeat recebido.
+
+        Parâmetros:
+            primary_addr (tuple[str, int]): endereço do servidor principal
+            retry_interval (float): espera, em segundos, antes de voltar a
+                                    se conectar
+        """
+
+        self.primary_addr = primary_addr
+        self.retry_interval = retry_interval
+
+        # Estado replicado, protegido por `lock`
+        self.lock = threading.Lock()
+        self.wallets: dict[str, int] = {}
+        self.payment_orders: dict[int, tuple[int, str]] = {}
+        self.next_order = 1
+        self.log_id = ""
+        self.lsn = 0
+        self.synced = threading.Event()
+        # Carteiras e ordens do snapshot que está sendo recebido
+        self._pending = None
+
+        # Instante (do servidor principal) até o qual o estado é conhecido e
+        # último LSN informado pelo servidor principal
+        self.as_of = 0.0
+        self.primary_lsn = 0
+
+        self._stop = threading.Event()
+        self._channel = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def staleness(self) -> float:
+        """
+        Retorna há quantos segundos o estado da réplica pode estar
+        desatualizado (infinito antes do primeiro snapshot).
+        """
+
+        if not self.synced.is_set():
+            return float("inf")
+        return max(0.0, time.time() - self.as_of)
+
+    def lag(self) -> int:
+        """
+        Retorna o número de alterações do servidor principal que a réplica
+        ainda não aplicou (segundo a última mensagem recebida).
+        """
+
+        return max(0, self.primary_lsn - self.lsn)
+
+    def _run(self):
+        while not self._stop.is_set():
+            host, port = self.primary_addr
+            self._channel = grpc.insecure_channel(f"{host}:{port}")
+            stub = wallet_pb2_grpc.WalletStub(self._channel)
+            try:
+                for message in stub.replicate(
+                    wallet_pb2.ReplicateRequest(log_id=self.log_id, after=self.lsn)
+                ):
+                    self._apply(message)
+            except grpc.RpcError:
+                # Inclusive RESOURCE_EXHAUSTED, quando o servidor principal já
+                # tem o máximo de streams abertos: enquanto não sincroniza, a
+                # réplica responde UNAVAILABLE e as consultas vão ao principal
+                pass
+            self._channel.close()
+            self._stop.wait(self.retry_interval)
+
+    def _apply(self, message):
+        """
+        Aplica uma mensagem recebida do servidor principal.
+
+        Parâmetros:
+            message (ReplicationMessage): lote de alterações, parte de um
+                                          snapshot ou heartbeat
+        """
+
+        if message.HasField("snapshot"):
+            chunk = message.snapshot
+            # O snapshot chega em partes; o estado só é trocado na última
+            if chunk.first:
+                self._pending = ({}, {})
+            wallets, orders = self._pending
+            wallets.update(chunk.wallets)
+            for order in chunk.orders:
+                orders[order.payment_order] = (order.value, order.wallet or None)
+            if not chunk.last:
+                return
+            with self.lock:
+                self.wallets, self.payment_orders = wallets, orders
+                self.next_order = chunk.next_order
+                self.log_id = chunk.log_id
+                self.lsn = message.lsn
+            # Os LSNs de um novo registro recomeçam do início
+            self.primary_lsn = message.primary_lsn
+            self._pending = None
+            self.synced.set()
+
+        elif message.records:
+            with self.lock:
+                for record in message.records:
+                    self.next_order = apply_record(
+                        record.split(),
+                        self.wallets,
+                        self.payment_orders,
+                        self.next_order,
+                    )
+                self.lsn = message.lsn
+
+        # Uma alteração deixa o estado igual ao do servidor principal no
+        # instante em que ela foi feita; um heartbeat só indica isso quando
+        # não há alterações pendentes
+        self.primary_lsn = max(self.primary_lsn, message.primary_lsn)
+        if message.records or self.lsn >= message.primary_lsn:
+            self.as_of = max(self.as_of, message.sent_at)
+
+    def close(self) -> None:
+        """
+        Para a thread de replicação.
+        """
+
+        self._stop.set()
+        if self._channel is not None:
+            self._channel.close()
+
+
+class ReplicaReader:
+    def __init__(self, primary_stub, replica_addr: tuple[str, int]) -> None:
+        """
+        Stub de leitura usado pelos clientes: as consultas de saldo vão para
+        a réplica e, caso ela esteja indisponível ou mais atrasada que o
+        permitido (código UNAVAILABLE), para o servidor principal.
+
+        Parâmetros:
+            primary_stub: stub do servidor principal
+            replica_addr (tuple[str, int]): endereço da réplica
+        """
+
+        self._primary = primary_stub
+        host, port = replica_addr
+        self._channel = grpc.insecure_channel(f"{host}:{port}")
+        self._replica = wallet_pb2_grpc.WalletStub(self._channel)
+
+    def balance(self, request):
+        try:
+            return self._replica.balance(request)
+        except grpc.RpcError as error:
+            if error.code() != grpc.StatusCode.UNAVAILABLE:
+                raise
+            return self._primary.balance(request)
+
+    def close(self) -> None:
+        self._channel.close()
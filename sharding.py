@@ -0,0 +1,474 @@
+# Particionamento das carteiras entre vários servidores de carteiras
+# Vinicius Gomes - 2021421869
+
+import bisect
+import hashlib
+import itertools
+import time
+import uuid
+
+import grpc
+
+import admission
+import transport
+import wallet_pb2
+import wallet_pb2_grpc
+from channel_pool import ChannelPool
+
+
+class HashRing:
+    def __init__(self, shards: int, replicas: int = 128) -> None:
+        """
+        Anel de hash consistente que associa cada carteira a um dos shards
+        (servidores de carteiras). Cada shard ocupa `replicas` pontos do
+        anel, e uma carteira pertence ao shard do primeiro ponto após o hash
+        do seu identificador. Os pontos dependem apenas do índice do shard,
+        então os servidores e os roteadores calculam o mesmo mapeamento sem
+        precisar conhecer os endereços uns dos outros.
+
+        Parâmetros:
+            shards (int): número de shards
+            replicas (int): número de pontos de cada shard no anel
+        """
+
+        self.shards = shards
+        points = sorted(
+            (_hash(f"shard{shard}-{replica}"), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard(self, wallet: str) -> int:
+        """
+        Retorna o índice do shard que guarda a carteira informada.
+
+        Parâmetros:
+            wallet (str): identificador da carteira
+        """
+
+        index = bisect.bisect(self._hashes, _hash(wallet)) % len(self._hashes)
+        return self._owners[index]
+
+
+def _hash(key):
+    # O hash de strings do Python é randomizado a cada execução, então um
+    # hash estável é usado para que todos os processos concordem
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+# Os identificadores das ordens de pagamento carregam o shard que as criou:
+# a ordem de número `sequence` do shard `shard` recebe o ID
+# sequence * shards + shard. Com um único shard, os IDs não mudam
+
+
+def order_id(sequence: int, shard: int, shards: int) -> int:
+    """
+    Retorna o identificador externo de uma ordem de pagamento.
+
+    Parâmetros:
+        sequence (int): número da ordem dentro do shard
+        shard (int): índice do shard que criou a ordem
+        shards (int): número de shards
+    """
+
+    return sequence * shards + shard
+
+
+def order_shard(payment_order: int, shards: int) -> int:
+    """
+    Retorna o índice do shard que guarda a ordem de pagamento.
+
+    Parâmetros:
+        payment_order (int): identificador externo da ordem
+        shards (int): número de shards
+    """
+
+    return payment_order % shards
+
+
+def parse_wallet_addr(text: str):
+    """
+    Lê o endereço do servidor de carteiras informado na linha de comando. Com
+    as carteiras particionadas, são informados os endereços de todos os
+    shards, separados por vírgula e na ordem dos índices ("host:porta,...").
+    Cada endereço também pode ser um socket Unix ("unix:/caminho").
+
+    Parâmetros:
+        text (str): endereço ou endereços
+
+    Retorna:
+        Um par (host, porta), caso haja um único servidor, ou a lista de
+        pares de cada shard (ver `transport.parse_address`).
+    """
+
+    addresses = [transport.parse_address(address) for address in text.split(",")]
+    return addresses[0] if len(addresses) == 1 else addresses
+
+
+def connect(wallet_addr, pool_options: dict | None = None):
+    """
+    Abre a comunicação com o serviço de carteiras.
+
+    Parâmetros:
+        wallet_addr (tuple[str, int] | list[tuple[str, int]]): endereço do
+            servidor de carteiras ou lista dos endereços dos shards
+        pool_options (dict | None): parâmetros do conjunto de canais com cada
+                                    servidor (ver `channel_pool.from_args`)
+
+    Retorna:
+        Uma tupla (canais, stub), em que os canais são um ChannelPool. Com
+        vários shards, o roteador faz o papel dos dois: tem os procedimentos
+        do stub e o `close` dos canais.
+    """
+
+    if isinstance(wallet_addr, list):
+        router = ShardRouter(wallet_addr, pool_options)
+        return router, router
+
+    pool = ChannelPool(f"{wallet_addr[0]}:{wallet_addr[1]}", **(pool_options or {}))
+    return pool, pool.stub(wallet_pb2_grpc.WalletStub)
+
+
+class TransactionAborted(grpc.RpcError):
+    """
+    Erro de uma transferência entre shards desfeita pelo shard da ordem de
+    pagamento porque a preparação venceu antes da decisão chegar. A ordem
+    volta a ficar pendente, então a transferência pode ser tentada de novo.
+    Tem a interface de um erro do gRPC (código ABORTED).
+    """
+
+    def code(self):
+        return grpc.StatusCode.ABORTED
+
+    def details(self):
+        return "transação entre shards desfeita"
+
+
+class CreditLost(grpc.RpcError):
+    """
+    Erro de uma transferência entre shards confirmada pelo shard da ordem de
+    pagamento cujo crédito o shard da carteira de destino não conhece mais
+    (p.ex. porque ele reiniciou sem o log durável). O débito já foi feito,
+    então a transferência não pode ser tentada de novo. Tem a interface de
+    um erro do gRPC (código DATA_LOSS).
+    """
+
+    def code(self):
+        return grpc.StatusCode.DATA_LOSS
+
+    def details(self):
+        return "crédito da transação entre shards perdido"
+
+
+class ShardRouter:
+    # Número de tentativas e prazo, em segundos, de cada tentativa de enviar
+    # uma decisão a um shard
+    DECISION_ATTEMPTS = 5
+    DECISION_TIMEOUT = 5.0
+
+    def __init__(
+        self, addresses: list[tuple[str, int]], pool_options: dict | None = None
+    ) -> None:
+        """
+        Roteador das chamadas ao serviço de carteiras quando as carteiras
+        estão particionadas entre vários servidores. Tem a mesma interface do
+        WalletStub (os procedimentos recebem e retornam as mesmas mensagens),
+        então pode ser usado no lugar dele pela loja e pelos clientes.
+
+        As consultas e as criações de ordens vão para o shard da carteira.
+        Uma transferência vai para o shard da ordem de pagamento quando a
+        carteira de destino também está nele; caso contrário, o roteador
+        coordena uma confirmação em duas fases entre os dois shards: prepara
+        o débito da ordem (que fica reservada) e o crédito na carteira e,
+        caso as duas preparações tenham sucesso, confirma as duas; caso
+        contrário, desfaz a preparação do débito. Os códigos de retorno são
+        os mesmos de uma transferência dentro de um único servidor.
+
+        O shard da ordem de pagamento é quem decide a transação: o commit é
+        enviado primeiro a ele, que guarda a decisão, e só depois ao shard da
+        carteira de destino, e cada decisão é repetida até ser recebida. Caso
+        o roteador termine (ou um shard não responda) entre as duas fases, as
+        preparações vencem depois de `Wallet.PREPARE_TIMEOUT` segundos: o
+        débito é desfeito pelo shard da ordem, e o crédito é aplicado ou
+        descartado conforme a decisão que o shard da carteira consulta no
+        shard da ordem.
+
+        Parâmetros:
+            addresses (list[tuple[str, int]]): endereço de cada shard, na
+                                               ordem dos índices
+            pool_options (dict | None): parâmetros do conjunto de canais com
+                                        cada shard
+        """
+
+        self.ring = HashRing(len(addresses))
+        # Endereços enviados no crédito, para que o shard da carteira de
+        # destino possa consultar a decisão no shard da ordem
+        self._targets = [f"{host}:{port}" for host, port in addresses]
+        self._channels = [
+            ChannelPool(f"{host}:{port}", **(pool_options or {}))
+            for host, port in addresses
+        ]
+        self._stubs = [
+            pool.stub(wallet_pb2_grpc.WalletStub) for pool in self._channels
+        ]
+        # Identificadores únicos das transações entre shards
+        self._transaction_prefix = uuid.uuid4().hex[:16]
+        self._transactions = itertools.count(1)
+
+    def _wallet_stub(self, wallet):
+        return self._stubs[self.ring.shard(wallet)]
+
+    def balance(self, request, timeout=None):
+        return self._wallet_stub(request.wallet).balance(request, timeout=timeout)
+
+    def create_payment_order(self, request, timeout=None):
+        return self._wallet_stub(request.wallet).create_payment_order(
+            request, timeout=timeout
+        )
+
+    def transfer(self, request, timeout=None):
+        """
+        Transfere uma ordem de pagamento, usando a confirmação em duas fases
+        quando a ordem e a carteira de destino estão em shards diferentes.
+
+        Com `timeout`, a transferência e as duas preparações terminam dentro
+        do prazo (um grpc.RpcError é propagado caso ele acabe). Depois que as
+        duas preparações tiveram sucesso, a decisão é enviada aos shards
+        independentemente do prazo (ver `_send_decision`). Caso o shard da
+        ordem responda que desfez a transação, TransactionAborted é
+        propagado; caso ele não responda, o último grpc.RpcError é
+        propagado, e a transação é resolvida pelos shards. Caso o shard da
+        carteira de destino responda ao commit que não conhece a transação,
+        CreditLost é propagado.
+
+        Parâmetros:
+            request (TransferRequest): transferência a ser feita
+            timeout (float | None): prazo, em segundos (None: sem prazo)
+
+        Retorna:
+            Uma mensagem do tipo TransferReply, com os mesmos códigos da
+            transferência em um único servidor.
+        """
+
+        source = order_shard(request.payment_order, len(self._stubs))
+        destination = self.ring.shard(request.wallet)
+        if source == destination:
+            return self._stubs[source].transfer(request, timeout=timeout)
+
+        transaction = f"{self._transaction_prefix}-{next(self._transactions)}"
+        deadline = admission.deadline(timeout)
+
+        # Primeira fase: o débito é preparado antes do crédito, para que os
+        # erros da ordem de pagamento (-1 e -2) tenham precedência sobre o
+        # erro da carteira de destino (-3), como em um único servidor
+        debit = self._stubs[source].prepare(
+            wallet_pb2.PrepareRequest(transaction=transaction, debit=request),
+            timeout=timeout,
+        )
+        if debit.status < 0:
+            return wallet_pb2.TransferReply(status=debit.status)
+
+        decision = wallet_pb2.DecisionRequest(transaction=transaction)
+        try:
+            credit = self._stubs[destination].prepare(
+                wallet_pb2.PrepareRequest(
+                    transaction=transaction,
+                    credit=wallet_pb2.CreditRequest(
+                        wallet=request.wallet, value=request.recount
+                    ),
+                    source=self._targets[source],
+                ),
+                timeout=admission.remaining(deadline),
+            )
+        except grpc.RpcError:
+            # O débito preparado é desfeito, liberando a ordem de pagamento
+            self._stubs[source].abort(decision)
+            raise
+        if credit.status < 0:
+            self._stubs[source].abort(decision)
+            return wallet_pb2.TransferReply(status=credit.status)
+
+        # Segunda fase: as duas preparações tiveram sucesso, e o commit no
+        # shard da ordem decide a transação
+        if self._send_decision(source, "commit", decision).status < 0:
+            # A preparação do débito venceu antes do commit: o crédito também
+            # é desfeito (ou, caso o shard não responda, vence e consulta a
+            # decisão no shard da ordem)
+            try:
+                self._send_decision(destination, "abort", decision)
+            except grpc.RpcError:
+                pass
+            raise TransactionAborted()
+
+        # A transação já está confirmada; caso o commit do crédito não chegue,
+        # o shard da carteira de destino consulta a decisão quando a
+        # preparação vencer
+        try:
+            credit = self._send_decision(destination, "commit", decision)
+        except grpc.RpcError:
+            return wallet_pb2.TransferReply(status=0)
+        if credit.status < 0:
+            # O shard de destino não tem a preparação nem a decisão: o
+            # crédito foi perdido e não há como refazê-lo daqui
+            raise CreditLost()
+        return wallet_pb2.TransferReply(status=0)
+
+    def _send_decision(self, shard, method, decision):
+        """
+        Envia uma decisão (commit ou abort) a um shard, repetindo a chamada,
+        com espera exponencial entre as tentativas, até que ela seja
+        recebida. As decisões são idempotentes, então repetir uma decisão
+        que já foi aplicada não muda nada.
+
+        Parâmetros:
+            shard (int): índice do shard
+            method (str): "commit" ou "abort"
+            decision (DecisionRequest): transação
+
+        Retorna:
+            A mensagem DecisionReply do shard. Caso todas as
+            `DECISION_ATTEMPTS` tentativas falhem, o último grpc.RpcError é
+            propagado.
+        """
+
+        call = getattr(self._stubs[shard], method)
+        for attempt in range(self.DECISION_ATTEMPTS):
+            try:
+                return call(decision, timeout=self.DECISION_TIMEOUT)
+            except grpc.RpcError:
+                if attempt == self.DECISION_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.05 * 2**attempt)
+
+    def batch_create_payment_orders(self, request):
+        """
+        Divide o lote entre os shards das carteiras, enviando os sub-lotes em
+        paralelo.
+
+        Retorna:
+            Uma mensagem do tipo BatchCreatePaymentOrdersReply com os
+            resultados na mesma ordem da requisição.
+        """
+
+        groups = {}
+        for index, item in enumerate(request.orders):
+            groups.setdefault(self.ring.shard(item.wallet), []).append(index)
+
+        calls = {
+            shard: self._stubs[shard].batch_create_payment_orders.future(
+                wallet_pb2.BatchCreatePaymentOrdersRequest(
+                    orders=[request.orders[index] for index in indexes]
+                )
+            )
+            for shard, indexes in groups.items()
+        }
+
+        results = [None] * len(request.orders)
+        for shard, indexes in groups.items():
+            for index, result in zip(indexes, calls[shard].result().results):
+                results[index] = result
+        return wallet_pb2.BatchCreatePaymentOrdersReply(results=results)
+
+    def batch_transfer(self, request, timeout=None):
+        """
+        Envia em lote, para cada shard e em paralelo, as transferências cuja
+        ordem e carteira de destino estão no mesmo shard. As transferências
+        entre shards são feitas em seguida, uma a uma, com a confirmação em
+        duas fases. Todas as chamadas terminam dentro do prazo `timeout`
+        (None: sem prazo).
+
+        Retorna:
+            Uma mensagem do tipo BatchTransferReply com os resultados na
+            mesma ordem da requisição.
+        """
+
+        groups = {}
+        crossing = []
+        for index, item in enumerate(request.transfers):
+            source = order_shard(item.payment_order, len(self._stubs))
+            if source == self.ring.shard(item.wallet):
+                groups.setdefault(source, []).append(index)
+            else:
+                crossing.append(index)
+
+        deadline = admission.deadline(timeout)
+        calls = {
+            shard: self._stubs[shard].batch_transfer.future(
+                wallet_pb2.BatchTransferRequest(
+                    transfers=[request.transfers[index] for index in indexes]
+                ),
+                timeout=timeout,
+            )
+            for shard, indexes in groups.items()
+        }
+
+        results = [None] * len(request.transfers)
+        for shard, indexes in groups.items():
+            for index, result in zip(indexes, calls[shard].result().results):
+                results[index] = result
+        for index in crossing:
+            results[index] = self.transfer(
+                request.transfers[index], admission.remaining(deadline)
+            )
+        return wallet_pb2.BatchTransferReply(results=results)
+
+    def purchase(self, request, timeout=None):
+        """
+        Realiza uma compra. Quando o comprador e o vendedor estão no mesmo
+        shard, a compra é atômica nesse shard; caso contrário, a ordem de
+        pagamento é criada no shard do comprador e transferida em seguida
+        com a confirmação em duas fases, ambas dentro do prazo `timeout`
+        (None: sem prazo).
+
+        Retorna:
+            Uma mensagem do tipo PurchaseReply, com os mesmos códigos da
+            compra em um único servidor.
+        """
+
+        buyer = self.ring.shard(request.buyer)
+        if buyer == self.ring.shard(request.seller):
+            return self._stubs[buyer].purchase(request, timeout=timeout)
+
+        deadline = admission.deadline(timeout)
+        order = self._stubs[buyer].create_payment_order(
+            wallet_pb2.CreatePaymentOrderRequest(
+                wallet=request.buyer, value=request.value
+            ),
+            timeout=timeout,
+        )
+        if order.retval < 0:
+            return wallet_pb2.PurchaseReply(retval=order.retval)
+
+        transfer = self.transfer(
+            wallet_pb2.TransferRequest(
+                payment_order=order.retval,
+                recount=request.value,
+                wallet=request.seller,
+            ),
+            admission.remaining(deadline),
+        )
+        return wallet_pb2.PurchaseReply(retval=order.retval, status=transfer.status)
+
+    def end_execution(self, request):
+        """
+        Finaliza todos os shards.
+
+        Retorna:
+            Uma mensagem do tipo EndExecutionReply com o total de ordens de
+            pagamento pendentes em todos os shards.
+        """
+
+        calls = [stub.end_execution.future(request) for stub in self._stubs]
+        pendencies = sum(call.result().pendencies for call in calls)
+        return wallet_pb2.EndExecutionReply(pendencies=pendencies)
+
+    def close(self) -> None:
+        """
+        Fecha os canais com todos os shards.
+        """
+
+        for channel in self._channels:
+            channel.close()
@@ -0,0 +1,204 @@
+# Estado do servidor de carteiras compartilhado entre processos
+# Vinicius Gomes - 2021421869
+
+import multiprocessing
+from collections.abc import Mapping
+
+
+class SharedWalletTable(Mapping):
+    def __init__(self, wallets: Mapping[str, int]) -> None:
+        """
+        Tabela de carteiras com os saldos em memória compartilhada, usada
+        quando vários processos atendem o mesmo servidor de carteiras. Deve
+        ser criada antes de os processos serem iniciados (com fork), que
+        herdam o mesmo mapeamento de memória.
+
+        Os identificadores das carteiras são conhecidos quando o servidor
+        começa e nenhuma carteira é criada depois disso, então cada processo
+        guarda a sua própria cópia (somente-leitura) do índice identificador →
+        slot; apenas os saldos, um inteiro de 64 bits por slot, ficam na
+        memória compartilhada. A tabela se comporta como o dicionário de
+        carteiras, exceto pela atribuição a uma carteira inexistente, que
+        gera KeyError.
+
+        Os acessos não são sincronizados: quem altera um saldo deve ter o
+        lock (compartilhado entre os processos) da carteira adquirido.
+
+        Parâmetros:
+            wallets (Mapping[str, int]): carteiras iniciais
+        """
+
+        self.names = list(wallets)
+        self._index = {wallet: slot for slot, wallet in enumerate(self.names)}
+        self._balances = multiprocessing.RawArray(
+            "q", [wallets[wallet] for wallet in self.names]
+        )
+
+    def slot(self, wallet: str) -> int:
+        """
+        Retorna o slot da carteira informada.
+
+        Parâmetros:
+            wallet (str): identificador da carteira
+        """
+
+        return self._index[wallet]
+
+    def __getitem__(self, wallet: str) -> int:
+        return self._balances[self._index[wallet]]
+
+    def __setitem__(self, wallet: str, balance: int) -> None:
+        self._balances[self._index[wallet]] = balance
+
+    def __contains__(self, wallet) -> bool:
+        return wallet in self._index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+class SharedOrderStore:
+    def __init__(self, wallets: SharedWalletTable, capacity: int = 1 << 20) -> None:
+        """
+        Armazenamento das ordens de pagamento em memória compartilhada, com a
+        mesma interface de DictOrderStore. Deve ser criado antes de os
+        processos serem iniciados.
+
+        Os identificadores são sequenciais e a ordem de ID `n` fica no slot
+        `(n - 1) % capacity` de arrays com o ID, o valor, o slot da carteira
+        de origem e a marca de pendente de cada ordem. Assim, os IDs não têm
+        limite, mas no máximo `capacity` ordens podem estar pendentes ao mesmo
+        tempo (mais precisamente, uma ordem só pode ser criada se a ordem de
+        `capacity` IDs antes dela já não estiver pendente). O próximo ID e o
+        número de ordens pendentes também ficam na memória compartilhada.
+
+        Os métodos não são sincronizados: quem os chama deve ter o lock
+        (compartilhado entre os processos) das ordens de pagamento adquirido.
+
+        Parâmetros:
+            wallets (SharedWalletTable): carteiras, usadas para guardar a
+                                         origem de cada ordem como um slot
+            capacity (int): número máximo de ordens pendentes
+        """
+
+        self._wallets = wallets
+        self.capacity = capacity
+        self._ids = multiprocessing.RawArray("q", capacity)
+        self._amounts = multiprocessing.RawArray("q", capacity)
+        self._sources = multiprocessing.RawArray("i", capacity)
+        self._live = multiprocessing.RawArray("b", capacity)
+        self._next = multiprocessing.RawValue("q", 1)
+        self._count = multiprocessing.RawValue("q", 0)
+
+    def _slot(self, payment_order):
+        # Slot da ordem de pagamento, ou -1 caso ela não esteja pendente
+        if payment_order < 1:
+            return -1
+        slot = (payment_order - 1) % self.capacity
+        if not self._live[slot] or self._ids[slot] != payment_order:
+            return -1
+        return slot
+
+    def has_room(self) -> bool:
+        """
+        Indica se uma nova ordem de pagamento pode ser criada, isto é, se o
+        slot do próximo ID não está ocupado por uma ordem pendente.
+        """
+
+        return not self._live[(self._next.value - 1) % self.capacity]
+
+    def create(self, value: int, wallet: str) -> int:
+        """
+        Registra uma nova ordem de pagamento. Caso o slot da nova ordem
+        ainda esteja ocupado por uma ordem pendente, gera OverflowError
+        (quem cria a ordem deve consultar `has_room` antes).
+
+        Parâmetros:
+            value (int): valor da ordem de pagamento
+            wallet (str): carteira de origem
+
+        Retorna:
+            O identificador da ordem de pagamento criada.
+        """
+
+        payment_order = self._next.value
+        slot = (payment_order - 1) % self.capacity
+        if self._live[slot]:
+            raise OverflowError("capacidade de ordens pendentes esgotada")
+
+        self._ids[slot] = payment_order
+        self._amounts[slot] = value
+        self._sources[slot] = self._wallets.slot(wallet)
+        self._live[slot] = 1
+        self._next.value = payment_order + 1
+        self._count.value += 1
+        return payment_order
+
+    def check(self, payment_order: int, recount: int) -> int:
+        slot = self._slot(payment_order)
+        if slot < 0:
+            return -1
+        if self._amounts[slot] != recount:
+            return -2
+        return 0
+
+    def take(self, payment_order: int, recount: int) -> int:
+        status = self.check(payment_order, recount)
+        if status == 0:
+            self._remove((payment_order - 1) % self.capacity)
+        return status
+
+    def source(self, payment_order: int) -> str | None:
+        slot = self._slot(payment_order)
+        return self._wallets.names[self._sources[slot]] if slot >= 0 else None
+
+    def expire(self, payment_order: int) -> tuple[int, str] | None:
+        slot = self._slot(payment_order)
+        if slot < 0:
+            return None
+        entry = self._amounts[slot], self._wallets.names[self._sources[slot]]
+        self._remove(slot)
+        return entry
+
+    def _remove(self, slot):
+        self._live[slot] = 0
+        self._count.value -= 1
+
+    @property
+    def next_id(self) -> int:
+        return self._next.value
+
+    def __contains__(self, payment_order) -> bool:
+        return self._slot(payment_order) >= 0
+
+    def __len__(self) -> int:
+        return self._count.value
+
+    def items(self):
+        for payment_order, value, _ in self.records():
+            yield payment_order, value
+
+    def records(self):
+        # Percorre as ordens pendentes em ordem crescente de ID
+        pending = sorted(
+            (self._ids[slot], slot)
+            for slot in range(self.capacity)
+            if self._live[slot]
+        )
+        for payment_order, slot in pending:
+            yield (
+                payment_order,
+                self._amounts[slot],
+                self._wallets.names[self._sources[slot]],
+            )
+
+    def __repr__(self) -> str:
+        # Mesmo formato da exibição de um dicionário
+        items = ", ".join(f"{order}: {value}" for order, value in self.items())
+        return "{" + items + "}"
@@ -3,17 +3,20 @@
 
 from __future__ import print_function
 
-import sys
+import argparse
 
 import grpc
 
+import channel_pool
+import pipeline
+import sharding
 import store_pb2
 import store_pb2_grpc
+import transport
 import wallet_pb2
-import wallet_pb2_grpc
 
 
-def buy(buyer_wallet, wallet_stub, store_stub, price):
+def buy(buyer_wallet, wallet_stub, store_stub, price, deadline=None):
     """
     Realiza uma série de requisições para efetuar a compra do produto vendido
     pela loja. O primeiro passo é criar a ordem de pagamento, debitando o valor
@@ -31,25 +34,150 @@ def buy(buyer_wallet, wallet_stub, store_stub, price):
         store_stub: stub gRPC para se comunicar com seguindo a interface do
                     servidor de lojas
         price (int): preço do produto vendido pela loja
+        deadline (float | None): prazo, em segundos, de cada chamada; uma
+                                 chamada que não termina dentro dele é
+                                 exibida com o código -9 (None: sem prazo)
     """
 
     # Cria a ordem de pagamento, debitando o valor do produto
     # da conta do usuário que comprou
-    payment_order_response = wallet_stub.create_payment_order(
-        wallet_pb2.CreatePaymentOrderRequest(wallet=buyer_wallet, value=price)
-    )
+    try:
+        payment_order_response = wallet_stub.create_payment_order(
+            wallet_pb2.CreatePaymentOrderRequest(wallet=buyer_wallet, value=price),
+            timeout=deadline,
+        )
+    except grpc.RpcError:
+        print(-9)
+        return
     retval = payment_order_response.retval
     print(retval)
 
     # Caso a criação da ordem de pagamento tenha sido um sucesso
-    if retval not in [-1, -2]:
+    if retval not in [-1, -2, -3]:
         # Chama o procedimento de venda no servidor, que será
         # responsável por transferir o valor da ordem de pagamento
         # para a carteira do vendedor
-        sell_response = store_stub.sell(store_pb2.SellRequest(payment_order=retval))
+        # O prazo é repassado pela loja ao servidor de carteiras; caso ele
+        # acabe, a venda é exibida com o mesmo código -9 de um erro de
+        # comunicação
+        try:
+            sell_response = store_stub.sell(
+                store_pb2.SellRequest(payment_order=retval), timeout=deadline
+            )
+        except grpc.RpcError:
+            print(-9)
+            return
         print(sell_response.status)
 
 
+def buy_atomic(buyer_wallet, store_stub, deadline=None):
+    """
+    Realiza a compra do produto com uma única requisição para o servidor da
+    loja, que pede ao servidor de carteiras a compra atômica (débito do
+    comprador e crédito do vendedor em uma só chamada). A saída é a mesma de
+    `buy`: o resultado da criação da ordem de pagamento e, se não houver erro
+    nessa etapa, o status da venda.
+
+    Parâmetros:
+        buyer_wallet (str): identificador da carteira do comprador
+        store_stub: stub gRPC para se comunicar com seguindo a interface do
+                    servidor de lojas
+        deadline (float | None): prazo, em segundos, da chamada (None: sem
+                                 prazo)
+    """
+
+    try:
+        buy_response = store_stub.buy(
+            store_pb2.BuyRequest(wallet=buyer_wallet), timeout=deadline
+        )
+    except grpc.RpcError:
+        print(-9)
+        return
+    retval = buy_response.retval
+    print(retval)
+
+    # Caso a criação da ordem de pagamento tenha sido um sucesso
+    if retval not in [-1, -2, -3]:
+        print(buy_response.status)
+
+
+def _status(future, field):
+    # Campo da resposta de uma chamada terminada, ou -9 caso ela tenha falhado
+    try:
+        return getattr(future.result(), field)
+    except grpc.RpcError:
+        return -9
+
+
+def buy_future(buyer_wallet, wallet_stub, store_stub, price, deadline=None):
+    """
+    Versão de `buy` que não espera pelas respostas: a ordem de pagamento é
+    criada com `.future` e, quando a sua resposta chega, a venda é pedida à
+    loja da mesma forma, com o número da ordem.
+
+    Parâmetros:
+        buyer_wallet (str): identificador da carteira do comprador
+        wallet_stub: stub gRPC do servidor de carteiras
+        store_stub: stub gRPC do servidor de lojas
+        price (int): preço do produto vendido pela loja
+        deadline (float | None): prazo, em segundos, de cada chamada
+
+    Retorna:
+        Um future com os valores que `buy` exibiria, em uma tupla.
+    """
+
+    created = wallet_stub.create_payment_order.future(
+        wallet_pb2.CreatePaymentOrderRequest(wallet=buyer_wallet, value=price),
+        timeout=deadline,
+    )
+
+    def sell(created):
+        retval = _status(created, "retval")
+        if retval in [-1, -2, -3, -9]:
+            return (retval,)
+        sold = store_stub.sell.future(
+            store_pb2.SellRequest(payment_order=retval), timeout=deadline
+        )
+        return pipeline.then(sold, lambda sold: (retval, _status(sold, "status")))
+
+    return pipeline.then(created, sell)
+
+
+def buy_atomic_future(buyer_wallet, store_stub, deadline=None):
+    """
+    Versão de `buy_atomic` que não espera pela resposta.
+
+    Parâmetros:
+        buyer_wallet (str): identificador da carteira do comprador
+        store_stub: stub gRPC do servidor de lojas
+        deadline (float | None): prazo, em segundos, da chamada
+
+    Retorna:
+        Um future com os valores que `buy_atomic` exibiria, em uma tupla.
+    """
+
+    def result(bought):
+        try:
+            reply = bought.result()
+        except grpc.RpcError:
+            return (-9,)
+        if reply.retval in [-1, -2, -3]:
+            return (reply.retval,)
+        return (reply.retval, reply.status)
+
+    bought = store_stub.buy.future(
+        store_pb2.BuyRequest(wallet=buyer_wallet), timeout=deadline
+    )
+    return pipeline.then(bought, result)
+
+
+def print_lines(future):
+    # Exibe os valores de uma compra feita com `buy_future` ou
+    # `buy_atomic_future`, um por linha
+    for value in future.result():
+        print(value)
+
+
 def end_execution(store_stub):
     """
     Realiza uma requisição para o servidor de lojas para encerrar a sua
@@ -66,32 +194,58 @@ def end_execution(store_stub):
     print(response.balance, response.pendencies)
 
 
-def run(buyer_wallet, wallet_addr, store_addr):
+def run(
+    buyer_wallet,
+    wallet_addr,
+    store_addr,
+    atomic=False,
+    pool_options=None,
+    deadline=None,
+    window=1,
+):
     """
     Inicia o cliente do servidor de lojas e processa os comandos
     do usuário.
 
     Parâmetros:
         buyer_wallet (str): identificador da carteira do cliente
-        wallet_addr (tuple[str, int]): endereço do servidor de carteiras
+        wallet_addr (tuple[str, int] | list[tuple[str, int]]): endereço do
+            servidor de carteiras ou, com as carteiras particionadas, de cada
+            shard
         store_addr (tuple[str, int]): endereço do servidor da loja
+        atomic (bool): realiza cada compra com uma única chamada ao servidor
+                       da loja (procedimento `buy`)
+        pool_options (dict | None): parâmetros dos conjuntos de canais com os
+                                    servidores (ver `channel_pool.from_args`)
+        deadline (float | None): prazo, em segundos, de cada chamada de uma
+                                 compra (None: sem prazo)
+        window (int): número máximo de compras em andamento ao mesmo tempo
+                      (1 faz uma compra por vez). As compras não dependem umas
+                      das outras, então são feitas em paralelo, com a saída na
+                      ordem dos comandos; como acontece com vários clientes,
+                      os números das ordens de pagamento podem não seguir a
+                      ordem das compras
     """
 
-    # Abre um canal para se comunicar com o servidor de carteiras
-    wallet_channel = grpc.insecure_channel(f"{wallet_addr[0]}:{wallet_addr[1]}")
-    # Gera o stub para se comunicar com o servidor da loja
-    wallet_stub = wallet_pb2_grpc.WalletStub(wallet_channel)
+    # Abre um canal para se comunicar com o servidor de carteiras e gera o
+    # stub (com vários shards, o roteador faz o papel dos dois)
+    wallet_channel, wallet_stub = sharding.connect(wallet_addr, pool_options)
 
     # Abre um canal para se comunicar com o servidor da loja
-    store_channel = grpc.insecure_channel(f"{store_addr[0]}:{store_addr[1]}")
+    store_channel = channel_pool.ChannelPool(
+        f"{store_addr[0]}:{store_addr[1]}", **(pool_options or {})
+    )
     # Gera o stub para se comunicar com o servidor da loja
-    store_stub = store_pb2_grpc.StoreStub(store_channel)
+    store_stub = store_channel.stub(store_pb2_grpc.StoreStub)
 
     # Lê e exibe o preço do produto vendido pelo servidor daquela loja
     price_response = store_stub.read_price(store_pb2.ReadPriceRequest())
     price = price_response.price
     print(price)
 
+    # Compras em andamento, exibidas na ordem dos comandos
+    pending = pipeline.Pipeline(window)
+
     while True:
         # Lê uma linha da entrada e em caso de EOFError
         # (fim da leitura) sai do loop
@@ -108,32 +262,70 @@ def run(buyer_wallet, wallet_addr, store_addr):
         match command:
             # Realiza a compra de um produto
             case "C":
-                buy(buyer_wallet, wallet_stub, store_stub, price)
+                if window > 1 and atomic:
+                    pending.submit(
+                        buy_atomic_future(buyer_wallet, store_stub, deadline),
+                        print_lines,
+                    )
+                elif window > 1:
+                    pending.submit(
+                        buy_future(
+                            buyer_wallet, wallet_stub, store_stub, price, deadline
+                        ),
+                        print_lines,
+                    )
+                elif atomic:
+                    buy_atomic(buyer_wallet, store_stub, deadline)
+                else:
+                    buy(buyer_wallet, wallet_stub, store_stub, price, deadline)
 
-            # Termina a execução
+            # Termina a execução, depois de todas as compras em andamento
             case "T":
+                pending.drain()
                 end_execution(store_stub)
                 break
 
             case _:
                 pass
 
+    pending.drain()
+
     # Fecha os canais de comunicação criados
     wallet_channel.close()
     store_channel.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cliente do servidor de lojas")
     # Identificador da carteira do comprador
-    buyer_wallet = sys.argv[1]
+    parser.add_argument("buyer_wallet")
+    # Endereço do servidor de carteiras (ou dos shards, separados por vírgula)
+    parser.add_argument("wallet_addr")
+    # Endereço do servidor da loja ("host:porta" ou "unix:/caminho")
+    parser.add_argument("store_addr")
+    # Realiza cada compra com uma única chamada ao servidor da loja
+    parser.add_argument("--atomic", action="store_true")
+    # Conjuntos de canais com os servidores e opções de HTTP/2
+    channel_pool.add_arguments(parser)
+    # Prazo, em segundos, de cada chamada de uma compra
+    parser.add_argument("--deadline", type=float)
+    # Número máximo de compras em andamento ao mesmo tempo
+    parser.add_argument("--window", type=int, default=1)
+    args = parser.parse_args()
 
-    # Endereço do servidor de carteiras
-    wallet_host, wallet_port = sys.argv[2].split(":")
-    wallet_addr = (wallet_host, int(wallet_port))
+    wallet_addr = sharding.parse_wallet_addr(args.wallet_addr)
+    if args.window > 1 and not args.atomic and isinstance(wallet_addr, list):
+        parser.error("--window sem --atomic não é suportado com vários shards")
 
-    # Endereço do servidor da loja
-    store_host, store_port = sys.argv[3].split(":")
-    store_addr = (store_host, int(store_port))
+    store_addr = transport.parse_address(args.store_addr)
 
     # Chama a função que inicia o cliente
-    run(buyer_wallet, wallet_addr, store_addr)
+    run(
+        args.buyer_wallet,
+        wallet_addr,
+        store_addr,
+        args.atomic,
+        channel_pool.from_args(args),
+        args.deadline,
+        args.window,
+    )
@@ -1,17 +1,57 @@
 # Servidor de lojas
 # Vinicius Gomes - 2021421869
 
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import itertools
+import os
+import queue
 import sys
 import threading
+import time
+import uuid
 from concurrent import futures
 
 import grpc
 
+import admission
+import audit
+import breaker
+import channel_pool
+import metrics
+import sharding
 import store_pb2
 import store_pb2_grpc
+import transport
+import wallet_loader
 import wallet_pb2
 import wallet_pb2_grpc
 
+# Códigos do gRPC com os quais uma transferência é tentada de novo
+RETRYABLE = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+# Espera, em segundos, antes da primeira nova tentativa (dobra a cada uma)
+RETRY_BACKOFF = 0.01
+
+# Número mínimo de transferências medidas antes que o quantil de latência
+# seja usado para decidir quando enviar uma chamada redundante, e intervalo,
+# em segundos, entre os recálculos do quantil
+HEDGE_MIN_CALLS = 100
+HEDGE_REFRESH = 0.5
+
+# Respostas às chamadas recusadas pelo controle de admissão: as vendas e as
+# compras recusadas recebem o código -9, o mesmo de um erro de comunicação
+# com o servidor de carteiras, já que nenhuma delas foi feita
+REJECTIONS = {
+    "sell": lambda request: store_pb2.SellReply(status=-9),
+    "buy": lambda request: store_pb2.BuyReply(retval=-9, status=-9),
+    "batch_sell": lambda request: store_pb2.BatchSellReply(
+        results=[store_pb2.SellReply(status=-9) for _ in request.sales]
+    ),
+}
+
 
 # Classe que provê os métodos que implementam o serviço de loja
 class Store(store_pb2_grpc.StoreServicer):
@@ -21,6 +61,13 @@ class Store(store_pb2_grpc.StoreServicer):
         wallet_addr: tuple[str, int],
         seller_wallet: str,
         price: int,
+        audit_log: audit.AuditLog | None = None,
+        pool_options: dict | None = None,
+        hedge_quantile: float | None = None,
+        retries: int = 0,
+        circuit_breaker: breaker.CircuitBreaker | None = None,
+        watch_balance: bool = False,
+        wallet_servicer=None,
     ) -> None:
         """
         Construtor da classe que provê os procedimentos que implementam o
@@ -29,14 +76,79 @@ class Store(store_pb2_grpc.StoreServicer):
         Parâmetros:
             stop_event (threading.Event): evento usado para determinar quando
                                           o servidor deve parar de executar
-            wallet_addr (tuple[str, int]): endereço do servidor de carteiras
+            wallet_addr (tuple[str, int] | list[tuple[str, int]]): endereço
+                do servidor de carteiras ou, com as carteiras particionadas
+                entre vários servidores, lista dos endereços dos shards
             seller_wallet (str): identificador da carteira do vendedor
             price (int): preço do produto vendido
+            audit_log (AuditLog | None): log de auditoria das vendas (None
+                                         desativa)
+            pool_options (dict | None): parâmetros do conjunto de canais com
+                                        o servidor de carteiras (ver
+                                        `channel_pool.from_args`)
+            hedge_quantile (float | None): quantil da latência de `transfer`
+                                           (entre 0 e 1) após o qual uma
+                                           segunda chamada, redundante, é
+                                           enviada (None desativa)
+            retries (int): número de novas tentativas de uma transferência
+                           que falhou com UNAVAILABLE ou DEADLINE_EXCEEDED
+            circuit_breaker (CircuitBreaker | None): disjuntor das chamadas
+                                                     ao servidor de carteiras
+                                                     (None desativa)
+            watch_balance (bool): acompanha o saldo do vendedor pelos eventos
+                                  de `watch_mutations` do servidor de
+                                  carteiras, em vez de somar o preço a cada
+                                  venda (ver `watch_balance`)
+            wallet_servicer (Wallet | None): servicer de carteiras do mesmo
+                                             processo, chamado diretamente em
+                                             vez do servidor em wallet_addr
+                                             (ver `start_wallet_service`)
         """
 
         # Evento de término do servidor
         self._stop_event = stop_event
 
+        # Cada venda registra um evento no log de auditoria, escrito por uma
+        # thread própria fora do caminho da requisição
+        self.audit = audit_log or audit.AuditLog(verbosity=audit.OFF)
+
+        # Métricas de cada procedimento (preenchidas pelo interceptador do
+        # servidor) e das chamadas ao servidor de carteiras
+        self.metrics = metrics.Metrics()
+        self.metrics.add_counters(
+            lambda: {
+                "balance": self.balance,
+                "audit_dropped": self.audit.dropped,
+                "hedged_transfers": self.hedged_transfers,
+                "hedge_wins": self.hedge_wins,
+                "retried_transfers": self.retried_transfers,
+            }
+        )
+
+        # Chamadas redundantes e novas tentativas de `transfer`. Uma venda só
+        # pode ser repetida porque cada requisição leva um identificador
+        # único, e o servidor de carteiras responde a uma repetição com a
+        # resposta da primeira em vez de transferir a ordem de novo (o que
+        # daria -1)
+        self.hedge_quantile = hedge_quantile
+        self.retries = retries
+        self.hedged_transfers = 0
+        self.hedge_wins = 0
+        self.retried_transfers = 0
+        self._hedge_delay = None
+        self._hedge_updated = 0.0
+        self._request_prefix = uuid.uuid4().hex[:16]
+        self._requests = itertools.count(1)
+
+        # Com o servidor de carteiras fora do ar ou lento, o disjuntor faz as
+        # vendas e compras falharem (-9) imediatamente, em vez de cada uma
+        # ocupar uma thread até o gRPC desistir. As mudanças de estado vão
+        # para o log de auditoria e o estado atual, para as métricas
+        self.breaker = circuit_breaker
+        if circuit_breaker is not None:
+            circuit_breaker.on_change = self._breaker_changed
+            self.metrics.add_counters(circuit_breaker.counters)
+
         # Carteira do vendedor
         self.seller_wallet = seller_wallet
         print("seller wallet:", self.seller_wallet)
@@ -46,19 +158,261 @@ class Store(store_pb2_grpc.StoreServicer):
         print("price:", self.price)
 
         # Saldo em conta do vendedor
+        # As vendas são atendidas concorrentemente pelas threads do pool do
+        # servidor, então as atualizações do saldo são protegidas por um lock
         self.balance = 0
+        self._balance_lock = threading.Lock()
+        self.watch_balance = watch_balance
 
         # A abertura do canal e a geração dos stubs é feita no construtor da
         # classe para evitar que a comunicação tenha que ser estabelecida toda
         # vez que for preciso comunicar com o servidor de carteiras
         # Dessa forma, minimizamos o overhead de estabelecimento da conexão
         # entre as duas pontas, obtendo um ligeiro ganho de desempenho
-        self.wallet_channel = grpc.insecure_channel(
-            f"{wallet_addr[0]}:{wallet_addr[1]}"
+        # Com várias vendas concorrentes, uma única conexão HTTP/2 pode virar
+        # o gargalo, então a comunicação usa um conjunto de canais
+        pool_options = pool_options or {}
+        if wallet_servicer is not None:
+            # No mesmo processo, as chamadas vão direto ao servicer, sem
+            # serializar as mensagens nem passar pelo HTTP/2
+            self.wallet_channel = self.wallet_stub = transport.LocalStub(
+                wallet_servicer
+            )
+        elif isinstance(wallet_addr, list):
+            # Com vários shards, o roteador faz o papel do canal e do stub
+            self.wallet_channel = self.wallet_stub = sharding.ShardRouter(
+                wallet_addr, pool_options
+            )
+        else:
+            self.wallet_channel = self._open_channel(
+                f"{wallet_addr[0]}:{wallet_addr[1]}", pool_options
+            )
+            self.wallet_stub = self.wallet_channel.stub(wallet_pb2_grpc.WalletStub)
+
+    def _open_channel(self, target, pool_options):
+        """
+        Abre os canais de comunicação com o servidor de carteiras.
+
+        Parâmetros:
+            target (str): endereço do servidor de carteiras
+            pool_options (dict): parâmetros do conjunto de canais
+        """
+
+        return channel_pool.ChannelPool(target, **pool_options)
+
+    def _record_sale(self, transfer_status):
+        """
+        Função auxiliar que atualiza o saldo do vendedor a partir do status
+        da transferência feita no servidor de carteiras.
+
+        Parâmetros:
+            transfer_status (int): status retornado pela transferência
+        """
+
+        with self._balance_lock:
+            failed = transfer_status in [-1, -2, -3]
+            # Com os eventos do servidor de carteiras, o saldo é atualizado
+            # por eles (ver `watch_balance`)
+            if not failed and not self.watch_balance:
+                self.balance += self.price
+            # Vendas que não alteraram o saldo só são registradas a partir do
+            # nível REQUESTS
+            self.audit.record(
+                audit.REQUESTS if failed else audit.MUTATIONS,
+                "sell",
+                transfer_status,
+                self.balance,
+            )
+
+    def _breaker_changed(self, previous, state):
+        self.audit.record(
+            audit.MUTATIONS,
+            "breaker",
+            breaker.STATES[previous],
+            breaker.STATES[state],
         )
-        self.wallet_stub = wallet_pb2_grpc.WalletStub(self.wallet_channel)
 
-        self._fetch_balance()
+    def _wallet_call(self):
+        """
+        Função auxiliar que envolve uma chamada ao servidor de carteiras com
+        o disjuntor, caso ele esteja ativo. Com o disjuntor aberto, a entrada
+        no contexto falha com CircuitOpenError (um grpc.RpcError), que é
+        tratado como um erro de comunicação.
+        """
+
+        if self.breaker is None:
+            return contextlib.nullcontext()
+        return self.breaker.guard()
+
+    def _transfer_request(self, payment_order):
+        """
+        Função auxiliar que monta a requisição de transferência de uma ordem
+        de pagamento para a carteira do vendedor.
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+        """
+
+        return wallet_pb2.TransferRequest(
+            payment_order=payment_order,
+            recount=self.price,
+            wallet=self.seller_wallet,
+        )
+
+    def _hedge_after(self):
+        """
+        Função auxiliar que retorna quanto tempo, em segundos, esperar pela
+        resposta de `transfer` antes de enviar uma chamada redundante: o
+        quantil `hedge_quantile` das latências medidas, recalculado a cada
+        HEDGE_REFRESH segundos.
+
+        Retorna:
+            O tempo de espera, ou None enquanto não houver medidas
+            suficientes (nesse caso, nenhuma chamada redundante é enviada).
+        """
+
+        now = time.monotonic()
+        if now - self._hedge_updated >= HEDGE_REFRESH:
+            self._hedge_updated = now
+            stats = self.metrics.method("wallet.transfer")
+            if stats.calls >= HEDGE_MIN_CALLS:
+                self._hedge_delay = stats.quantile(self.hedge_quantile) / 1e6
+        return self._hedge_delay
+
+    def _idempotent_request(self, payment_order):
+        """
+        Função auxiliar que monta a requisição de transferência com um
+        identificador único, que permite repeti-la.
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+        """
+
+        request = self._transfer_request(payment_order)
+        request.request_id = f"{self._request_prefix}-{next(self._requests)}"
+        return request
+
+    def _retry_fits(self, attempt, error, deadline):
+        """
+        Função auxiliar que decide se uma transferência que falhou deve ser
+        tentada de novo: ainda há tentativas, o erro é de comunicação e a
+        espera antes da nova tentativa termina antes do prazo da venda.
+        """
+
+        if attempt == self.retries or error.code() not in RETRYABLE:
+            return False
+        backoff = RETRY_BACKOFF * 2**attempt
+        return deadline is None or time.monotonic() + backoff < deadline
+
+    def _call_transfer(self, payment_order, timeout=None):
+        """
+        Função auxiliar que faz a transferência de uma venda no servidor de
+        carteiras, com as chamadas redundantes e as novas tentativas
+        configuradas.
+
+        Parâmetros:
+            payment_order (int): número da ordem de pagamento
+            timeout (float | None): tempo, em segundos, que resta do prazo da
+                                    venda; todas as chamadas ao servidor de
+                                    carteiras terminam dentro dele (None:
+                                    sem prazo)
+
+        Retorna:
+            A mensagem TransferReply da transferência. Um erro de
+            comunicação que persiste após as tentativas (ou o fim do prazo)
+            é propagado como grpc.RpcError.
+        """
+
+        if self.hedge_quantile is None and not self.retries:
+            return self.wallet_stub.transfer(
+                self._transfer_request(payment_order), timeout=timeout
+            )
+
+        # Todas as chamadas da mesma venda usam o mesmo identificador
+        request = self._idempotent_request(payment_order)
+        deadline = admission.deadline(timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                if self.hedge_quantile is None:
+                    return self.wallet_stub.transfer(
+                        request, timeout=admission.remaining(deadline)
+                    )
+                return self._hedged_transfer(request, deadline)
+            except grpc.RpcError as error:
+                if not self._retry_fits(attempt, error, deadline):
+                    raise
+            self.retried_transfers += 1
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+
+    def _hedged_transfer(self, request, deadline=None):
+        """
+        Função auxiliar que envia a transferência e, caso a resposta demore
+        mais que o quantil configurado, envia a mesma requisição de novo,
+        usando a primeira resposta que chegar e cancelando a outra chamada.
+
+        Parâmetros:
+            request (TransferRequest): requisição com identificador
+            deadline (float | None): fim do prazo da venda (relógio de
+                                     time.monotonic()); nenhuma chamada
+                                     redundante é enviada depois dele
+
+        Retorna:
+            A mensagem TransferReply da transferência.
+        """
+
+        timeout = admission.remaining(deadline)
+        first = self.wallet_stub.transfer.future(request, timeout=timeout)
+        delay = self._hedge_after()
+        if delay is None or (timeout is not None and delay >= timeout):
+            return first.result()
+        try:
+            return first.result(timeout=delay)
+        except grpc.FutureTimeoutError:
+            pass
+
+        self.hedged_transfers += 1
+        second = self.wallet_stub.transfer.future(
+            request, timeout=admission.remaining(deadline)
+        )
+        done = queue.SimpleQueue()
+        first.add_done_callback(done.put)
+        second.add_done_callback(done.put)
+
+        # Caso a primeira chamada a terminar tenha falhado, a resposta da
+        # outra é usada
+        winner = done.get()
+        other = second if winner is first else first
+        try:
+            reply = winner.result()
+        except grpc.RpcError:
+            return other.result()
+        other.cancel()
+        if winner is second:
+            self.hedge_wins += 1
+        return reply
+
+    def _transfer_batch(self, payment_orders, timeout=None):
+        """
+        Função auxiliar que transfere para a carteira do vendedor o valor de
+        várias ordens de pagamento, usando uma única chamada em lote ao
+        servidor de carteiras.
+
+        Parâmetros:
+            payment_orders (list[int]): números das ordens de pagamento
+            timeout (float | None): tempo que resta do prazo do lote
+
+        Retorna:
+            A lista com o status de cada transferência, na mesma ordem das
+            ordens de pagamento informadas.
+        """
+
+        batch_response = self.wallet_stub.batch_transfer(
+            wallet_pb2.BatchTransferRequest(
+                transfers=[self._transfer_request(order) for order in payment_orders]
+            ),
+            timeout=timeout,
+        )
+        return [result.status for result in batch_response.results]
 
     def _fetch_balance(self):
         """
@@ -78,6 +432,101 @@ class Store(store_pb2_grpc.StoreServicer):
         self.balance = balance_response.balance
         print("balance:", self.balance)
 
+    def _apply_events(self, message):
+        """
+        Função auxiliar que atualiza o saldo do vendedor com os eventos de uma
+        mensagem de `watch_mutations`. Cada evento traz o saldo da carteira
+        depois da alteração, então o último evento do vendedor dá o saldo
+        atual, qualquer que seja a alteração (inclusive as que não vieram
+        das vendas desta loja).
+
+        Parâmetros:
+            message (MutationEvents): mensagem recebida do stream
+        """
+
+        with self._balance_lock:
+            for event in message.events:
+                if event.wallet == self.seller_wallet:
+                    self.balance = event.balance
+
+    def _stream_failed(self, request, error):
+        """
+        Função auxiliar que trata o fim inesperado do stream de eventos.
+
+        Parâmetros:
+            request (WatchMutationsRequest): assinatura, atualizada para a
+                                             próxima tentativa
+            error (grpc.RpcError): erro do stream
+
+        Retorna:
+            True caso o stream deva ser aberto de novo (e o saldo consultado
+            de novo, caso os eventos não possam ser retomados de onde
+            pararam), ou False caso o servidor de carteiras não publique os
+            eventos ou recuse a primeira assinatura por já ter o máximo de
+            streams abertos (e o saldo volte a ser somado pela loja).
+        """
+
+        code = error.code()
+        if code == grpc.StatusCode.FAILED_PRECONDITION or (
+            code == grpc.StatusCode.RESOURCE_EXHAUSTED and not request.feed_id
+        ):
+            self.watch_balance = False
+            print("balance events unavailable:", error.details(), file=sys.stderr)
+            return False
+        if code == grpc.StatusCode.DATA_LOSS:
+            request.after = 0
+        return True
+
+    def watch(self, ready: threading.Event) -> None:
+        """
+        Acompanha o saldo do vendedor pelo stream `watch_mutations` do
+        servidor de carteiras, até o fim da execução. Caso o stream caia, ele
+        é retomado a partir do último evento recebido; caso os eventos
+        seguintes tenham sido perdidos (DATA_LOSS), o stream recomeça e o
+        saldo é consultado de novo.
+
+        Parâmetros:
+            ready (threading.Event): sinalizado quando a primeira assinatura
+                                     é aceita (ou recusada)
+        """
+
+        stub = wallet_pb2_grpc.WalletStub(self.wallet_channel.channels[0])
+        request = wallet_pb2.WatchMutationsRequest(wallets=[self.seller_wallet])
+        while not self._stop_event.is_set():
+            resync = request.after == 0 and ready.is_set()
+            try:
+                for message in stub.watch_mutations(request):
+                    request.feed_id = message.feed_id
+                    request.after = message.sequence
+                    ready.set()
+                    if resync:
+                        self._fetch_balance()
+                        resync = False
+                    self._apply_events(message)
+            except grpc.RpcError as error:
+                retry = self._stream_failed(request, error)
+                ready.set()
+                if not retry:
+                    return
+            # O stream também cai quando a loja fecha o canal no fim da
+            # execução
+            if self._stop_event.wait(1.0):
+                return
+
+    def stats(self, request, context):
+        """
+        Retorna as estatísticas do servidor da loja. A chamada `transfer`
+        feita ao servidor de carteiras aparece como "wallet.transfer", o que
+        separa o tempo de rede e de processamento no servidor de carteiras do
+        tempo total de `sell`.
+
+        Retorna:
+            Uma mensagem do tipo StatsReply com as estatísticas de cada
+            procedimento e das chamadas ao servidor de carteiras.
+        """
+
+        return self.metrics.stats_reply(store_pb2)
+
     def read_price(self, request, context):
         """
         Envia para o cliente o preço do produto vendido pelo servidor.
@@ -107,7 +556,9 @@ class Store(store_pb2_grpc.StoreServicer):
             pagamento informada não exista, -2, caso o valor de conferência seja
             diferente do valor contido na ordem de pagamento, -3, caso a
             carteira informada não exista, ou -9, caso haja erro de comunicação
-            entre o servidor da loja e o servidor de carteiras.
+            entre o servidor da loja e o servidor de carteiras (incluindo o fim
+            do prazo da venda antes da resposta de `transfer` e o disjuntor
+            aberto).
 
         """
 
@@ -115,24 +566,97 @@ class Store(store_pb2_grpc.StoreServicer):
         # na chamada de `transfer`
         # Dessa forma, é possível capturar esse erro e retornar o código
         # de erro -9, assim como a especificação do trabalho sugere
+        # A chamada a `transfer` recebe o tempo que resta do prazo do
+        # cliente, para que o servidor de carteiras não faça uma venda cuja
+        # resposta ninguém mais espera
         try:
-            transfer_response = self.wallet_stub.transfer(
-                wallet_pb2.TransferRequest(
-                    payment_order=request.payment_order,
-                    recount=self.price,
-                    wallet=self.seller_wallet,
+            with self._wallet_call(), self.metrics.track("wallet.transfer") as call:
+                transfer_response = self._call_transfer(
+                    request.payment_order, admission.time_remaining(context)
                 )
-            )
+                call.code = transfer_response.status
             transfer_status = transfer_response.status
-            print("sell")
-            print("transfer status:", transfer_status)
-            if transfer_status not in [-1, -2, -3]:
-                self.balance += self.price
-            print("updated balance:", self.balance)
+            self._record_sale(transfer_status)
             return store_pb2.SellReply(status=transfer_status)
-        except:
+        except grpc.RpcError:
+            # Inclui CircuitOpenError, quando o disjuntor recusa a chamada
             return store_pb2.SellReply(status=-9)
 
+    def _purchase_request(self, buyer_wallet):
+        """
+        Função auxiliar que monta a requisição de compra atômica do produto
+        a partir da carteira do comprador.
+
+        Parâmetros:
+            buyer_wallet (str): carteira do comprador
+        """
+
+        return wallet_pb2.PurchaseRequest(
+            buyer=buyer_wallet, value=self.price, seller=self.seller_wallet
+        )
+
+    def buy(self, request, context):
+        """
+        Realiza a compra do produto com uma única chamada ao servidor de
+        carteiras, que debita o comprador e credita o vendedor atomicamente.
+
+        Parâmetros:
+            request.wallet (str): carteira do comprador
+
+        Retorna:
+            Uma mensagem de tipo BuyReply contendo o resultado da criação da
+            ordem de pagamento (retval) e o status da venda (status), ou -9 em
+            ambos caso haja erro de comunicação com o servidor de carteiras.
+        """
+
+        try:
+            with self._wallet_call():
+                purchase_response = self.wallet_stub.purchase(
+                    self._purchase_request(request.wallet),
+                    timeout=admission.time_remaining(context),
+                )
+        except grpc.RpcError:
+            return store_pb2.BuyReply(retval=-9, status=-9)
+
+        # A venda só acontece se a ordem de pagamento foi criada
+        if purchase_response.retval not in [-1, -2, -3]:
+            self._record_sale(purchase_response.status)
+
+        return store_pb2.BuyReply(
+            retval=purchase_response.retval, status=purchase_response.status
+        )
+
+    def batch_sell(self, request, context):
+        """
+        Realiza várias vendas com uma única chamada em lote ao servidor de
+        carteiras.
+
+        Parâmetros:
+            request.sales (list[SellRequest]): vendas a serem realizadas
+
+        Retorna:
+            Uma mensagem de tipo BatchSellReply com um SellReply para cada
+            venda, na mesma ordem e com os mesmos códigos de `sell`. Caso haja
+            erro de comunicação com o servidor de carteiras, todas as vendas
+            do lote recebem o código -9.
+        """
+
+        payment_orders = [sale.payment_order for sale in request.sales]
+        try:
+            with self._wallet_call():
+                statuses = self._transfer_batch(
+                    payment_orders, admission.time_remaining(context)
+                )
+        except grpc.RpcError:
+            statuses = [-9] * len(payment_orders)
+        else:
+            for status in statuses:
+                self._record_sale(status)
+
+        return store_pb2.BatchSellReply(
+            results=[store_pb2.SellReply(status=status) for status in statuses]
+        )
+
     def end_execution(self, request, context):
         """
         Finaliza o servidor da loja. Além disso, finaliza também o servidor de
@@ -151,6 +675,13 @@ class Store(store_pb2_grpc.StoreServicer):
         # o servidor de carteiras normalmente e, com isso, receber o número
         # de ordens de pagamento existentes no momento do término dele
 
+        # O evento da última venda pode ainda não ter chegado, então o saldo
+        # final é lido diretamente do servidor de carteiras
+        if self.watch_balance:
+            self.balance = self.wallet_stub.balance(
+                wallet_pb2.BalanceRequest(wallet=self.seller_wallet)
+            ).balance
+
         # Chama o procedimento de término do servidor de carteiras
         end_execution_response = self.wallet_stub.end_execution(
             wallet_pb2.EndExecutionRequest()
@@ -169,49 +700,575 @@ class Store(store_pb2_grpc.StoreServicer):
         return store_pb2.EndExecutionReply(balance=self.balance, pendencies=pendencies)
 
 
-def run(price, port, seller_wallet, wallet_addr):
+# Versão assíncrona (grpc.aio) do serviço de loja
+class AsyncStore(Store):
+    """
+    Nessa versão, o canal com o servidor de carteiras também é um canal
+    grpc.aio. Enquanto uma venda espera a resposta de `transfer`, o event loop
+    continua atendendo outras requisições, então o número de vendas em
+    andamento não fica limitado ao número de threads de um pool.
+    """
+
+    def _open_channel(self, target, pool_options):
+        return channel_pool.ChannelPool(target, **pool_options, asynchronous=True)
+
+    async def _fetch_balance(self):
+        balance_response = await self.wallet_stub.balance(
+            wallet_pb2.BalanceRequest(wallet=self.seller_wallet)
+        )
+        self.balance = balance_response.balance
+        print("balance:", self.balance)
+
+    async def watch(self, ready: asyncio.Event) -> None:
+        stub = wallet_pb2_grpc.WalletStub(self.wallet_channel.channels[0])
+        request = wallet_pb2.WatchMutationsRequest(wallets=[self.seller_wallet])
+        while not self._stop_event.is_set():
+            resync = request.after == 0 and ready.is_set()
+            try:
+                async for message in stub.watch_mutations(request):
+                    request.feed_id = message.feed_id
+                    request.after = message.sequence
+                    ready.set()
+                    if resync:
+                        await self._fetch_balance()
+                        resync = False
+                    self._apply_events(message)
+            except grpc.RpcError as error:
+                retry = self._stream_failed(request, error)
+                ready.set()
+                if not retry:
+                    return
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), 1.0)
+            except asyncio.TimeoutError:
+                continue
+
+    async def read_price(self, request, context):
+        return super().read_price(request, context)
+
+    async def stats(self, request, context):
+        return super().stats(request, context)
+
+    async def _call_transfer(self, payment_order, timeout=None):
+        if self.hedge_quantile is None and not self.retries:
+            return await self.wallet_stub.transfer(
+                self._transfer_request(payment_order), timeout=timeout
+            )
+
+        request = self._idempotent_request(payment_order)
+        deadline = admission.deadline(timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                if self.hedge_quantile is None:
+                    return await self.wallet_stub.transfer(
+                        request, timeout=admission.remaining(deadline)
+                    )
+                return await self._hedged_transfer(request, deadline)
+            except grpc.RpcError as error:
+                if not self._retry_fits(attempt, error, deadline):
+                    raise
+            self.retried_transfers += 1
+            await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+    async def _hedged_transfer(self, request, deadline=None):
+        timeout = admission.remaining(deadline)
+        first = asyncio.ensure_future(
+            self.wallet_stub.transfer(request, timeout=timeout)
+        )
+        delay = self._hedge_after()
+        if delay is not None and timeout is not None and delay >= timeout:
+            delay = None
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        self.hedged_transfers += 1
+        second = asyncio.ensure_future(
+            self.wallet_stub.transfer(request, timeout=admission.remaining(deadline))
+        )
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for call in done:
+                if call.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if call is second:
+                        self.hedge_wins += 1
+                    return call.result()
+        # As duas chamadas falharam
+        return call.result()
+
+    async def sell(self, request, context):
+        # Assim como na versão síncrona, um erro de comunicação com o
+        # servidor de carteiras é convertido no código de erro -9
+        try:
+            with self._wallet_call(), self.metrics.track("wallet.transfer") as call:
+                transfer_response = await self._call_transfer(
+                    request.payment_order, admission.time_remaining(context)
+                )
+                call.code = transfer_response.status
+        except grpc.RpcError:
+            return store_pb2.SellReply(status=-9)
+
+        transfer_status = transfer_response.status
+        self._record_sale(transfer_status)
+        return store_pb2.SellReply(status=transfer_status)
+
+    async def _transfer_batch(self, payment_orders, timeout=None):
+        batch_response = await self.wallet_stub.batch_transfer(
+            wallet_pb2.BatchTransferRequest(
+                transfers=[self._transfer_request(order) for order in payment_orders]
+            ),
+            timeout=timeout,
+        )
+        return [result.status for result in batch_response.results]
+
+    async def batch_sell(self, request, context):
+        payment_orders = [sale.payment_order for sale in request.sales]
+        try:
+            with self._wallet_call():
+                statuses = await self._transfer_batch(
+                    payment_orders, admission.time_remaining(context)
+                )
+        except grpc.RpcError:
+            statuses = [-9] * len(payment_orders)
+        else:
+            for status in statuses:
+                self._record_sale(status)
+
+        return store_pb2.BatchSellReply(
+            results=[store_pb2.SellReply(status=status) for status in statuses]
+        )
+
+    async def buy(self, request, context):
+        try:
+            with self._wallet_call():
+                purchase_response = await self.wallet_stub.purchase(
+                    self._purchase_request(request.wallet),
+                    timeout=admission.time_remaining(context),
+                )
+        except grpc.RpcError:
+            return store_pb2.BuyReply(retval=-9, status=-9)
+
+        if purchase_response.retval not in [-1, -2, -3]:
+            self._record_sale(purchase_response.status)
+
+        return store_pb2.BuyReply(
+            retval=purchase_response.retval, status=purchase_response.status
+        )
+
+    async def end_execution(self, request, context):
+        if self.watch_balance:
+            balance_response = await self.wallet_stub.balance(
+                wallet_pb2.BalanceRequest(wallet=self.seller_wallet)
+            )
+            self.balance = balance_response.balance
+
+        # Chama o procedimento de término do servidor de carteiras
+        end_execution_response = await self.wallet_stub.end_execution(
+            wallet_pb2.EndExecutionRequest()
+        )
+        # Recebe o número de ordens de pagamento pendentes
+        pendencies = end_execution_response.pendencies
+
+        # Fecha o canal de comunicação com o servidor de carteiras
+        await self.wallet_channel.close()
+
+        # Sinaliza o evento de encerramento do servidor
+        self._stop_event.set()
+
+        return store_pb2.EndExecutionReply(balance=self.balance, pendencies=pendencies)
+
+
+def run(
+    price,
+    port,
+    seller_wallet,
+    wallet_addr,
+    audit_log=None,
+    metrics_port=None,
+    pool_options=None,
+    max_workers=10,
+    hedge_quantile=None,
+    retries=0,
+    max_queue=None,
+    circuit_breaker=None,
+    watch_balance=False,
+    wallet_servicer=None,
+):
     """
     Inicia o servidor da loja.
 
     Parâmetros:
         price (int): preço do produto vendido pelo servidor
-        port (int): porta que o servidor da loja irá executar
+        port (int | str): porta (ou socket Unix) que o servidor da loja irá executar
         seller_wallet (str): identificador da carteira do vendedor
-        wallet_addr (tuple[str, int]): endereço do servidor de carteiras
+        wallet_addr (tuple[str, int] | list[tuple[str, int]]): endereço do
+            servidor de carteiras ou lista dos endereços dos shards
+        audit_log (AuditLog | None): log de auditoria (None desativa)
+        metrics_port (int | None): porta local do endpoint HTTP das métricas
+                                   (None desativa)
+        pool_options (dict | None): parâmetros do conjunto de canais com o
+                                    servidor de carteiras
+        max_workers (int): número de threads do pool que atende as requisições
+        hedge_quantile (float | None): quantil da latência de `transfer` após
+                                       o qual uma chamada redundante é
+                                       enviada (None desativa)
+        retries (int): número de novas tentativas de uma transferência
+        max_queue (int | None): tamanho da fila de admissão; com a fila
+                                cheia, as vendas e compras são recusadas com
+                                o código -9 (None: sem limite)
+        circuit_breaker (CircuitBreaker | None): disjuntor das chamadas ao
+                                                 servidor de carteiras (None
+                                                 desativa)
+        watch_balance (bool): acompanha o saldo do vendedor pelos eventos do
+                              servidor de carteiras
+        wallet_servicer (Wallet | None): servicer de carteiras do mesmo
+                                         processo (None: usa o servidor em
+                                         wallet_addr)
     """
 
     # Define o evento de parada do servidor
     stop_event = threading.Event()
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+
+    # Busca o saldo inicial do vendedor antes de começar a atender os
+    # clientes
+    store = Store(
+        stop_event,
+        wallet_addr,
+        seller_wallet,
+        price,
+        audit_log,
+        pool_options,
+        hedge_quantile,
+        retries,
+        circuit_breaker,
+        watch_balance,
+        wallet_servicer,
+    )
+    # A assinatura dos eventos começa antes da consulta do saldo, para que
+    # nenhuma alteração feita entre as duas seja perdida
+    if watch_balance:
+        ready = threading.Event()
+        threading.Thread(target=store.watch, args=(ready,), daemon=True).start()
+        ready.wait()
+    store._fetch_balance()
+
+    # Os interceptadores medem todos os procedimentos atendidos pelo
+    # servidor e recusam as chamadas com o prazo esgotado ou que não cabem
+    # na fila de admissão
+    server = grpc.server(
+        futures.ThreadPoolExecutor(
+            max_workers=admission.pool_size(max_workers, max_queue)
+        ),
+        interceptors=admission.server_interceptors(
+            store.metrics, max_workers, max_queue, REJECTIONS
+        ),
+    )
 
     # Liga o servidor à classe que implementa os métodos disponibilizados
     # pelo servidor
-    store_pb2_grpc.add_StoreServicer_to_server(
-        Store(stop_event, wallet_addr, seller_wallet, price), server
-    )
-    server.add_insecure_port(f"0.0.0.0:{port}")
+    store_pb2_grpc.add_StoreServicer_to_server(store, server)
+    server.add_insecure_port(transport.listen_address(port))
+
+    # Exposição das métricas em texto, em uma porta local
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = store.metrics.serve(metrics_port)
 
     server.start()
 
     # Espera a ocorrência do evento de término do servidor
     stop_event.wait()
-    # Quando detectado, o servidor é terminado
-    server.stop(None)
+    # Quando detectado, o servidor deixa de aceitar novas requisições e
+    # espera as que estão em andamento (incluindo a resposta do próprio
+    # end_execution, que com o servidor de carteiras no mesmo processo sai
+    # logo depois do evento) antes de terminar
+    server.stop(1).wait()
+
+    # Escreve os eventos de auditoria pendentes
+    if audit_log is not None:
+        audit_log.close()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+def start_wallet_service(wallet_addr, max_workers=10):
+    """
+    Inicia o servidor de carteiras (wallet-server.py, com as opções padrão)
+    em uma thread deste processo, com as carteiras lidas da entrada padrão,
+    para o modo em que a loja chama o servicer de carteiras diretamente. O
+    servidor continua recebendo conexões no endereço informado, usado pelos
+    clientes, e termina junto com a loja.
+
+    Parâmetros:
+        wallet_addr (tuple[str, int | str]): endereço do servidor de
+                                             carteiras
+        max_workers (int): número de threads do pool do servidor de carteiras
+
+    Retorna:
+        Uma tupla (thread do servidor, servicer de carteiras).
+    """
+
+    # O nome do programa usa "-", então ele não pode ser importado
+    # diretamente
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wallet-server.py")
+    spec = importlib.util.spec_from_file_location("wallet_server", path)
+    wallet_server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(wallet_server)
+
+    wallets = {}
+    wallet_loader.load_wallets(sys.stdin.buffer, wallets)
+    started = futures.Future()
+
+    def serve():
+        try:
+            wallet_server.run(
+                transport.endpoint(wallet_addr),
+                wallets,
+                max_workers,
+                started=started.set_result,
+            )
+        except BaseException as error:
+            if not started.done():
+                started.set_exception(error)
+            raise
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    return thread, started.result()
+
+
+async def run_async(
+    price,
+    port,
+    seller_wallet,
+    wallet_addr,
+    audit_log=None,
+    metrics_port=None,
+    pool_options=None,
+    hedge_quantile=None,
+    retries=0,
+    max_queue=None,
+    max_workers=10,
+    circuit_breaker=None,
+    watch_balance=False,
+):
+    """
+    Inicia o servidor da loja usando grpc.aio, tanto para atender os clientes
+    quanto para se comunicar com o servidor de carteiras.
+
+    Parâmetros:
+        price (int): preço do produto vendido pelo servidor
+        port (int | str): porta (ou socket Unix) que o servidor da loja irá executar
+        seller_wallet (str): identificador da carteira do vendedor
+        wallet_addr (tuple[str, int]): endereço do servidor de carteiras
+        audit_log (AuditLog | None): log de auditoria (None desativa)
+        metrics_port (int | None): porta local do endpoint HTTP das métricas
+                                   (None desativa)
+        pool_options (dict | None): parâmetros do conjunto de canais com o
+                                    servidor de carteiras
+        hedge_quantile (float | None): quantil da latência de `transfer` após
+                                       o qual uma chamada redundante é
+                                       enviada (None desativa)
+        retries (int): número de novas tentativas de uma transferência
+        max_queue (int | None): tamanho da fila de admissão (None: sem
+                                limite)
+        max_workers (int): número máximo de chamadas em execução ao mesmo
+                           tempo quando há fila de admissão
+        circuit_breaker (CircuitBreaker | None): disjuntor das chamadas ao
+                                                 servidor de carteiras (None
+                                                 desativa)
+        watch_balance (bool): acompanha o saldo do vendedor pelos eventos do
+                              servidor de carteiras
+    """
+
+    # Define o evento de parada do servidor
+    stop_event = asyncio.Event()
+
+    # Busca o saldo inicial do vendedor antes de começar a atender os
+    # clientes
+    store = AsyncStore(
+        stop_event,
+        wallet_addr,
+        seller_wallet,
+        price,
+        audit_log,
+        pool_options,
+        hedge_quantile,
+        retries,
+        circuit_breaker,
+        watch_balance,
+    )
+    watcher = None
+    if watch_balance:
+        ready = asyncio.Event()
+        watcher = asyncio.create_task(store.watch(ready))
+        await ready.wait()
+    await store._fetch_balance()
+
+    server = grpc.aio.server(
+        interceptors=admission.server_interceptors(
+            store.metrics, max_workers, max_queue, REJECTIONS, asynchronous=True
+        )
+    )
+
+    # Liga o servidor à classe que implementa os métodos disponibilizados
+    # pelo servidor
+    store_pb2_grpc.add_StoreServicer_to_server(store, server)
+    server.add_insecure_port(transport.listen_address(port))
+
+    # Exposição das métricas em texto, em uma porta local
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = store.metrics.serve(metrics_port)
+
+    await server.start()
+
+    # Espera a ocorrência do evento de término do servidor
+    await stop_event.wait()
+    # Quando detectado, o servidor deixa de aceitar novas requisições e
+    # espera as que estão em andamento (incluindo a resposta do próprio
+    # end_execution) antes de terminar
+    await server.stop(1)
+    # O fechamento do canal no fim da execução cancela o stream de eventos
+    if watcher is not None:
+        watcher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await watcher
+
+    if audit_log is not None:
+        audit_log.close()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor da loja")
     # Preço do produto vendido
-    price = int(sys.argv[1])
+    parser.add_argument("price", type=int)
+    # Porta que o servidor irá usar (ou socket Unix, "unix:/caminho")
+    parser.add_argument("port", type=transport.parse_endpoint)
+    # Identificador da carteira do vendedor
+    parser.add_argument("seller_wallet")
+    # Endereço do servidor de carteiras (ou dos shards, separados por vírgula)
+    parser.add_argument("wallet_addr")
+    # Atende as requisições e fala com o servidor de carteiras usando
+    # grpc.aio em vez do pool de threads
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    # Log de auditoria: arquivo (por padrão, a saída padrão), formato, nível
+    # de detalhe e número máximo de eventos por segundo. Por padrão o log é
+    # desativado, e o servidor não escreve nada na saída padrão durante a
+    # execução
+    parser.add_argument("--audit-log")
+    parser.add_argument("--audit-format", choices=["line", "binary"], default="line")
+    parser.add_argument(
+        "--audit-verbosity", choices=list(audit.VERBOSITY), default="off"
+    )
+    parser.add_argument("--audit-rate", type=float)
+    # Porta local do endpoint HTTP com as métricas em texto
+    parser.add_argument("--metrics-port", type=int)
+    # Número de threads que atendem as requisições
+    parser.add_argument("--workers", type=int, default=10)
+    # Conjunto de canais com o servidor de carteiras e opções de HTTP/2
+    channel_pool.add_arguments(parser)
+    # Percentil da latência de `transfer` (p.ex. 95) após o qual uma chamada
+    # redundante é enviada e número de novas tentativas de uma transferência
+    # que falhou por erro de comunicação
+    parser.add_argument("--hedge-percentile", type=float)
+    parser.add_argument("--retries", type=int, default=0)
+    # Número máximo de chamadas esperando para executar; com a fila cheia,
+    # as novas vendas e compras são recusadas imediatamente (código -9)
+    parser.add_argument("--max-queue", type=int)
+    # Disjuntor das chamadas ao servidor de carteiras
+    breaker.add_arguments(parser)
+    # Acompanha o saldo do vendedor pelos eventos `watch_mutations` do
+    # servidor de carteiras (iniciado com --change-feed), em vez de somar o
+    # preço de cada venda
+    parser.add_argument("--watch-balance", action="store_true")
+    # Atende também o serviço de carteiras, no endereço wallet_addr e com as
+    # carteiras lidas da entrada padrão, chamando-o diretamente
+    parser.add_argument("--in-process", action="store_true")
+    args = parser.parse_args()
 
-    # Porta que o servidor irá usar
-    port = int(sys.argv[2])
+    wallet_addr = sharding.parse_wallet_addr(args.wallet_addr)
+    # O roteador entre shards usa chamadas síncronas
+    if args.use_async and isinstance(wallet_addr, list):
+        parser.error("--async não é suportado com vários shards")
+    if args.watch_balance and isinstance(wallet_addr, list):
+        parser.error("--watch-balance não é suportado com vários shards")
+    if args.in_process and (
+        args.use_async or args.watch_balance or isinstance(wallet_addr, list)
+    ):
+        parser.error(
+            "--in-process não pode ser combinado com --async, --watch-balance"
+            " ou vários shards"
+        )
+    # As transferências entre shards (confirmação em duas fases) não
+    # reconhecem requisições repetidas
+    if isinstance(wallet_addr, list) and (
+        args.hedge_percentile is not None or args.retries
+    ):
+        parser.error("--hedge-percentile e --retries não são suportados com shards")
+    if args.hedge_percentile is not None and not 0 < args.hedge_percentile < 100:
+        parser.error("--hedge-percentile deve estar entre 0 e 100")
+    hedge_quantile = None
+    if args.hedge_percentile is not None:
+        hedge_quantile = args.hedge_percentile / 100
 
-    # Identificador da carteira do vendedor
-    seller_wallet = sys.argv[3]
+    audit_log = audit.AuditLog(
+        args.audit_log,
+        binary=args.audit_format == "binary",
+        verbosity=audit.VERBOSITY[args.audit_verbosity],
+        rate=args.audit_rate,
+    )
 
-    # Endereço do servidor de carteiras
-    wallet_host, wallet_port = sys.argv[4].split(":")
-    wallet_addr = (wallet_host, int(wallet_port))
+    wallet_thread = wallet_servicer = None
+    if args.in_process:
+        wallet_thread, wallet_servicer = start_wallet_service(
+            wallet_addr, args.workers
+        )
 
     # Chama a função que inicia o servidor
-    run(price, port, seller_wallet, wallet_addr)
+    if args.use_async:
+        asyncio.run(
+            run_async(
+                args.price,
+                args.port,
+                args.seller_wallet,
+                wallet_addr,
+                audit_log,
+                args.metrics_port,
+                channel_pool.from_args(args),
+                hedge_quantile,
+                args.retries,
+                args.max_queue,
+                args.workers,
+                breaker.from_args(args),
+                args.watch_balance,
+            )
+        )
+    else:
+        run(
+            args.price,
+            args.port,
+            args.seller_wallet,
+            wallet_addr,
+            audit_log,
+            args.metrics_port,
+            channel_pool.from_args(args),
+            args.workers,
+            hedge_quantile,
+            args.retries,
+            args.max_queue,
+            breaker.from_args(args),
+            args.watch_balance,
+            wallet_servicer,
+        )
+    if wallet_thread is not None:
+        wallet_thread.join()
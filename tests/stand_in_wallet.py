@@ -0,0 +1,43 @@
+# Servidor de carteiras substituto usado pelos testes e benchmarks do
+# disjuntor (circuit breaker) da loja
+# Vinicius Gomes - 2021421869
+
+import time
+
+import grpc
+
+import wallet_pb2
+import wallet_pb2_grpc
+
+
+class StandInWallet(wallet_pb2_grpc.WalletServicer):
+    """
+    Servidor de carteiras substituto: as transferências sempre têm sucesso,
+    a menos que o modo atual injete falhas ("down"), não responda ("hang")
+    ou atrase as respostas ("slow").
+    """
+
+    def __init__(self, slow_delay):
+        self.mode = "ok"
+        self.slow_delay = slow_delay
+        self.transfers = 0
+
+    def balance(self, request, context):
+        return wallet_pb2.BalanceReply(balance=0)
+
+    def transfer(self, request, context):
+        mode = self.mode
+        if mode == "down":
+            context.abort(grpc.StatusCode.UNAVAILABLE, "servidor fora do ar")
+        if mode == "hang":
+            # A chamada só termina quando quem chamou desiste
+            while context.is_active():
+                time.sleep(0.01)
+            context.abort(grpc.StatusCode.UNAVAILABLE, "servidor travado")
+        if mode == "slow":
+            time.sleep(self.slow_delay)
+        self.transfers += 1
+        return wallet_pb2.TransferReply(status=0)
+
+    def end_execution(self, request, context):
+        return wallet_pb2.EndExecutionReply(pendencies=0)
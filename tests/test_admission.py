@@ -0,0 +1,89 @@
+# Testes do limite de streams de resposta do controle de admissão
+# Vinicius Gomes - 2021421869
+
+import os
+import sys
+import types
+
+import grpc
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import admission  # noqa: E402
+
+
+class Aborted(Exception):
+    pass
+
+
+class FakeContext:
+    def abort(self, code, details):
+        self.code = code
+        raise Aborted(details)
+
+
+def intercept(interceptor, handler):
+    details = types.SimpleNamespace(method="/wallet.Wallet/watch_mutations")
+    return interceptor.intercept_service(lambda _: handler, details)
+
+
+def test_streams_beyond_the_limit_are_rejected():
+    interceptor = admission.AdmissionInterceptor(2, max_streams=2)
+    handler = intercept(
+        interceptor,
+        grpc.unary_stream_rpc_method_handler(lambda request, context: iter(range(3))),
+    )
+
+    # Cada stream ocupa o seu lugar até terminar
+    first = handler.unary_stream(None, FakeContext())
+    second = handler.unary_stream(None, FakeContext())
+    assert next(first) == 0 and next(second) == 0
+
+    context = FakeContext()
+    with pytest.raises(Aborted):
+        next(handler.unary_stream(None, context))
+    assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+    assert interceptor.counters()["streams_rejected"] == 1
+
+    # Um stream que termina libera o lugar
+    assert list(first) == [1, 2]
+    assert interceptor.counters()["open_streams"] == 1
+    assert next(handler.unary_stream(None, FakeContext())) == 0
+
+
+def test_pool_has_threads_for_the_streams():
+    assert admission.pool_size(10, None, 8) == 18
+    assert admission.pool_size(10, 5, 8) == 10 + 5 + 8 + admission.SPARE_THREADS
+
+
+def test_request_streams_share_the_limit():
+    interceptor = admission.AdmissionInterceptor(2, max_streams=1)
+    session = intercept(
+        interceptor,
+        grpc.stream_stream_rpc_method_handler(
+            lambda requests, context: (request * 2 for request in requests)
+        ),
+    )
+    imported = intercept(
+        interceptor,
+        grpc.stream_unary_rpc_method_handler(
+            lambda requests, context: sum(requests)
+        ),
+    )
+
+    # Uma sessão aberta ocupa o único lugar, e a importação é recusada
+    replies = session.stream_stream(iter([1, 2]), FakeContext())
+    assert next(replies) == 2
+    context = FakeContext()
+    with pytest.raises(Aborted):
+        imported.stream_unary(iter([1, 2]), context)
+    assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+
+    # Com a sessão encerrada, a importação executa e libera o lugar ao
+    # terminar
+    assert list(replies) == [4]
+    assert imported.stream_unary(iter([1, 2]), FakeContext()) == 3
+    assert interceptor.counters()["open_streams"] == 0
+    assert interceptor.counters()["streams_rejected"] == 1
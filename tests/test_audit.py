@@ -0,0 +1,59 @@
+# Testes do log de auditoria
+# Vinicius Gomes - 2021421869
+
+import contextlib
+import io
+import os
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import audit  # noqa: E402
+
+
+class FailingFile(io.StringIO):
+    # Arquivo cuja escrita falha enquanto `full` for verdadeiro, como um
+    # disco cheio
+    full = True
+
+    def write(self, data):
+        if self.full:
+            raise OSError(28, "No space left on device")
+        return super().write(data)
+
+
+def test_write_errors_do_not_block_flush(tmp_path):
+    log = audit.AuditLog(str(tmp_path / "audit.log"), interval=0.01)
+    log._file.close()
+    log._file = FailingFile()
+
+    # O lote que falha é perdido, mas `flush` retorna e a thread continua
+    errors = io.StringIO()
+    with contextlib.redirect_stderr(errors):
+        log.record(audit.MUTATIONS, "transfer", 1, 10)
+        log.flush()
+    assert "1 events lost" in errors.getvalue()
+    assert log._writer.is_alive()
+
+    log._file.full = False
+    log.record(audit.MUTATIONS, "transfer", 2, 10)
+    log.flush()
+    assert log._file.getvalue().split()[1:] == ["transfer", "2", "10"]
+    log.close()
+
+
+def test_flush_returns_when_the_writer_dies(monkeypatch):
+    log = audit.AuditLog(interval=0.01)
+    monkeypatch.setattr(audit, "_FLUSH_CHECK", 0.01)
+    monkeypatch.setattr(threading, "excepthook", lambda args: None)
+
+    # A thread de escrita termina com um erro inesperado sem sinalizar a
+    # marca de `flush`, que retorna em vez de esperar para sempre
+    def crash():
+        raise RuntimeError("erro inesperado")
+
+    log._drain = crash
+    log.flush()
+    assert not log._writer.is_alive()
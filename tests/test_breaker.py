@@ -0,0 +1,213 @@
+# Testes do disjuntor (circuit breaker) da loja
+# Vinicius Gomes - 2021421869
+
+import os
+import sys
+import time
+import types
+from concurrent import futures
+
+import grpc
+import pytest
+
+# Os auxiliares dos benchmarks ficam em benchmarks/, e `common` acrescenta a
+# raiz do repositório ao sys.path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import common  # noqa: E402
+from stand_in_wallet import StandInWallet  # noqa: E402
+
+import breaker  # noqa: E402
+import store_pb2  # noqa: E402
+import store_pb2_grpc  # noqa: E402
+import wallet_pb2_grpc  # noqa: E402
+
+
+class FakeClock:
+    # Relógio usado no lugar de time.monotonic, avançado pelo teste
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(
+        breaker,
+        "time",
+        types.SimpleNamespace(monotonic=clock, perf_counter=time.perf_counter),
+    )
+    return clock
+
+
+def make_breaker(**kwargs):
+    changes = []
+    circuit = breaker.CircuitBreaker(
+        **{"window": 10.0, "min_calls": 4, "open_for": 5.0, "probes": 2, **kwargs}
+    )
+    circuit.on_change = lambda previous, state: changes.append(
+        (breaker.STATES[previous], breaker.STATES[state])
+    )
+    return circuit, changes
+
+
+def fail(circuit, times=1):
+    for _ in range(times):
+        generation = circuit.allow()
+        assert generation
+        circuit.record(generation, True, 0.0)
+
+
+def test_closed_open_half_open_closed(clock):
+    circuit, changes = make_breaker()
+
+    # Abaixo de min_calls, as falhas não abrem o disjuntor
+    fail(circuit, 3)
+    assert circuit.state == breaker.CLOSED
+    fail(circuit)
+    assert circuit.state == breaker.OPEN
+    assert circuit.opened == 1
+
+    # Aberto, recusa as chamadas até o fim de open_for
+    clock.now += 4.9
+    assert not circuit.allow()
+    assert circuit.rejected == 1
+
+    # Meio aberto, deixa passar apenas `probes` chamadas de teste
+    clock.now += 0.1
+    probes = [circuit.allow(), circuit.allow()]
+    assert all(probes)
+    assert circuit.state == breaker.HALF_OPEN
+    assert not circuit.allow()
+    assert circuit.rejected == 2
+
+    # O sucesso das chamadas de teste fecha o disjuntor com a janela vazia
+    circuit.record(probes[0], False, 0.0)
+    assert circuit.state == breaker.HALF_OPEN
+    circuit.record(probes[1], False, 0.0)
+    assert circuit.state == breaker.CLOSED
+    fail(circuit, 3)
+    assert circuit.state == breaker.CLOSED
+
+    assert changes == [
+        ("closed", "open"),
+        ("open", "half_open"),
+        ("half_open", "closed"),
+    ]
+    assert circuit.counters() == {
+        "breaker_state": breaker.CLOSED,
+        "breaker_opened": 1,
+        "breaker_rejected": 2,
+    }
+
+
+def test_failed_probe_reopens(clock):
+    circuit, changes = make_breaker()
+    fail(circuit, 4)
+
+    clock.now += 5.0
+    fail(circuit)
+    assert circuit.state == breaker.OPEN
+    assert circuit.opened == 2
+    # O tempo aberto conta a partir da nova abertura
+    clock.now += 1.0
+    assert not circuit.allow()
+    assert changes[-2:] == [("open", "half_open"), ("half_open", "open")]
+
+
+def test_old_failures_leave_the_window(clock):
+    circuit, _ = make_breaker()
+    fail(circuit, 3)
+
+    clock.now += 11.0
+    fail(circuit, 3)
+    assert circuit.state == breaker.CLOSED
+
+
+def test_slow_calls_open(clock):
+    circuit, _ = make_breaker(slow_call=0.1)
+    for elapsed in [0.2, 0.01, 0.3, 0.05]:
+        generation = circuit.allow()
+        assert generation
+        circuit.record(generation, False, elapsed)
+    assert circuit.state == breaker.OPEN
+
+
+def test_results_from_an_earlier_state_are_ignored(clock):
+    circuit, _ = make_breaker()
+
+    # Uma chamada lenta é permitida com o disjuntor fechado e só termina
+    # depois que ele abre e passa a meio aberto
+    slow = circuit.allow()
+    fail(circuit, 4)
+    clock.now += 5.0
+    probe = circuit.allow()
+    assert circuit.state == breaker.HALF_OPEN
+
+    # O sucesso dela não conta como chamada de teste nem libera mais uma
+    circuit.record(slow, False, 0.0)
+    assert circuit.state == breaker.HALF_OPEN
+    assert circuit.allow()
+    assert not circuit.allow()
+
+    circuit.record(probe, False, 0.0)
+    assert circuit.state == breaker.HALF_OPEN
+
+
+@pytest.mark.parametrize("store_args", [[], ["--async"]])
+def test_store_fails_fast_while_open(store_args):
+    wallet = StandInWallet(slow_delay=0.0)
+    wallet_server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    wallet_pb2_grpc.add_WalletServicer_to_server(wallet, wallet_server)
+    wallet_port = common.free_port()
+    wallet_server.add_insecure_port(f"localhost:{wallet_port}")
+    wallet_server.start()
+
+    store_port = common.free_port()
+    store_server = common.start_store_server(
+        store_port,
+        10,
+        "seller",
+        wallet_port,
+        "--breaker",
+        "--breaker-min-calls",
+        "5",
+        "--breaker-open-for",
+        "60",
+        *store_args,
+    )
+    try:
+        with grpc.insecure_channel(f"localhost:{store_port}") as channel:
+            stub = store_pb2_grpc.StoreStub(channel)
+
+            # As falhas do servidor de carteiras abrem o disjuntor
+            wallet.mode = "down"
+            for _ in range(5):
+                status = stub.sell(store_pb2.SellRequest(payment_order=1), timeout=10)
+                assert status.status == -9
+
+            # Com o disjuntor aberto, a venda falha sem chamar o servidor de
+            # carteiras, que agora nunca responderia dentro do prazo
+            wallet.mode = "hang"
+            started = time.perf_counter()
+            status = stub.sell(store_pb2.SellRequest(payment_order=1), timeout=10)
+            assert status.status == -9
+            assert time.perf_counter() - started < 1.0
+
+            counters = stub.stats(store_pb2.StatsRequest()).counters
+            assert counters["breaker_state"] == breaker.OPEN
+            assert counters["breaker_opened"] == 1
+            assert counters["breaker_rejected"] >= 1
+
+            wallet.mode = "ok"
+            stub.end_execution(store_pb2.EndExecutionRequest())
+        store_server.wait(timeout=30)
+    finally:
+        if store_server.poll() is None:
+            store_server.kill()
+        wallet_server.stop(None)
@@ -0,0 +1,44 @@
+# Testes do cache de respostas para requisições repetidas
+# Vinicius Gomes - 2021421869
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dedup  # noqa: E402
+
+
+def test_reinserted_key_moves_to_the_end(monkeypatch):
+    clock = types.SimpleNamespace(now=0.0)
+    monkeypatch.setattr(
+        dedup, "time", types.SimpleNamespace(monotonic=lambda: clock.now)
+    )
+    cache = dedup.DedupCache(capacity=10, ttl=10.0)
+
+    cache.put("a", 1)
+    clock.now = 5.0
+    cache.put("b", 2)
+
+    # A repetição de "a" chega depois de a entrada expirar e recebe um novo
+    # prazo, que termina depois do prazo de "b"
+    clock.now = 11.0
+    assert cache.get("a") is None
+    cache.put("a", 3)
+
+    # Quando "b" expira, ele é descartado mesmo estando atrás de "a"
+    clock.now = 16.0
+    cache.put("c", 4)
+    assert len(cache) == 2
+    assert cache.get("a") == 3 and cache.get("b") is None
+
+
+def test_capacity_drops_the_oldest_insertion():
+    cache = dedup.DedupCache(capacity=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 3)
+    cache.put("c", 4)
+    assert cache.get("a") == 3 and cache.get("b") is None and cache.get("c") == 4
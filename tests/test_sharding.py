@@ -0,0 +1,247 @@
+# Testes das transferências entre shards (confirmação em duas fases)
+# Vinicius Gomes - 2021421869
+
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+import grpc
+import pytest
+
+# Os auxiliares dos benchmarks ficam em benchmarks/, e `common` acrescenta a
+# raiz do repositório ao sys.path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import common  # noqa: E402
+
+import sharding  # noqa: E402
+import wallet_pb2  # noqa: E402
+from wal import WriteAheadLog  # noqa: E402
+
+wallet_server = common.load_script("wallet-server")
+
+
+class Unavailable(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class DirectStub:
+    # Stub que chama os procedimentos do servicer diretamente; os
+    # procedimentos em `failing` falham como um shard fora do ar
+
+    def __init__(self, servicer):
+        self.servicer = servicer
+        self.failing = set()
+
+    def __getattr__(self, name):
+        def call(request, timeout=None):
+            if name in self.failing:
+                raise Unavailable()
+            return getattr(self.servicer, name)(request, None)
+
+        return call
+
+
+def wallet_in(ring, shard):
+    return next(f"w{i}" for i in range(1000) if ring.shard(f"w{i}") == shard)
+
+
+def start_shard(shards, index, wallets, directory):
+    # O construtor exibe o estado inicial
+    with contextlib.redirect_stdout(io.StringIO()):
+        shard = wallet_server.Wallet(
+            threading.Event(),
+            wallets,
+            WriteAheadLog(directory, group_commit=False),
+            shard=(index, 2),
+        )
+
+    # O shard da carteira de destino consulta a decisão no shard da ordem
+    shard._ask_source = (
+        lambda source, transaction: shards[0]
+        .abort(wallet_pb2.DecisionRequest(transaction=transaction), None)
+        .status
+        == 0
+    )
+    return shard
+
+
+def restart(router, shards, index):
+    # O shard para sem gravar um snapshot final, como em uma queda, e volta a
+    # partir do seu log
+    shard = shards[index]
+    shard._background_stop.set()
+    shard.wal.close()
+    shards[index] = start_shard(shards, index, {}, shard.wal.directory)
+    router._stubs[index].servicer = shards[index]
+
+
+@pytest.fixture
+def cluster(monkeypatch, tmp_path):
+    monkeypatch.setattr(sharding.ShardRouter, "DECISION_ATTEMPTS", 2)
+    router = sharding.ShardRouter([("localhost", 1), ("localhost", 2)])
+    router.close()
+    buyer, seller = wallet_in(router.ring, 0), wallet_in(router.ring, 1)
+
+    shards = []
+    for index, wallets in enumerate([{buyer: 100}, {seller: 0}]):
+        shards.append(
+            start_shard(shards, index, wallets, str(tmp_path / f"shard{index}"))
+        )
+    router._stubs = [DirectStub(shard) for shard in shards]
+    yield router, shards, buyer, seller
+    for shard in shards:
+        shard._background_stop.set()
+        shard.wal.close()
+
+
+def total(shards, buyer, seller):
+    pending = sum(value for _, value in shards[0].payment_orders.items())
+    return shards[0].wallets[buyer] + shards[1].wallets[seller] + pending
+
+
+def create_order(router, buyer, value):
+    return router.create_payment_order(
+        wallet_pb2.CreatePaymentOrderRequest(wallet=buyer, value=value)
+    ).retval
+
+
+def later():
+    return time.monotonic() + wallet_server.Wallet.PREPARE_TIMEOUT + 1
+
+
+def test_lost_destination_commit_is_recovered(cluster):
+    router, shards, buyer, seller = cluster
+    payment_order = create_order(router, buyer, 10)
+
+    # O commit do crédito nunca chega, mas a transação já foi decidida pelo
+    # shard da ordem
+    router._stubs[1].failing.add("commit")
+    reply = router.transfer(
+        wallet_pb2.TransferRequest(
+            payment_order=payment_order, recount=10, wallet=seller
+        )
+    )
+    assert reply.status == 0
+    assert len(shards[0].payment_orders) == 0
+    assert shards[1].wallets[seller] == 0
+
+    # Quando a preparação vence, o crédito é aplicado
+    shards[1]._recover_prepared(later())
+    assert shards[1].wallets[seller] == 10
+    assert not shards[1]._prepared
+    assert total(shards, buyer, seller) == 100
+
+    # Um commit repetido recebe a decisão, mas não credita de novo
+    router._stubs[1].failing.clear()
+    transaction = next(iter(shards[1]._committed._entries))
+    reply = router._stubs[1].commit(
+        wallet_pb2.DecisionRequest(transaction=transaction)
+    )
+    assert reply.status == 0
+    assert shards[1].wallets[seller] == 10
+
+
+def test_coordinator_crash_between_phases(cluster):
+    router, shards, buyer, seller = cluster
+    payment_order = create_order(router, buyer, 10)
+    transaction = "crashed"
+
+    # O coordenador prepara as duas ações e termina antes da decisão
+    debit = wallet_pb2.TransferRequest(payment_order=payment_order, recount=10)
+    credit = wallet_pb2.CreditRequest(wallet=seller, value=10)
+    for shard, action in [(0, {"debit": debit}), (1, {"credit": credit})]:
+        status = router._stubs[shard].prepare(
+            wallet_pb2.PrepareRequest(transaction=transaction, **action)
+        ).status
+        assert status == 0
+    assert shards[0]._local_order(payment_order) is None
+
+    # O débito vencido é desfeito, e o crédito segue a decisão do shard da
+    # ordem
+    shards[0]._recover_prepared(later())
+    shards[1]._recover_prepared(later())
+    assert not shards[0]._prepared and not shards[1]._prepared
+    assert shards[1].wallets[seller] == 0
+    assert total(shards, buyer, seller) == 100
+
+    # A ordem volta a poder ser transferida
+    reply = router.transfer(
+        wallet_pb2.TransferRequest(
+            payment_order=payment_order, recount=10, wallet=seller
+        )
+    )
+    assert reply.status == 0
+    assert shards[1].wallets[seller] == 10
+    assert total(shards, buyer, seller) == 100
+
+
+def test_restarted_shards_keep_their_transactions(cluster):
+    router, shards, buyer, seller = cluster
+    payment_order = create_order(router, buyer, 10)
+    stub = router._stubs[1]
+
+    # O shard de destino reinicia logo depois de preparar o crédito, e o
+    # commit chega ao shard reiniciado
+    def prepare(request, timeout=None):
+        reply = shards[1].prepare(request, None)
+        restart(router, shards, 1)
+        return reply
+
+    stub.prepare = prepare
+    reply = router.transfer(
+        wallet_pb2.TransferRequest(
+            payment_order=payment_order, recount=10, wallet=seller
+        )
+    )
+    assert reply.status == 0
+    assert shards[1].wallets[seller] == 10
+    assert total(shards, buyer, seller) == 100
+
+
+def test_decision_survives_a_source_restart(cluster):
+    router, shards, buyer, seller = cluster
+    payment_order = create_order(router, buyer, 10)
+
+    # O commit do crédito não chega, e os dois shards reiniciam antes de o
+    # crédito vencer
+    router._stubs[1].failing.add("commit")
+    reply = router.transfer(
+        wallet_pb2.TransferRequest(
+            payment_order=payment_order, recount=10, wallet=seller
+        )
+    )
+    assert reply.status == 0
+    restart(router, shards, 0)
+    restart(router, shards, 1)
+    assert len(shards[0].payment_orders) == 0
+    assert len(shards[1]._prepared) == 1
+
+    # O shard da ordem ainda sabe que a transação foi confirmada
+    shards[1]._recover_prepared(later())
+    assert shards[1].wallets[seller] == 10
+    assert total(shards, buyer, seller) == 100
+
+
+def test_lost_credit_is_reported(cluster):
+    router, shards, buyer, seller = cluster
+    payment_order = create_order(router, buyer, 10)
+
+    # O shard de destino esquece a preparação antes do commit
+    def prepare(request, timeout=None):
+        reply = shards[1].prepare(request, None)
+        shards[1]._prepared.clear()
+        return reply
+
+    router._stubs[1].prepare = prepare
+    with pytest.raises(sharding.CreditLost):
+        router.transfer(
+            wallet_pb2.TransferRequest(
+                payment_order=payment_order, recount=10, wallet=seller
+            )
+        )
@@ -0,0 +1,75 @@
+# Testes do estado compartilhado entre os processos do servidor de carteiras
+# Vinicius Gomes - 2021421869
+
+import contextlib
+import io
+import os
+import sys
+
+# Os auxiliares dos benchmarks ficam em benchmarks/, e `common` acrescenta a
+# raiz do repositório ao sys.path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import common  # noqa: E402
+
+import wallet_pb2  # noqa: E402
+from shared_state import SharedOrderStore, SharedWalletTable  # noqa: E402
+
+wallet_server = common.load_script("wallet-server")
+
+
+def make_wallet(capacity):
+    # O construtor exibe o estado inicial
+    with contextlib.redirect_stdout(io.StringIO()):
+        return wallet_server.SharedWallet(
+            {"buyer": 100, "seller": 0}, order_capacity=capacity
+        )
+
+
+def create(wallet, value):
+    return wallet.create_payment_order(
+        wallet_pb2.CreatePaymentOrderRequest(wallet="buyer", value=value), None
+    ).retval
+
+
+def test_order_store_has_room():
+    table = SharedWalletTable({"buyer": 100})
+    orders = SharedOrderStore(table, capacity=2)
+
+    assert orders.has_room()
+    first = orders.create(1, "buyer")
+    orders.create(1, "buyer")
+    assert not orders.has_room()
+
+    # O slot da próxima ordem é o da primeira, que deixa de estar pendente
+    assert orders.take(first, 1) == 0
+    assert orders.has_room()
+
+
+def test_full_ring_does_not_debit():
+    wallet = make_wallet(capacity=2)
+
+    assert create(wallet, 10) == 1
+    assert create(wallet, 10) == 2
+    assert wallet.wallets["buyer"] == 80
+
+    # Com as ordens pendentes ocupando todos os slots, a criação falha com
+    # -3 e o comprador não perde o valor
+    assert create(wallet, 10) == -3
+    reply = wallet.purchase(
+        wallet_pb2.PurchaseRequest(buyer="buyer", value=10, seller="seller"), None
+    )
+    assert reply.retval == -3
+    assert wallet.wallets["buyer"] == 80
+    assert wallet.wallets["seller"] == 0
+    assert len(wallet.payment_orders) == 2
+
+    # Ao transferir a ordem mais antiga, o slot dela é liberado
+    status = wallet.transfer(
+        wallet_pb2.TransferRequest(payment_order=1, recount=10, wallet="seller"),
+        None,
+    ).status
+    assert status == 0
+    assert create(wallet, 10) == 3
+    assert wallet.wallets["buyer"] + wallet.wallets["seller"] == 100 - 20
@@ -0,0 +1,124 @@
+# Roda de temporização (timing wheel) hierárquica
+# Vinicius Gomes - 2021421869
+
+import math
+
+
+class TimingWheel:
+    def __init__(
+        self, tick: float, start: float, slots: int = 64, levels: int = 4
+    ) -> None:
+        """
+        Roda de temporização hierárquica, usada para expirar itens após um
+        prazo sem percorrer todos os itens pendentes.
+
+        O tempo é dividido em ticks. O nível 0 tem uma posição por tick; cada
+        posição do nível `n` cobre `slots ** n` ticks. Um item é guardado no
+        nível mais baixo cujo alcance contém o seu prazo e, quando a posição
+        de um nível superior é alcançada, os seus itens descem para os níveis
+        inferiores. Assim, agendar um item é O(1) e cada tick custa O(1) mais
+        o número de itens que expiram nele (cada item desce no máximo
+        `levels` vezes). Prazos além do alcance do último nível ficam na sua
+        posição mais distante e são reagendados quando ela é alcançada.
+
+        Itens não podem ser cancelados: quem os consome deve ignorar os que
+        já não são mais válidos quando eles expiram.
+
+        Parâmetros:
+            tick (float): duração de um tick em segundos
+            start (float): instante inicial (mesmo relógio de `advance`)
+            slots (int): número de posições em cada nível
+            levels (int): número de níveis
+        """
+
+        self.tick = tick
+        self._start = start
+        self._slots = slots
+        self._levels = levels
+        # Ticks já processados
+        self._now = 0
+        # Cada posição guarda pares (tick de expiração, item)
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._count = 0
+
+    def _ticks(self, instant):
+        return (instant - self._start) / self.tick
+
+    def schedule(self, item, deadline: float) -> None:
+        """
+        Agenda a expiração de um item.
+
+        Parâmetros:
+            item: item que será retornado por `advance` após o prazo
+            deadline (float): instante de expiração
+        """
+
+        # Um prazo que já passou expira no próximo tick
+        self._insert(max(math.ceil(self._ticks(deadline)), self._now + 1), item)
+        self._count += 1
+
+    def _insert(self, expires, item):
+        delta = expires - self._now
+        span = self._slots
+        for level in range(self._levels):
+            if delta < span or level == self._levels - 1:
+                break
+            span *= self._slots
+        span //= self._slots
+
+        # No último nível, prazos fora do alcance ficam na posição anterior à
+        # atual, a última a ser alcançada
+        if delta >= span * self._slots:
+            position = (self._now // span - 1) % self._slots
+        else:
+            position = (expires // span) % self._slots
+        self._wheels[level][position].append((expires, item))
+
+    def advance(self, now: float) -> list:
+        """
+        Avança a roda até o instante informado.
+
+        Parâmetros:
+            now (float): instante atual
+
+        Retorna:
+            A lista dos itens cujo prazo terminou, em ordem de expiração.
+        """
+
+        # Um item nunca expira antes do seu prazo, e sim até um tick depois
+        expired = []
+        target = math.floor(self._ticks(now))
+        while self._now < target:
+            self._now += 1
+            self._cascade(1)
+
+            position = self._now % self._slots
+            entries = self._wheels[0][position]
+            self._wheels[0][position] = []
+            for expires, item in entries:
+                # Com um único nível, prazos fora do alcance passam pelo
+                # nível 0 antes de vencerem
+                if expires <= self._now:
+                    expired.append(item)
+                else:
+                    self._insert(expires, item)
+
+        self._count -= len(expired)
+        return expired
+
+    def _cascade(self, level):
+        # Quando o nível inferior completa uma volta, a posição atual deste
+        # nível desce para os níveis inferiores (começando pelos superiores)
+        span = self._slots**level
+        if level >= self._levels or self._now % span:
+            return
+        self._cascade(level + 1)
+
+        position = (self._now // span) % self._slots
+        entries = self._wheels[level][position]
+        self._wheels[level][position] = []
+        for expires, item in entries:
+            self._insert(expires, item)
+
+    def __len__(self) -> int:
+        return self._count
@@ -0,0 +1,201 @@
+# Endereços dos servidores e transportes locais: sockets Unix e chamadas
+# feitas diretamente a um servicer do mesmo processo
+# Vinicius Gomes - 2021421869
+
+import argparse
+import os
+import socket
+import stat
+from concurrent import futures
+
+import grpc
+
+# Prefixo dos endereços de sockets Unix ("unix:/caminho"), no formato
+# aceito pelo gRPC tanto para receber quanto para abrir conexões
+UNIX = "unix"
+
+
+def parse_endpoint(text: str) -> int | str:
+    """
+    Lê o endpoint em que um servidor recebe conexões, informado na linha de
+    comando: uma porta TCP ou o caminho de um socket Unix ("unix:/caminho").
+    Usada como `type` do argparse.
+
+    Parâmetros:
+        text (str): porta ou endereço do socket
+
+    Retorna:
+        A porta (int) ou o próprio endereço do socket (str).
+    """
+
+    if text.startswith(f"{UNIX}:"):
+        if len(text) == len(UNIX) + 1:
+            raise argparse.ArgumentTypeError("socket Unix sem caminho")
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"porta inválida: {text}") from None
+
+
+def listen_address(endpoint: int | str) -> str:
+    """
+    Retorna o endereço passado a `add_insecure_port` para receber conexões
+    no endpoint informado: todas as interfaces, no caso de uma porta TCP, ou
+    o socket Unix. O gRPC substitui o arquivo de um socket Unix que já
+    exista, o que tiraria as conexões de outro servidor ainda em execução no
+    mesmo caminho, então esse caso é recusado antes (um socket que sobrou de
+    uma execução anterior é substituído normalmente).
+
+    Parâmetros:
+        endpoint (int | str): endpoint lido por `parse_endpoint`
+    """
+
+    if isinstance(endpoint, str):
+        _check_unused(endpoint[len(UNIX) + 1 :])
+        return endpoint
+    return f"0.0.0.0:{endpoint}"
+
+
+def _check_unused(path):
+    if not os.path.exists(path) or not stat.S_ISSOCK(os.stat(path).st_mode):
+        return
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return
+    raise RuntimeError(f"outro servidor já recebe conexões em {path}")
+
+
+def parse_address(text: str) -> tuple[str, int | str]:
+    """
+    Lê o endereço de um servidor informado na linha de comando: "host:porta"
+    ou "unix:/caminho". O socket Unix vira o par ("unix", caminho), que os
+    clientes formatam de volta como "unix:/caminho" da mesma forma que um
+    par (host, porta) vira "host:porta", então ele pode ser usado em todos os
+    lugares que recebem um endereço.
+
+    Parâmetros:
+        text (str): endereço
+
+    Retorna:
+        O par (host, porta) ou ("unix", caminho).
+    """
+
+    if text.startswith(f"{UNIX}:"):
+        return UNIX, text[len(UNIX) + 1 :]
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+
+def endpoint(address: tuple[str, int | str]) -> int | str:
+    """
+    Retorna o endpoint em que um servidor deve receber as conexões feitas ao
+    endereço informado (a porta, ou o socket Unix), para quando o próprio
+    processo que usa o endereço atende o serviço.
+
+    Parâmetros:
+        address (tuple[str, int | str]): endereço lido por `parse_address`
+    """
+
+    host, port = address
+    return f"{UNIX}:{port}" if host == UNIX else port
+
+
+class LocalRpcError(grpc.RpcError):
+    def __init__(self, code: grpc.StatusCode, details: str) -> None:
+        """
+        Erro de uma chamada feita por LocalStub, com os mesmos métodos do
+        erro de uma chamada do gRPC.
+
+        Parâmetros:
+            code (grpc.StatusCode): código do erro
+            details (str): descrição do erro
+        """
+
+        super().__init__(f"{code.name}: {details}")
+        self._code = code
+        self._details = details
+
+    def code(self) -> grpc.StatusCode:
+        return self._code
+
+    def details(self) -> str:
+        return self._details
+
+
+class _LocalContext:
+    # Contexto das chamadas feitas por LocalStub, com os métodos de
+    # grpc.ServicerContext usados pelos servicers
+
+    def __init__(self, stub):
+        self._stub = stub
+
+    def abort(self, code, details):
+        raise LocalRpcError(code, details)
+
+    def is_active(self):
+        return not self._stub.closed
+
+    def time_remaining(self):
+        return None
+
+
+class LocalStub:
+    def __init__(self, servicer) -> None:
+        """
+        Stub que chama os procedimentos de um servicer do mesmo processo
+        diretamente, sem serializar as mensagens nem passar pelo HTTP/2. Os
+        procedimentos têm a mesma assinatura dos do stub gerado (inclusive
+        `.future`), e os erros são gerados como LocalRpcError. Também faz o
+        papel do canal: depois de `close`, os streams de resposta terminam.
+
+        As chamadas não passam pelos interceptadores do servidor, então não
+        entram nas métricas nem na fila de admissão dele, e o prazo
+        (`timeout`) é ignorado: a chamada executa na thread de quem chama.
+
+        Parâmetros:
+            servicer: servicer síncrono (p.ex. Wallet)
+        """
+
+        self._servicer = servicer
+        self.closed = False
+
+    def __getattr__(self, name):
+        method = _LocalMethod(self, getattr(self._servicer, name))
+        # Os próximos acessos encontram o método sem passar por __getattr__
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        self.closed = True
+
+
+class _LocalMethod:
+    def __init__(self, stub, method):
+        self._stub = stub
+        self._method = method
+
+    def __call__(self, request, **kwargs):
+        if self._stub.closed:
+            raise ValueError("chamada em um stub local fechado")
+        try:
+            return self._method(request, _LocalContext(self._stub))
+        except grpc.RpcError:
+            raise
+        except Exception as error:
+            # Como no gRPC, uma exceção do servicer chega a quem chamou como
+            # um erro UNKNOWN
+            raise LocalRpcError(
+                grpc.StatusCode.UNKNOWN, f"{type(error).__name__}: {error}"
+            ) from error
+
+    def future(self, request, **kwargs):
+        # A chamada é feita na hora, então o future já está terminado
+        result = futures.Future()
+        try:
+            result.set_result(self(request, **kwargs))
+        except grpc.RpcError as error:
+            result.set_exception(error)
+        return result
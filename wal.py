@@ -0,0 +1,447 @@
+# Log de escrita antecipada (write-ahead log) do servidor de carteiras
+# Vinicius Gomes - 2021421869
+
+import asyncio
+import json
+import os
+import threading
+
+# Nome do arquivo de snapshot dentro do diretório do log
+SNAPSHOT_FILE = "snapshot.json"
+
+
+class WriteAheadLog:
+    def __init__(self, directory: str, group_commit: bool = True) -> None:
+        """
+        Log de escrita antecipada das operações que alteram o estado do
+        servidor de carteiras.
+
+        Cada registro recebe um número de sequência (LSN) crescente e é
+        escrito em uma linha no formato "<lsn> <operação> <campos...>". Os
+        registros ficam em segmentos (wal-<lsn inicial>.log) e, de tempos em
+        tempos, o estado completo é gravado em um snapshot; os segmentos
+        totalmente cobertos pelo snapshot são então apagados, o que limita o
+        tempo de recuperação.
+
+        No modo de group commit, os registros são acumulados em memória e uma
+        thread dedicada os escreve e faz um único fsync para todos os
+        registros acumulados desde o último fsync. Quem precisa que o seu
+        registro seja durável espera em `wait`, então várias requisições
+        concorrentes compartilham o mesmo fsync. Sem group commit, cada
+        registro é escrito e sincronizado individualmente em `append`.
+
+        Parâmetros:
+            directory (str): diretório onde ficam os segmentos e o snapshot
+            group_commit (bool): agrupa os fsyncs de registros concorrentes
+        """
+
+        self.directory = directory
+        self.group_commit = group_commit
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._buffer: list[str] = []
+        # Último LSN entregue e último LSN gravado em disco
+        self._lsn = 0
+        self._durable_lsn = 0
+        # Esperas de corrotinas: tuplas (lsn, event loop, future)
+        self._async_waiters = []
+        self._closed = False
+
+        # Segmentos já fechados: pares (caminho, maior LSN do segmento)
+        self._segments: list[tuple[str, int]] = []
+        self._file = None
+        self._file_max_lsn = 0
+        # LSN coberto pelo último snapshot e pedido de troca de segmento
+        self._snapshot_lsn = 0
+        self._rotate = False
+
+        self._flusher = None
+
+    def recover(self, wallets: dict[str, int]):
+        """
+        Reconstrói o estado do servidor a partir do último snapshot e dos
+        registros do log posteriores a ele. Caso não exista snapshot, as
+        carteiras informadas (lidas da entrada padrão) são usadas como estado
+        inicial e gravadas no primeiro snapshot. Deve ser chamada uma única
+        vez, antes de qualquer `append`.
+
+        Parâmetros:
+            wallets (dict[str, int] | WalletTable): carteiras lidas da entrada
+                                                   padrão
+
+        Retorna:
+            Uma tupla (carteiras, ordens de pagamento, próximo identificador
+            de ordem de pagamento, transações preparadas, transações
+            confirmadas). Cada ordem de pagamento é uma tupla (valor,
+            carteira de origem); as transações entre shards preparadas e sem
+            decisão são um dicionário identificador → ação (ver
+            `apply_record`), e as confirmadas, uma lista de identificadores
+            em ordem de confirmação.
+        """
+
+        payment_orders: dict[int, tuple[int, str | None]] = {}
+        next_order = 1
+        prepared: dict[str, tuple] = {}
+        committed: list[str] = []
+
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as snapshot:
+                state = json.load(snapshot)
+            # A tabela de carteiras recuperada é do mesmo tipo da informada
+            # (dicionário ou WalletTable)
+            wallets = type(wallets)(state["wallets"])
+            payment_orders = {
+                int(order): _order_entry(entry)
+                for order, entry in state["payment_orders"].items()
+            }
+            next_order = state["next_order"]
+            # Snapshots anteriores não guardavam as transações entre shards
+            prepared = {
+                transaction: tuple(action)
+                for transaction, action in state.get("prepared", {}).items()
+            }
+            committed = state.get("committed", [])
+            self._snapshot_lsn = self._lsn = state["lsn"]
+
+        # Reaplica os registros posteriores ao snapshot, segmento a segmento
+        for path in self._segment_paths():
+            max_lsn = 0
+            with open(path) as segment:
+                for line in segment:
+                    fields = line.split()
+                    # Uma linha incompleta no fim do último segmento é um
+                    # registro que não chegou a ser gravado por inteiro
+                    if not line.endswith("\n") or len(fields) < 2:
+                        break
+
+                    lsn = int(fields[0])
+                    max_lsn = lsn
+                    if lsn <= self._snapshot_lsn:
+                        continue
+
+                    next_order = apply_record(
+                        fields[1:],
+                        wallets,
+                        payment_orders,
+                        next_order,
+                        prepared,
+                        committed,
+                    )
+                    self._lsn = lsn
+
+            # Segmentos vazios são descartados (um novo será aberto abaixo)
+            if max_lsn == 0:
+                os.remove(path)
+            else:
+                self._segments.append((path, max_lsn))
+
+        self._durable_lsn = self._file_max_lsn = self._lsn
+        if not os.path.exists(snapshot_path):
+            self.write_snapshot(
+                dict(wallets),
+                payment_orders,
+                next_order,
+                self._lsn,
+                prepared,
+                committed,
+            )
+
+        self._open_segment()
+        if self.group_commit:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+        return wallets, payment_orders, next_order, prepared, committed
+
+    def _segment_paths(self):
+        names = [
+            name
+            for name in os.listdir(self.directory)
+            if name.startswith("wal-") and name.endswith(".log")
+        ]
+        names.sort(key=lambda name: int(name[4:-4]))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _open_segment(self):
+        # O nome do segmento é o LSN do primeiro registro que ele receberá
+        path = os.path.join(self.directory, f"wal-{self._file_max_lsn + 1}.log")
+        self._file = open(path, "a")
+        self._file_path = path
+
+    def _close_segment(self):
+        self._file.close()
+        self._segments.append((self._file_path, self._file_max_lsn))
+
+    def append(self, *fields) -> int:
+        """
+        Acrescenta um registro ao log. Deve ser chamada enquanto os locks que
+        protegem a alteração registrada estão adquiridos, para que a ordem dos
+        registros no log seja a mesma ordem em que as alterações aconteceram.
+
+        Parâmetros:
+            fields: operação e campos do registro
+
+        Retorna:
+            O LSN do registro, usado em `wait`.
+        """
+
+        with self._cond:
+            self._lsn += 1
+            line = f"{self._lsn} {' '.join(map(str, fields))}\n"
+            if self.group_commit:
+                self._buffer.append(line)
+                self._cond.notify_all()
+            else:
+                self._write([line], self._lsn)
+                self._durable_lsn = self._lsn
+            return self._lsn
+
+    def wait(self, lsn: int) -> None:
+        """
+        Bloqueia até que o registro com o LSN informado esteja gravado em
+        disco.
+
+        Parâmetros:
+            lsn (int): LSN retornado por `append`
+        """
+
+        with self._cond:
+            while self._durable_lsn < lsn:
+                self._cond.wait()
+
+    async def wait_async(self, lsn: int) -> None:
+        """
+        Versão de `wait` para corrotinas, que não bloqueia o event loop.
+
+        Parâmetros:
+            lsn (int): LSN retornado por `append`
+        """
+
+        with self._cond:
+            if self._durable_lsn >= lsn:
+                return
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._async_waiters.append((lsn, loop, future))
+        await future
+
+    def _write(self, lines, max_lsn):
+        # Escreve os registros no segmento atual e os sincroniza com o disco
+        self._file.writelines(lines)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file_max_lsn = max_lsn
+
+        # Troca de segmento pedida por um snapshot
+        if self._rotate:
+            self._rotate = False
+            self._close_segment()
+            self._open_segment()
+            self._remove_covered_segments()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed and not self._rotate:
+                    self._cond.wait()
+                if self._closed and not self._buffer:
+                    return
+                lines, self._buffer = self._buffer, []
+                max_lsn = self._lsn
+
+            # A escrita e o fsync são feitos sem o lock, enquanto novos
+            # registros continuam sendo acumulados para o próximo fsync
+            self._write(lines, max_lsn)
+
+            with self._cond:
+                self._durable_lsn = max_lsn
+                self._cond.notify_all()
+                waiters = []
+                for waiter in self._async_waiters:
+                    if waiter[0] <= max_lsn:
+                        _, loop, future = waiter
+                        loop.call_soon_threadsafe(_resolve, future)
+                    else:
+                        waiters.append(waiter)
+                self._async_waiters = waiters
+
+    def write_snapshot(
+        self, wallets, payment_orders, next_order, lsn, prepared=None, committed=None
+    ) -> None:
+        """
+        Grava um snapshot do estado do servidor que inclui todos os registros
+        até o LSN informado e pede a remoção dos segmentos cobertos por ele.
+        O snapshot é escrito em um arquivo temporário e renomeado, então um
+        snapshot incompleto nunca substitui o anterior.
+
+        Parâmetros:
+            wallets (dict[str, int]): cópia das carteiras
+            payment_orders (dict[int, tuple[int, str]]): cópia das ordens de
+                                                         pagamento (valor e
+                                                         carteira de origem)
+            next_order (int): próximo identificador de ordem de pagamento
+            lsn (int): último LSN refletido no estado
+            prepared (dict[str, tuple] | None): transações entre shards
+                                                preparadas e sem decisão
+                                                (identificador → ação)
+            committed (list[str] | None): transações entre shards
+                                          confirmadas recentemente
+        """
+
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "w") as snapshot:
+            json.dump(
+                {
+                    "lsn": lsn,
+                    "next_order": next_order,
+                    "wallets": wallets,
+                    "payment_orders": payment_orders,
+                    "prepared": prepared or {},
+                    "committed": committed or [],
+                },
+                snapshot,
+            )
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(path + ".tmp", path)
+
+        with self._cond:
+            self._snapshot_lsn = lsn
+            if self._file is None:
+                return
+            if self.group_commit:
+                self._rotate = True
+                self._cond.notify_all()
+            else:
+                self._close_segment()
+                self._open_segment()
+                self._remove_covered_segments()
+
+    def _remove_covered_segments(self):
+        # Apaga os segmentos fechados cujos registros estão todos no snapshot
+        remaining = []
+        for path, max_lsn in self._segments:
+            if max_lsn <= self._snapshot_lsn:
+                os.remove(path)
+            else:
+                remaining.append((path, max_lsn))
+        self._segments = remaining
+
+    @property
+    def lsn(self) -> int:
+        """
+        LSN do último registro acrescentado ao log.
+        """
+
+        return self._lsn
+
+    def close(self) -> None:
+        """
+        Grava os registros pendentes e fecha o log.
+        """
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        self._file.close()
+
+
+def apply_record(
+    fields, wallets, payment_orders, next_order, prepared=None, committed=None
+):
+    """
+    Aplica um registro do log ao estado do servidor. As transações entre
+    shards só são reconstruídas quando `prepared` e `committed` são
+    informados (as réplicas de leitura não as usam).
+
+    Parâmetros:
+        fields (list[str]): operação e campos do registro
+        wallets (dict[str, int]): carteiras
+        payment_orders (dict[int, tuple[int, str]]): ordens de pagamento
+        next_order (int): próximo identificador de ordem de pagamento
+        prepared (dict[str, tuple] | None): transações preparadas e sem
+                                            decisão; a ação é ("debit",
+                                            ordem) ou ("credit", carteira,
+                                            valor, endereço do shard da
+                                            ordem)
+        committed (list[str] | None): transações confirmadas
+
+    Retorna:
+        O próximo identificador de ordem de pagamento após o registro.
+    """
+
+    match fields:
+        # Criação de ordem de pagamento: "O <ordem> <carteira> <valor>"
+        case ["O", order, wallet, value]:
+            order, value = int(order), int(value)
+            wallets[wallet] -= value
+            payment_orders[order] = (value, wallet)
+            next_order = max(next_order, order + 1)
+
+        # Transferência de ordem de pagamento: "X <ordem> <carteira>"
+        case ["X", order, wallet]:
+            wallets[wallet] += payment_orders.pop(int(order))[0]
+
+        # Débito de uma transferência para outro shard:
+        # "T <ordem> [<transação>]"
+        case ["T", order, *transaction]:
+            payment_orders.pop(int(order))
+            _decided(transaction, prepared, committed)
+
+        # Crédito de uma transferência vinda de outro shard:
+        # "D <carteira> <valor> [<transação>]"
+        case ["D", wallet, value, *transaction]:
+            wallets[wallet] += int(value)
+            _decided(transaction, prepared, committed)
+
+        # Preparação de uma transferência entre shards:
+        # "P <transação> debit <ordem>" ou
+        # "P <transação> credit <carteira> <valor> [<shard da ordem>]"
+        case ["P", transaction, "debit", order] if prepared is not None:
+            prepared[transaction] = ("debit", int(order))
+        case ["P", transaction, "credit", wallet, value, *source] if (
+            prepared is not None
+        ):
+            prepared[transaction] = ("credit", wallet, int(value), "".join(source))
+
+        # Transação entre shards desfeita: "A <transação>"
+        case ["A", transaction] if prepared is not None:
+            prepared.pop(transaction, None)
+
+        # Carteira importada com o servidor em execução:
+        # "W <carteira> <saldo>"
+        case ["W", wallet, value]:
+            wallets[wallet] = int(value)
+
+        # Expiração de ordem de pagamento, com o reembolso para a carteira de
+        # origem quando ela é conhecida: "E <ordem> [<carteira>]"
+        case ["E", order, *source]:
+            value, _ = payment_orders.pop(int(order))
+            if source:
+                wallets[source[0]] += value
+
+    return next_order
+
+
+def _decided(transaction, prepared, committed):
+    # Registros anteriores de débito e crédito não traziam a transação
+    if transaction and prepared is not None:
+        prepared.pop(transaction[0], None)
+        committed.append(transaction[0])
+
+
+def _order_entry(entry):
+    # Snapshots anteriores guardavam apenas o valor da ordem, sem a carteira
+    # de origem
+    if isinstance(entry, list):
+        return tuple(entry)
+    return entry, None
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
@@ -3,12 +3,17 @@
 
 from __future__ import print_function
 
-import sys
-
-import grpc
+import argparse
 
+import channel_pool
+import pipeline
+import replication
+import sharding
+import wallet_loader
 import wallet_pb2
-import wallet_pb2_grpc
+
+# Número de carteiras por mensagem na importação de carteiras
+IMPORT_BATCH = 1000
 
 
 def balance(stub, wallet):
@@ -83,6 +88,63 @@ def transfer(stub, payment_order, value, wallet):
     print(response.status)
 
 
+def batch_create_payment_orders(stub, orders):
+    """
+    Realiza uma única requisição para o servidor de carteiras para criar
+    várias ordens de pagamento. Essa função exibe na tela, para cada ordem e
+    na mesma ordem em que foram informadas, o mesmo valor que
+    `create_payment_order` exibiria.
+
+    Parâmetros:
+        stub: stub gRPC para se comunicar com seguindo a interface do
+              servidor de carteiras
+        orders (list[tuple[str, int]]): pares (carteira, valor) das ordens de
+                                        pagamento
+    """
+
+    response = stub.batch_create_payment_orders(
+        wallet_pb2.BatchCreatePaymentOrdersRequest(
+            orders=[
+                wallet_pb2.CreatePaymentOrderRequest(wallet=wallet, value=value)
+                for wallet, value in orders
+            ]
+        )
+    )
+    for result in response.results:
+        print(result.retval)
+
+
+def batch_transfer(stub, transfers):
+    """
+    Realiza uma única requisição para o servidor de carteiras para fazer
+    várias transferências. Essa função exibe na tela, para cada transferência
+    e na mesma ordem em que foram informadas, o mesmo status que `transfer`
+    exibiria.
+
+    Parâmetros:
+        stub: stub gRPC para se comunicar com seguindo a interface do
+              servidor de carteiras
+        transfers (list[tuple[int, int, str]]): triplas (ordem de pagamento,
+                                                valor de conferência, carteira
+                                                de destino)
+    """
+
+    response = stub.batch_transfer(
+        wallet_pb2.BatchTransferRequest(
+            transfers=[
+                wallet_pb2.TransferRequest(
+                    payment_order=payment_order,
+                    recount=value,
+                    wallet=wallet,
+                )
+                for payment_order, value, wallet in transfers
+            ]
+        )
+    )
+    for result in response.results:
+        print(result.status)
+
+
 def end_execution(stub):
     """
     Realiza uma requisição para o servidor de carteiras para encerrar a sua
@@ -98,20 +160,19 @@ def end_execution(stub):
     print(response.pendencies)
 
 
-def run(wallet, wallet_addr):
+def read_commands(wallet):
     """
-    Inicia o cliente do servidor de carteiras e processa os comandos
-    do usuário.
+    Lê os comandos da entrada padrão, um por linha, até o fim da entrada ou
+    até o comando F. Linhas vazias ou que não comecem com S, O, X ou F são
+    ignoradas.
 
     Parâmetros:
         wallet (str): identificador da carteira do cliente
-        wallet_addr (tuple[str, int]): endereço do servidor de carteiras
-    """
 
-    # Abre um canal para se comunicar com o servidor de carteiras
-    channel = grpc.insecure_channel(f"{wallet_addr[0]}:{wallet_addr[1]}")
-    # Gera o stub para se comunicar com o servidor de carteiras
-    stub = wallet_pb2_grpc.WalletStub(channel)
+    Retorna:
+        Um gerador de pares (comando, argumentos), em que os argumentos são
+        os parâmetros da função que executa o comando (sem o stub).
+    """
 
     while True:
         # Lê uma linha da entrada e em caso de EOFError
@@ -129,7 +190,7 @@ def run(wallet, wallet_addr):
         match command:
             # Lê o saldo
             case "S":
-                balance(stub, wallet)
+                yield command, (wallet,)
 
             # Cria ordem de pagamento
             case "O":
@@ -137,7 +198,7 @@ def run(wallet, wallet_addr):
                 _, *args = line.split()
                 value = int(args[0])
 
-                create_payment_order(stub, wallet, value)
+                yield command, (wallet, value)
 
             # Realiza uma transferência
             case "X":
@@ -147,28 +208,361 @@ def run(wallet, wallet_addr):
                 value = int(args[1])
                 wallet = args[2]
 
-                transfer(stub, payment_order, value, wallet)
+                yield command, (payment_order, value, wallet)
 
             # Termina a execução
             case "F":
-                end_execution(stub)
+                yield command, ()
 
                 break
 
             case _:
                 pass
 
+
+def session_commands(commands):
+    """
+    Converte os comandos lidos da entrada nas mensagens enviadas pelo stream
+    do procedimento `session` do servidor de carteiras.
+
+    Parâmetros:
+        commands: gerador de pares (comando, argumentos) de `read_commands`
+    """
+
+    for command, args in commands:
+        match command:
+            case "S":
+                (wallet,) = args
+                yield wallet_pb2.SessionCommand(
+                    balance=wallet_pb2.BalanceRequest(wallet=wallet)
+                )
+
+            case "O":
+                wallet, value = args
+                yield wallet_pb2.SessionCommand(
+                    create_payment_order=wallet_pb2.CreatePaymentOrderRequest(
+                        wallet=wallet, value=value
+                    )
+                )
+
+            case "X":
+                payment_order, value, wallet = args
+                yield wallet_pb2.SessionCommand(
+                    transfer=wallet_pb2.TransferRequest(
+                        payment_order=payment_order, recount=value, wallet=wallet
+                    )
+                )
+
+            case "F":
+                yield wallet_pb2.SessionCommand(
+                    end_execution=wallet_pb2.EndExecutionRequest()
+                )
+
+
+def run_session(stub, commands):
+    """
+    Executa os comandos por meio de um único stream bidirecional com o
+    servidor de carteiras: os comandos são enviados à medida que são lidos,
+    sem esperar pela resposta do anterior, e os resultados chegam na mesma
+    ordem dos comandos. A saída é a mesma do modo com uma chamada por comando.
+
+    Parâmetros:
+        stub: stub gRPC para se comunicar com seguindo a interface do
+              servidor de carteiras
+        commands: gerador de pares (comando, argumentos) de `read_commands`
+    """
+
+    for result in stub.session(session_commands(commands)):
+        match result.WhichOneof("result"):
+            case "balance":
+                print(result.balance.balance)
+            case "create_payment_order":
+                print(result.create_payment_order.retval)
+            case "transfer":
+                print(result.transfer.status)
+            case "end_execution":
+                print(result.end_execution.pendencies)
+
+
+def run_pipelined(stub, commands, window):
+    """
+    Executa os comandos com até `window` chamadas em andamento ao mesmo
+    tempo (feitas com `.future`), sem esperar pela resposta de cada uma para
+    ler o próximo comando. Os resultados são exibidos na ordem dos comandos,
+    e um comando só é enviado depois dos anteriores de que ele depende, então
+    a saída é a mesma da execução em sequência:
+        - S lê a carteira, e espera as alterações anteriores dela;
+        - O altera a carteira e cria a próxima ordem de pagamento, então
+          também espera os comandos O anteriores (os números das ordens são
+          atribuídos na ordem dos comandos);
+        - X espera os comandos O anteriores (que podem ter criado a ordem
+          transferida) e altera a ordem e a carteira de destino;
+        - F espera todos os comandos anteriores.
+
+    Parâmetros:
+        stub: stub gRPC para se comunicar com seguindo a interface do
+              servidor de carteiras
+        commands: gerador de pares (comando, argumentos) de `read_commands`
+        window (int): número máximo de comandos em andamento
+    """
+
+    pending = pipeline.Pipeline(window)
+    dependencies = pipeline.Dependencies()
+
+    for command, args in commands:
+        match command:
+            case "S":
+                (wallet,) = args
+                request = wallet_pb2.BalanceRequest(wallet=wallet)
+                call, reads, writes = stub.balance, [("wallet", wallet)], []
+
+                def report(future):
+                    print(future.result().balance)
+
+            case "O":
+                wallet, value = args
+                request = wallet_pb2.CreatePaymentOrderRequest(
+                    wallet=wallet, value=value
+                )
+                call, reads, writes = (
+                    stub.create_payment_order,
+                    [],
+                    [("wallet", wallet), ("orders",)],
+                )
+
+                def report(future):
+                    print(future.result().retval)
+
+            case "X":
+                payment_order, value, wallet = args
+                request = wallet_pb2.TransferRequest(
+                    payment_order=payment_order, recount=value, wallet=wallet
+                )
+                call, reads, writes = (
+                    stub.transfer,
+                    [("orders",)],
+                    [("order", payment_order), ("wallet", wallet)],
+                )
+
+                def report(future):
+                    print(future.result().status)
+
+            case "F":
+                pending.drain()
+                end_execution(stub)
+                return
+
+        future = pipeline.after(
+            dependencies.wait_for(reads, writes),
+            lambda call=call, request=request: call.future(request),
+        )
+        dependencies.register(future, reads, writes)
+        pending.submit(future, report)
+
+    pending.drain()
+
+
+def import_wallets(stub, path, batch_size=IMPORT_BATCH):
+    """
+    Importa as carteiras de um arquivo, no mesmo formato da entrada padrão do
+    servidor de carteiras, com o servidor em execução. O arquivo é lido em
+    blocos grandes e as carteiras são enviadas em lotes por um único stream
+    (procedimento `import_wallets`). Essa função exibe na tela o número de
+    carteiras importadas, de carteiras que já existiam e de carteiras
+    recusadas.
+
+    Parâmetros:
+        stub: stub gRPC para se comunicar com seguindo a interface do
+              servidor de carteiras
+        path (str): caminho do arquivo com as carteiras
+        batch_size (int): número de carteiras por mensagem
+    """
+
+    def requests():
+        with open(path, "rb") as wallets:
+            for data in wallet_loader.read_chunks(wallets):
+                names, balances = wallet_loader.parse_chunk(data)
+                for start in range(0, len(names), batch_size):
+                    yield wallet_pb2.ImportWalletsRequest(
+                        wallets=[
+                            wallet_pb2.WalletEntry(wallet=name, balance=balance)
+                            for name, balance in zip(
+                                names[start : start + batch_size],
+                                balances[start : start + batch_size],
+                            )
+                        ]
+                    )
+
+    response = stub.import_wallets(requests())
+    print(response.imported, response.existing, response.rejected)
+
+
+def run(
+    wallet,
+    wallet_addr,
+    batch_size=0,
+    stream=False,
+    replica_addr=None,
+    pool_options=None,
+    import_path=None,
+    window=1,
+):
+    """
+    Inicia o cliente do servidor de carteiras e processa os comandos
+    do usuário.
+
+    Parâmetros:
+        wallet (str): identificador da carteira do cliente
+        wallet_addr (tuple[str, int] | list[tuple[str, int]]): endereço do
+            servidor de carteiras ou, com as carteiras particionadas, de cada
+            shard
+        batch_size (int): quando maior que zero, comandos O (ou X) seguidos
+                          são acumulados e enviados em lotes de até esse
+                          tamanho, usando as chamadas em lote do servidor
+        stream (bool): envia todos os comandos por um único stream
+                       bidirecional (procedimento `session`)
+        replica_addr (tuple[str, int] | None): endereço de uma réplica de
+                                               leitura para onde vão as
+                                               consultas de saldo (None envia
+                                               tudo ao servidor principal)
+        pool_options (dict | None): parâmetros do conjunto de canais com o
+                                    servidor de carteiras (ver
+                                    `channel_pool.from_args`)
+        import_path (str | None): importa as carteiras desse arquivo, em vez
+                                  de processar os comandos
+        window (int): número máximo de comandos em andamento ao mesmo tempo
+                      (1 executa um comando por vez)
+    """
+
+    # Abre um canal para se comunicar com o servidor de carteiras e gera o
+    # stub (com vários shards, o roteador faz o papel dos dois)
+    channel, stub = sharding.connect(wallet_addr, pool_options)
+
+    # As consultas de saldo podem ir para uma réplica, que volta para o
+    # servidor principal quando a réplica está atrasada demais
+    reader = stub
+    if replica_addr is not None:
+        reader = replication.ReplicaReader(stub, replica_addr)
+
+    if import_path is not None:
+        import_wallets(stub, import_path, batch_size or IMPORT_BATCH)
+        channel.close()
+        return
+
+    if stream:
+        run_session(stub, read_commands(wallet))
+        channel.close()
+        return
+
+    if window > 1:
+        run_pipelined(stub, read_commands(wallet), window)
+        channel.close()
+        return
+
+    # Comandos acumulados para serem enviados no próximo lote. Um lote contém
+    # apenas comandos do mesmo tipo ("O" ou "X"); ao mudar de tipo (ou ao
+    # encontrar qualquer outro comando) o lote é enviado antes, o que mantém a
+    # ordem de execução e de exibição dos resultados
+    pending = []
+    pending_command = None
+
+    def flush():
+        nonlocal pending_command
+        if pending_command == "O":
+            batch_create_payment_orders(stub, pending)
+        elif pending_command == "X":
+            batch_transfer(stub, pending)
+        pending.clear()
+        pending_command = None
+
+    for command, args in read_commands(wallet):
+        if batch_size > 0:
+            # Envia o lote pendente antes de um comando de outro tipo
+            if command != pending_command:
+                flush()
+
+            # Acumula os comandos O e X no lote
+            if command in "OX":
+                pending_command = command
+                pending.append(args)
+
+                # Envia o lote quando ele atinge o tamanho máximo
+                if len(pending) >= batch_size:
+                    flush()
+                continue
+
+        match command:
+            case "S":
+                balance(reader, *args)
+            case "O":
+                create_payment_order(stub, *args)
+            case "X":
+                transfer(stub, *args)
+            case "F":
+                end_execution(stub)
+
+    # Envia o que restou do último lote
+    flush()
+
     # Fecha os canal de comunicação criado
     channel.close()
+    if replica_addr is not None:
+        reader.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cliente do servidor de carteiras")
     # Identificador da carteira do cliente
-    wallet = sys.argv[1]
-
-    # Endereço do servidor de carteiras
-    host, port = sys.argv[2].split(":")
-    wallet_addr = (host, int(port))
+    parser.add_argument("wallet")
+    # Endereço do servidor de carteiras (ou dos shards, separados por vírgula)
+    parser.add_argument("wallet_addr")
+    # Tamanho máximo dos lotes de comandos O e X (0 desativa os lotes)
+    parser.add_argument("--batch-size", type=int, default=0)
+    # Envia os comandos por um único stream bidirecional
+    parser.add_argument("--stream", action="store_true")
+    # Envia as consultas de saldo a uma réplica de leitura ("host:porta").
+    # O saldo pode estar atrasado em relação às alterações feitas pelo
+    # próprio cliente, até o atraso máximo configurado na réplica
+    parser.add_argument("--replica")
+    # Conjunto de canais com o servidor de carteiras e opções de HTTP/2
+    channel_pool.add_arguments(parser)
+    # Importa as carteiras do arquivo informado (mesmo formato da entrada
+    # padrão do servidor) com o servidor em execução, em vez de ler comandos;
+    # --batch-size define o número de carteiras por mensagem
+    parser.add_argument("--import-wallets", metavar="PATH")
+    # Número máximo de comandos em andamento ao mesmo tempo: os comandos que
+    # não dependem dos anteriores são enviados sem esperar pelas respostas
+    # deles, e a saída continua na ordem dos comandos
+    parser.add_argument("--window", type=int, default=1)
+    args = parser.parse_args()
+
+    wallet_addr = sharding.parse_wallet_addr(args.wallet_addr)
+    if args.stream and isinstance(wallet_addr, list):
+        parser.error("--stream não é suportado com vários shards")
+    if args.stream and args.replica is not None:
+        parser.error("--stream não pode ser combinado com --replica")
+    if args.import_wallets is not None and isinstance(wallet_addr, list):
+        parser.error("--import-wallets não é suportado com vários shards")
+    if args.window > 1 and isinstance(wallet_addr, list):
+        parser.error("--window não é suportado com vários shards")
+    if args.window > 1 and (
+        args.stream or args.replica is not None or args.batch_size > 0
+    ):
+        parser.error(
+            "--window não pode ser combinado com --stream, --replica ou --batch-size"
+        )
+    replica_addr = None
+    if args.replica is not None:
+        replica_addr = sharding.parse_wallet_addr(args.replica)
 
     # Chama a função que inicia o cliente
-    run(wallet, wallet_addr)
+    run(
+        args.wallet,
+        wallet_addr,
+        args.batch_size,
+        args.stream,
+        replica_addr,
+        channel_pool.from_args(args),
+        args.import_wallets,
+        args.window,
+    )
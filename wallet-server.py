@@ -1,19 +1,55 @@
 # Servidor de carteiras
 # Vinicius Gomes - 2021421869
 
+import argparse
+import asyncio
+import multiprocessing
 import sys
 import threading
+import time
 from concurrent import futures
 
 import grpc
 
+import admission
+import audit
+import changefeed
+import metrics
+import replication
+import sharding
+import transport
+import wallet_loader
 import wallet_pb2
 import wallet_pb2_grpc
+from dedup import DedupCache
+from locks import LockManager
+from order_store import CompactOrderStore, DictOrderStore
+from shared_state import SharedOrderStore, SharedWalletTable
+from timing_wheel import TimingWheel
+from wal import WriteAheadLog
+from wallet_table import WalletTable
 
 
 # Classe que provê os métodos que implementam o serviço de carteiras
 class Wallet(wallet_pb2_grpc.WalletServicer):
-    def __init__(self, stop_event: threading.Event, wallets: dict[str, int]) -> None:
+    # Tempo, em segundos, que uma transação entre shards pode ficar
+    # preparada antes de ser resolvida sem a decisão do coordenador
+    PREPARE_TIMEOUT = 30.0
+
+    def __init__(
+        self,
+        stop_event: threading.Event,
+        wallets: dict[str, int],
+        wal: WriteAheadLog | None = None,
+        snapshot_interval: float = 60.0,
+        order_store=DictOrderStore,
+        order_ttl: float | None = None,
+        audit_log: audit.AuditLog | None = None,
+        shard: tuple[int, int] = (0, 1),
+        mutation_log: replication.MutationLog | None = None,
+        dedup_cache: DedupCache | None = None,
+        change_feed: changefeed.ChangeFeed | None = None,
+    ) -> None:
         """
         Construtor da classe que provê os procedimentos que implementam o
         serviço de carteira.
@@ -21,14 +57,58 @@ class Wallet(wallet_pb2_grpc.WalletServicer):
         Parâmetros:
             stop_event (threading.Event): evento usado para determinar quando
                                           o servidor deve parar de executar
-            wallets (dict[str, int]): dicionário com as carteiras lidas da
-                                      entrada padrão antes do servidor começar
-                                      a executar
+            wallets (dict[str, int] | WalletTable): carteiras lidas da entrada
+                                                   padrão antes do servidor
+                                                   começar a executar
+            wal (WriteAheadLog | None): log onde as alterações são registradas
+                                        no modo durável (None desativa)
+            snapshot_interval (float): intervalo, em segundos, entre os
+                                       snapshots do estado no modo durável
+            order_store: classe que armazena as ordens de pagamento
+                         (DictOrderStore ou CompactOrderStore)
+            order_ttl (float | None): tempo, em segundos, após o qual uma
+                                      ordem de pagamento não transferida
+                                      expira e o seu valor volta para a
+                                      carteira de origem (None desativa)
+            audit_log (AuditLog | None): log de auditoria das operações
+                                         (None desativa)
+            shard (tuple[int, int]): índice deste servidor e número total de
+                                     servidores, quando as carteiras estão
+                                     particionadas entre vários deles
+            mutation_log (MutationLog | None): registro das alterações lido
+                                               pelas réplicas de leitura
+                                               (None desativa)
+            dedup_cache (DedupCache | None): cache das respostas das
+                                             requisições com identificador
+                                             (por padrão, um DedupCache com
+                                             os parâmetros padrão)
+            change_feed (ChangeFeed | None): registro das alterações de saldo
+                                             lido pelos assinantes de
+                                             `watch_mutations` (None
+                                             desativa)
         """
 
         # Evento de término do servidor
         self._stop_event = stop_event
 
+        # As alterações do estado também são registradas para as réplicas,
+        # no mesmo formato do log de escrita antecipada
+        self.mutation_log = mutation_log
+
+        # As alterações de saldo também viram eventos para os assinantes de
+        # `watch_mutations`, com o saldo resultante de cada carteira
+        self.change_feed = change_feed
+
+        # Os procedimentos registram um evento por operação no log de
+        # auditoria, que é escrito por uma thread própria, em vez de exibir
+        # o estado completo a cada alteração
+        self.audit = audit_log or audit.AuditLog(verbosity=audit.OFF)
+
+        # Métricas de cada procedimento, preenchidas pelo interceptador do
+        # servidor e lidas pelo procedimento `stats`
+        self.metrics = metrics.Metrics()
+        self.metrics.add_counters(self._counters)
+
         # A representação de carteiras e ordens de pagamento segue a sugestão
         # dada pelo professor no enunciado do trabalho
         # Além disso, como as carteiras são identificadas pela String
@@ -37,16 +117,296 @@ class Wallet(wallet_pb2_grpc.WalletServicer):
         # estrutura, o que simplificou bastante as verificações realizadas em
         # cada procedimento e o acesso aos valores que cada par guarda
 
+        # No modo durável, o estado é reconstruído a partir do último
+        # snapshot e do log, e as carteiras da entrada padrão só são usadas na
+        # primeira execução
+        self.wal = wal
+        payment_orders: dict[int, int] = {}
+        next_payment_order = 1
+        prepared: dict[str, tuple] = {}
+        committed: list[str] = []
+        if self.wal is not None:
+            wallets, payment_orders, next_payment_order, prepared, committed = (
+                self.wal.recover(wallets)
+            )
+
         # Carteiras
         self.wallets = wallets
         print("wallets:", self.wallets)
 
-        # Ordens de pagamento
-        self.payment_orders: dict[int, int] = {}
+        # Ordens de pagamento e o índice da próxima ordem, que fica dentro do
+        # armazenamento das ordens
+        self.payment_orders = order_store(payment_orders, next_payment_order)
         print("payment orders:", self.payment_orders)
 
-        # Índice das ordens de pagamento
-        self.payment_orders_index = 1
+        # Com as carteiras particionadas, os IDs entregues aos clientes
+        # indicam o shard da ordem (ver `sharding.order_id`); o armazenamento,
+        # o log e a roda de expiração continuam usando a numeração local
+        self.shard, self.shards = shard
+        self._ring = sharding.HashRing(self.shards) if self.shards > 1 else None
+
+        # Transações entre shards preparadas e ainda não decididas
+        # (identificador → ação) e as ordens reservadas por elas, que não
+        # podem ser transferidas nem expirar até a decisão. Ambos são
+        # protegidos pelo lock das ordens de pagamento. As preparações
+        # recuperadas do log recebem um prazo inteiro, como as ordens
+        deadline = time.monotonic() + self.PREPARE_TIMEOUT
+        self._prepared: dict[str, tuple] = {
+            transaction: (*action, deadline)
+            for transaction, action in prepared.items()
+        }
+        self._reserved: set[int] = {
+            action[1] for action in prepared.values() if action[0] == "debit"
+        }
+
+        # Transações entre shards já confirmadas neste servidor, para que um
+        # commit repetido (ou a consulta do outro shard) receba a decisão. Uma
+        # transação ausente foi desfeita ou nunca foi preparada. As entradas
+        # são guardadas por muito mais tempo que o prazo das preparações,
+        # depois do qual ninguém mais pergunta por elas
+        self._committed = DedupCache(1 << 20, 20 * self.PREPARE_TIMEOUT)
+        for transaction in committed:
+            self._committed.put(transaction, True)
+
+        # Respostas das requisições recentes que têm um identificador, para
+        # que uma repetição (nova tentativa ou chamada redundante da loja)
+        # receba a mesma resposta. Protegido pelo lock das ordens de
+        # pagamento, adquirido por todos os procedimentos que o usam
+        self.dedup = DedupCache() if dedup_cache is None else dedup_cache
+
+        # LSN do último registro feito por cada thread, que precisa estar
+        # gravado em disco antes da resposta ser enviada
+        self._local = threading.local()
+
+        # Os procedimentos são executados concorrentemente pelas threads do
+        # pool do servidor, portanto o acesso às carteiras e às ordens de
+        # pagamento é protegido pelos locks do gerenciador abaixo
+        # Um único lock global serializaria todas as requisições; com um lock
+        # por grupo de carteiras e outro para as ordens de pagamento,
+        # operações sobre carteiras diferentes podem executar em paralelo
+        self.locks = LockManager()
+
+        # As threads de fundo (snapshots e expiração) param com um evento
+        # próprio (e não o de parada do servidor) porque o evento de parada
+        # pode ser um asyncio.Event no modo assíncrono
+        self._background_stop = threading.Event()
+
+        # Snapshots periódicos limitam o tamanho do log a ser reaplicado
+        self._snapshot_interval = snapshot_interval
+
+        # Expiração das ordens de pagamento: cada ordem criada é agendada em
+        # uma roda de temporização, protegida pelo lock das ordens de
+        # pagamento, e uma thread a avança a cada tick
+        self.order_ttl = order_ttl
+        self.expired_orders = 0
+        self.refunded_orders = 0
+        self._expiry = None
+        if order_ttl is not None:
+            # Com um décimo do prazo por tick, uma ordem expira com no máximo
+            # 10% de atraso
+            self._expiry = TimingWheel(min(0.1, order_ttl / 10), time.monotonic())
+            # As ordens recuperadas do log recebem um prazo inteiro, já que o
+            # instante em que foram criadas não é guardado
+            deadline = time.monotonic() + order_ttl
+            for payment_order, _, _ in self.payment_orders.records():
+                self._expiry.schedule(payment_order, deadline)
+
+        self._start_background()
+
+    def _start_background(self):
+        """
+        Função auxiliar que inicia as tarefas de fundo do servidor: os
+        snapshots periódicos, no modo durável, a expiração das ordens de
+        pagamento e, com vários shards, a resolução das transações entre
+        shards sem decisão, cada uma em uma thread própria.
+        """
+
+        if self.wal is not None:
+            threading.Thread(
+                target=self._snapshot_loop,
+                args=(self._snapshot_interval,),
+                daemon=True,
+            ).start()
+        if self._expiry is not None:
+            threading.Thread(target=self._expiry_loop, daemon=True).start()
+        if self.shards > 1:
+            threading.Thread(target=self._recovery_loop, daemon=True).start()
+
+    def _log(self, *fields):
+        """
+        Função auxiliar que registra uma alteração do estado no log, quando o
+        modo durável está ativo, e no registro lido pelas réplicas, quando a
+        replicação está ativa. Deve ser chamada com os locks que protegem a
+        alteração adquiridos.
+
+        Parâmetros:
+            fields: operação e campos do registro
+        """
+
+        if self.wal is not None:
+            self._local.lsn = self.wal.append(*fields)
+        if self.mutation_log is not None:
+            self.mutation_log.append(*fields)
+
+    def _publish(self, kind, wallet, value, payment_order=0, source=""):
+        """
+        Função auxiliar que publica uma alteração de saldo para os assinantes
+        de `watch_mutations`, quando o registro de eventos está ativo. Deve
+        ser chamada com os locks da carteira alterada e das ordens de
+        pagamento adquiridos.
+
+        Parâmetros:
+            kind (str): tipo do evento
+            wallet (str | None): carteira alterada
+            value (int): valor da alteração
+            payment_order (int): identificador (externo) da ordem de pagamento
+            source (str | None): carteira de origem, nas transferências
+        """
+
+        if self.change_feed is not None:
+            balance = self.wallets[wallet] if wallet else 0
+            self.change_feed.publish(
+                kind, wallet or "", value, balance, payment_order, source or ""
+            )
+
+    def _pending_lsn(self):
+        """
+        Função auxiliar que retorna (e esquece) o LSN do último registro feito
+        pela thread atual, ou None caso não haja registro pendente.
+        """
+
+        lsn = getattr(self._local, "lsn", None)
+        self._local.lsn = None
+        return lsn
+
+    def _wait_durable(self):
+        """
+        Função auxiliar que espera até que os registros feitos pela thread
+        atual estejam gravados em disco. Deve ser chamada depois que os locks
+        forem liberados, para que outras requisições possam entrar no mesmo
+        fsync (group commit).
+        """
+
+        lsn = self._pending_lsn()
+        if lsn is not None:
+            self.wal.wait(lsn)
+
+    def _audit(self, operation, *fields, failed=False):
+        """
+        Função auxiliar que registra uma operação no log de auditoria.
+        Operações que falharam só são registradas a partir do nível
+        REQUESTS.
+
+        Parâmetros:
+            operation (str): nome da operação
+            fields: campos do evento, terminando pelo resultado da operação
+            failed (bool): indica se a operação falhou
+        """
+
+        level = audit.REQUESTS if failed else audit.MUTATIONS
+        self.audit.record(level, operation, *fields)
+
+    def _audit_state(self):
+        """
+        Função auxiliar que registra o estado completo do servidor no log de
+        auditoria, no nível STATE. Deve ser chamada com os locks da operação
+        adquiridos.
+        """
+
+        if self.audit.enabled(audit.STATE):
+            self.audit.record(audit.STATE, "wallets:", repr(self.wallets))
+            self.audit.record(
+                audit.STATE, "payment orders:", repr(self.payment_orders)
+            )
+
+    def _snapshot_state(self, last_lsn):
+        """
+        Função auxiliar que copia o estado gravado em um snapshot. A cópia é
+        feita com todos os locks adquiridos, então ela corresponde exatamente
+        ao estado após o registro de LSN `lsn`.
+
+        Parâmetros:
+            last_lsn (int): LSN do último snapshot gravado
+
+        Retorna:
+            Os argumentos de `WriteAheadLog.write_snapshot` (carteiras,
+            ordens pendentes, próximo identificador de ordem, LSN e
+            transações entre shards preparadas e confirmadas), ou None caso
+            nada tenha sido registrado desde o último snapshot.
+        """
+
+        with self.locks.all_locks():
+            lsn = self.wal.lsn
+            if lsn == last_lsn:
+                return None
+            wallets = dict(self.wallets)
+            payment_orders = {
+                payment_order: (value, wallet)
+                for payment_order, value, wallet in self.payment_orders.records()
+            }
+            # O prazo das preparações não é guardado
+            prepared = {
+                transaction: action[:-1]
+                for transaction, action in self._prepared.items()
+            }
+            return (
+                wallets,
+                payment_orders,
+                self.payment_orders.next_id,
+                lsn,
+                prepared,
+                self._committed.keys(),
+            )
+
+    def _snapshot_loop(self, interval):
+        """
+        Grava periodicamente um snapshot do estado do servidor no modo
+        durável.
+
+        Parâmetros:
+            interval (float): intervalo entre os snapshots em segundos
+        """
+
+        last_lsn = self.wal.lsn
+        while not self._background_stop.wait(interval):
+            state = self._snapshot_state(last_lsn)
+            if state is not None:
+                self.wal.write_snapshot(*state)
+                last_lsn = state[3]
+
+    def _counters(self):
+        """
+        Função auxiliar que retorna os contadores próprios do servidor,
+        exibidos junto das métricas dos procedimentos. Os valores são lidos
+        sem adquirir os locks, então são apenas aproximados.
+        """
+
+        counters = {
+            "wallets": len(self.wallets),
+            "pending_orders": len(self.payment_orders),
+            "expired_orders": self.expired_orders,
+            "refunded_orders": self.refunded_orders,
+            "audit_dropped": self.audit.dropped,
+            "prepared_transactions": len(self._prepared),
+            "dedup_entries": len(self.dedup),
+            "dedup_hits": self.dedup.hits,
+        }
+        if self.wal is not None:
+            counters["wal_lsn"] = self.wal.lsn
+        if self.mutation_log is not None:
+            counters["replication_lsn"] = self.mutation_log.lsn
+        return counters
+
+    def stats(self, request, context):
+        """
+        Retorna as estatísticas do servidor.
+
+        Retorna:
+            Uma mensagem do tipo StatsReply com as estatísticas de cada
+            procedimento atendido e os contadores do servidor.
+        """
+
+        return self.metrics.stats_reply(wallet_pb2)
 
     def balance(self, request, context):
         """
@@ -64,50 +424,358 @@ class Wallet(wallet_pb2_grpc.WalletServicer):
         # Verifica se a carteira informada existe
         if request.wallet in self.wallets:
             # Caso sim, retorna o saldo na carteira
-            return wallet_pb2.BalanceReply(balance=self.wallets[request.wallet])
+            balance = self.wallets[request.wallet]
         else:
             # Caso não, retorna o código de erro -1
-            return wallet_pb2.BalanceReply(balance=-1)
+            balance = -1
 
-    def create_payment_order(self, request, context):
+        # Consultas não alteram o estado e só são registradas no nível
+        # REQUESTS
+        self.audit.record(audit.REQUESTS, "balance", request.wallet, balance)
+        return wallet_pb2.BalanceReply(balance=balance)
+
+    def _debit(self, wallet, value):
         """
-        Cria uma ordem de pagamento a partir da carteira e do valor informado
-        para essa ordem.
+        Função auxiliar que debita da carteira informada o valor de uma nova
+        ordem de pagamento. Deve ser chamada com os locks da carteira e das
+        ordens de pagamento adquiridos.
 
         Parâmetros:
-            request.wallet (str): carteira em que o valor será debitado
-            request.value (int): valor da ordem de pagamento
+            wallet (str): carteira em que o valor será debitado
+            value (int): valor a ser debitado
 
         Retorna:
-            Uma mensagem de tipo CreatePaymentOrderReply contendo o número da
-            ordem de pagamento criada ou os códigos de erro -1, caso a carteira
-            informada não existe, ou -2, caso o saldo da carteira informada
-            seja menor que o valor da ordem de pagamento criada.
+            0, caso o valor tenha sido debitado, ou os códigos de erro -1,
+            caso a carteira não exista, -2, caso o saldo seja insuficiente, ou
+            -3, caso não haja espaço para mais uma ordem pendente.
         """
 
         # Verifica se a carteira informada existe, caso não retorna o status
         # de erro -1
-        if request.wallet not in self.wallets:
-            return wallet_pb2.CreatePaymentOrderReply(retval=-1)
+        if wallet not in self.wallets:
+            return -1
 
         # Verifica se a carteira informada tem saldo suficiente, caso não
         # retorna o status de erro -2
-        if self.wallets[request.wallet] < request.value:
-            return wallet_pb2.CreatePaymentOrderReply(retval=-2)
+        if self.wallets[wallet] < value:
+            return -2
 
-        # Cria a ordem de pagamento
-        self.payment_orders[self.payment_orders_index] = request.value
-        self.payment_orders_index += 1
+        # Verifica, antes de debitar, se a ordem poderá ser criada (apenas o
+        # armazenamento em memória compartilhada tem capacidade limitada),
+        # caso não retorna o status de erro -3
+        if not self.payment_orders.has_room():
+            return -3
 
         # Debita o valor da ordem de pagamento na carteira informada
-        self.wallets[request.wallet] -= request.value
+        self.wallets[wallet] -= value
+        return 0
 
-        print("create payment order")
-        print("wallets:", self.wallets)
-        print("payment orders:", self.payment_orders)
+    def _create_order(self, wallet, value):
+        """
+        Função auxiliar que registra uma nova ordem de pagamento, cujo valor já
+        foi debitado da carteira de origem. Deve ser chamada com os locks da
+        carteira de origem e das ordens de pagamento adquiridos.
+
+        Parâmetros:
+            wallet (str): carteira de origem
+            value (int): valor da ordem de pagamento
+
+        Retorna:
+            O identificador (externo) da ordem de pagamento criada.
+        """
+
+        # Reserva o identificador e registra a ordem de pagamento. Como o
+        # lock das ordens está adquirido, duas requisições concorrentes nunca
+        # recebem o mesmo ID
+        payment_order = self.payment_orders.create(value, wallet)
+        self._log("O", payment_order, wallet, value)
+        external = sharding.order_id(payment_order, self.shard, self.shards)
+        self._publish("create", wallet, value, external)
+
+        # Ordens transferidas antes do prazo continuam na roda e são
+        # ignoradas quando expiram
+        if self._expiry is not None:
+            self._expiry.schedule(payment_order, time.monotonic() + self.order_ttl)
+        return external
+
+    def _local_order(self, payment_order):
+        """
+        Função auxiliar que converte o identificador externo de uma ordem de
+        pagamento no número local. Deve ser chamada com o lock das ordens de
+        pagamento adquirido.
+
+        Parâmetros:
+            payment_order (int): identificador recebido do cliente
+
+        Retorna:
+            O número local da ordem, ou None caso ela tenha sido criada por
+            outro shard ou esteja reservada por uma transação entre shards
+            (nos dois casos, ela não pode ser transferida por este servidor).
+        """
+
+        if sharding.order_shard(payment_order, self.shards) != self.shard:
+            return None
+        payment_order = payment_order // self.shards
+        if payment_order in self._reserved:
+            return None
+        return payment_order
+
+    def _expire_due(self):
+        """
+        Função auxiliar que expira as ordens de pagamento cujo prazo terminou
+        até o momento (um tick da roda de temporização), devolvendo o valor
+        de cada uma para a carteira de origem.
+        """
+
+        # As ordens vencidas e as suas carteiras de origem são lidas com o
+        # lock das ordens adquirido, mas o reembolso precisa dos locks das
+        # carteiras, que vêm antes do lock das ordens
+        with self.locks.orders_lock:
+            now = time.monotonic()
+            due = self._expiry.advance(now)
+            # Ordens reservadas por uma transação entre shards recebem um
+            # novo prazo, já que podem voltar a ficar pendentes
+            for payment_order in self._reserved.intersection(due):
+                self._expiry.schedule(payment_order, now + self.order_ttl)
+            # Ordens já transferidas não têm mais origem e são ignoradas
+            sources = {
+                payment_order: self.payment_orders.source(payment_order)
+                for payment_order in due
+                if payment_order in self.payment_orders
+                and payment_order not in self._reserved
+            }
+        if not sources:
+            return
+
+        wallets = [wallet for wallet in sources.values() if wallet is not None]
+        with self.locks.wallets_lock(wallets), self.locks.orders_lock:
+            for payment_order, wallet in sources.items():
+                # A ordem pode ter sido transferida (ou reservada)
+                # enquanto os locks estavam liberados
+                if payment_order in self._reserved:
+                    continue
+                entry = self.payment_orders.expire(payment_order)
+                if entry is None:
+                    continue
+                self.expired_orders += 1
+                external = sharding.order_id(payment_order, self.shard, self.shards)
+
+                # Ordens recuperadas de snapshots antigos não têm a
+                # carteira de origem, e o seu valor é perdido
+                value, wallet = entry
+                if wallet is None:
+                    self._log("E", payment_order)
+                    self._publish("expire", None, value, external)
+                    self._audit("expire", external, value)
+                    continue
+                self.wallets[wallet] += value
+                self.refunded_orders += 1
+                self._log("E", payment_order, wallet)
+                self._publish("refund", wallet, value, external)
+                self._audit("expire", external, value, wallet)
+
+            self._audit_state()
+
+        # O reembolso não tem quem espere pela sua gravação em disco
+        self._pending_lsn()
+
+    def _expiry_loop(self):
+        """
+        Expira as ordens de pagamento cujo prazo terminou, a cada tick da roda
+        de temporização.
+        """
 
-        # Retorna o ID da ordem de pagamento criada
-        return wallet_pb2.CreatePaymentOrderReply(retval=self.payment_orders_index - 1)
+        while not self._background_stop.wait(self._expiry.tick):
+            self._expire_due()
+
+    def _transfer(self, payment_order, recount, wallet):
+        """
+        Função auxiliar que transfere o valor de uma ordem de pagamento para
+        uma carteira. Deve ser chamada com o lock da carteira de destino e o
+        lock das ordens de pagamento adquiridos.
+
+        Parâmetros:
+            payment_order (int): identificador (externo) da ordem de pagamento
+            recount (int): valor de conferência da ordem de pagamento
+            wallet (str): carteira de destino
+
+        Retorna:
+            0, em caso de sucesso, ou os códigos de erro -1, -2 ou -3
+            descritos em `transfer`.
+        """
+
+        # Ordens de outro shard (ou reservadas) não existem neste servidor
+        external = payment_order
+        payment_order = self._local_order(payment_order)
+        if payment_order is None:
+            return -1
+
+        # Caso a carteira informada não exista, o código de erro -3 só é
+        # retornado se a ordem de pagamento existe e tem o valor de
+        # conferência (caso contrário, os códigos -1 e -2 têm precedência)
+        if wallet not in self.wallets:
+            status = self.payment_orders.check(payment_order, recount)
+            return status if status < 0 else -3
+
+        # Verifica se a ordem de pagamento existe (-1) e se o valor de
+        # conferência é igual ao valor da ordem (-2) e, caso esteja tudo
+        # certo, remove a ordem, tudo em uma única operação
+        source = None
+        if self.change_feed is not None:
+            source = self.payment_orders.source(payment_order)
+        status = self.payment_orders.take(payment_order, recount)
+        if status < 0:
+            return status
+
+        # Transfere o valor da ordem de pagamento (igual ao valor de
+        # conferência) para a carteira
+        self.wallets[wallet] += recount
+        self._log("X", payment_order, wallet)
+        self._publish("transfer", wallet, recount, external, source)
+        return 0
+
+    def _replay(self, procedure, request_id):
+        """
+        Função auxiliar que retorna a resposta guardada de uma requisição
+        repetida. Deve ser chamada com o lock das ordens de pagamento
+        adquirido, antes de executar a requisição.
+
+        Parâmetros:
+            procedure (str): nome do procedimento
+            request_id (str): identificador da requisição (vazio quando o
+                              cliente não informa um)
+
+        Retorna:
+            A resposta da primeira requisição com o mesmo identificador, ou
+            None caso ela deva ser executada.
+        """
+
+        if not request_id:
+            return None
+        reply = self.dedup.get((procedure, request_id))
+        if reply is None:
+            return None
+
+        # A primeira requisição pode ainda estar esperando o fsync do seu
+        # registro; a repetição espera pelo mesmo registro (ou um posterior)
+        if self.wal is not None:
+            self._local.lsn = self.wal.lsn
+        self.audit.record(audit.REQUESTS, "replay", procedure, request_id)
+        return reply
+
+    def _remember(self, procedure, request_id, reply):
+        """
+        Função auxiliar que guarda a resposta de uma requisição com
+        identificador. Deve ser chamada com o lock das ordens de pagamento
+        adquirido, o mesmo usado em `_replay`, para que duas requisições
+        concorrentes com o mesmo identificador nunca sejam executadas.
+
+        Parâmetros:
+            procedure (str): nome do procedimento
+            request_id (str): identificador da requisição
+            reply: resposta da requisição
+        """
+
+        if request_id:
+            self.dedup.put((procedure, request_id), reply)
+
+    def _create_item(self, request):
+        """
+        Função auxiliar que cria uma ordem de pagamento, ou repete a resposta
+        de uma requisição já atendida. Deve ser chamada com os locks da
+        carteira e das ordens de pagamento adquiridos.
+
+        Parâmetros:
+            request (CreatePaymentOrderRequest): ordem de pagamento
+
+        Retorna:
+            Uma mensagem do tipo CreatePaymentOrderReply, com os códigos
+            descritos em `create_payment_order`.
+        """
+
+        reply = self._replay("create_payment_order", request.request_id)
+        if reply is not None:
+            return reply
+
+        retval = self._debit(request.wallet, request.value)
+        if retval == 0:
+            retval = self._create_order(request.wallet, request.value)
+        self._audit(
+            "create_payment_order",
+            request.wallet,
+            request.value,
+            retval,
+            failed=retval < 0,
+        )
+
+        reply = wallet_pb2.CreatePaymentOrderReply(retval=retval)
+        self._remember("create_payment_order", request.request_id, reply)
+        return reply
+
+    def _transfer_item(self, request):
+        """
+        Função auxiliar que faz uma transferência, ou repete a resposta de
+        uma requisição já atendida. Deve ser chamada com os locks da carteira
+        de destino e das ordens de pagamento adquiridos.
+
+        Parâmetros:
+            request (TransferRequest): transferência
+
+        Retorna:
+            Uma mensagem do tipo TransferReply, com os códigos descritos em
+            `transfer`.
+        """
+
+        reply = self._replay("transfer", request.request_id)
+        if reply is not None:
+            return reply
+
+        status = self._transfer(request.payment_order, request.recount, request.wallet)
+        self._audit(
+            "transfer",
+            request.payment_order,
+            request.recount,
+            request.wallet,
+            status,
+            failed=status < 0,
+        )
+
+        reply = wallet_pb2.TransferReply(status=status)
+        self._remember("transfer", request.request_id, reply)
+        return reply
+
+    def create_payment_order(self, request, context):
+        """
+        Cria uma ordem de pagamento a partir da carteira e do valor informado
+        para essa ordem.
+
+        Parâmetros:
+            request.wallet (str): carteira em que o valor será debitado
+            request.value (int): valor da ordem de pagamento
+            request.request_id (str): identificador opcional da requisição;
+                                      uma repetição recebe a mesma resposta
+
+        Retorna:
+            Uma mensagem de tipo CreatePaymentOrderReply contendo o número da
+            ordem de pagamento criada ou os códigos de erro -1, caso a carteira
+            informada não existe, -2, caso o saldo da carteira informada
+            seja menor que o valor da ordem de pagamento criada, ou -3, caso
+            o limite de ordens pendentes tenha sido atingido.
+        """
+
+        # O débito e a criação da ordem acontecem com os dois locks
+        # adquiridos, para que nenhum snapshot veja um sem o outro
+        with self.locks.wallet_lock(request.wallet), self.locks.orders_lock:
+            reply = self._create_item(request)
+
+            # Caso o débito tenha falhado, o estado não mudou
+            if reply.retval >= 0:
+                self._audit_state()
+
+        self._wait_durable()
+
+        # Retorna o ID da ordem de pagamento criada (ou o código de erro)
+        return reply
 
     def transfer(self, request, context):
         """
@@ -119,6 +787,8 @@ class Wallet(wallet_pb2_grpc.WalletServicer):
             request.recount (int): valor de conferência da ordem de pagamento
             request.wallet (str): carteira de destino do dinheiro da ordem de
                                   pagamento
+            request.request_id (str): identificador opcional da requisição;
+                                      uma repetição recebe a mesma resposta
 
         Retorna:
             Uma mensagem do tipo TransferReply contendo o valor 0, caso a
@@ -129,33 +799,562 @@ class Wallet(wallet_pb2_grpc.WalletServicer):
             caso a carteira informada não exista.
         """
 
-        # Verifica se a ordem de pagamento informada existe, caso não
-        # retorna o status de erro -1
-        if request.payment_order not in self.payment_orders:
-            return wallet_pb2.TransferReply(status=-1)
+        # Apenas a carteira de destino e a tabela de ordens de pagamento são
+        # travadas (nessa ordem, a mesma usada pelos demais procedimentos)
+        with self.locks.wallet_lock(request.wallet), self.locks.orders_lock:
+            reply = self._transfer_item(request)
+            if reply.status == 0:
+                self._audit_state()
 
-        # Verifica se o valor de conferência é igual ao valor da ordem de
-        # pagamento, caso não retorna o status de erro -2
-        if self.payment_orders[request.payment_order] != request.recount:
-            return wallet_pb2.TransferReply(status=-2)
+        self._wait_durable()
 
-        # Verifica se a carteira informada existe, caso não retorna o
-        # status de erro -3
-        if request.wallet not in self.wallets:
-            return wallet_pb2.TransferReply(status=-3)
+        # Retorna o status 0 (sucesso) ou o código de erro
+        return reply
 
-        # Transfere o valor da ordem de pagamento para a carteira
-        self.wallets[request.wallet] += self.payment_orders[request.payment_order]
+    def batch_create_payment_orders(self, request, context):
+        """
+        Cria, em uma única passada, todas as ordens de pagamento informadas.
+        Os locks de todas as carteiras envolvidas e o das ordens de pagamento
+        são adquiridos uma única vez para o lote inteiro.
 
-        # Deleta a ordem de pagamento
-        del self.payment_orders[request.payment_order]
+        Parâmetros:
+            request.orders (list[CreatePaymentOrderRequest]): ordens de
+                                                              pagamento
 
-        print("transfer")
-        print("wallets:", self.wallets)
-        print("payment orders:", self.payment_orders)
+        Retorna:
+            Uma mensagem do tipo BatchCreatePaymentOrdersReply com um
+            CreatePaymentOrderReply para cada item, na mesma ordem e com os
+            mesmos códigos de `create_payment_order`.
+        """
+
+        results = []
+        with self.locks.wallets_lock(item.wallet for item in request.orders):
+            with self.locks.orders_lock:
+                for item in request.orders:
+                    results.append(self._create_item(item))
+
+                # O estado completo é registrado uma única vez por lote
+                self._audit_state()
+
+        # Como os registros do lote são gravados em ordem, basta esperar pelo
+        # último deles
+        self._wait_durable()
+
+        return wallet_pb2.BatchCreatePaymentOrdersReply(results=results)
+
+    def batch_transfer(self, request, context):
+        """
+        Realiza, em uma única passada, todas as transferências informadas.
+        Os locks de todas as carteiras de destino e o das ordens de pagamento
+        são adquiridos uma única vez para o lote inteiro.
+
+        Parâmetros:
+            request.transfers (list[TransferRequest]): transferências
+
+        Retorna:
+            Uma mensagem do tipo BatchTransferReply com um TransferReply para
+            cada item, na mesma ordem e com os mesmos códigos de `transfer`.
+        """
+
+        results = []
+        with self.locks.wallets_lock(item.wallet for item in request.transfers):
+            with self.locks.orders_lock:
+                for item in request.transfers:
+                    results.append(self._transfer_item(item))
+
+                self._audit_state()
+
+        self._wait_durable()
+
+        return wallet_pb2.BatchTransferReply(results=results)
+
+    def purchase(self, request, context):
+        """
+        Realiza uma compra de forma atômica: cria a ordem de pagamento
+        debitando o valor da carteira do comprador e, em seguida, transfere a
+        ordem para a carteira do vendedor, tudo com os locks das duas
+        carteiras e das ordens de pagamento adquiridos uma única vez.
+
+        Parâmetros:
+            request.buyer (str): carteira do comprador
+            request.value (int): valor da compra
+            request.seller (str): carteira do vendedor
+
+        Retorna:
+            Uma mensagem do tipo PurchaseReply contendo em retval o mesmo valor
+            de `create_payment_order` e, caso a ordem tenha sido criada, em
+            status o mesmo valor de `transfer`.
+        """
+
+        with self.locks.wallets_lock([request.buyer, request.seller]):
+            with self.locks.orders_lock:
+                retval = self._debit(request.buyer, request.value)
+                if retval < 0:
+                    self._audit(
+                        "purchase",
+                        request.buyer,
+                        request.value,
+                        request.seller,
+                        retval,
+                        failed=True,
+                    )
+                    return wallet_pb2.PurchaseReply(retval=retval)
+
+                payment_order = self._create_order(request.buyer, request.value)
+                # A ordem de pagamento acabou de ser criada com o valor da
+                # compra, então a transferência só pode falhar com o código -3
+                # (nesse caso a ordem continua pendente)
+                status = self._transfer(payment_order, request.value, request.seller)
+
+                self._audit(
+                    "purchase",
+                    request.buyer,
+                    request.value,
+                    request.seller,
+                    payment_order,
+                    status,
+                )
+                self._audit_state()
+
+        self._wait_durable()
+
+        return wallet_pb2.PurchaseReply(retval=payment_order, status=status)
+
+    def prepare(self, request, context):
+        """
+        Primeira fase de uma transferência entre shards. O débito reserva a
+        ordem de pagamento, que deixa de poder ser transferida ou expirar até
+        a decisão; o crédito apenas verifica se a carteira de destino existe
+        (carteiras nunca são removidas).
+
+        Parâmetros:
+            request.transaction (str): identificador da transação
+            request.debit (TransferRequest): ordem de pagamento e valor de
+                                             conferência, no shard da ordem
+            request.credit (CreditRequest): carteira e valor, no shard da
+                                            carteira de destino
+
+        Retorna:
+            Uma mensagem do tipo PrepareReply com o status 0, caso a ação
+            tenha sido preparada, ou os mesmos códigos de erro de `transfer`.
+        """
+
+        if request.WhichOneof("action") == "debit":
+            with self.locks.orders_lock:
+                payment_order = self._local_order(request.debit.payment_order)
+                if payment_order is None:
+                    status = -1
+                else:
+                    status = self.payment_orders.check(
+                        payment_order, request.debit.recount
+                    )
+                if status == 0:
+                    self._reserved.add(payment_order)
+                    self._prepared[request.transaction] = (
+                        "debit",
+                        payment_order,
+                        time.monotonic() + self.PREPARE_TIMEOUT,
+                    )
+                    self._log("P", request.transaction, "debit", payment_order)
+        else:
+            credit = request.credit
+            with self.locks.wallet_lock(credit.wallet), self.locks.orders_lock:
+                status = 0 if credit.wallet in self.wallets else -3
+                if status == 0:
+                    self._prepared[request.transaction] = (
+                        "credit",
+                        credit.wallet,
+                        credit.value,
+                        request.source,
+                        time.monotonic() + self.PREPARE_TIMEOUT,
+                    )
+                    self._log(
+                        "P",
+                        request.transaction,
+                        "credit",
+                        credit.wallet,
+                        credit.value,
+                        request.source,
+                    )
+
+        self._audit("prepare", request.transaction, status, failed=status < 0)
+        # A preparação precisa estar em disco antes da resposta: depois dela,
+        # o coordenador pode decidir a transação
+        self._wait_durable()
+        return wallet_pb2.PrepareReply(status=status)
+
+    def _decide(self, transaction, commit):
+        """
+        Função auxiliar que aplica (commit) ou descarta (abort) a ação
+        preparada de uma transação entre shards. O débito confirmado remove a
+        ordem de pagamento reservada e o crédito soma o valor à carteira de
+        destino; o débito desfeito devolve a ordem às pendentes. Uma
+        transação já decidida não muda.
+
+        Parâmetros:
+            transaction (str): identificador da transação
+            commit (bool): True para aplicar a ação, False para descartá-la
+
+        Retorna:
+            Uma tupla (ação, status): a ação preparada, ou None caso a
+            transação já tenha sido decidida (ou não exista), e 0, caso a
+            transação tenha sido confirmada (agora ou antes), ou -1, caso
+            contrário.
+        """
+
+        # O lock da carteira do crédito vem antes do lock das ordens, então a
+        # ação é consultada antes e removida depois, com os dois adquiridos
+        with self.locks.orders_lock:
+            action = self._prepared.get(transaction)
+        wallets = [action[1]] if action is not None and action[0] == "credit" else []
+
+        with self.locks.wallets_lock(wallets), self.locks.orders_lock:
+            action = self._prepared.pop(transaction, None)
+            if action is None:
+                pass
+            elif not commit:
+                if action[0] == "debit":
+                    self._reserved.discard(action[1])
+                self._log("A", transaction)
+            elif action[0] == "debit":
+                # O valor de conferência já foi verificado na preparação
+                payment_order = action[1]
+                self._reserved.discard(payment_order)
+                value, source = self.payment_orders.expire(payment_order)
+                self._log("T", payment_order, transaction)
+                self._publish(
+                    "remote_debit",
+                    None,
+                    value,
+                    sharding.order_id(payment_order, self.shard, self.shards),
+                    source,
+                )
+                self._committed.put(transaction, True)
+                self._audit_state()
+            else:
+                _, wallet, value, _, _ = action
+                self.wallets[wallet] += value
+                self._log("D", wallet, value, transaction)
+                self._publish("remote_credit", wallet, value)
+                self._committed.put(transaction, True)
+                self._audit_state()
+
+            status = 0 if self._committed.get(transaction) is not None else -1
+        return action, status
+
+    def commit(self, request, context):
+        """
+        Segunda fase de uma transferência entre shards: aplica a ação
+        preparada (ver `_decide`). O shard da ordem de pagamento recebe o
+        commit primeiro e é quem decide a transação: caso ele responda -1
+        (a preparação venceu e foi desfeita), o crédito é desfeito.
+
+        Parâmetros:
+            request.transaction (str): identificador da transação
+
+        Retorna:
+            Uma mensagem do tipo DecisionReply com o status 0, caso a
+            transação tenha sido confirmada (agora ou por um commit
+            anterior), ou -1, caso ela tenha sido desfeita.
+        """
+
+        action, status = self._decide(request.transaction, True)
+        self._audit("commit", request.transaction, status, failed=action is None)
+        self._wait_durable()
+        return wallet_pb2.DecisionReply(status=status)
+
+    def abort(self, request, context):
+        """
+        Segunda fase de uma transferência entre shards que não pôde ser
+        feita: descarta a ação preparada, devolvendo a ordem de pagamento
+        reservada às ordens pendentes. No shard da ordem, também é a consulta
+        feita pelo shard do crédito cuja decisão não chegou: uma transação
+        ainda preparada é desfeita, e a resposta é a decisão final.
+
+        Parâmetros:
+            request.transaction (str): identificador da transação
+
+        Retorna:
+            Uma mensagem do tipo DecisionReply com o status 0, caso a
+            transação já tenha sido confirmada, ou -1, caso ela tenha sido
+            desfeita.
+        """
+
+        action, status = self._decide(request.transaction, False)
+        self._audit("abort", request.transaction, status, failed=action is None)
+        # A resposta é a decisão final da transação, então o abort precisa
+        # estar em disco antes dela
+        self._wait_durable()
+        return wallet_pb2.DecisionReply(status=status)
+
+    def _expired_prepared(self, now=None):
+        """
+        Função auxiliar que resolve as transações entre shards preparadas há
+        mais de PREPARE_TIMEOUT segundos, cuja decisão não chegou (p.ex.
+        porque o coordenador terminou entre as duas fases). O shard da ordem
+        de pagamento é quem decide, então um débito vencido é desfeito,
+        liberando a ordem reservada; um crédito vencido depende da decisão
+        do shard da ordem, que precisa ser consultado.
+
+        Parâmetros:
+            now (float | None): instante atual (por padrão, time.monotonic())
+
+        Retorna:
+            A lista de pares (transação, endereço do shard da ordem) dos
+            créditos vencidos.
+        """
+
+        now = time.monotonic() if now is None else now
+        with self.locks.orders_lock:
+            expired = [
+                (transaction, action)
+                for transaction, action in self._prepared.items()
+                if action[-1] <= now
+            ]
+
+        credits = []
+        for transaction, action in expired:
+            if action[0] == "debit":
+                self._settle(transaction, False)
+            else:
+                credits.append((transaction, action[3]))
+        return credits
+
+    def _ask_source(self, source, transaction):
+        """
+        Função auxiliar que consulta a decisão de uma transação no shard da
+        ordem de pagamento, com um abort (que desfaz a transação caso ela
+        ainda esteja preparada lá).
+
+        Parâmetros:
+            source (str): endereço do shard da ordem de pagamento
+            transaction (str): identificador da transação
+
+        Retorna:
+            True caso a transação tenha sido confirmada, False caso tenha sido
+            desfeita, ou None caso o shard não tenha respondido.
+        """
+
+        try:
+            with grpc.insecure_channel(source) as channel:
+                reply = wallet_pb2_grpc.WalletStub(channel).abort(
+                    wallet_pb2.DecisionRequest(transaction=transaction),
+                    timeout=self.PREPARE_TIMEOUT / 4,
+                )
+        except grpc.RpcError:
+            return None
+        return reply.status == 0
+
+    def _settle(self, transaction, commit):
+        """
+        Função auxiliar que aplica a decisão de uma transação vencida, tomada
+        sem o coordenador.
+
+        Parâmetros:
+            transaction (str): identificador da transação
+            commit (bool): True para aplicar a ação, False para descartá-la
+        """
+
+        action, status = self._decide(transaction, commit)
+        if action is not None:
+            self._audit("recover", transaction, status)
+        # A resolução não tem quem espere pela sua gravação em disco
+        self._pending_lsn()
+
+    def _recover_prepared(self, now=None):
+        """
+        Resolve as transações entre shards vencidas (ver `_expired_prepared`).
+        Caso o shard da ordem de pagamento de um crédito não responda, a
+        consulta é repetida na próxima rodada.
+
+        Parâmetros:
+            now (float | None): instante atual (por padrão, time.monotonic())
+        """
+
+        for transaction, source in self._expired_prepared(now):
+            committed = self._ask_source(source, transaction)
+            if committed is not None:
+                self._settle(transaction, committed)
 
-        # Retorna o status 0 (sucesso)
-        return wallet_pb2.TransferReply(status=0)
+    def _recovery_loop(self):
+        """
+        Resolve as transações entre shards vencidas, quatro vezes a cada
+        PREPARE_TIMEOUT.
+        """
+
+        while not self._background_stop.wait(self.PREPARE_TIMEOUT / 4):
+            self._recover_prepared()
+
+    def replicate(self, request, context):
+        """
+        Envia a uma réplica de leitura o estado do servidor e, em seguida,
+        cada alteração feita nele, até o fim da execução. Cada réplica
+        conectada ocupa uma das `--max-streams` threads do pool reservadas às
+        chamadas com stream, e nunca as das demais chamadas; com todas
+        ocupadas, a réplica é recusada com RESOURCE_EXHAUSTED (e tenta de
+        novo depois de um intervalo).
+
+        Parâmetros:
+            request.log_id (str): registro do qual veio o estado da réplica
+            request.after (int): LSN da última alteração aplicada na réplica
+
+        Retorna:
+            Um gerador de mensagens do tipo ReplicationMessage.
+        """
+
+        if self.mutation_log is None:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION, "replicação desativada"
+            )
+        return self.mutation_log.stream(
+            request, self._replication_snapshot, self._background_stop
+        )
+
+    def watch_mutations(self, request, context):
+        """
+        Envia a um assinante os eventos de alteração de saldo, em ordem, a
+        partir do evento seguinte ao informado (ou dos próximos eventos),
+        até o fim da execução ou até o assinante desistir. Cada assinante
+        lê os eventos no seu próprio ritmo, sem atrasar as operações, e
+        ocupa uma das `--max-streams` threads do pool reservadas às chamadas
+        com stream (não as das demais chamadas); com todas ocupadas, o
+        assinante é recusado com RESOURCE_EXHAUSTED.
+
+        Parâmetros:
+            request.wallets (list[str]): carteiras de interesse (vazio: todas)
+            request.after (int): último número de sequência recebido (0:
+                                 apenas os eventos novos)
+            request.feed_id (str): registro de onde veio `after`
+
+        Retorna:
+            Um gerador de mensagens do tipo MutationEvents. O stream termina
+            com DATA_LOSS caso os eventos seguintes a `after` não estejam
+            mais guardados.
+        """
+
+        if self.change_feed is None:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION, "eventos de saldo desativados"
+            )
+        try:
+            yield from self.change_feed.stream(
+                request, context.is_active, self._background_stop
+            )
+        except changefeed.EventsLost as error:
+            context.abort(grpc.StatusCode.DATA_LOSS, str(error))
+
+    def _replication_snapshot(self):
+        """
+        Função auxiliar que copia o estado enviado a uma réplica. A cópia é
+        feita com todos os locks adquiridos, então ela corresponde
+        exatamente ao estado após a alteração de LSN `lsn`.
+
+        Retorna:
+            Uma tupla (LSN, carteiras, ordens pendentes, próximo identificador
+            de ordem), com as carteiras como pares (identificador, saldo) e as
+            ordens como tuplas (identificador, valor, carteira de origem).
+        """
+
+        with self.locks.all_locks():
+            return (
+                self.mutation_log.lsn,
+                list(self.wallets.items()),
+                list(self.payment_orders.records()),
+                self.payment_orders.next_id,
+            )
+
+    def session(self, request_iterator, context):
+        """
+        Executa os comandos recebidos por um stream, respondendo cada um com
+        um resultado no stream de resposta, na mesma ordem dos comandos. Como
+        o cliente não precisa esperar por uma resposta para enviar o próximo
+        comando, uma única conexão HTTP/2 é mantida ocupada o tempo todo.
+
+        Parâmetros:
+            request_iterator (Iterator[SessionCommand]): comandos da sessão
+
+        Retorna:
+            Um gerador de mensagens do tipo SessionResult, com a mesma
+            resposta que a chamada individual de cada procedimento daria.
+        """
+
+        for command in request_iterator:
+            # O nome do campo preenchido no comando é o nome do procedimento
+            # que deve ser executado
+            procedure = command.WhichOneof("command")
+            if procedure is None:
+                continue
+
+            reply = getattr(self, procedure)(getattr(command, procedure), context)
+            yield wallet_pb2.SessionResult(**{procedure: reply})
+
+            # O fim da execução encerra também a sessão
+            if procedure == "end_execution":
+                return
+
+    def _import_chunk(self, entries):
+        """
+        Função auxiliar que importa um lote de carteiras, com todos os locks
+        adquiridos (a inserção de uma carteira nova pode reorganizar a
+        estrutura das carteiras, como a tabela de espalhamento da
+        WalletTable). As carteiras que já existem não são alteradas.
+
+        Parâmetros:
+            entries (list[WalletEntry]): carteiras e saldos iniciais
+
+        Retorna:
+            Uma tupla (carteiras importadas, carteiras que já existiam,
+            carteiras recusadas).
+        """
+
+        imported = existing = rejected = 0
+        with self.locks.all_locks():
+            for entry in entries:
+                wallet = entry.wallet
+                # Identificadores vazios ou com espaços não poderiam ser
+                # lidos de volta da entrada padrão nem do log
+                if wallet.split() != [wallet] or (
+                    self._ring is not None and self._ring.shard(wallet) != self.shard
+                ):
+                    rejected += 1
+                elif wallet in self.wallets:
+                    existing += 1
+                else:
+                    self.wallets[wallet] = entry.balance
+                    self._log("W", wallet, entry.balance)
+                    self._publish("import", wallet, entry.balance)
+                    imported += 1
+            if imported:
+                self._audit_state()
+        return imported, existing, rejected
+
+    def import_wallets(self, request_iterator, context):
+        """
+        Importa as carteiras recebidas em lotes por um stream, com o servidor
+        em execução. Cada lote é aplicado (e, no modo durável, gravado em
+        disco) antes do próximo ser lido, então um cliente mais rápido que o
+        servidor é contido pelo controle de fluxo do HTTP/2.
+
+        Parâmetros:
+            request_iterator (Iterator[ImportWalletsRequest]): lotes de
+                                                               carteiras
+
+        Retorna:
+            Uma mensagem do tipo ImportWalletsReply com o número de carteiras
+            importadas, de carteiras que já existiam (e não foram alteradas)
+            e de carteiras recusadas, somados em todos os lotes.
+        """
+
+        totals = [0, 0, 0]
+        for request in request_iterator:
+            for index, count in enumerate(self._import_chunk(request.wallets)):
+                totals[index] += count
+            self._wait_durable()
+
+        self._audit("import_wallets", *totals)
+        return wallet_pb2.ImportWalletsReply(
+            imported=totals[0], existing=totals[1], rejected=totals[2]
+        )
 
     def end_execution(self, request, context):
         """
@@ -169,64 +1368,1018 @@ class Wallet(wallet_pb2_grpc.WalletServicer):
             servidor.
         """
 
-        # Imprime na saída padrão as carteiras e os saldos
-        for wallet, value in self.wallets.items():
-            print(wallet, value)
+        # Todos os locks são adquiridos para que os saldos exibidos e o número
+        # de pendências correspondam a um mesmo estado do servidor
+        with self.locks.all_locks():
+            # Os eventos de auditoria que ainda estão na fila são escritos
+            # antes, para não se misturarem à saída do término
+            self.audit.flush()
+
+            # Imprime na saída padrão as carteiras e os saldos
+            for wallet, value in self.wallets.items():
+                print(wallet, value)
+
+            pendencies = len(self.payment_orders)
+
+            if self._expiry is not None:
+                print("expired orders:", self.expired_orders)
+                print("refunded orders:", self.refunded_orders)
 
         # Sinaliza o evento de encerramento do servidor
+        self._background_stop.set()
         self._stop_event.set()
 
         # Monta a resposta com o número de ordens de pagamento pendentes e
         # envia para o cliente
-        return wallet_pb2.EndExecutionReply(pendencies=len(self.payment_orders))
+        return wallet_pb2.EndExecutionReply(pendencies=pendencies)
 
 
-def run(port, wallets):
+# Versão assíncrona (grpc.aio) do serviço de carteiras
+class AsyncWallet(Wallet):
     """
-    Inicia o servidor de carteiras.
+    Os procedimentos da carteira não fazem E/S nem esperam por outros
+    servidores, então as versões assíncronas apenas delegam para as
+    implementações da classe `Wallet`. A diferença está em quem as executa:
+    todas as requisições são atendidas por um único event loop, sem ocupar uma
+    thread do pool por chamada em andamento.
+
+    Os locks de `Wallet` continuam sendo adquiridos. Um lock mantido por
+    outra thread bloquearia o event loop inteiro até ser liberado, então as
+    tarefas de fundo que adquirem os locks (a cópia do estado dos snapshots,
+    a expiração das ordens e a resolução das transações entre shards
+    vencidas) também executam no event loop, em vez de em threads próprias,
+    e só a gravação do snapshot em disco e a consulta a outro shard são
+    feitas em outra thread. Da mesma forma, a cópia do estado enviada a uma
+    réplica é feita no event loop, e não na thread que avança o stream de
+    replicação.
+    """
+
+    def _start_background(self):
+        # As tarefas são guardadas para não serem coletadas enquanto executam
+        self._background_tasks = []
+        if self.wal is not None:
+            self._background_tasks.append(
+                asyncio.create_task(self._snapshot_task(self._snapshot_interval))
+            )
+        if self._expiry is not None:
+            self._background_tasks.append(asyncio.create_task(self._expiry_task()))
+        if self.shards > 1:
+            self._background_tasks.append(asyncio.create_task(self._recovery_task()))
+
+    async def _snapshot_task(self, interval):
+        last_lsn = self.wal.lsn
+        while True:
+            await asyncio.sleep(interval)
+            if self._background_stop.is_set():
+                return
+            state = self._snapshot_state(last_lsn)
+            if state is not None:
+                await asyncio.to_thread(self.wal.write_snapshot, *state)
+                last_lsn = state[3]
+
+    async def _expiry_task(self):
+        while True:
+            await asyncio.sleep(self._expiry.tick)
+            if self._background_stop.is_set():
+                return
+            self._expire_due()
+
+    async def _recovery_task(self):
+        # Apenas a consulta ao shard da ordem, que não adquire locks, é feita
+        # em outra thread
+        while True:
+            await asyncio.sleep(self.PREPARE_TIMEOUT / 4)
+            if self._background_stop.is_set():
+                return
+            for transaction, source in self._expired_prepared():
+                committed = await asyncio.to_thread(
+                    self._ask_source, source, transaction
+                )
+                if committed is not None:
+                    self._settle(transaction, committed)
+
+    async def stop_background(self):
+        """
+        Interrompe as tarefas de fundo, antes que o log seja fechado.
+        """
+
+        for task in self._background_tasks:
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    def _wait_durable(self):
+        # Esperar pelo fsync aqui bloquearia o event loop; a espera é feita
+        # de forma assíncrona por `_durable`, logo após a chamada
+        pass
+
+    async def _durable(self, reply):
+        """
+        Espera, sem bloquear o event loop, até que os registros feitos pelo
+        procedimento que acabou de executar estejam gravados em disco.
+
+        Parâmetros:
+            reply: resposta do procedimento
+
+        Retorna:
+            A própria resposta.
+        """
+
+        lsn = self._pending_lsn()
+        if lsn is not None:
+            await self.wal.wait_async(lsn)
+        return reply
+
+    async def balance(self, request, context):
+        return super().balance(request, context)
+
+    async def stats(self, request, context):
+        return super().stats(request, context)
+
+    async def create_payment_order(self, request, context):
+        return await self._durable(super().create_payment_order(request, context))
+
+    async def transfer(self, request, context):
+        return await self._durable(super().transfer(request, context))
+
+    async def batch_create_payment_orders(self, request, context):
+        return await self._durable(
+            super().batch_create_payment_orders(request, context)
+        )
+
+    async def batch_transfer(self, request, context):
+        return await self._durable(super().batch_transfer(request, context))
+
+    async def purchase(self, request, context):
+        return await self._durable(super().purchase(request, context))
+
+    async def prepare(self, request, context):
+        return await self._durable(super().prepare(request, context))
+
+    async def commit(self, request, context):
+        return await self._durable(super().commit(request, context))
+
+    async def abort(self, request, context):
+        return await self._durable(super().abort(request, context))
+
+    async def replicate(self, request, context):
+        if self.mutation_log is None:
+            await context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION, "replicação desativada"
+            )
+
+        loop = asyncio.get_running_loop()
+
+        async def snapshot():
+            return self._replication_snapshot()
+
+        # A espera por novas alterações é bloqueante, então o gerador
+        # síncrono é avançado em outra thread; a cópia do estado, que
+        # adquire todos os locks, é pedida ao event loop
+        messages = self.mutation_log.stream(
+            request,
+            lambda: asyncio.run_coroutine_threadsafe(snapshot(), loop).result(),
+            self._background_stop,
+        )
+        while (message := await asyncio.to_thread(next, messages, None)) is not None:
+            yield message
+
+    async def watch_mutations(self, request, context):
+        if self.change_feed is None:
+            await context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION, "eventos de saldo desativados"
+            )
+
+        # A espera por novos eventos é bloqueante, então o gerador síncrono é
+        # avançado em outra thread
+        messages = self.change_feed.stream(
+            request, lambda: not context.done(), self._background_stop
+        )
+        try:
+            while (
+                message := await asyncio.to_thread(next, messages, None)
+            ) is not None:
+                yield message
+        except changefeed.EventsLost as error:
+            await context.abort(grpc.StatusCode.DATA_LOSS, str(error))
+
+    async def session(self, request_iterator, context):
+        async for command in request_iterator:
+            procedure = command.WhichOneof("command")
+            if procedure is None:
+                continue
+
+            # Os procedimentos são chamados diretamente nas implementações
+            # síncronas de `Wallet`, sem criar uma corrotina por comando
+            reply = await self._durable(
+                getattr(Wallet, procedure)(self, getattr(command, procedure), context)
+            )
+            yield wallet_pb2.SessionResult(**{procedure: reply})
+
+            if procedure == "end_execution":
+                return
+
+    async def import_wallets(self, request_iterator, context):
+        totals = [0, 0, 0]
+        async for request in request_iterator:
+            for index, count in enumerate(self._import_chunk(request.wallets)):
+                totals[index] += count
+            await self._durable(None)
+
+        self._audit("import_wallets", *totals)
+        return wallet_pb2.ImportWalletsReply(
+            imported=totals[0], existing=totals[1], rejected=totals[2]
+        )
+
+    async def end_execution(self, request, context):
+        # O evento de parada aqui é um asyncio.Event, sinalizado da mesma
+        # forma que o threading.Event usado no modo com threads
+        return super().end_execution(request, context)
+
+
+# Versão do serviço de carteiras atendida por vários processos
+class SharedWallet(Wallet):
+    def __init__(
+        self,
+        wallets: dict[str, int],
+        order_capacity: int = 1 << 20,
+        dedup_cache: DedupCache | None = None,
+    ) -> None:
+        """
+        Servicer usado quando vários processos atendem o mesmo servidor de
+        carteiras. Deve ser criado antes dos processos, que o herdam com
+        fork: os saldos e as ordens de pagamento ficam em memória
+        compartilhada (SharedWalletTable e SharedOrderStore) e os locks de
+        LockManager são multiprocessing.Lock, então as operações continuam
+        atômicas entre processos diferentes. O restante do estado (métricas,
+        log de auditoria, cache de requisições repetidas) é próprio de cada
+        processo: uma repetição só é reconhecida quando chega ao mesmo
+        processo que a primeira requisição, o que acontece quando as duas
+        usam a mesma conexão.
+
+        Parâmetros:
+            wallets (dict[str, int]): carteiras lidas da entrada padrão
+            order_capacity (int): número máximo de ordens pendentes
+            dedup_cache (DedupCache | None): cache das respostas das
+                                             requisições com identificador
+        """
+
+        table = SharedWalletTable(wallets)
+        super().__init__(
+            threading.Event(),
+            table,
+            order_store=lambda orders, next_id: SharedOrderStore(table, order_capacity),
+            dedup_cache=dedup_cache,
+        )
+
+        # Nenhuma thread usou os locks ainda, então eles podem ser trocados
+        # pelos locks compartilhados entre os processos
+        self.locks = LockManager(lock_factory=multiprocessing.Lock)
+
+        # Evento de término de todos os processos e marca de que o estado
+        # final já foi exibido por algum deles
+        self.shutdown = multiprocessing.Event()
+        self._ended = multiprocessing.RawValue("b", 0)
+
+    def import_wallets(self, request_iterator, context):
+        # A tabela em memória compartilhada tem o tamanho fixo das carteiras
+        # iniciais, então não recebe carteiras novas
+        context.abort(
+            grpc.StatusCode.FAILED_PRECONDITION,
+            "importação indisponível com vários processos",
+        )
+
+    def end_execution(self, request, context):
+        """
+        Finaliza todos os processos do servidor de carteiras. O processo que
+        atende a primeira chamada exibe as carteiras e os saldos, lidos da
+        memória compartilhada; chamadas concorrentes em outros processos
+        apenas recebem o número de pendências.
+
+        Retorna:
+            Uma mensagem do tipo EndExecutionReply contendo o número de ordens
+            de pagamento pendentes.
+        """
+
+        with self.locks.all_locks():
+            pendencies = len(self.payment_orders)
+            if not self._ended.value:
+                self._ended.value = 1
+                self.audit.flush()
+                for wallet, value in self.wallets.items():
+                    print(wallet, value)
+                sys.stdout.flush()
+
+        self.shutdown.set()
+        return wallet_pb2.EndExecutionReply(pendencies=pendencies)
+
+
+def _serve_process(
+    servicer, index, port, max_workers, make_audit_log, metrics_port, max_queue
+):
+    """
+    Processo do servidor de carteiras no modo com vários processos: atende as
+    requisições na mesma porta dos demais processos (SO_REUSEPORT, com o
+    kernel distribuindo as conexões) até o fim da execução.
+
+    Parâmetros:
+        servicer (SharedWallet): servicer herdado do processo principal
+        index (int): índice do processo
+        port (int): porta do servidor
+        max_workers (int): número de threads do pool do processo
+        make_audit_log: função que cria o log de auditoria do processo (a
+                        thread de escrita não sobrevive ao fork, então o log é
+                        criado depois dele)
+        metrics_port (int | None): porta do endpoint HTTP das métricas do
+                                   primeiro processo; o processo de índice i
+                                   usa a porta metrics_port + i
+        max_queue (int | None): tamanho da fila de admissão do processo
+                                (None: sem limite)
+    """
+
+    audit_log = make_audit_log()
+    if audit_log is not None:
+        servicer.audit = audit_log
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(
+            max_workers=admission.pool_size(max_workers, max_queue)
+        ),
+        interceptors=admission.server_interceptors(
+            servicer.metrics, max_workers, max_queue
+        ),
+        options=[("grpc.so_reuseport", 1)],
+    )
+    wallet_pb2_grpc.add_WalletServicer_to_server(servicer, server)
+    server.add_insecure_port(transport.listen_address(port))
+
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = servicer.metrics.serve(metrics_port + index)
+
+    server.start()
+
+    # O fim da execução pode ser pedido a qualquer um dos processos
+    servicer.shutdown.wait()
+    server.stop(1).wait()
+
+    if audit_log is not None:
+        audit_log.close()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+def run_processes(
+    port,
+    wallets,
+    processes,
+    max_workers=10,
+    order_capacity=1 << 20,
+    make_audit_log=lambda: None,
+    metrics_port=None,
+    dedup_cache=None,
+    max_queue=None,
+):
+    """
+    Inicia o servidor de carteiras com vários processos, que compartilham o
+    estado e a porta, contornando o GIL: cada processo executa os
+    procedimentos em um núcleo diferente. Para os clientes, continua
+    existindo um único servidor.
 
     Parâmetros:
         port (int): porta que o servidor de carteiras irá executar
         wallets (dict[str, int]): carteiras recebidas da entrada padrão
+        processes (int): número de processos
+        max_workers (int): número de threads do pool de cada processo
+        order_capacity (int): número máximo de ordens pendentes
+        make_audit_log: função que cria o log de auditoria de cada processo
+        metrics_port (int | None): porta local do endpoint HTTP das métricas
+                                   do primeiro processo (None desativa)
+        dedup_cache (DedupCache | None): cache das respostas das requisições
+                                         com identificador
+        max_queue (int | None): tamanho da fila de admissão de cada processo
+                                (None: sem limite)
+    """
+
+    # O servicer é criado antes do fork, então as carteiras e as ordens são
+    # exibidas uma única vez. Nenhum objeto do gRPC pode existir antes do
+    # fork, então os servidores são criados dentro de cada processo
+    servicer = SharedWallet(wallets, order_capacity, dedup_cache)
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(
+            target=_serve_process,
+            args=(
+                servicer,
+                index,
+                port,
+                max_workers,
+                make_audit_log,
+                metrics_port,
+                max_queue,
+            ),
+        )
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# Réplica de leitura do serviço de carteiras
+class ReplicaWallet(wallet_pb2_grpc.WalletServicer):
+    def __init__(
+        self,
+        stop_event: threading.Event,
+        primary_addr: tuple[str, int],
+        max_staleness: float = 1.0,
+    ) -> None:
+        """
+        Servicer de uma réplica de leitura: mantém uma cópia do estado de um
+        servidor de carteiras (o principal), recebida pelo procedimento
+        `replicate` dele, e atende apenas as consultas de saldo. As
+        alterações devem ser enviadas ao servidor principal e recebem o
+        código FAILED_PRECONDITION.
+
+        Uma consulta só é respondida quando o estado da réplica está, no
+        máximo, `max_staleness` segundos atrasado em relação ao principal;
+        caso contrário (ou antes de o primeiro snapshot chegar), ela recebe o
+        código UNAVAILABLE e o cliente pode repeti-la no servidor principal.
+
+        Parâmetros:
+            stop_event (threading.Event): evento de término do servidor
+            primary_addr (tuple[str, int]): endereço do servidor principal
+            max_staleness (float): atraso máximo, em segundos, com que a
+                                   réplica responde as consultas
+        """
+
+        self._stop_event = stop_event
+        self.max_staleness = max_staleness
+        self.replica = replication.Replica(primary_addr)
+        self.stale_reads = 0
+
+        self.metrics = metrics.Metrics()
+        self.metrics.add_counters(self._counters)
+
+    def _counters(self):
+        """
+        Função auxiliar que retorna os contadores da réplica: o LSN aplicado,
+        o número de alterações ainda não aplicadas, o atraso em milissegundos
+        (-1 antes do primeiro snapshot) e as consultas recusadas pelo atraso.
+        """
+
+        staleness = self.replica.staleness()
+        return {
+            "wallets": len(self.replica.wallets),
+            "pending_orders": len(self.replica.payment_orders),
+            "replica_lsn": self.replica.lsn,
+            "replica_lag": self.replica.lag(),
+            "replica_staleness_ms": (
+                int(staleness * 1000) if staleness != float("inf") else -1
+            ),
+            "stale_reads": self.stale_reads,
+        }
+
+    def stats(self, request, context):
+        return self.metrics.stats_reply(wallet_pb2)
+
+    def balance(self, request, context):
+        """
+        Retorna o saldo da carteira informada segundo o estado replicado.
+
+        Parâmetros:
+            request.wallet (str): carteira do cliente
+
+        Retorna:
+            Uma mensagem do tipo BalanceReply com o saldo da carteira ou -1,
+            caso ela não exista.
+        """
+
+        if self.replica.staleness() > self.max_staleness:
+            self.stale_reads += 1
+            context.abort(grpc.StatusCode.UNAVAILABLE, "réplica desatualizada")
+
+        with self.replica.lock:
+            balance = self.replica.wallets.get(request.wallet, -1)
+        return wallet_pb2.BalanceReply(balance=balance)
+
+    def _read_only(self, request, context):
+        context.abort(
+            grpc.StatusCode.FAILED_PRECONDITION,
+            "réplica somente leitura: envie as alterações ao servidor principal",
+        )
+
+    create_payment_order = transfer = _read_only
+    batch_create_payment_orders = batch_transfer = purchase = _read_only
+    prepare = commit = abort = session = replicate = _read_only
+    import_wallets = watch_mutations = _read_only
+
+    def end_execution(self, request, context):
+        """
+        Finaliza a réplica (o servidor principal continua executando). Exibe
+        as carteiras e os saldos replicados.
+
+        Retorna:
+            Uma mensagem do tipo EndExecutionReply com o número de ordens de
+            pagamento pendentes segundo o estado replicado.
+        """
+
+        self.replica.close()
+        with self.replica.lock:
+            for wallet, value in self.replica.wallets.items():
+                print(wallet, value)
+            pendencies = len(self.replica.payment_orders)
+
+        self._stop_event.set()
+        return wallet_pb2.EndExecutionReply(pendencies=pendencies)
+
+
+def run_replica(
+    port,
+    primary_addr,
+    max_staleness=1.0,
+    max_workers=10,
+    metrics_port=None,
+    max_queue=None,
+):
+    """
+    Inicia uma réplica de leitura do servidor de carteiras.
+
+    Parâmetros:
+        port (int | str): porta (ou socket Unix) que a réplica irá executar
+        primary_addr (tuple[str, int]): endereço do servidor principal
+        max_staleness (float): atraso máximo, em segundos, com que a réplica
+                               responde as consultas
+        max_workers (int): número de threads do pool que atende as requisições
+        metrics_port (int | None): porta local do endpoint HTTP das métricas
+                                   (None desativa)
+        max_queue (int | None): tamanho da fila de admissão (None: sem
+                                limite)
+    """
+
+    stop_event = threading.Event()
+    servicer = ReplicaWallet(stop_event, primary_addr, max_staleness)
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(
+            max_workers=admission.pool_size(max_workers, max_queue)
+        ),
+        interceptors=admission.server_interceptors(
+            servicer.metrics, max_workers, max_queue
+        ),
+    )
+    wallet_pb2_grpc.add_WalletServicer_to_server(servicer, server)
+    server.add_insecure_port(transport.listen_address(port))
+
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = servicer.metrics.serve(metrics_port)
+
+    server.start()
+    stop_event.wait()
+    server.stop(1).wait()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+def run(
+    port,
+    wallets,
+    max_workers=10,
+    wal=None,
+    snapshot_interval=60.0,
+    order_store=DictOrderStore,
+    order_ttl=None,
+    audit_log=None,
+    metrics_port=None,
+    shard=(0, 1),
+    mutation_log=None,
+    dedup_cache=None,
+    max_queue=None,
+    change_feed=None,
+    started=None,
+    max_streams=8,
+):
+    """
+    Inicia o servidor de carteiras.
+
+    Parâmetros:
+        port (int | str): porta (ou socket Unix) que o servidor de carteiras irá
+                          executar
+        wallets (dict[str, int]): carteiras recebidas da entrada padrão
+        max_workers (int): número de threads do pool que atende as requisições
+        wal (WriteAheadLog | None): log do modo durável (None desativa)
+        snapshot_interval (float): intervalo entre snapshots no modo durável
+        order_store (type): classe que armazena as ordens de pagamento
+        order_ttl (float | None): prazo das ordens de pagamento (None desativa)
+        audit_log (AuditLog | None): log de auditoria (None desativa)
+        metrics_port (int | None): porta local do endpoint HTTP das métricas
+                                   (None desativa)
+        shard (tuple[int, int]): índice do servidor e número de shards
+        mutation_log (MutationLog | None): registro das alterações lido pelas
+                                          réplicas (None desativa)
+        dedup_cache (DedupCache | None): cache das respostas das requisições
+                                         com identificador
+        max_queue (int | None): tamanho da fila de admissão; com a fila
+                                cheia, as chamadas são recusadas com
+                                RESOURCE_EXHAUSTED (None: sem limite)
+        change_feed (ChangeFeed | None): registro das alterações de saldo
+                                         (None desativa)
+        started (Callable[[Wallet], None] | None): chamada com o servicer
+            quando o servidor começa a atender (usada pela loja no modo em
+            que os dois serviços executam no mesmo processo)
+        max_streams (int): número máximo de chamadas com stream abertas
+                           (assinantes de `watch_mutations`, réplicas,
+                           sessões e importações), cada uma com uma thread
+                           própria no pool; as demais são recusadas com
+                           RESOURCE_EXHAUSTED
     """
 
     # Define o evento de parada do servidor
     stop_event = threading.Event()
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    servicer = Wallet(
+        stop_event,
+        wallets,
+        wal,
+        snapshot_interval,
+        order_store,
+        order_ttl,
+        audit_log,
+        shard,
+        mutation_log,
+        dedup_cache,
+        change_feed,
+    )
+
+    # Os interceptadores medem todos os procedimentos atendidos pelo
+    # servidor e recusam as chamadas com o prazo esgotado ou que não cabem
+    # na fila de admissão. As chamadas com stream têm threads próprias no
+    # pool, então nunca ocupam as das demais chamadas
+    server = grpc.server(
+        futures.ThreadPoolExecutor(
+            max_workers=admission.pool_size(max_workers, max_queue, max_streams)
+        ),
+        interceptors=admission.server_interceptors(
+            servicer.metrics, max_workers, max_queue, max_streams=max_streams
+        ),
+    )
 
     # Liga o servidor à classe que implementa os métodos disponibilizados
     # pelo servidor
-    wallet_pb2_grpc.add_WalletServicer_to_server(Wallet(stop_event, wallets), server)
-    server.add_insecure_port(f"0.0.0.0:{port}")
+    wallet_pb2_grpc.add_WalletServicer_to_server(servicer, server)
+    server.add_insecure_port(transport.listen_address(port))
+
+    # Exposição das métricas em texto, em uma porta local
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = servicer.metrics.serve(metrics_port)
 
     server.start()
+    if started is not None:
+        started(servicer)
 
     # Espera a ocorrência do evento de término do servidor
     stop_event.wait()
-    # Quando detectado, o servidor é terminado
-    server.stop(None)
+    # Quando detectado, o servidor deixa de aceitar novas requisições e
+    # espera as que estão em andamento (incluindo a resposta do próprio
+    # end_execution) antes de terminar
+    server.stop(1).wait()
+
+    # Grava os registros pendentes do log
+    if wal is not None:
+        wal.close()
+
+    # Escreve os eventos de auditoria pendentes
+    if audit_log is not None:
+        audit_log.close()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+
+async def run_async(
+    port,
+    wallets,
+    wal=None,
+    snapshot_interval=60.0,
+    order_store=DictOrderStore,
+    order_ttl=None,
+    audit_log=None,
+    metrics_port=None,
+    shard=(0, 1),
+    mutation_log=None,
+    dedup_cache=None,
+    max_queue=None,
+    max_workers=10,
+    change_feed=None,
+    max_streams=8,
+):
+    """
+    Inicia o servidor de carteiras usando grpc.aio, atendendo todas as
+    requisições em um único event loop.
+
+    Parâmetros:
+        port (int | str): porta (ou socket Unix) que o servidor de carteiras irá
+                          executar
+        wallets (dict[str, int]): carteiras recebidas da entrada padrão
+        wal (WriteAheadLog | None): log do modo durável (None desativa)
+        snapshot_interval (float): intervalo entre snapshots no modo durável
+        order_store (type): classe que armazena as ordens de pagamento
+        order_ttl (float | None): prazo das ordens de pagamento (None desativa)
+        audit_log (AuditLog | None): log de auditoria (None desativa)
+        metrics_port (int | None): porta local do endpoint HTTP das métricas
+                                   (None desativa)
+        shard (tuple[int, int]): índice do servidor e número de shards
+        mutation_log (MutationLog | None): registro das alterações lido pelas
+                                          réplicas (None desativa)
+        dedup_cache (DedupCache | None): cache das respostas das requisições
+                                         com identificador
+        max_queue (int | None): tamanho da fila de admissão (None: sem
+                                limite)
+        max_workers (int): número máximo de chamadas em execução ao mesmo
+                           tempo quando há fila de admissão
+        change_feed (ChangeFeed | None): registro das alterações de saldo
+                                         (None desativa)
+        max_streams (int): número máximo de chamadas com stream abertas; as
+                           demais são recusadas com RESOURCE_EXHAUSTED
+    """
+
+    # Define o evento de parada do servidor
+    stop_event = asyncio.Event()
+    servicer = AsyncWallet(
+        stop_event,
+        wallets,
+        wal,
+        snapshot_interval,
+        order_store,
+        order_ttl,
+        audit_log,
+        shard,
+        mutation_log,
+        dedup_cache,
+        change_feed,
+    )
+
+    # Os interceptadores medem todos os procedimentos atendidos pelo
+    # servidor e recusam as chamadas com o prazo esgotado ou que não cabem
+    # na fila de admissão
+    server = grpc.aio.server(
+        interceptors=admission.server_interceptors(
+            servicer.metrics,
+            max_workers,
+            max_queue,
+            asynchronous=True,
+            max_streams=max_streams,
+        )
+    )
+
+    # Liga o servidor à classe que implementa os métodos disponibilizados
+    # pelo servidor
+    wallet_pb2_grpc.add_WalletServicer_to_server(servicer, server)
+    server.add_insecure_port(transport.listen_address(port))
+
+    # Exposição das métricas em texto, em uma porta local
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = servicer.metrics.serve(metrics_port)
+
+    await server.start()
+
+    # Espera a ocorrência do evento de término do servidor
+    await stop_event.wait()
+    # Quando detectado, o servidor deixa de aceitar novas requisições e
+    # espera as que estão em andamento (incluindo a resposta do próprio
+    # end_execution) antes de terminar
+    await server.stop(1)
+    await servicer.stop_background()
+
+    # Grava os registros pendentes do log
+    if wal is not None:
+        wal.close()
+
+    # Escreve os eventos de auditoria pendentes
+    if audit_log is not None:
+        audit_log.close()
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 
 if __name__ == "__main__":
-    # Lê as carteiras da entrada padrão
-    wallets = {}
+    parser = argparse.ArgumentParser(description="Servidor de carteiras")
+    # Porta que o servidor irá usar (ou socket Unix, "unix:/caminho")
+    parser.add_argument("port", type=transport.parse_endpoint)
+    # Número de threads que atendem as requisições
+    parser.add_argument("--workers", type=int, default=10)
+    # Atende as requisições com grpc.aio em vez do pool de threads
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    # Estrutura usada para guardar as carteiras: o dicionário padrão ou a
+    # tabela compacta em arrays (para um grande número de carteiras, com
+    # cerca de metade da memória, mas consultas 3 a 7 vezes mais lentas)
+    parser.add_argument("--storage", choices=["dict", "array"], default="dict")
+    # Estrutura usada para guardar as ordens de pagamento: o dicionário
+    # padrão ou o armazenamento compacto com IDs sequenciais
+    parser.add_argument("--orders", choices=["dict", "compact"], default="dict")
+    # Prazo, em segundos, para que uma ordem de pagamento seja transferida
+    # antes de expirar e ter o valor devolvido à carteira de origem
+    parser.add_argument("--order-ttl", type=float)
+    # Modo durável: diretório do log de escrita antecipada e dos snapshots
+    parser.add_argument("--wal-dir")
+    # Faz um fsync por operação em vez de agrupar os fsyncs (group commit)
+    parser.add_argument("--fsync-per-op", action="store_true")
+    # Intervalo, em segundos, entre os snapshots do modo durável
+    parser.add_argument("--snapshot-interval", type=float, default=60.0)
+    # Log de auditoria: arquivo (por padrão, a saída padrão), formato, nível
+    # de detalhe e número máximo de eventos por segundo. Por padrão o log é
+    # desativado, e o servidor não escreve nada na saída padrão durante a
+    # execução
+    parser.add_argument("--audit-log")
+    parser.add_argument("--audit-format", choices=["line", "binary"], default="line")
+    parser.add_argument(
+        "--audit-verbosity", choices=list(audit.VERBOSITY), default="off"
+    )
+    parser.add_argument("--audit-rate", type=float)
+    # Porta local do endpoint HTTP com as métricas em texto
+    parser.add_argument("--metrics-port", type=int)
+    # Número de processos que atendem as requisições na mesma porta, com o
+    # estado em memória compartilhada, e número máximo de ordens pendentes
+    # nesse modo
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--max-orders", type=int, default=1 << 20)
+    # Carteiras particionadas entre vários servidores: índice deste servidor
+    # e número total de servidores (cada um recebe todas as carteiras na
+    # entrada padrão e guarda apenas as do seu shard)
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=1)
+    # Registra as alterações para réplicas de leitura (procedimento
+    # `replicate`)
+    parser.add_argument("--replication", action="store_true")
+    # Executa como réplica de leitura do servidor informado ("host:porta"),
+    # sem ler carteiras da entrada padrão, e atraso máximo, em segundos, com
+    # que a réplica responde as consultas de saldo
+    parser.add_argument("--replica-of")
+    parser.add_argument("--max-staleness", type=float, default=1.0)
+    # Número máximo de respostas guardadas para as requisições com
+    # identificador e tempo, em segundos, que cada uma é guardada
+    parser.add_argument("--dedup-size", type=int, default=100_000)
+    parser.add_argument("--dedup-ttl", type=float, default=60.0)
+    # Número máximo de chamadas esperando para executar; com a fila cheia,
+    # as novas chamadas são recusadas imediatamente (RESOURCE_EXHAUSTED)
+    parser.add_argument("--max-queue", type=int)
+    # Número máximo de chamadas com stream (assinantes de `watch_mutations`,
+    # réplicas, sessões e importações) abertas ao mesmo tempo; cada uma ocupa
+    # uma thread própria, e as demais são recusadas (RESOURCE_EXHAUSTED)
+    parser.add_argument("--max-streams", type=int, default=8)
+    # Número de processos que interpretam as carteiras lidas da entrada
+    # padrão na inicialização
+    parser.add_argument("--load-workers", type=int, default=1)
+    # Publica as alterações de saldo para os assinantes de `watch_mutations`,
+    # guardando os últimos eventos para que um assinante possa retomar o
+    # stream de onde parou
+    parser.add_argument("--change-feed", action="store_true")
+    parser.add_argument("--change-feed-size", type=int, default=65536)
+    args = parser.parse_args()
 
-    while True:
-        # Lê uma linha da entrada e em caso de EOFError
-        # (fim da leitura) sai do loop
-        try:
-            line = input()
-        except EOFError:
-            break
+    if not 0 <= args.shard < args.shards:
+        parser.error("--shard deve estar entre 0 e --shards - 1")
+    # O modo com vários processos usa as suas próprias estruturas de estado
+    # e não tem log durável, expiração de ordens nem transações entre shards
+    if args.processes > 1 and (
+        args.use_async
+        or args.storage != "dict"
+        or args.orders != "dict"
+        or args.order_ttl is not None
+        or args.wal_dir is not None
+        or args.shards > 1
+    ):
+        parser.error(
+            "--processes não pode ser combinado com --async, --storage, --orders,"
+            " --order-ttl, --wal-dir ou --shards"
+        )
+    # A réplica recebe todo o estado do servidor principal e não tem opções
+    # próprias de armazenamento, durabilidade ou expiração
+    if args.replica_of is not None and (
+        args.use_async
+        or args.processes > 1
+        or args.storage != "dict"
+        or args.orders != "dict"
+        or args.order_ttl is not None
+        or args.wal_dir is not None
+        or args.replication
+    ):
+        parser.error(
+            "--replica-of não pode ser combinado com --async, --processes,"
+            " --storage, --orders, --order-ttl, --wal-dir ou --replication"
+        )
+    # Os processos dividem a mesma porta com SO_REUSEPORT, que não existe
+    # para sockets Unix
+    if args.processes > 1 and isinstance(args.port, str):
+        parser.error("--processes não pode ser usado com um socket Unix")
+    if args.processes > 1 and args.replication:
+        parser.error("--processes não pode ser combinado com --replication")
+    if args.change_feed and (args.processes > 1 or args.replica_of is not None):
+        parser.error(
+            "--change-feed não pode ser combinado com --processes ou --replica-of"
+        )
+
+    if args.replica_of is not None:
+        run_replica(
+            args.port,
+            sharding.parse_wallet_addr(args.replica_of),
+            args.max_staleness,
+            args.workers,
+            args.metrics_port,
+            args.max_queue,
+        )
+        sys.exit()
+
+    ring = sharding.HashRing(args.shards)
+
+    # Lê as carteiras da entrada padrão em blocos grandes, em vez de uma
+    # linha por vez, e informa a taxa de carga na saída de erro (a saída
+    # padrão continua igual)
+    wallets = WalletTable() if args.storage == "array" else {}
+    # Com vários shards, apenas as carteiras deste shard são carregadas
+    accept = (lambda id: ring.shard(id) == args.shard) if args.shards > 1 else None
+    count, elapsed = wallet_loader.load_wallets(
+        sys.stdin.buffer, wallets, accept, args.load_workers
+    )
+    print(
+        f"loaded wallets: {count} in {elapsed:.3f}s"
+        f" ({count / max(elapsed, 1e-9):.0f}/s)",
+        file=sys.stderr,
+    )
 
-        if not line:
-            continue
+    wal = None
+    if args.wal_dir is not None:
+        wal = WriteAheadLog(args.wal_dir, group_commit=not args.fsync_per_op)
 
-        id, value = line.split()
-        wallets[id] = int(value)
+    order_store = CompactOrderStore if args.orders == "compact" else DictOrderStore
+    mutation_log = replication.MutationLog() if args.replication else None
+    change_feed = None
+    if args.change_feed:
+        change_feed = changefeed.ChangeFeed(args.change_feed_size)
+    dedup_cache = DedupCache(args.dedup_size, args.dedup_ttl)
 
-        # Porta que o servidor irá usar
-    port = int(sys.argv[1])
+    def make_audit_log():
+        return audit.AuditLog(
+            args.audit_log,
+            binary=args.audit_format == "binary",
+            verbosity=audit.VERBOSITY[args.audit_verbosity],
+            rate=args.audit_rate,
+        )
 
     # Chama a função que inicia o servidor
-    run(port, wallets)
+    if args.processes > 1:
+        run_processes(
+            args.port,
+            wallets,
+            args.processes,
+            args.workers,
+            args.max_orders,
+            make_audit_log,
+            args.metrics_port,
+            dedup_cache,
+            args.max_queue,
+        )
+    elif args.use_async:
+        asyncio.run(
+            run_async(
+                args.port,
+                wallets,
+                wal,
+                args.snapshot_interval,
+                order_store,
+                args.order_ttl,
+                make_audit_log(),
+                args.metrics_port,
+                (args.shard, args.shards),
+                mutation_log,
+                dedup_cache,
+                args.max_queue,
+                args.workers,
+                change_feed,
+                args.max_streams,
+            )
+        )
+    else:
+        run(
+            args.port,
+            wallets,
+            args.workers,
+            wal,
+            args.snapshot_interval,
+            order_store,
+            args.order_ttl,
+            make_audit_log(),
+            args.metrics_port,
+            (args.shard, args.shards),
+            mutation_log,
+            dedup_cache,
+            args.max_queue,
+            change_feed,
+            max_streams=args.max_streams,
+        )
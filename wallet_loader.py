@@ -0,0 +1,118 @@
+# Carga das carteiras lidas da entrada padrão pelo servidor de carteiras
+# Vinicius Gomes - 2021421869
+
+import collections
+import multiprocessing
+import time
+from concurrent import futures
+
+# Tamanho, em bytes, de cada bloco lido da entrada
+CHUNK_SIZE = 1 << 22
+
+
+def read_chunks(stream, size: int = CHUNK_SIZE):
+    """
+    Lê um arquivo binário em blocos grandes, terminados sempre no fim de uma
+    linha: o trecho depois da última quebra de linha de um bloco é guardado
+    e vai para o início do próximo.
+
+    Parâmetros:
+        stream: arquivo aberto em modo binário (p.ex. sys.stdin.buffer)
+        size (int): número de bytes lidos de cada vez
+
+    Retorna:
+        Um gerador dos blocos (bytes), cada um com linhas inteiras.
+    """
+
+    rest = b""
+    while data := stream.read(size):
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            rest = data
+            continue
+        rest = data[end:]
+        yield data[:end]
+    if rest:
+        yield rest
+
+
+def parse_chunk(data: bytes) -> tuple[list[str], list[int]]:
+    """
+    Interpreta um bloco de linhas "<carteira> <saldo>", o mesmo formato lido
+    linha a linha com `input()`. Linhas vazias são ignoradas, e uma linha
+    com outro número de campos gera ValueError.
+
+    Parâmetros:
+        data (bytes): bloco de linhas inteiras
+
+    Retorna:
+        Uma tupla (identificadores, saldos), na ordem das linhas.
+    """
+
+    names = []
+    balances = []
+    for line in data.decode().splitlines():
+        if not line:
+            continue
+        wallet, value = line.split()
+        names.append(wallet)
+        balances.append(int(value))
+    return names, balances
+
+
+def load_wallets(stream, wallets, accept=None, workers: int = 1):
+    """
+    Carrega as carteiras de um arquivo binário na estrutura das carteiras do
+    servidor (dicionário ou WalletTable). Os blocos são lidos com
+    `read_chunks` e interpretados com `parse_chunk` e, em vez de uma
+    atribuição por carteira, cada bloco é inserido com um único `update`
+    (que, na WalletTable, dimensiona a tabela de espalhamento uma vez só).
+
+    Com `workers` maior que 1, os blocos são interpretados em paralelo por
+    outros processos, enquanto este lê os próximos blocos e insere os já
+    interpretados, na ordem da entrada. Os processos são criados com fork,
+    então a função deve ser chamada antes de qualquer canal ou servidor do
+    gRPC ser criado.
+
+    Parâmetros:
+        stream: arquivo aberto em modo binário (p.ex. sys.stdin.buffer)
+        wallets (dict[str, int] | WalletTable): carteiras, preenchidas pela
+                                               função
+        accept (Callable[[str], bool] | None): filtro das carteiras que
+                                               devem ser guardadas (p.ex. as
+                                               do shard deste servidor)
+        workers (int): número de processos que interpretam os blocos
+
+    Retorna:
+        Uma tupla (número de carteiras lidas, tempo da carga em segundos).
+    """
+
+    started = time.perf_counter()
+    count = 0
+
+    def insert(parsed):
+        nonlocal count
+        names, balances = parsed
+        count += len(names)
+        pairs = zip(names, balances)
+        if accept is not None:
+            pairs = [(name, balance) for name, balance in pairs if accept(name)]
+        wallets.update(pairs)
+
+    if workers <= 1:
+        for data in read_chunks(stream):
+            insert(parse_chunk(data))
+        return count, time.perf_counter() - started
+
+    context = multiprocessing.get_context("fork")
+    with futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        # No máximo dois blocos por processo ficam em memória esperando
+        pending = collections.deque()
+        for data in read_chunks(stream):
+            pending.append(pool.submit(parse_chunk, data))
+            if len(pending) >= 2 * workers:
+                insert(pending.popleft().result())
+        while pending:
+            insert(pending.popleft().result())
+    return count, time.perf_counter() - started
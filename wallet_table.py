@@ -0,0 +1,186 @@
+# Tabela compacta de carteiras do servidor de carteiras
+# Vinicius Gomes - 2021421869
+
+from array import array
+from collections.abc import Mapping
+
+# Marca de posição vazia na tabela de espalhamento
+EMPTY = -1
+
+
+class WalletTable(Mapping):
+    def __init__(self, wallets=()) -> None:
+        """
+        Tabela de carteiras guardada em arrays contíguos, como alternativa ao
+        dicionário `dict[str, int]` para um grande número de carteiras.
+
+        Cada carteira recebe uma posição ("slot") sequencial, na ordem em que
+        foi inserida. Os identificadores ficam concatenados em um único
+        bytearray (com um array de deslocamentos de 32 bits), os saldos e os
+        hashes em arrays de inteiros de 64 bits e o índice identificador →
+        slot é uma tabela de espalhamento com endereçamento aberto, em um
+        array de inteiros de 32 bits. Assim, não é criado nenhum objeto
+        Python por carteira (nem a string do identificador, nem o inteiro do
+        saldo). Os inteiros de 32 bits limitam a tabela a 2³¹ - 1 carteiras e
+        a 4 GiB de identificadores.
+
+        O custo é o tempo de acesso: a busca no índice é feita em Python,
+        então cada consulta é 3 a 7 vezes mais lenta que no dicionário, e a
+        construção, 2,5 a 4 vezes mais lenta, para cerca de metade da memória
+        (ver benchmarks/bench_wallet_table.py). Por isso a tabela só é usada
+        quando pedida (--storage array).
+
+        A tabela se comporta como um dicionário somente-leitura com
+        atribuição: `in`, `[]`, `[] =` (que insere a carteira caso ela ainda
+        não exista), `len`, `items()` e a iteração na ordem de inserção têm a
+        mesma semântica do dicionário. Carteiras nunca são removidas.
+
+        Parâmetros:
+            wallets: carteiras iniciais (dicionário ou pares (carteira, saldo))
+        """
+
+        self._names = bytearray()
+        self._offsets = array("I", [0])
+        self._hashes = array("q")
+        self._balances = array("q")
+        self._table = array("i", [EMPTY]) * 8
+        self._mask = 7
+
+        if isinstance(wallets, Mapping):
+            wallets = wallets.items()
+        self.update(wallets)
+
+    def _find(self, name, name_hash):
+        """
+        Função auxiliar que procura o identificador na tabela de
+        espalhamento.
+
+        Parâmetros:
+            name (bytes): identificador codificado em UTF-8
+            name_hash (int): hash do identificador
+
+        Retorna:
+            Uma tupla (posição na tabela, slot da carteira), em que o slot é
+            EMPTY caso a carteira não exista (e a posição é onde ela deve ser
+            inserida).
+        """
+
+        table = self._table
+        position = name_hash & self._mask
+        perturb = name_hash & 0x7FFFFFFFFFFFFFFF
+        while True:
+            slot = table[position]
+            if slot == EMPTY:
+                return position, EMPTY
+            if (
+                self._hashes[slot] == name_hash
+                and self._names[self._offsets[slot] : self._offsets[slot + 1]] == name
+            ):
+                return position, slot
+            # Sondagem no mesmo estilo do dicionário do CPython, que usa todos
+            # os bits do hash para espalhar as colisões
+            perturb >>= 5
+            position = (position * 5 + perturb + 1) & self._mask
+
+    def slot(self, wallet: str) -> int:
+        """
+        Retorna o slot da carteira informada ou EMPTY, caso ela não exista.
+
+        Parâmetros:
+            wallet (str): identificador da carteira
+        """
+
+        name = wallet.encode()
+        return self._find(name, hash(name))[1]
+
+    def _grow(self, size=None):
+        # Dobra a tabela de espalhamento (ou a aumenta para `size` posições,
+        # uma potência de 2) e reinsere todos os slots, usando os hashes
+        # guardados
+        size = size or len(self._table) * 2
+        self._table = array("i", [EMPTY]) * size
+        self._mask = size - 1
+        for slot, name_hash in enumerate(self._hashes):
+            position = name_hash & self._mask
+            perturb = name_hash & 0x7FFFFFFFFFFFFFFF
+            while self._table[position] != EMPTY:
+                perturb >>= 5
+                position = (position * 5 + perturb + 1) & self._mask
+            self._table[position] = slot
+
+    def __contains__(self, wallet) -> bool:
+        return self.slot(wallet) != EMPTY
+
+    def __getitem__(self, wallet: str) -> int:
+        slot = self.slot(wallet)
+        if slot == EMPTY:
+            raise KeyError(wallet)
+        return self._balances[slot]
+
+    def __setitem__(self, wallet: str, balance: int) -> None:
+        name = wallet.encode()
+        name_hash = hash(name)
+        position, slot = self._find(name, name_hash)
+        if slot != EMPTY:
+            self._balances[slot] = balance
+            return
+
+        # Insere a nova carteira no próximo slot
+        self._table[position] = len(self._balances)
+        self._names += name
+        self._offsets.append(len(self._names))
+        self._hashes.append(name_hash)
+        self._balances.append(balance)
+
+        # Mantém a tabela de espalhamento no máximo pela metade
+        if 2 * len(self._balances) > len(self._table):
+            self._grow()
+
+    def update(self, wallets) -> None:
+        """
+        Insere ou atualiza várias carteiras, como o `update` do dicionário.
+        A tabela de espalhamento é aumentada uma única vez, já com o tamanho
+        final, em vez de dobrar repetidas vezes durante a carga.
+
+        Parâmetros:
+            wallets: carteiras (dicionário ou pares (carteira, saldo))
+        """
+
+        if isinstance(wallets, Mapping):
+            wallets = wallets.items()
+        wallets = list(wallets)
+        size = len(self._table)
+        while 2 * (len(self._balances) + len(wallets)) > size:
+            size *= 2
+        if size > len(self._table):
+            self._grow(size)
+        for wallet, balance in wallets:
+            self[wallet] = balance
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def name(self, slot: int) -> str:
+        """
+        Retorna o identificador da carteira no slot informado.
+
+        Parâmetros:
+            slot (int): slot da carteira
+        """
+
+        return self._names[self._offsets[slot] : self._offsets[slot + 1]].decode()
+
+    def __iter__(self):
+        for slot in range(len(self._balances)):
+            yield self.name(slot)
+
+    def items(self):
+        # Percorre os slots em ordem, sem consultar a tabela de espalhamento
+        for slot in range(len(self._balances)):
+            yield self.name(slot), self._balances[slot]
+
+    def __repr__(self) -> str:
+        # Mesmo formato da exibição de um dicionário
+        return (
+            "{" + ", ".join(f"{name!r}: {value}" for name, value in self.items()) + "}"
+        )